@@ -15,9 +15,10 @@
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Base class for AO simulation modules"""
 
-import threading,thread,os,sys,getopt,types
+import threading,thread,os,sys,getopt,types,time
 import socket, string
 import util.rwlock
+import util.checkpoint
 #import Scientific.MPI as MPI
 import base.dataType
 
@@ -51,6 +52,8 @@ class aobase:
     @type outputData: None or numpy array
     @cvar dataValid: Whether the data in outputData is valid
     @type dataValid: Int
+    @cvar nextIterCnt: Number of times doNextIter has been called
+    @type nextIterCnt: Int
     @cvar newDataWaiting: Whether expecting new data from parent object
     @type newDataWaiting: Int
     @cvar generate: Whether to generate data this iteration
@@ -73,7 +76,16 @@ class aobase:
     @type selfModifiesInput: Int
     @cvar config: Configuration object
     @type config: Instance
+    @cvar profiler: If not None, a util.profiler.Profiler object (set by Ctrl)
+    @type profiler: None or Profiler
+    @cvar checkpointAttrs: Attributes (possibly dotted) holding the evolving state of this module, saved when checkpointing (see getState)
+    @type checkpointAttrs: List of String
+    @cvar checkpointThisAttrs: Attributes holding the state of each resource sharing object (thisObjList)
+    @type checkpointThisAttrs: List of String
     """
+    profiler=None
+    checkpointAttrs=["outputData","dataValid"]
+    checkpointThisAttrs=[]
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         """
         Create a simulation object base class.
@@ -135,6 +147,7 @@ class aobase:
         self.myID=socket.gethostname()+"-"+self.moduleName
         self.version=0.001
         self.currentIdObjCnt=0#used if resource sharing is implemented, this keeps track of the current idstr to use.
+        self.nextIterCnt=0#number of calls to doNextIter, so children can tell whether this has run yet in the current iteration.
         self.selfModifiesInput=0#set to one if the input data is to be
         #modified inplace.  This amoung other things means that parent can't be a splitter.
         #self.busyLock=threading.Lock()#when this is acquired, updateState cannot run... (it is run as a 
@@ -274,12 +287,43 @@ class aobase:
     def doNextIter(self):
         """This is called by the ctrl.mainloop every time the object should compute new data. This method
         should not be overridden.  To override, please override the generateNext or calcData methods."""
-
-        self.prepareNextIter()
-        self.generateNext()
-        self.endThisIter()
+        if self.profiler is None:
+            self.prepareNextIter()
+            self.generateNext()
+            self.endThisIter()
+        else:
+            p=self.profiler
+            t0=time.time()
+            self.prepareNextIter()
+            t1=time.time()
+            self.generateNext()
+            t2=time.time()
+            self.endThisIter()
+            t3=time.time()
+            p.add(self.objID,"prepareNextIter",t0,t1-t0)
+            p.add(self.objID,"generateNext",t1,t2-t1)
+            p.add(self.objID,"endThisIter",t2,t3-t2)
+        self.nextIterCnt+=1
         self.currentIdObjCnt=(self.currentIdObjCnt+1)%len(self.idstr)
 
+    def getState(self):
+        """Return the evolving state of this module (integrators, counters,
+        random number states etc), used by util.checkpoint.  By default, the
+        attributes named in checkpointAttrs, and checkpointThisAttrs for each
+        resource sharing object.  Modules with state held elsewhere (e.g. in
+        cmod structures) should extend this and setState.
+        @return: The state
+        @rtype: Dict
+        """
+        return util.checkpoint.getModuleState(self)
+
+    def setState(self,state):
+        """Restore the state returned by getState.  Arrays are restored in place.
+        @param state: The state
+        @type state: Dict
+        """
+        util.checkpoint.setModuleState(self,state)
+
     def calcData(self):
         """Dummy function to be overwridden by science module, which must perform
         its calculations, placing the result into self.outputData.
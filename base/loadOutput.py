@@ -62,41 +62,19 @@ class loadOutput(base.aobase.aobase):
             self.filename=args["filename"]
         else:
             self.filename=self.config.getVal("loadOutputFilename")
-        self.header=util.FITS.ReadHeader(self.filename)
-        self.dataOffset=len(self.header["raw"])*80
-        if self.dataOffset%2880!=0:
-            raise Exception("base.loadOutput - dataOffset not multiple of 2880 for file %s"%filename)
-        self.header=self.header["parsed"]
-        self.shape=[]
-        for i in range(int(self.header["NAXIS"])-1):
-            self.shape.insert(0,int(self.header["NAXIS%d"%(i+1)]))
-        self.shape=tuple(self.shape)
-        self.nd=int(self.header["NAXIS%d"%(int(self.header["NAXIS"]))])#this is the number of iterations for which we have data...
-        self.bitpix=int(self.header["BITPIX"])
-        if self.bitpix==-64:
-            self.dtype="d"
-        elif self.bitpix==-32:
-            self.dtype="f"
-        elif self.bitpix==32:
-            self.dtype="i"
-        elif self.bitpix==16:
-            self.dtype=="s"
-        elif self.bitpix==8:
-            self.dtype="1"
-        else:
-            raise Exception("base.loadOutput - bitpix not known (please update)")
-        self.dataSize=reduce(lambda x,y:x*y,self.shape)*numpy.abs(self.bitpix)/8
+        #The file is indexed and memory mapped, so each iteration only reads
+        #(and byteswaps) the frame needed.
+        self.index=util.FITS.getIndex(self.filename,cacheDir=self.config.getVal("fitsCacheDir",default=None,raiseerror=0))
+        self.header=self.index.header(0)["parsed"]
+        fullShape=self.index.hdus[0]["shape"]
+        self.shape=fullShape[1:]
+        self.nd=fullShape[0]#this is the number of iterations for which we have data...
+        self.dtype=self.index.hdus[0]["dtype"].char
         self.dataValid=0#never changes... no output...
         if forGUISetup:
             self.outputData=[self.shape,self.dtype]
         else:
             self.outputData=numpy.zeros(self.shape,self.dtype)
-        #self.ff=open(self.filename,"r")
-        #self.ff.seek(self.dataOffset)
-        self.map=numpy.memmap(self.filename,dtype=self.dtype,mode="r")
-        self.dataOffset/=self.map.itemsize
-        self.littleEndianData=int(eval(self.header.get("LITTLE_E",0)))
-        self.doByteSwap=(self.littleEndianData!=numpy.little_endian)
         self.dataCnt=0
    
     def generateNext(self,msg=None):
@@ -108,12 +86,7 @@ class loadOutput(base.aobase.aobase):
             print "splitOutput: generateNext (debug=%s)"%str(self.debug)
         if self.generate==1:
             self.dataValid=1
-            data=self.map[self.dataOffset+self.dataCnt*self.dataSize/self.map.itemsize:self.dataOffset+(self.dataCnt+1)*self.dataSize/self.map.itemsize]
-            self.outputData.flat[:]=data
-            #data=self.ff.read(self.dataSize)
-            #self.outputData.flat[:]=numpy.fromstring(data,dtype=self.dtype)
-            if self.doByteSwap:
-                self.outputData[:]=self.outputData.byteswap()
+            self.outputData[:]=self.index.rows(0,self.dataCnt)[0]
             self.dataCnt+=1
             if self.dataCnt>=self.nd:
                 self.dataCnt=0
@@ -127,7 +100,9 @@ if __name__=="__main__":
         def __init__(self):
             pass
         def getVal(self,val,default=None,raiseerror=1):
-            return "tmp.fits"
+            if val=="loadOutputFilename":
+                return "tmp.fits"
+            return default
         def setSearchOrder(self,so):
             pass
     config=dumconfig()
@@ -16,7 +16,7 @@
 
 #import Scientific.MPI
 import numpy,time
-import base.aobase
+import base.aobase,base.mpiWrapper,base.shmRing
 
 debugConnections=0
 class mpiGet(base.aobase.aobase):
@@ -78,6 +78,21 @@ class mpiGet(base.aobase.aobase):
 
         self.syncarr=numpy.ones((1,),numpy.uint8)
         self.mpiComm=mpiComm#Scientific.MPI.world.duplicate()
+        self.shmRing=None
+        #Pipelined mode - receives posted in advance, with the data used
+        #pipelineLatency iterations after it was sent.
+        self.pipelineDepth=args.get("pipelineDepth",base.mpiWrapper.pipelineDepth)
+        self.pipelineLatency=args.get("pipelineLatency",base.mpiWrapper.pipelineLatency)
+        if self.pipelineLatency>0 and self.pipelineDepth<self.pipelineLatency+1:
+            print "WARNING mpiGet: pipelineDepth increased to pipelineLatency+1 (%d)"%(self.pipelineLatency+1)
+            self.pipelineDepth=self.pipelineLatency+1
+        self.pipe=None
+        if base.mpiWrapper.autoShm and base.mpiWrapper.sameHost(self.mpiParent.sourceRank) and isinstance(self.mpiParent.data,numpy.ndarray):
+            #Sender is on the same node - use shared memory instead of MPI.
+            name=base.shmRing.ringName(base.mpiWrapper.shmtag,self.mpiParent.sourceRank,self.rank,self.mpiParent.tag)
+            self.shmRing=base.shmRing.shmRing(name,self.mpiParent.data.shape,self.mpiParent.data.dtype)
+            self.outputData=self.shmRing.slots[0]
+            print "INFORMATION mpiGet: using shared memory %s for data from rank %d"%(name,self.mpiParent.sourceRank)
 
     def generateNext(self,msg=None):
         """called by the child when it wants more data.
@@ -89,6 +104,23 @@ class mpiGet(base.aobase.aobase):
         @type msg: None or fwdMsg object
         """
         t1=time.time()
+        if self.shmRing is not None:
+            self.shmRing.request(self.generate)
+            tb=time.time()
+            data=self.shmRing.get()
+            if self.profiler is not None:
+                self.profiler.addBlocked(self.objID,tb,time.time()-tb)
+            if data is None:
+                self.dataValid=0
+            else:
+                self.outputData=data
+                self.dataValid=1
+            self.generateNextTime=time.time()-t1
+            return
+        if self.pipelineDepth>0:
+            self.pipelineReceive()
+            self.generateNextTime=time.time()-t1
+            return
         if self.debug!=None: print "mpiGet: generate=%d, Receiving MPI message from rank %d, tag %d (debug=%s)"%(self.generate,self.mpiParent.sourceRank,self.mpiParent.tag,str(self.debug))
         if self.debug!=None: print "mpiGet: Sending sync response (generate=%s) (debug=%s)"%(str(self.generate),str(self.debug))
         #try:
@@ -99,7 +131,10 @@ class mpiGet(base.aobase.aobase):
         #    self.mpiComm.send(self.syncarr,self.mpiParent.sourceRank,self.mpiParent.tag)
         #    self.mpiParent.data=Numeric.array(self.mpiParent.data,copy=0)
         if self.debug!=None: print "mpiGet: Waiting to receive (debug=%s)"%str(self.debug)
+        tb=time.time()
         data,rank,tag,nelements=self.mpiComm.receive(self.mpiParent.data,self.mpiParent.sourceRank,self.mpiParent.tag)
+        if self.profiler is not None:
+            self.profiler.addBlocked(self.objID,tb,time.time()-tb)
         if self.debug!=None: print "mpiGet: Received MPI data (debug=%s)"%str(self.debug)
         #print "mpiGet: data=",data
         if nelements==0:#nelements is the number of elements of the array (not bytes) returned.
@@ -113,6 +148,71 @@ class mpiGet(base.aobase.aobase):
             print "mpiGet: Done generateNext, dataValid=%d shape=%s (debug=%s)"%(self.dataValid,str(sh),str(self.debug))
         self.generateNextTime=time.time()-t1
 
+    def postReceive(self,k):
+        flag,buf=self.pipe["bufs"][k]
+        rank=self.mpiParent.sourceRank
+        tag=self.mpiParent.tag
+        self.pipe["posted"].append((k,base.mpiWrapper.irecv(flag,rank,tag),base.mpiWrapper.irecv(buf,rank,tag)))
+
+    def pipelineReceive(self):
+        """Non-blocking receive.  pipelineDepth receives are kept posted,
+        into pipelineDepth+1 buffers (one being the current outputData).
+        With pipelineLatency>0, the frame sent that many iterations ago is
+        used (dataValid is 0 for the first iterations), so that
+        communication overlaps with computation.
+        """
+        if self.pipe is None:
+            if not isinstance(self.mpiParent.data,numpy.ndarray):
+                raise Exception("mpiGet: pipelined mode requires dims to be specified")
+            bufs=[]
+            for k in range(self.pipelineDepth+1):
+                bufs.append((numpy.zeros((1,),numpy.uint8),numpy.zeros_like(self.mpiParent.data)))
+            self.pipe={"bufs":bufs,"posted":[],"free":range(self.pipelineDepth+1),"current":None,"iter":0}
+        if self.pipe["current"] is not None:#finished with the last frame
+            self.pipe["free"].append(self.pipe["current"])
+            self.pipe["current"]=None
+        while len(self.pipe["posted"])<self.pipelineDepth and len(self.pipe["free"])>0:
+            self.postReceive(self.pipe["free"].pop(0))
+        self.pipe["iter"]+=1
+        if self.pipe["iter"]<=self.pipelineLatency:
+            self.dataValid=0
+            return
+        k,freq,dreq=self.pipe["posted"].pop(0)
+        tb=time.time()
+        freq.wait()
+        dreq.wait()
+        if self.profiler is not None:
+            self.profiler.addBlocked(self.objID,tb,time.time()-tb)
+        self.pipe["current"]=k
+        if len(self.pipe["free"])>0:#keep pipelineDepth receives posted
+            self.postReceive(self.pipe["free"].pop(0))
+        flag,buf=self.pipe["bufs"][k]
+        if flag[0]:
+            self.outputData=buf
+            self.dataValid=1
+        else:
+            self.dataValid=0
+
+    def endSim(self):
+        if self.shmRing is not None:
+            self.shmRing.close()
+            self.shmRing=None
+        if self.pipe is not None:
+            #The frames sent during the last pipelineLatency iterations have
+            #not been used yet - receive them (so that the sender's isends
+            #complete), and cancel the other posted receives, for which
+            #nothing has been sent.
+            nsent=min(self.pipe["iter"],self.pipelineLatency)
+            for i in range(len(self.pipe["posted"])):
+                k,freq,dreq=self.pipe["posted"][i]
+                if i<nsent:
+                    freq.wait()
+                    dreq.wait()
+                else:
+                    base.mpiWrapper.cancel(freq)
+                    base.mpiWrapper.cancel(dreq)
+            self.pipe=None
+
     def setGenerate(self,val):
         """set value of generate class variable
         @param val: Value to set generate to
@@ -16,8 +16,8 @@
 
 #import Scientific.MPI#,threading
 import numpy
-import types,time
-import base.aobase
+import types,time,os
+import base.aobase,base.mpiWrapper,base.shmRing
 
 debugConnections=0
 class mpiSend(base.aobase.aobase):
@@ -102,6 +102,10 @@ class mpiSend(base.aobase.aobase):
         #print "remoteMPISend: creating mpi.world.duplicate()"
         self.mpiComm=mpiComm#Scientific.MPI.world.duplicate()
         self.syncmsg=numpy.zeros((1,),numpy.uint8)
+        self.shmRingList=None#opened on first iteration, once the receivers have created them.
+        #Pipelined mode - non-blocking sends, with up to pipelineDepth frames in flight.
+        self.pipelineDepth=args.get("pipelineDepth",base.mpiWrapper.pipelineDepth)
+        self.pipeList=None
             
         print "remoteMPISend: Initialised"
     def generateNext(self,msg=None):
@@ -131,11 +135,31 @@ class mpiSend(base.aobase.aobase):
             self.dataValid=0
             #self.outputDataList.append("")
 
+        if self.shmRingList is None:
+            self.openShmRings()
         for i in range(len(self.mpiChild.rank)):
             rank=self.mpiChild.rank[i]
             tag=self.mpiChild.tag[i]
+            ring=self.shmRingList[i]
+            if ring is not None:#receiver on same node - use shared memory.
+                tb=time.time()
+                gen=ring.waitRequest()
+                if self.profiler is not None:
+                    self.profiler.addBlocked(self.objID,tb,time.time()-tb)
+                self.parent.setGenerate(gen)
+                if gen and self.dataValid:
+                    ring.put(self.outputData)
+                else:
+                    ring.put(None)
+                continue
+            if self.pipelineDepth>0:
+                self.pipelineSend(i)
+                continue
             if self.debug!=None: print "mpiSend: Receiving synchronisation rank %d tag %s (debug=%s)"%(rank,str(tag),str(self.debug))
+            tb=time.time()
             self.mpiComm.receive(self.syncmsg,rank,tag)
+            if self.profiler is not None:
+                self.profiler.addBlocked(self.objID,tb,time.time()-tb)
             if self.syncmsg[0]==1:#generate=1
                 self.parent.setGenerate(1)
                 #data=self.outputDataList.pop(0)
@@ -153,6 +177,69 @@ class mpiSend(base.aobase.aobase):
             self.mpiComm.send(data,rank,tag)#blocking
             if self.debug!=None: print "mpiSend: data sent rank %d tag %s (debug=%s)"%(rank,str(tag),str(self.debug))
         self.generateNextTime=time.time()-t1
+
+    def pipelineSend(self,i):
+        """Non-blocking send of the data (and a valid flag) to the ith child.
+        The generate handshake is not done in this mode - the parent always
+        generates.  Data is copied into one of pipelineDepth buffers, which
+        is reused once its previous send has completed.
+        @param i: Index of the child
+        @type i: Int
+        """
+        if self.pipeList is None:
+            self.pipeList=[]
+            for j in range(len(self.mpiChild.rank)):
+                if not isinstance(self.parent.outputData,numpy.ndarray):
+                    raise Exception("mpiSend: pipelined mode requires parent outputData to be an array")
+                bufs=[]
+                for k in range(self.pipelineDepth):
+                    bufs.append((numpy.zeros((1,),numpy.uint8),numpy.zeros_like(self.parent.outputData)))
+                self.pipeList.append({"bufs":bufs,"cnt":0,"inflight":[]})
+        p=self.pipeList[i]
+        if len(p["inflight"])>=self.pipelineDepth:#wait for the oldest to complete
+            tb=time.time()
+            for req in p["inflight"].pop(0):
+                req.wait()
+            if self.profiler is not None:
+                self.profiler.addBlocked(self.objID,tb,time.time()-tb)
+        flag,buf=p["bufs"][p["cnt"]%self.pipelineDepth]
+        p["cnt"]+=1
+        if self.dataValid:
+            flag[0]=1
+            buf[:]=self.outputData
+        else:
+            flag[0]=0
+        rank=self.mpiChild.rank[i]
+        tag=self.mpiChild.tag[i]
+        p["inflight"].append((base.mpiWrapper.isend(flag,rank,tag),base.mpiWrapper.isend(buf,rank,tag)))
+
+    def openShmRings(self):
+        """For each receiver, open the shared memory ring if the receiver
+        (mpiGet) has created one (it does so if on the same node and
+        mpiAutoShm is set).  Called on the first iteration, after the
+        Ctrl barrier, so receivers will have been created."""
+        self.shmRingList=[]
+        for i in range(len(self.mpiChild.rank)):
+            rank=self.mpiChild.rank[i]
+            ring=None
+            if base.mpiWrapper.autoShm and base.mpiWrapper.sameHost(rank):
+                name=base.shmRing.ringName(base.mpiWrapper.shmtag,self.mpiComm.rank,rank,self.mpiChild.tag[i])
+                if os.path.exists("/dev/shm"+name):
+                    ring=base.shmRing.shmRing(name)
+                    print "INFORMATION mpiSend: using shared memory %s for data to rank %d"%(name,rank)
+            self.shmRingList.append(ring)
+
+    def endSim(self):
+        for p in self.pipeList or []:
+            for reqs in p["inflight"]:
+                for req in reqs:
+                    req.wait()
+            p["inflight"]=[]
+        for ring in self.shmRingList or []:
+            if ring is not None:
+                ring.close()
+        self.shmRingList=[]
+
 class mpiChild:
     """Structure class holding information about connecting object via MPI.
     @cvar rank: MPI rank of the connecting object (to which data is sent).
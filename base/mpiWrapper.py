@@ -102,3 +102,64 @@ elif mpitype=="DUMMY":
         def share(self,send,recv):
             print "Not implemented - share"
     comm=mympi()
+
+#Used for automatic substitution of shared memory for MPI between ranks on
+#the same node (base.shmRing).  Set by util.Ctrl if mpiAutoShm is set.
+autoShm=0
+shmtag=0
+hostIDs=None
+
+def sameHost(rank):
+    """Return 1 if the given MPI rank is on the same node as this one (only
+    known if hostIDs has been set, by util.Ctrl)."""
+    if hostIDs is None or rank==comm.rank:
+        return 0
+    return int(hostIDs[rank]==hostIDs[comm.rank])
+
+#Pipelined (non-blocking) mode for mpiSend/mpiGet: number of frames in
+#flight, and number of frames latency at the receiver.  Set by util.Ctrl
+#from mpiPipelineDepth and mpiPipelineLatency, and can be overridden for
+#a given connection using the args dict of mpiSend/mpiGet.
+pipelineDepth=0
+pipelineLatency=0
+
+class mpiRequest:
+    """Wraps a mpi4py request, to give the same interface as Scientific.MPI"""
+    def __init__(self,req):
+        self.req=req
+    def wait(self):
+        self.req.Wait()
+    def test(self):
+        return self.req.Test()
+    def cancel(self):
+        self.req.Cancel()
+        self.req.Wait()#completes the cancellation (or the request, if already matched).
+
+def isend(data,rank,tag):
+    """Non-blocking send.  data must not be changed until the request has completed.
+    @return: A request, with a wait() method.
+    @rtype: Object
+    """
+    if mpitype=="Scientific.MPI":
+        return comm.nonblockingSend(data,rank,tag)
+    elif mpitype=="mpi4py.MPI":
+        return mpiRequest(comm.comm.Isend(data,rank,tag))
+    raise Exception("Non-blocking MPI not available with %s"%mpitype)
+
+def cancel(req):
+    """Cancel a non-blocking request (from isend/irecv) that will not be
+    matched.  Not available with Scientific.MPI, in which case the request
+    is left outstanding."""
+    if hasattr(req,"cancel"):
+        req.cancel()
+
+def irecv(data,rank,tag):
+    """Non-blocking receive into array data.
+    @return: A request, with a wait() method.
+    @rtype: Object
+    """
+    if mpitype=="Scientific.MPI":
+        return comm.nonblockingReceive(data,rank,tag)
+    elif mpitype=="mpi4py.MPI":
+        return mpiRequest(comm.comm.Irecv(data,rank,tag))
+    raise Exception("Non-blocking MPI not available with %s"%mpitype)
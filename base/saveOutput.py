@@ -37,6 +37,8 @@ class saveOutput(base.aobase.aobase):
     @type dtype: Char
     @cvar debug: Flag, whether to print debug message (if None, won't print)
     @type debug: None or user defined.
+    @cvar stream: If set, frames are written into a growing memory mapped region of the file, and the header is only updated at checkpoints and at the end of the simulation.  Use recoverStream() to tidy a file if the simulation crashed.
+    @type stream: Int
     """
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         """Initialise the splitOutput module. 
@@ -70,6 +72,11 @@ class saveOutput(base.aobase.aobase):
                 str(self.idstr), self.filename )
             )
         self.doByteSwap=self.config.getVal("doByteSwap",default=0)
+        self.stream=self.config.getVal("saveOutputStream",default=0)#write frames into a memory mapped region.
+        self.streamChunk=self.config.getVal("saveOutputStreamChunk",default=1024)#number of frames to grow the file by.
+        self.checkpointInterval=self.config.getVal("saveOutputCheckpoint",default=1000)#frames between header updates when streaming.
+        self.mm=None
+        self.nframes=0
         self.dataValid=0#never changes... no output...
         if forGUISetup:
             self.outputData=[None,None]
@@ -85,6 +92,8 @@ class saveOutput(base.aobase.aobase):
                 print(("INFORMATION:**saveOutput:{:s}**: Finalising FITS file"+
                        " {:s}").format( str(self.idstr), self.filename )
                     )
+                if self.mm is not None:
+                    self.endStream()
                 import stat
                 try:
                     s=os.stat(self.filename)
@@ -190,6 +199,57 @@ class saveOutput(base.aobase.aobase):
             if self.parentList!=None:
                 util.FITS.WriteKey(self.ff,"PARENTS",str(self.parentList))
             util.FITS.EndHeader(self.ff)
+            self.dataOffset=self.ff.tell()
+            if self.stream:
+                self.initStream()
+
+    def initStream(self):
+        """Set up the memory mapped region for streaming frames"""
+        dtype={"1":numpy.int8,"s":numpy.int16}.get(self.dtype,self.dtype)
+        self.streamDtype=numpy.dtype(dtype)
+        if self.doByteSwap and numpy.little_endian:#numpy byteswaps on assignment.
+            self.streamDtype=self.streamDtype.newbyteorder(">")
+        self.frameSize=reduce(lambda x,y:x*y,self.shape,1)
+        self.frameBytes=self.frameSize*self.streamDtype.itemsize
+        self.nframes=0
+        self.nalloc=0
+        self.growStream(self.streamChunk)
+
+    def growStream(self,nalloc):
+        """Extend the file, and (re)map the data region, to hold nalloc frames"""
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm=None
+        self.ff.flush()
+        os.ftruncate(self.ff.fileno(),self.dataOffset+nalloc*self.frameBytes)
+        self.nalloc=nalloc
+        self.mm=numpy.memmap(self.ff,self.streamDtype,mode="r+",offset=self.dataOffset,shape=(nalloc,self.frameSize))
+
+    def writeStream(self,data,offset=0):
+        """Copy data into the current frame, starting at element offset."""
+        if self.nframes>=self.nalloc:
+            self.growStream(self.nalloc+self.streamChunk)
+        self.mm[self.nframes,offset:offset+data.size]=data.ravel()
+
+    def nextStreamFrame(self):
+        """Finish the current frame, and update the header if at a checkpoint."""
+        self.nframes+=1
+        if self.checkpointInterval>0 and self.nframes%self.checkpointInterval==0:
+            self.checkpointStream()
+
+    def checkpointStream(self):
+        """Flush the frames to disk, then update the header with the number of frames.
+        The header therefore never counts frames that haven't been written."""
+        self.mm.flush()
+        self.ff.seek(self.axisIncPos)
+        util.FITS.WriteKey(self.ff,"NAXIS%d"%self.nd,str(self.nframes))
+        self.ff.flush()
+
+    def endStream(self):
+        """Write the final header, and remove the unused preallocated frames."""
+        self.checkpointStream()
+        self.mm=None
+        self.ff.truncate(self.dataOffset+self.nframes*self.frameBytes)
 
     def newParent(self,parent,idstr=None):
         self.parent=parent
@@ -227,6 +287,10 @@ class saveOutput(base.aobase.aobase):
                                       ).format(
                                          str(self.idstr), p, self.dtype)
                                     )
+                            if self.mm is not None:
+                                self.writeStream(outputData,offset)
+                                offset+=outputData.size
+                                continue
                             if self.doByteSwap and numpy.little_endian:
                                 outputData=outputData.byteswap()
                             self.ff.seek(0,2)#move to end of file.
@@ -234,6 +298,9 @@ class saveOutput(base.aobase.aobase):
                             offset+=outputData.size
                         if offset!=self.shape[0]:
                             raise Exception("Combined output data wrong shape (%d != %s)"%(offset,str(self.shape)))
+                        if self.mm is not None:
+                            self.nextStreamFrame()
+                            return
                         self.ff.seek(self.axisIncPos)
                         key=self.ff.read(80)
                         self.ff.seek(self.axisIncPos)
@@ -252,6 +319,10 @@ class saveOutput(base.aobase.aobase):
                         if outputData.dtype.char!=self.dtype:
                             outputData=outputData.astype(self.dtype)
                             print("Warning: saveOutput - converting outputData to type %s"%self.dtype)
+                        if self.mm is not None:
+                            self.writeStream(outputData)
+                            self.nextStreamFrame()
+                            return
                         if self.doByteSwap and numpy.little_endian:
                             outputData=outputData.byteswap()
                         self.ff.seek(0,2)#move to end of file.
@@ -270,6 +341,30 @@ class saveOutput(base.aobase.aobase):
         else:
             self.dataValid=0
 
+def recoverStream(filename):
+    """Tidy up a file written with saveOutputStream=1 by a simulation that
+    did not finish (e.g. crashed).  The file is truncated to the frames
+    recorded in the header at the last checkpoint, and padded to a FITS
+    block.
+    @param filename: The FITS file
+    @type filename: String
+    @return: The number of frames recovered
+    @rtype: Int
+    """
+    hdr=util.FITS.ReadHeader(filename)
+    h=hdr["parsed"]
+    offset=len(hdr["raw"])*80
+    nax=int(h["NAXIS"])
+    size=abs(int(h["BITPIX"]))/8
+    for i in range(nax):
+        size*=int(h["NAXIS%d"%(i+1)])
+    size+=offset
+    size=((size+2879)//2880)*2880
+    f=open(filename,"rb+")
+    f.truncate(size)
+    f.close()
+    return int(h["NAXIS%d"%nax])
+
 if __name__=="__main__":
     class dummy:
         outputData=numpy.zeros((5,10),"i")
@@ -279,7 +374,9 @@ if __name__=="__main__":
         def __init__(self):
             pass
         def getVal(self,val,default=None,raiseerror=1):
-            return "tmp.fits"
+            if val=="saveOutputFilename":
+                return "tmp.fits"
+            return default
         def setSearchOrder(self,so):
             pass
     parent=dummy()
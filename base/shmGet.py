@@ -386,7 +386,10 @@ class shmGet2(base.aobase.aobase):
     def generateNext(self,msg=None):
         self.setParentGenerateFlag()#can the parent generate?
         cmod.shmem.semop(self.semid,0,1)#allow shmSend to decrement...
+        tb=time.time()
         cmod.shmem.semop(self.semid,1,-1)#wait until we can decrement.
+        if self.profiler is not None:
+            self.profiler.addBlocked(self.objID,tb,time.time()-tb)
         #now check data is valid or None...
         if self.NoneFlagIsSet():
             self.outputData=None
@@ -0,0 +1,162 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Shared memory transport used by mpiSend and mpiGet when both ranks are
+on the same node, and the mpiAutoShm parameter is set.
+
+Data goes through a double buffered shared memory region rather than
+through MPI buffers.  Each frame is copied once, from the parent's
+outputData into the ring.  The receiving side then uses the ring
+directly, without a copy, as its outputData.  A frame stays valid until
+the iteration after next, so a child that keeps a reference to last
+iteration's data is not affected.
+
+The synchronisation follows the same protocol as mpiSend/mpiGet, using
+SysV semaphores instead of MPI messages:
+ - The receiver sets the generate flag and posts a request.
+ - The sender waits for the request, sets parent.setGenerate, copies
+   the data (if valid) into the next slot, and posts full.
+ - The receiver waits for full.
+
+The ring is created by the receiving end (mpiGet), which knows the
+dimensions.  The sender opens it on its first iteration.
+"""
+import os
+import numpy
+import cmod.shmem
+
+hdrSize=128
+REQ=0#request from the receiver
+FULL=1#data ready from the sender
+GEN=2#generate flag
+VALID=3#data valid flag
+magic=0x44415350
+
+def ringName(shmtag,sourceRank,destRank,tag):
+    """The shared memory name for a connection (unique to this simulation
+    since shmtag is shared by all ranks)"""
+    return "/daspring%x_%d_%d_%d_%s"%(shmtag&0xffffffffffff,sourceRank,destRank,tag,os.environ.get("USER","dasp"))
+
+class shmRing:
+    """A double buffered shared memory connection between two processes.
+    @cvar name: Shared memory name
+    @type name: String
+    @cvar slots: The two data buffers
+    @type slots: List of Array
+    @cvar semid: Semaphore identifier
+    @type semid: Int
+    """
+    def __init__(self,name,dims=None,dtype=None):
+        """If dims and dtype are given, creates the ring, otherwise opens
+        an existing one.
+        @param name: Shared memory name, from ringName()
+        @type name: String
+        @param dims: Data dimensions (creator only)
+        @type dims: Tuple of Int
+        @param dtype: Data type (creator only)
+        @type dtype: numpy dtype or char
+        """
+        self.name=name
+        self.creator=dims is not None
+        if self.creator:
+            dtype=numpy.dtype(dtype)
+            nbytes=int(numpy.prod(dims))*dtype.itemsize
+            slotSize=(nbytes+63)//64*64
+            total=hdrSize+2*slotSize
+            self.shm=cmod.shmem.open((total,),"b",name,1)
+            hdr=self.shm[:hdrSize].view(numpy.int64)
+            hdr[:]=0
+            hdr[1]=nbytes
+            hdr[2]=slotSize
+            hdr[3]=ord(dtype.char)
+            hdr[4]=len(dims)
+            hdr[5:5+len(dims)]=dims
+            self.semid=cmod.shmem.newsemid(name="/dev/shm"+name,existingFile=1,nSems=4)
+            cmod.shmem.initSemaphore(self.semid,REQ,0)
+            cmod.shmem.initSemaphore(self.semid,FULL,0)
+            cmod.shmem.initSemaphore(self.semid,GEN,1)
+            cmod.shmem.initSemaphore(self.semid,VALID,0)
+            hdr[0]=magic#now ready.
+        else:
+            total=os.stat("/dev/shm"+name).st_size#open would truncate to the size given.
+            self.shm=cmod.shmem.open((total,),"b",name,0)
+            hdr=self.shm[:hdrSize].view(numpy.int64)
+            if hdr[0]!=magic:
+                raise Exception("shmRing %s not initialised"%name)
+            nbytes,slotSize=int(hdr[1]),int(hdr[2])
+            dtype=numpy.dtype(chr(hdr[3]))
+            dims=tuple(map(int,hdr[5:5+hdr[4]]))
+            self.semid=cmod.shmem.newsemid(name="/dev/shm"+name,existingFile=1,nSems=4)
+            cmod.shmem.unlink(name)#both ends now attached.
+        self.dims=dims
+        self.dtype=dtype
+        self.slots=[]
+        for i in range(2):
+            s=self.shm[hdrSize+i*slotSize:hdrSize+i*slotSize+nbytes].view(dtype)
+            s.shape=dims
+            self.slots.append(s)
+        self.cnt=0
+
+    def request(self,generate):
+        """Receiver: ask the sender for the next frame"""
+        cmod.shmem.initSemaphore(self.semid,GEN,int(generate))
+        cmod.shmem.semop(self.semid,REQ,1)
+
+    def waitRequest(self):
+        """Sender: wait for the receiver to request data.
+        @return: The generate flag set by the receiver
+        @rtype: Int
+        """
+        cmod.shmem.semop(self.semid,REQ,-1)
+        return cmod.shmem.getSemValue(self.semid,GEN)
+
+    def put(self,data):
+        """Sender: write data (or None if not valid) into the next slot,
+        and tell the receiver it is ready."""
+        if data is None:
+            cmod.shmem.initSemaphore(self.semid,VALID,0)
+        else:
+            slot=self.slots[self.cnt%2]
+            if data.shape!=slot.shape:
+                raise Exception("shmRing %s: data shape %s doesn't match %s"%(self.name,str(data.shape),str(slot.shape)))
+            slot[:]=data
+            cmod.shmem.initSemaphore(self.semid,VALID,1)
+        self.cnt+=1
+        cmod.shmem.semop(self.semid,FULL,1)
+
+    def get(self):
+        """Receiver: wait for the next frame.
+        @return: The slot containing the data (not a copy), or None if not valid
+        @rtype: Array
+        """
+        cmod.shmem.semop(self.semid,FULL,-1)
+        slot=self.slots[self.cnt%2]
+        self.cnt+=1
+        if cmod.shmem.getSemValue(self.semid,VALID):
+            return slot
+        return None
+
+    def close(self):
+        self.slots=[]
+        if self.shm is not None:
+            cmod.shmem.unmap(self.shm)
+            self.shm=None
+        if self.creator:
+            if os.path.exists("/dev/shm"+self.name):#not opened by the sender
+                cmod.shmem.unlink(self.name)
+            try:
+                cmod.shmem.semdel(self.semid)
+            except:
+                pass
@@ -14,7 +14,7 @@
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import types,os,numpy
+import types,os,numpy,time
 import cmod.shmem
 import base.aobase
 #also see shmSend2 below... I think shmSend is probably depreciated - I think they do the same thing anyway...
@@ -308,7 +308,10 @@ class shmSend2(base.aobase.aobase):
 
         if self.debug!=None: print "shmSend: blocking on sem 0 (debug=%s)"%str(self.debug)
 
+        tb=time.time()
         cmod.shmem.semop(self.semid,0,-1)#block until can write
+        if self.profiler is not None:
+            self.profiler.addBlocked(self.objID,tb,time.time()-tb)
         self.generate=cmod.shmem.getSemValue(self.semid,2)
         if self.generate:
             self.parent.setGenerate(1)
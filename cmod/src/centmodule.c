@@ -128,6 +128,7 @@ void pcg32_srandom_r(pcg32_random_t* rng, uint64_t initstate, uint64_t initseq)
 #define USEBRIGHTEST 20
 #define INTEGSTEPS 21
 #define OUTPUTPHASEARR 22
+#define CURINTEG 23
 
 #define CENTROIDSFROMPHASE 1
 #define CENTROIDSFROMIMAGE 2
@@ -2829,6 +2830,16 @@ PyObject *py_update(PyObject *self,PyObject *args){
 	return NULL;
       }
       break;
+  case CURINTEG://used when restoring from a checkpoint.
+    if(PyInt_Check(obj)){
+      c->curInteg=(int)PyInt_AsLong(obj);
+      if(c->curInteg<0 || c->curInteg>=c->nintegrations+c->nlatency)
+	c->curInteg=0;
+    }else{
+      printf("centmodule: Error in set curInteg\n");
+      return NULL;
+    }
+    break;
   case OUTPUTPHASEARR://only used for testing.
     if(PyArray_Check(obj)){
       if(checkFloatContigArr((PyArrayObject*)obj)!=0){
@@ -3272,6 +3283,66 @@ PyObject *py_runSlope(PyObject *self,PyObject *args){
 }
 
 
+PyObject *py_runBatch(PyObject *self,PyObject *args){
+  //Run several centstructs (e.g. resource shared WFSs) together.  All the
+  //thread pools are woken at once, and then waited for, with the GIL released,
+  //so that N WFSs each with nthreads/N threads keep all CPUs busy.
+  PyObject *tup;
+  centstruct **clist;
+  int n,i,mode=CENTROIDSFROMPHASE,slope=0;
+  float dtime=0.;
+  struct timeval t1,t2;
+  if(!PyArg_ParseTuple(args,"O!|i",&PyTuple_Type,&tup,&slope)){
+    printf("Usage: tuple of centstruct, slope flag (optional, 0 for phase input, 1 for image input)\n");
+    return NULL;
+  }
+  if(slope)
+    mode=CENTROIDSFROMIMAGE;
+  n=(int)PyTuple_Size(tup);
+  if(n==0)
+    return Py_BuildValue("f",dtime);
+  if((clist=malloc(sizeof(centstruct*)*n))==NULL){
+    PyErr_SetString(PyExc_MemoryError,"runBatch: Unable to allocate centstruct list");
+    return NULL;
+  }
+  for(i=0; i<n; i++){
+    clist[i]=(centstruct*)PyInt_AsLong(PyTuple_GET_ITEM(tup,i));
+    if(PyErr_Occurred()){
+      free(clist);
+      return NULL;
+    }
+    if(clist[i]==NULL || clist[i]->nthreads<1){
+      PyErr_SetString(PyExc_ValueError,"runBatch: centstruct not initialised with threads");
+      free(clist);
+      return NULL;
+    }
+    if(slope && clist[i]->inputImage==NULL){
+      PyErr_SetString(PyExc_ValueError,"runBatch: inputImage is NULL");
+      free(clist);
+      return NULL;
+    }
+  }
+  gettimeofday(&t1,NULL);
+  Py_BEGIN_ALLOW_THREADS;
+  for(i=0; i<n; i++){
+    clist[i]->doWork=mode;
+    pthread_barrier_wait(&clist[i]->barrier);//wake threads up
+  }
+  for(i=0; i<n; i++){
+    pthread_barrier_wait(&clist[i]->barrier);//now wait for threads to finish.
+    if(!slope){
+      clist[i]->curInteg++;
+      if(clist[i]->curInteg>=clist[i]->nintegrations+clist[i]->nlatency)
+	clist[i]->curInteg=0;
+    }
+  }
+  Py_END_ALLOW_THREADS;
+  gettimeofday(&t2,NULL);
+  dtime=(t2.tv_sec*1000000+t2.tv_usec-t1.tv_sec*1000000-t1.tv_usec)/1e6;
+  free(clist);
+  return Py_BuildValue("f",dtime);
+}
+
 PyObject *py_testcorrelation(PyObject *self,PyObject *args){
   fftwf_plan corrPlan;
   fftwf_plan invCorrPlan;
@@ -3313,6 +3384,7 @@ PyObject *py_testcorrelation(PyObject *self,PyObject *args){
 static PyMethodDef centMethods[] = {
   {"run",  py_run, METH_VARARGS,"Run the phase -> centroid algorithm."},
   {"runSlope",  py_runSlope, METH_VARARGS,"Run the image -> centroid algorithm ."},
+  {"runBatch",  py_runBatch, METH_VARARGS,"Run several centstructs (phase or image -> centroid) concurrently."},
   {"initialise",py_initialise,METH_VARARGS,"Initialise the cent module"},
   {"update",py_update,METH_VARARGS,"Update values used for centroiding"},
   {"free",py_free,METH_VARARGS,"Free the arrays allocated (invalidates the centstruct pointer)"},
@@ -75,6 +75,38 @@ static PyObject* Plan(PyObject *self,PyObject *args){
   return Py_BuildValue("l",(long)p);
 }
 
+static PyObject* PlanMany(PyObject *self,PyObject *args){
+  //Plan a batch of 2D FFTs, over the last 2 dimensions of 3D arrays.
+  //If nthreads is given, InitialiseThreading must have been called first
+  //(note, this then also applies to subsequent plans).
+  fftwf_plan p;
+  PyArrayObject *in,*out;
+  int nthreads=0;
+  int n[2],dist;
+  if(!PyArg_ParseTuple(args,"O!O!|i",&PyArray_Type,&in,&PyArray_Type,&out,&nthreads)){
+    printf("Usage - in array, out array, nthreads (optional)\n");
+    return NULL;
+  }
+  if(in->nd!=3 || out->nd!=3 || in->dimensions[0]!=out->dimensions[0] || in->dimensions[1]!=out->dimensions[1] || in->dimensions[2]!=out->dimensions[2]){
+    printf("PlanMany - dimensions must be same for input and output, 3D array\n");
+    return NULL;
+  }
+  if(checkCFloatContigArr(in)!=0 || checkCFloatContigArr(out)!=0){
+    printf("input and output must be complex float contiguous\n");
+    return NULL;
+  }
+  if(((long)(in->data))&0xf || ((long)(out->data))&0xf){
+    printf("Warning - cmod.fftmodule - data may not be aligned for SIMD operation\n");
+  }
+  if(nthreads>0)
+    fftwf_plan_with_nthreads(nthreads);
+  n[0]=(int)(in->dimensions[1]);
+  n[1]=(int)(in->dimensions[2]);
+  dist=n[0]*n[1];
+  p=fftwf_plan_many_dft(2,n,(int)(in->dimensions[0]),(fftwf_complex*)(in->data),NULL,1,dist,(fftwf_complex*)(out->data),NULL,1,dist,FFTW_FORWARD,FFTW_DESTROY_INPUT | FFTW_MEASURE);
+  return Py_BuildValue("l",(long)p);
+}
+
 static PyObject* ExecutePlan(PyObject *self,PyObject *args){
   //execute an FFT from the plan.
   fftwf_plan p;
@@ -82,7 +114,9 @@ static PyObject* ExecutePlan(PyObject *self,PyObject *args){
     printf("Usage - fft plan (returned from Plan())\n");
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS;
   fftwf_execute(p);
+  Py_END_ALLOW_THREADS;
   Py_INCREF(Py_None);
   return Py_None;
 }
@@ -113,6 +147,7 @@ static PyMethodDef fftMethods[] = {
   {"InitialiseThreading",InitialiseThreading,METH_VARARGS,
    "Initialise the threading (arg=nthreads)"},
   {"Plan",Plan,METH_VARARGS,"Plan the FFT"},
+  {"PlanMany",PlanMany,METH_VARARGS,"Plan a batch of 2D FFTs (3D arrays)"},
   {"ExecutePlan",ExecutePlan,METH_VARARGS,"Do the FFT"},
   {"FreePlan",FreePlan,METH_VARARGS,"Free the plan"},
   {"CleanUp",CleanUp,METH_VARARGS,"Clean up at the end"},
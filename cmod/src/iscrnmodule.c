@@ -475,6 +475,62 @@ PyObject *py_free(PyObject *self,PyObject *args){
   return Py_None;
 }
 
+PyObject *py_getState(PyObject *self,PyObject *args){
+  //Return the evolving state (for checkpointing): insertPos, rowsAdded, extraCols, interpPosition, nadd, and the random number generator state as a uint8 array.
+  ScrnStruct *ss;
+  PyArrayObject *ssArr,*rngArr;
+  npy_intp size;
+  PyObject *rtval;
+  if(!PyArg_ParseTuple(args,"O!",&PyArray_Type,&ssArr)){
+    printf("Usage: ScrnStruct\n");
+    return NULL;
+  }
+  if(checkContigSize(ssArr,sizeof(ScrnStruct))!=0){
+    printf("ScrnStruct should be initialised with the initialise method of scrn module\n");
+    return NULL;
+  }
+  ss=(ScrnStruct*)ssArr->data;
+  size=(npy_intp)gsl_rng_size(ss->rng);
+  if((rngArr=(PyArrayObject*)PyArray_SimpleNew(1,&size,NPY_UBYTE))==NULL)
+    return NULL;
+  memcpy(rngArr->data,gsl_rng_state(ss->rng),size);
+  rtval=Py_BuildValue("iiidiN",ss->insertPos,ss->rowsAdded,ss->nrStruct.extraCols,ss->nrStruct.interpPosition,ss->nrStruct.nadd,rngArr);
+  return rtval;
+}
+
+PyObject *py_setState(PyObject *self,PyObject *args){
+  //Restore the state returned by getState.
+  ScrnStruct *ss;
+  PyArrayObject *ssArr,*rngArr;
+  int insertPos,rowsAdded,extraCols,nadd;
+  double interpPosition;
+  if(!PyArg_ParseTuple(args,"O!iiidiO!",&PyArray_Type,&ssArr,&insertPos,&rowsAdded,&extraCols,&interpPosition,&nadd,&PyArray_Type,&rngArr)){
+    printf("Usage: ScrnStruct, insertPos, rowsAdded, extraCols, interpPosition, nadd, rng state array\n");
+    return NULL;
+  }
+  if(checkContigSize(ssArr,sizeof(ScrnStruct))!=0){
+    printf("ScrnStruct should be initialised with the initialise method of scrn module\n");
+    return NULL;
+  }
+  ss=(ScrnStruct*)ssArr->data;
+  if(!PyArray_ISCONTIGUOUS(rngArr) || PyArray_NBYTES(rngArr)!=gsl_rng_size(ss->rng)){
+    PyErr_SetString(PyExc_ValueError,"iscrn.setState: random number state has wrong size");
+    return NULL;
+  }
+  if(insertPos<0 || insertPos>=ss->scrnYPxls){
+    PyErr_SetString(PyExc_ValueError,"iscrn.setState: insertPos out of range");
+    return NULL;
+  }
+  ss->insertPos=insertPos;
+  ss->rowsAdded=rowsAdded;
+  ss->nrStruct.extraCols=extraCols;
+  ss->nrStruct.interpPosition=interpPosition;
+  ss->nrStruct.nadd=nadd;
+  memcpy(gsl_rng_state(ss->rng),rngArr->data,gsl_rng_size(ss->rng));
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
 PyObject *py_run(PyObject *self,PyObject *args){
   ScrnStruct *ss;
   PyArrayObject *ssArr;
@@ -1334,6 +1390,164 @@ PyObject *py_rotShiftWrapSplineImageThreaded(PyObject *self,PyObject *args){
 
 
 
+typedef struct{
+  interpStruct **ss;//one per layer and direction (nlayer x ndir), NULL if not used
+  float *sx;//nlayer x ndir
+  float *sy;
+  int *wrappoint;//nlayer
+  unsigned char *used;//nlayer x ndir
+  float *out;//ndir x dim[0] x dim[1]
+  int nlayer;
+  int ndir;
+  int threadno;
+  int nthreads;
+  int nout;
+}manyThreadStruct;
+
+void *rswsiManyWorker(void *threaddata){
+  //Each thread computes a fixed set of directions, so that no two threads add into the same output.
+  //The layer is the outer loop, so that each layer is read for all of this thread's directions together.
+  manyThreadStruct *m=(manyThreadStruct*)threaddata;
+  interpStruct local;
+  threadStruct ts;
+  int d,l,npxl;
+  m->nout=0;
+  for(l=0;l<m->nlayer;l++){
+    for(d=m->threadno;d<m->ndir;d+=m->nthreads){
+      if(m->used[l*m->ndir+d]==0)
+	continue;
+      local=*(m->ss[l*m->ndir+d]);
+      npxl=local.dim[0]*local.dim[1];
+      local.out=&m->out[d*npxl];
+      local.sx=m->sx[l*m->ndir+d];
+      local.sy=m->sy[l*m->ndir+d];
+      local.wrappoint=m->wrappoint[l];
+      local.nthreads=1;
+      local.nblockx=1;
+      local.nblocky=1;
+      ts.s=&local;
+      ts.threadno=0;
+      ts.nout=0;
+      if(local.dimg==NULL)
+	rswsiWorkerNoGradLarge(&ts);
+      else
+	rswsiWorker(&ts);
+      m->nout+=ts.nout;
+    }
+  }
+  return NULL;
+}
+
+PyObject *py_rotShiftWrapSplineImageMany(PyObject *self,PyObject *args){
+  //Interpolate several layers along several lines of sight, in one threaded call.
+  //The output for each direction is the sum over the used layers.
+  //structList has one struct per layer (used for all directions), or one per layer and direction (layer major, None where not used), e.g. for sources with different cone effect scaling.
+  PyObject *structList,*item;
+  PyArrayObject *sxObj,*syObj,*wrapObj,*usedObj,*outObj,*structObj;
+  interpStruct **ss;
+  manyThreadStruct *ms;
+  pthread_t *tid;
+  int nthreads,nlayer,ndir,nstruct,i,j,nout=0;
+  npy_intp *dim;
+  if(!PyArg_ParseTuple(args,"O!O!O!O!O!O!i",&PyList_Type,&structList,&PyArray_Type,&sxObj,&PyArray_Type,&syObj,&PyArray_Type,&wrapObj,&PyArray_Type,&usedObj,&PyArray_Type,&outObj,&nthreads)){
+    printf("Args for rotShiftWrapSplineImageMany should be:\n");
+    printf("list of structs returned from initialiseInterp (nlayer or nlayer x ndir), shiftx (float32, nlayer x ndir), shifty (float32, nlayer x ndir), wrappoint (int32, nlayer), used (uint8, nlayer x ndir), out (float32, ndir x ny x nx), nthreads\n");
+    return NULL;
+  }
+  if(PyArray_NDIM(outObj)!=3 || checkContigFloat(outObj)!=0){
+    printf("out should be 3D contiguous float32\n");
+    return NULL;
+  }
+  dim=PyArray_DIMS(outObj);
+  ndir=(int)dim[0];
+  nlayer=(int)PyArray_SIZE(wrapObj);
+  nstruct=(int)PyList_Size(structList);
+  if(nstruct!=nlayer && nstruct!=nlayer*ndir){
+    printf("structList should have %d or %d entries\n",nlayer,nlayer*ndir);
+    return NULL;
+  }
+  if(checkContigFloat(sxObj)!=0 || checkContigFloat(syObj)!=0 || PyArray_SIZE(sxObj)!=nlayer*ndir || PyArray_SIZE(syObj)!=nlayer*ndir){
+    printf("shiftx and shifty should be contiguous float32 of shape (%d,%d)\n",nlayer,ndir);
+    return NULL;
+  }
+  if(PyArray_TYPE(wrapObj)!=NPY_INT32 || !PyArray_IS_C_CONTIGUOUS(wrapObj)){
+    printf("wrappoint should be contiguous int32\n");
+    return NULL;
+  }
+  if(checkContigByteSize(usedObj,nlayer*ndir)!=0){
+    printf("used should be contiguous uint8 of shape (%d,%d)\n",nlayer,ndir);
+    return NULL;
+  }
+  if((ss=calloc(sizeof(interpStruct*),nlayer*ndir))==NULL){
+    printf("Unable to alloc ss in iscrnmodule\n");
+    return NULL;
+  }
+  for(i=0;i<nlayer;i++){
+    for(j=0;j<ndir;j++){
+      if(((unsigned char*)PyArray_DATA(usedObj))[i*ndir+j]==0)
+	continue;
+      item=PyList_GetItem(structList,nstruct==nlayer?i:i*ndir+j);
+      structObj=(PyArrayObject*)item;
+      if(!PyArray_Check(item) || checkContigSize(structObj,sizeof(interpStruct))!=0){
+	printf("interpStruct should be initialised with the initialiseInterp method of iscrn module\n");
+	free(ss);
+	return NULL;
+      }
+      ss[i*ndir+j]=(interpStruct*)(structObj->data);
+      if(ss[i*ndir+j]->dim[0]!=dim[1] || ss[i*ndir+j]->dim[1]!=dim[2]){
+	printf("interpStruct %d output size (%d,%d) does not match out (%ld,%ld)\n",i,ss[i*ndir+j]->dim[0],ss[i*ndir+j]->dim[1],(long)dim[1],(long)dim[2]);
+	free(ss);
+	return NULL;
+      }
+      if(((int*)PyArray_DATA(wrapObj))[i]>ss[i*ndir+j]->imgdim[0] || ((int*)PyArray_DATA(wrapObj))[i]<0){
+	printf("Illegal wrappoint in iscrnmodule %d\n",((int*)PyArray_DATA(wrapObj))[i]);
+	free(ss);
+	return NULL;
+      }
+    }
+  }
+  if(nthreads<1)
+    nthreads=1;
+  if(nthreads>ndir)
+    nthreads=ndir;
+  if((tid=malloc(sizeof(pthread_t)*nthreads))==NULL){
+    printf("Unable to alloc tid in iscrnmodule\n");
+    free(ss);
+    return NULL;
+  }
+  if((ms=calloc(sizeof(manyThreadStruct),nthreads))==NULL){
+    printf("unable to alloc ms in iscrnmodule\n");
+    free(ss);
+    free(tid);
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  for(i=0;i<nthreads;i++){
+    ms[i].ss=ss;
+    ms[i].sx=(float*)PyArray_DATA(sxObj);
+    ms[i].sy=(float*)PyArray_DATA(syObj);
+    ms[i].wrappoint=(int*)PyArray_DATA(wrapObj);
+    ms[i].used=(unsigned char*)PyArray_DATA(usedObj);
+    ms[i].out=(float*)PyArray_DATA(outObj);
+    ms[i].nlayer=nlayer;
+    ms[i].ndir=ndir;
+    ms[i].threadno=i;
+    ms[i].nthreads=nthreads;
+    pthread_create(&tid[i],NULL,rswsiManyWorker,&ms[i]);
+  }
+  for(i=0;i<nthreads;i++){
+    pthread_join(tid[i],NULL);
+    nout+=ms[i].nout;
+  }
+  Py_END_ALLOW_THREADS;
+  free(tid);
+  free(ms);
+  free(ss);
+  return Py_BuildValue("i",nout);
+}
+
+
+
 PyObject *py_rotShiftWrapSplineImage(PyObject *self,PyObject *args){
   interpStruct *ss;
   int outofrange[4];
@@ -1602,9 +1816,12 @@ static PyMethodDef iscrn_methods[] = 	{
   {"initialise", py_initialise, METH_VARARGS}, 
   {"update", py_update, METH_VARARGS}, 
   {"free", py_free, METH_VARARGS}, 
+  {"getState", py_getState, METH_VARARGS},
+  {"setState", py_setState, METH_VARARGS},
   {"initialiseInterp",py_initialiseInterp,METH_VARARGS},
   {"rotShiftWrapSplineImage", py_rotShiftWrapSplineImage, METH_VARARGS},
   {"rotShiftWrapSplineImageThreaded", py_rotShiftWrapSplineImageThreaded, METH_VARARGS},
+  {"rotShiftWrapSplineImageMany", py_rotShiftWrapSplineImageMany, METH_VARARGS},
   {"rotShiftWrapSplineImageNoInit", py_rotShiftWrapSplineImageNoInit, METH_VARARGS},
   {NULL, NULL} };
 
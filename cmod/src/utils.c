@@ -745,6 +745,280 @@ static PyObject *UncompressFloatArrayAllThreaded(PyObject *self,PyObject *args){
 
 
 
+/*
+Fused decompress and matrix-vector multiply, for reconstructors stored in
+compact formats (see util/compactMatrix.py).  The matrix elements are
+decoded in registers and accumulated directly, so the matrix is only read
+once, and no decompressed copy is made.
+Formats:
+0 - compressed float (as compressFloatArrayAll), uint32 words.
+1 - float16, uint16.
+2 - bfloat16 (top 16 bits of float32), uint16.
+3 - int8, with a float32 scale per row.
+4 - int16, with a float32 scale per row.
+If trans==0, out[nrows]=mat.vec[ncols].  If trans==1, out[ncols]=mat^T.vec[nrows].
+*/
+typedef struct{
+  void *data;
+  int fmt;
+  long ncols;
+  float *scale;
+  int mbits;
+  int expMin;
+  int expMax;
+  float *vec;
+  float *out;
+  long rstart;
+  long rend;
+  int trans;
+}CmvmInfo;
+
+typedef union{
+  unsigned int i;
+  float f;
+}floatInt;
+
+static inline float halfToFloat(unsigned short h){
+  floatInt u;
+  unsigned int s=((unsigned int)(h&0x8000))<<16;
+  unsigned int e=(h>>10)&0x1f;
+  unsigned int m=h&0x3ff;
+  if(e==0){
+    if(m==0){
+      u.i=s;
+    }else{//subnormal - normalise.
+      e=127-15+1;
+      while((m&0x400)==0){
+	m<<=1;
+	e--;
+      }
+      m&=0x3ff;
+      u.i=s|(e<<23)|(m<<13);
+    }
+  }else if(e==31){
+    u.i=s|0x7f800000|(m<<13);
+  }else{
+    u.i=s|((e+127-15)<<23)|(m<<13);
+  }
+  return u.f;
+}
+
+int compactMvmWorker(CmvmInfo *info){
+  long r,c;
+  long ncols=info->ncols;
+  float *vec=info->vec;
+  float *out=info->out;
+  float acc,s;
+  floatInt u;
+  unsigned int word,mask,emask;
+  unsigned int *wdata;
+  unsigned long bitpos;
+  int bits,ebits,offset,left;
+  unsigned short *hdata;
+  signed char *cdata;
+  short *sdata;
+  float val=0;
+  if(info->fmt==0){
+    offset=info->expMax-info->expMin+1;
+    ebits=1;
+    while((offset>>ebits)>0)
+      ebits++;
+    bits=info->mbits+ebits+1;
+    mask=((1<<info->mbits)-1)<<(23-info->mbits);
+    emask=((1<<ebits)-1);
+  }else{
+    bits=ebits=0;
+    mask=emask=0;
+  }
+  for(r=info->rstart; r<info->rend; r++){
+    acc=0;
+    if(info->trans){
+      s=vec[r];
+      if(info->scale!=NULL)
+	s*=info->scale[r];
+      if(s==0)
+	continue;
+    }else
+      s=0;
+    switch(info->fmt){
+    case 0:
+      wdata=(unsigned int*)info->data;
+      bitpos=(unsigned long)r*ncols*bits;
+      for(c=0; c<ncols; c++){
+	offset=bitpos&31;
+	word=wdata[bitpos>>5]<<offset;
+	left=bits-(32-offset);
+	if(left>0)
+	  word|=wdata[(bitpos>>5)+1]>>(bits-left);
+	if(((word>>(31-ebits))&emask)==0)
+	  u.i=(word&0x80000000)|((word>>(8-ebits))&mask);
+	else
+	  u.i=(word&0x80000000)|((((word>>(31-ebits))&emask)+info->expMin-1)<<23)|((word>>(8-ebits))&mask);
+	bitpos+=bits;
+	if(info->trans)
+	  out[c]+=u.f*s;
+	else
+	  acc+=u.f*vec[c];
+      }
+      break;
+    case 1:
+      hdata=&((unsigned short*)info->data)[r*ncols];
+      for(c=0; c<ncols; c++){
+	val=halfToFloat(hdata[c]);
+	if(info->trans)
+	  out[c]+=val*s;
+	else
+	  acc+=val*vec[c];
+      }
+      break;
+    case 2:
+      hdata=&((unsigned short*)info->data)[r*ncols];
+      for(c=0; c<ncols; c++){
+	u.i=((unsigned int)hdata[c])<<16;
+	if(info->trans)
+	  out[c]+=u.f*s;
+	else
+	  acc+=u.f*vec[c];
+      }
+      break;
+    case 3:
+      cdata=&((signed char*)info->data)[r*ncols];
+      if(info->trans){
+	for(c=0; c<ncols; c++)
+	  out[c]+=cdata[c]*s;
+      }else{
+	for(c=0; c<ncols; c++)
+	  acc+=cdata[c]*vec[c];
+      }
+      break;
+    case 4:
+      sdata=&((short*)info->data)[r*ncols];
+      if(info->trans){
+	for(c=0; c<ncols; c++)
+	  out[c]+=sdata[c]*s;
+      }else{
+	for(c=0; c<ncols; c++)
+	  acc+=sdata[c]*vec[c];
+      }
+      break;
+    }
+    if(!info->trans){
+      if(info->scale!=NULL)
+	acc*=info->scale[r];
+      out[r]=acc;
+    }
+  }
+  return 0;
+}
+
+static PyObject *CompactMvm(PyObject *self,PyObject *args){
+  PyArrayObject *mat,*vec,*out;
+  PyObject *scaleObj;
+  PyArrayObject *scale=NULL;
+  int fmt,mbits,expMin,expMax,trans,nthreads;
+  long nrows,ncols,i,c,nleft,ndone;
+  CmvmInfo *info;
+  pthread_t *thread;
+  float *tmp=NULL;
+  int esize[5]={4,2,2,1,2};
+  if(!PyArg_ParseTuple(args,"O!O!O!illOiiiii",&PyArray_Type,&mat,&PyArray_Type,&vec,&PyArray_Type,&out,&fmt,&nrows,&ncols,&scaleObj,&mbits,&expMin,&expMax,&trans,&nthreads)){
+    printf("Usage: compact matrix, vector (float32), output (float32), format (0=compressed, 1=float16, 2=bfloat16, 3=int8, 4=int16), nrows, ncols, row scale (float32 array or None), mantissa bits, exp min, exp max (for format 0), transpose flag, nthreads\n");
+    return NULL;
+  }
+  if(fmt<0 || fmt>4){
+    PyErr_SetString(PyExc_ValueError,"compactMvm: format should be 0-4");
+    return NULL;
+  }
+  if(!PyArray_ISCONTIGUOUS(mat) || !PyArray_ISCONTIGUOUS(vec) || !PyArray_ISCONTIGUOUS(out)){
+    PyErr_SetString(PyExc_ValueError,"compactMvm: arrays must be contiguous");
+    return NULL;
+  }
+  if(vec->descr->type_num!=NPY_FLOAT || out->descr->type_num!=NPY_FLOAT){
+    PyErr_SetString(PyExc_ValueError,"compactMvm: vector and output must be float32");
+    return NULL;
+  }
+  if(mat->descr->elsize!=esize[fmt]){
+    PyErr_SetString(PyExc_ValueError,"compactMvm: matrix element size wrong for format");
+    return NULL;
+  }
+  if(fmt!=0 && PyArray_SIZE(mat)!=nrows*ncols){
+    PyErr_SetString(PyExc_ValueError,"compactMvm: matrix size wrong");
+    return NULL;
+  }
+  if(fmt==0 && (expMin<1 || expMax>255 || expMin>expMax || mbits>22)){
+    PyErr_SetString(PyExc_ValueError,"compactMvm: expMin should be >0, expMax<256, mbits<23");
+    return NULL;
+  }
+  if(PyArray_SIZE(vec)!=(trans?nrows:ncols) || PyArray_SIZE(out)!=(trans?ncols:nrows)){
+    PyErr_SetString(PyExc_ValueError,"compactMvm: vector or output wrong size");
+    return NULL;
+  }
+  if(scaleObj!=Py_None){
+    if(!PyArray_Check(scaleObj) || ((PyArrayObject*)scaleObj)->descr->type_num!=NPY_FLOAT || !PyArray_ISCONTIGUOUS((PyArrayObject*)scaleObj) || PyArray_SIZE((PyArrayObject*)scaleObj)!=nrows){
+      PyErr_SetString(PyExc_ValueError,"compactMvm: scale must be a contiguous float32 array of size nrows");
+      return NULL;
+    }
+    scale=(PyArrayObject*)scaleObj;
+  }
+  if(nthreads<1)
+    nthreads=1;
+  if(nthreads>nrows)
+    nthreads=nrows>0?nrows:1;
+  if((thread=malloc(sizeof(pthread_t)*nthreads))==NULL || (info=malloc(sizeof(CmvmInfo)*nthreads))==NULL){
+    PyErr_SetString(PyExc_MemoryError,"compactMvm: unable to malloc");
+    return NULL;
+  }
+  if(trans){//each thread accumulates into its own output.
+    if((tmp=calloc(sizeof(float),ncols*nthreads))==NULL){
+      free(thread);
+      free(info);
+      PyErr_SetString(PyExc_MemoryError,"compactMvm: unable to malloc");
+      return NULL;
+    }
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  nleft=nrows;
+  ndone=0;
+  for(i=0; i<nthreads; i++){
+    info[i].data=(void*)mat->data;
+    info[i].fmt=fmt;
+    info[i].ncols=ncols;
+    info[i].scale=(scale==NULL?NULL:(float*)scale->data);
+    info[i].mbits=mbits;
+    info[i].expMin=expMin;
+    info[i].expMax=expMax;
+    info[i].vec=(float*)vec->data;
+    info[i].out=(trans?&tmp[i*ncols]:(float*)out->data);
+    info[i].rstart=ndone;
+    info[i].rend=ndone+nleft/(nthreads-i);
+    info[i].trans=trans;
+    nleft-=info[i].rend-info[i].rstart;
+    ndone=info[i].rend;
+    if(nthreads>1)
+      pthread_create(&thread[i],NULL,(void*)compactMvmWorker,&info[i]);
+    else
+      compactMvmWorker(&info[i]);
+  }
+  if(nthreads>1){
+    for(i=0; i<nthreads; i++)
+      pthread_join(thread[i],NULL);
+  }
+  if(trans){
+    memcpy(out->data,tmp,sizeof(float)*ncols);
+    for(i=1; i<nthreads; i++){
+      for(c=0; c<ncols; c++)
+	((float*)out->data)[c]+=tmp[i*ncols+c];
+    }
+    free(tmp);
+  }
+  Py_END_ALLOW_THREADS;
+  free(info);
+  free(thread);
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+
 static PyObject* ArrayFromArray(PyObject *self,PyObject *args){
     //create an array from existing memory, and return new object.  The new array can use all or part of the old one, and can be different data type.
     char *type;
@@ -1874,6 +2148,7 @@ static PyMethodDef UtilsMethods[] = {
   {"uncompressFloatArrayAll",UncompressFloatArrayAll,METH_VARARGS,"uncompress floating point"},
   {"uncompressFloatArrayThreaded",UncompressFloatArrayThreaded,METH_VARARGS,"uncompress floating point"},
   {"uncompressFloatArrayAllThreaded",UncompressFloatArrayAllThreaded,METH_VARARGS,"uncompress floating point"},
+  {"compactMvm",CompactMvm,METH_VARARGS,"Fused decompress and matrix-vector multiply for compact format matrices"},
   {"arrayFromArray",  ArrayFromArray, METH_VARARGS,
    "Create an array using the memory from an existing array."},
   {"arrayFromDiagonal",ArrayFromDiagonal,METH_VARARGS,
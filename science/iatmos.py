@@ -23,6 +23,7 @@ import numpy
 import time,types
 import iscrn
 import util.atmos
+import cmod.iscrn
 import util.dist,util.zernikeMod
 from scipy.special import gamma,kv
 def calcLayerOffset(scrnSize,thetas,phis,altitude,npup,ntel,telDiam):
@@ -74,7 +75,18 @@ class iatmos(base.aobase.aobase):
     the number of direcions, while in the sharing case it isn't.
 
     Resource sharing implemented.
+
+    With batchDirections set, the directions of all resource sharers are
+    computed together when the first sharer is called (in one threaded
+    call, using batchNthreads threads, each layer being read once), and
+    copied into outputData as each sharer is called.  This uses
+    npup*npup*4 bytes of extra memory per direction.  Sharers computing
+    uplink tip/tilt are still computed individually.
     """
+    #state saved when checkpointing:
+    checkpointAttrs=["outputData","dataValid","phaseScreens","ygradient","insertPos","newRows","interpPosRow","nremRow","naddRow",
+                     "coeffsZernike","zernikeIters","phStructFn","phStructFnIter","phaseSum","phaseSumCnt"]
+
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         """Initialise the object.  The parent object here should be a dictionary with values for each atmospheric layer, ie instances of iscrn.  """
         if type(parent)!=type({}):
@@ -115,6 +127,12 @@ class iatmos(base.aobase.aobase):
             self.control={"cal_source":0,"profilePhase":0,"fullPupil":0,"removePiston":1}#full pupil is used as a flag for phase profiling (xinterp_recon etc) if want to return the whole pupil.
             self.tstep=self.config.getVal("tstep")
             self.vibration=self.config.getVal("vibration",raiseerror=0)#typically, a util.vibration.Vibration() instance
+            self.batchDirections=self.config.getVal("batchDirections",default=0)#compute all resource sharers together.
+            self.batchNthreads=self.config.getVal("batchNthreads",default="all")
+            if self.batchNthreads=="all":
+                self.batchNthreads=self.config.getVal("ncpu",default=1)
+            self.batchList=None#indices into thisObjList of the batched directions
+            self.batchIndex={}
             #self.niters=0
             self.outputData=numpy.zeros((self.npup,self.npup),self.outDataType)#resource sharing
             #self.scrnXPxls=self.config.getVal("scrnXPxls")#will depend on which screen it is, so this is no good!
@@ -237,6 +255,21 @@ class iatmos(base.aobase.aobase):
         self.doneFinalInit=1
         for this in self.thisObjList:
             this.atmosObj.initMem()#self.outputData)#,self.interpPhs)
+        if self.batchDirections and len(self.thisObjList)>1:
+            if not hasattr(cmod.iscrn,"rotShiftWrapSplineImageMany"):
+                print "WARNING - iatmos: cmod.iscrn.rotShiftWrapSplineImageMany not found (rebuild cmod) - not batching directions"
+            else:
+                self.batchList=[]
+                for i in range(len(self.thisObjList)):
+                    if not self.thisObjList[i].atmosObj.computeUplinkTT:
+                        self.batchIndex[i]=len(self.batchList)
+                        self.batchList.append(i)
+                if len(self.batchList)>1:
+                    self.batchPhs=numpy.zeros((len(self.batchList),self.npup,self.npup),self.outDataType)
+                    print "INFORMATION iatmos: Computing %d of %d directions together"%(len(self.batchList),len(self.thisObjList))
+                else:
+                    self.batchList=None
+                    self.batchIndex={}
 
     def generateNext(self,msg=None):
         """
@@ -281,7 +314,12 @@ class iatmos(base.aobase.aobase):
                     if self.control["cal_source"]:#calibration source
                         self.outputData[:,]=0.
                     else:
-                        self.thisObjList[self.currentIdObjCnt].atmosObj.createPupilPhs(self.interpPosRow,self.insertPos,self.control)
+                        if self.batchList is not None and self.currentIdObjCnt==0:
+                            self.createBatchPhs()
+                        if self.batchIndex.has_key(self.currentIdObjCnt):
+                            self.outputData[:]=self.batchPhs[self.batchIndex[self.currentIdObjCnt]]
+                        else:
+                            self.thisObjList[self.currentIdObjCnt].atmosObj.createPupilPhs(self.interpPosRow,self.insertPos,self.control)
                         if self.control["profilePhase"]:#compute phase covariance and profile.  This won't work if resource sharing.
                             #But doesn't matter, because its only really for testing anyway.
                             self.zernikeVariance(self.outputData,forDisplay=0)
@@ -297,6 +335,11 @@ class iatmos(base.aobase.aobase):
         self.generateNextTime=time.time()-t1
 
 
+    def createBatchPhs(self):
+        """Compute the pupil phase for all the batched directions, into batchPhs."""
+        atmosList=[self.thisObjList[i].atmosObj for i in self.batchList]
+        util.atmos.createPupilPhsBatch(atmosList,[atm.positionDict for atm in atmosList],self.interpPosRow,self.insertPos,self.control,self.batchPhs,self.batchNthreads)
+
     def makeLayers(self):
         for pkey in self.parent.keys():#for each atmosphere layer...
             if self.directPhaseScreen and hasattr(self.parent[pkey],"thisObjDict"):
@@ -60,6 +60,7 @@ import base.aobase,base.dataType,util.getNewCols#,cmod.utils
 ##for debug : plotting package
 import time
 import os
+import threading,Queue
 #import gist
 import traceback
 ##Numeric Python import
@@ -82,6 +83,8 @@ import scipy.linalg as LA
 ##import the matrix vector function (BLAS)
 #import util.matrix as matrix
 import util.FITS
+import util.matrixCache
+import util.screenArchive
 import cmod.iscrn
 
 ## for fast MVM:
@@ -150,6 +153,57 @@ Arguments
 
     ##we return the grid
     return f
+def initialScreenParams(config,idstr=None):
+    """Return a dict of the arguments to makeInitialScreen for layer idstr,
+    taken from config.  Used by computeInitialScreen, and by util/sweep.py to
+    find which simulations share the same initial screens.
+    """
+    so=config.searchOrder
+    if idstr!=None:
+        searchOrder=["iscrn_"+idstr,"iscrn","globals"]
+    else:
+        searchOrder=["iscrn","globals"]
+    config.setSearchOrder(searchOrder)
+    atmosGeom=config.getVal("atmosGeom",default=None,raiseerror=1)
+    params={"Dtel":config.getVal("telDiam"),#diameter in m.
+            "dpix":config.getVal("npup"),#diameter in pixels.
+            "windDirection":atmosGeom.layerWind(idstr),
+            "scrnXPxls":atmosGeom.getScrnXPxls(idstr,rotateDirections=1),
+            "scrnYPxls":atmosGeom.getScrnYPxls(idstr,rotateDirections=1),
+            "seed":atmosGeom.layerInitSeed(idstr),
+            "strLayer":atmosGeom.layerStrength(idstr),
+            "vWind":atmosGeom.layerSpeed(idstr),
+            "globR0":atmosGeom.r0,
+            "L0":atmosGeom.l0,
+            "tstep":config.getVal("tstep"),
+            "scrnDir":config.getVal("scrnDir",default="scrn"),
+            "natype":"d",#config.getVal("dataType")
+            "idstr":idstr}
+    config.setSearchOrder(so)
+    return params
+
+def initialScreenKey(params):
+    """Return the screenCacheDir key for an initial screen, or None if it
+    cannot be cached (a random seed).
+    @param params: From initialScreenParams
+    @type params: Dict
+    """
+    if params["seed"]==None:
+        return None
+    p=params.copy()
+    del(p["scrnDir"])
+    del(p["idstr"])
+    return util.matrixCache.makeKey("iscrn",p)
+
+def screenArchiveInfo(config,idstr):
+    """Return the screenArchive mode (None, "record" or "replay") and the
+    archive filename for layer idstr, using the current search order."""
+    mode=config.getVal("screenArchive",default=None,raiseerror=0)
+    if mode not in [None,"record","replay"]:
+        raise Exception("screenArchive should be None, record or replay, not %s"%str(mode))
+    archiveDir=config.getVal("screenArchiveDir",default="scrnArchive")
+    return mode,os.path.join(archiveDir,"iscrn_%s.scrn"%str(idstr))
+
 def computeInitialScreen(config,idstr=None):
     """computes the initial phase screen with FFT technique.
     This is not part of the class, so that it can be called by infAtmos also,
@@ -160,31 +214,37 @@ def computeInitialScreen(config,idstr=None):
     and is at either start or end, depending on wind direction.
     Also, not square - rectangular instead.
 
+    If screenCacheDir is set, screens are stored there (e.g. in /dev/shm),
+    and simulations sharing it (e.g. a parameter sweep) only generate each
+    screen once.
     """
     ##we first compute the physical size of the array required to perform the FFT
+    params=initialScreenParams(config,idstr)
     so=config.searchOrder
     if idstr!=None:
-        searchOrder=["iscrn_"+idstr,"iscrn","globals"]
+        config.setSearchOrder(["iscrn_"+idstr,"iscrn","globals"])
     else:
-        searchOrder=["iscrn","globals"]
-    config.setSearchOrder(searchOrder)
-    Dtel=config.getVal("telDiam")#diameter in m.
-    dpix=config.getVal("npup")#diameter in pixels.
-    atmosGeom=config.getVal("atmosGeom",default=None,raiseerror=1)
-    windDirection=atmosGeom.layerWind(idstr)
-    scrnXPxls=atmosGeom.getScrnXPxls(idstr,rotateDirections=1)
-    scrnYPxls=atmosGeom.getScrnYPxls(idstr,rotateDirections=1)
-    seed=atmosGeom.layerInitSeed(idstr)
-    strLayer=atmosGeom.layerStrength(idstr)
-    vWind=atmosGeom.layerSpeed(idstr)
-    globR0=atmosGeom.r0
-    L0=atmosGeom.l0
-    tstep=config.getVal("tstep")
-    scrnDir=config.getVal("scrnDir",default="scrn")
-    natype="d"#config.getVal("dataType")
-    phaseArray=makeInitialScreen(dpix,Dtel,L0,scrnXPxls,scrnYPxls,seed,tstep,globR0,strLayer,natype,windDirection,vWind,scrnDir=scrnDir,idstr=idstr)
-    ##we return the array corresponding to the pupil
+        config.setSearchOrder(["iscrn","globals"])
+    screenCacheDir=config.getVal("screenCacheDir",default=None,raiseerror=0)
+    screenCacheSize=config.getVal("screenCacheSize",default=10*1024**3)
+    archiveMode,archiveFile=screenArchiveInfo(config,idstr)
     config.setSearchOrder(so)
+    if archiveMode=="replay":
+        print "Using initial screen from archive %s"%archiveFile
+        return numpy.array(util.screenArchive.screenArchive(archiveFile,"r").screen)
+    key=None
+    if screenCacheDir!=None:
+        key=initialScreenKey(params)
+    if key!=None:
+        cache=util.matrixCache.matrixCache(screenCacheDir,screenCacheSize)
+        phaseArray=cache.getOrLock(key)
+        if phaseArray is not None:
+            print "Using cached screen %s for %s"%(key,str(idstr))
+            return numpy.array(phaseArray)#the screen evolves, so a writable copy is needed.
+    phaseArray=makeInitialScreen(**params)
+    if key!=None:
+        cache.put(key,phaseArray)
+    ##we return the array corresponding to the pupil
     return phaseArray
 
 def makeScrnQuick(npup,telDiam,l0=30.,r0=0.2,seed=0,scrnDir="scrn"):
@@ -312,6 +372,10 @@ class iscrn(base.aobase.aobase):
     The created phase screen is rectuangular.
     """
 	
+    #state saved when checkpointing (the cmod state is added in getState):
+    checkpointAttrs=["outputData","dataValid","niter","batchBlock","batchIter","batchRand"]
+    checkpointThisAttrs=["screen","insertPos","ystep","newRows","noisePos"]
+
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         """config is an readConfig.AOXml object loaded with the correct
         configuration file"""
@@ -392,44 +456,55 @@ class iscrn(base.aobase.aobase):
             scrnDir=config.getVal("scrnDir",default="scrn")
             if not os.path.exists(scrnDir):
                 os.makedirs(scrnDir)
-            ##we go now through the creation of the required matrices
-            ##we compute first the phase covariance matrices
-            for id in self.layerList:
-                this=self.thisObjDict[id]
-                fname=os.path.join(scrnDir,"iscrnData%d_%g_%g.fits"%(this.scrnXPxls,self.L0,self.pixScale))
-                covMatPhix=None
-                if os.path.exists(fname):
-                    print "Loading phase covariance data"
-                    try:
-                        data=util.FITS.Read(fname)
-                        covMatPhix=data[1]
-                        this.Ax=data[3]
-                        this.Bx=data[5]
-                        this.AStartx=data[7]
-                    except:
-                        print "Unable to load covariance data... generating"
-                        traceback.print_exc()
-                        covMatPhix=None
-                if covMatPhix is None:
-                    print "Computation of the X phase covariance matrix"
-                    covMatPhix=self.computePhaseCovarianceMatrix(this.scrnXPxls,self.L0,self.pixScale,self.nbColToAdd,self.nbCol)
-                    print "Computation of the Ax and Bx matrixes"        
-                    this.Ax,this.Bx,this.AStartx=self.computeAandBmatrices(this.scrnXPxls,covMatPhix,self.nbColToAdd,self.nbCol)##we compute the A and B matrices
-                    try:
-                        util.FITS.Write(covMatPhix,fname)
-                        util.FITS.Write(this.Ax,fname,writeMode="a")
-                        util.FITS.Write(this.Bx,fname,writeMode="a")
-                        util.FITS.Write(this.AStartx,fname,writeMode="a")
-                    except:
-                        print "Failed to write covariance matrices - disk full?  Continuing anyway..."
+            self.archiveMode=screenArchiveInfo(config,self.idstr[0])[0]
+            if self.archiveMode=="replay":
+                #Screens come from the archive, so the generator isn't needed.
+                for id in self.layerList:
+                    this=self.thisObjDict[id]
+                    mode,fname=screenArchiveInfo(config,id)
+                    print "iscrn: Replaying phase screen from %s"%fname
+                    this.archive=util.screenArchive.screenArchive(fname,"r")
+                    self.checkArchiveHeader(this,id)
+                    this.screen=numpy.array(this.archive.screen)
+            else:
+                ##we go now through the creation of the required matrices
+                ##we compute first the phase covariance matrices
+                for id in self.layerList:
+                    this=self.thisObjDict[id]
+                    fname=os.path.join(scrnDir,"iscrnData%d_%g_%g.fits"%(this.scrnXPxls,self.L0,self.pixScale))
+                    covMatPhix=None
+                    if os.path.exists(fname):
+                        print "Loading phase covariance data"
+                        try:
+                            data=util.FITS.Read(fname)
+                            covMatPhix=data[1]
+                            this.Ax=data[3]
+                            this.Bx=data[5]
+                            this.AStartx=data[7]
+                        except:
+                            print "Unable to load covariance data... generating"
+                            traceback.print_exc()
+                            covMatPhix=None
+                    if covMatPhix is None:
+                        print "Computation of the X phase covariance matrix"
+                        covMatPhix=self.computePhaseCovarianceMatrix(this.scrnXPxls,self.L0,self.pixScale,self.nbColToAdd,self.nbCol)
+                        print "Computation of the Ax and Bx matrixes"        
+                        this.Ax,this.Bx,this.AStartx=self.computeAandBmatrices(this.scrnXPxls,covMatPhix,self.nbColToAdd,self.nbCol)##we compute the A and B matrices
+                        try:
+                            util.FITS.Write(covMatPhix,fname)
+                            util.FITS.Write(this.Ax,fname,writeMode="a")
+                            util.FITS.Write(this.Bx,fname,writeMode="a")
+                            util.FITS.Write(this.AStartx,fname,writeMode="a")
+                        except:
+                            print "Failed to write covariance matrices - disk full?  Continuing anyway..."
+                        else:
+                            print "Saved %s with shape %s %s %s %s, dtype %s %s %s %s"%(fname,str(covMatPhix.shape),str(this.Ax.shape),str(this.Bx.shape),str(this.AStartx.shape),covMatPhix.dtype.char,this.Ax.dtype.char,this.Bx.dtype.char,this.AStartx.dtype.char)
+                    if self.keepCovMat:
+                        this.covMatPhix=covMatPhix
                     else:
-                        print "Saved %s with shape %s %s %s %s, dtype %s %s %s %s"%(fname,str(covMatPhix.shape),str(this.Ax.shape),str(this.Bx.shape),str(this.AStartx.shape),covMatPhix.dtype.char,this.Ax.dtype.char,this.Bx.dtype.char,this.AStartx.dtype.char)
-                if self.keepCovMat:
-                    this.covMatPhix=covMatPhix
-                else:
-                    del(covMatPhix)
-                print "Computation of the initial phase screen"
-                this.screen=computeInitialScreen(self.config,id)
+                        del(covMatPhix)
+                    print "Computation of the initial phase screen"
+                    this.screen=computeInitialScreen(self.config,id)
 
 
             ##we compute the initial phase screen
@@ -459,7 +534,12 @@ class iscrn(base.aobase.aobase):
                     tmp[:]=this.screen#copy the phase screen into the output array.
                     this.screen=tmp
                     pos+=this.scrnXPxls*this.scrnYPxls
-            if self.useCmodule:
+            if self.archiveMode=="replay":
+                self.batchIters=0
+                self.batchBlock=None
+                self.batchIter=0
+                self.prefetchThread=None
+            elif self.useCmodule:
                 nthreads=config.getVal("nthreads",default="all")
                 if nthreads=="all":
                     nthreads=config.getVal("ncpu")
@@ -473,14 +553,170 @@ class iscrn(base.aobase.aobase):
                         seed=0
                     #seed=0 if self.seed==None else self.seed
                     this.cmodInfo=cmod.iscrn.initialise(nthreads,this.r0,self.L0,this.scrnXPxls,this.scrnYPxls,self.sendWholeScreen,this.maxRowAdd,this.rowAdd,seed,this.screen,this.Ax,this.Bx,this.AStartx,this.ystep,this.randarr,this.rowOutput)
+            else:
+                #Python version.  Contiguous copies of the parts of Ax that
+                #multiply each previous row, so that the cmod dot can be used.
+                for id in self.layerList:
+                    this=self.thisObjDict[id]
+                    this.AxList=[]
+                    for i in range(self.nbCol):
+                        this.AxList.append(numpy.ascontiguousarray(this.Ax[:,i*this.scrnXPxls:(i+1)*this.scrnXPxls]))
+                #Batched generation of the random part of new rows.  The
+                #B.randn term doesn't depend on the screen, so can be
+                #computed for batchIters iterations (all layers) at once, as
+                #matrix-matrix products, and optionally in a background thread.
+                self.batchIters=config.getVal("iscrnBatchIters",default=0)
+                self.prefetch=config.getVal("iscrnPrefetch",default=0)
+                self.batchBlock=None
+                self.batchIter=0
+                self.prefetchThread=None
+                if self.batchIters>0:
+                    self.batchRand=ra.RandomState(self.seed)
+                    if self.prefetch>0:
+                        self.prefetchGo=1
+                        self.prefetchQueue=Queue.Queue(self.prefetch)
+                        self.prefetchThread=threading.Thread(target=self.prefetchWorker)
+                        self.prefetchThread.daemon=True
+                        self.prefetchThread.start()
+            if self.archiveMode=="record":
+                for id in self.layerList:
+                    this=self.thisObjDict[id]
+                    mode,fname=screenArchiveInfo(config,id)
+                    print "iscrn: Recording phase screen to %s"%fname
+                    this.archive=util.screenArchive.screenArchive(fname,"w",header=self.archiveHeader(this,id),screen=this.screen,maxRowAdd=this.maxRowAdd)
 
     def __del__(self):
+        self.stopPrefetch()
         for id in self.layerList:
             this=self.thisObjDict[id]
             if hasattr(this,"cmodInfo") and this.cmodInfo is not None:
                 cmod.iscrn.free(this.cmodInfo)
             this.cmodInfo=None
+            if getattr(this,"archive",None) is not None:
+                this.archive.close()
+                this.archive=None
         
+    def endSim(self):
+        self.stopPrefetch()
+        for id in self.layerList:
+            if getattr(self.thisObjDict[id],"archive",None) is not None:
+                self.thisObjDict[id].archive.flush()
+
+    def archiveHeader(self,this,id):
+        """The layer parameters and seeds stored in a screen archive, which
+        must match when replaying."""
+        seed=this.seed
+        if seed is not None:
+            seed=int(seed)
+        rowSeed=self.seed
+        if rowSeed is not None:
+            rowSeed=int(rowSeed)
+        return {"layer":str(id),"scrnXPxls":int(this.scrnXPxls),"scrnYPxls":int(this.scrnYPxls),
+                "rowAdd":float(this.rowAdd),"seed":seed,"rowSeed":rowSeed,"strLayer":float(this.strLayer),
+                "windDirection":float(this.windDirection),"vWind":float(this.vWind),
+                "r0":float(self.atmosGeom.r0),"L0":float(self.L0),"tstep":float(self.tstep),
+                "pixScale":float(self.pixScale),"r0Function":self.r0Fun is not None,
+                "stepFunction":this.stepFun is not None,"useCmodule":self.useCmodule}
+
+    def checkArchiveHeader(self,this,id):
+        """Check that a screen archive was recorded with the current layer parameters"""
+        hdr=self.archiveHeader(this,id)
+        del(hdr["useCmodule"])#doesn't matter.
+        for key in hdr.keys():
+            if this.archive.header.get(key)!=hdr[key]:
+                raise Exception("iscrn: Screen archive %s was recorded with %s=%s, but now %s"%(this.archive.filename,key,str(this.archive.header.get(key)),str(hdr[key])))
+        if this.archive.maxRowAdd!=this.maxRowAdd or tuple(this.archive.header["scrnShape"])!=(this.scrnYPxls,this.scrnXPxls):
+            raise Exception("iscrn: Screen archive %s has wrong shape"%this.archive.filename)
+
+    def getState(self):
+        """Checkpoint state, including the insert position and random state held by cmod."""
+        state=base.aobase.aobase.getState(self)
+        if self.useCmodule and self.archiveMode!="replay":
+            state["cmod"]={}
+            for id in self.layerList:
+                state["cmod"][id]=cmod.iscrn.getState(self.thisObjDict[id].cmodInfo)
+        return state
+
+    def setState(self,state):
+        base.aobase.aobase.setState(self,state)
+        if self.useCmodule and self.archiveMode!="replay":
+            for id,s in state.get("cmod",{}).items():
+                if self.thisObjDict.has_key(id):
+                    this=self.thisObjDict[id]
+                    cmod.iscrn.setState(this.cmodInfo,*s)
+                    this.insertPos=s[0]
+
+    def stopPrefetch(self):
+        """Stop the thread computing the random part of new rows"""
+        if getattr(self,"prefetchThread",None) is not None:
+            self.prefetchGo=0
+            try:
+                while 1:
+                    self.prefetchQueue.get_nowait()
+            except Queue.Empty:
+                pass
+            self.prefetchThread.join(1.)
+            self.prefetchThread=None
+
+    def makeNoiseBlock(self):
+        """Compute the random part (Bx.randn, without the r0 scaling) of
+        the new rows for the next batchIters iterations, for all layers.
+        The number of rows added each iteration is known in advance (from
+        getNewCols), so the random numbers for all layers are generated
+        in one call, and each layer then needs only one matrix-matrix
+        product.
+        @return: Number of rows to add (shape batchIters,nlayers), and a dict of the rows for each layer
+        @rtype: Tuple of (Array, Dict)
+        """
+        nlayer=len(self.layerList)
+        nadd=numpy.zeros((self.batchIters,nlayer),numpy.int32)
+        ntot=0
+        for j in range(nlayer):
+            this=self.thisObjDict[self.layerList[j]]
+            for i in range(self.batchIters):
+                nadd[i,j]=int(this.newRows.next()[1])
+            ntot+=int(nadd[:,j].sum())*this.scrnXPxls*self.nbColToAdd
+        rn=self.batchRand.standard_normal(ntot)
+        rows={}
+        pos=0
+        for j in range(nlayer):
+            id=self.layerList[j]
+            this=self.thisObjDict[id]
+            n=int(nadd[:,j].sum())
+            r=rn[pos:pos+n*this.scrnXPxls*self.nbColToAdd]
+            r.shape=n,this.scrnXPxls*self.nbColToAdd
+            pos+=r.size
+            rows[id]=numpy.dot(r,this.Bx.T)#row k is Bx.r[k]
+        return nadd,rows
+
+    def prefetchWorker(self):
+        while self.prefetchGo:
+            blk=self.makeNoiseBlock()
+            while self.prefetchGo:
+                try:
+                    self.prefetchQueue.put(blk,timeout=0.5)
+                except Queue.Full:
+                    continue
+                break
+
+    def nextNoiseIter(self):
+        """Get the number of rows to add for each layer for this iteration,
+        and the precomputed random parts, fetching a new block if needed.
+        @return: Number of rows for each layer, and dict of the rows for each layer.
+        @rtype: Tuple of (Array, Dict)
+        """
+        if self.batchBlock is None or self.batchIter>=self.batchIters:
+            if self.prefetchThread is not None:
+                self.batchBlock=self.prefetchQueue.get()
+            else:
+                self.batchBlock=self.makeNoiseBlock()
+            self.batchIter=0
+            for id in self.layerList:
+                self.thisObjDict[id].noisePos=0
+        nadd=self.batchBlock[0][self.batchIter]
+        self.batchIter+=1
+        return nadd,self.batchBlock[1]
+
     def computeR0(self):
         """Computes r0 as a function of time."""
         if self.r0Fun!=None:
@@ -598,8 +834,11 @@ class iscrn(base.aobase.aobase):
 
     ##The next functions are the functions used to add new rows at the end of the phase screen
 
-    def addNewRow(self,this,r0):
-        """Updates the phase screen by adding a new row to the end (actually, at the current update position) of the phase screen, overwriting whatever is there.        """
+    def addNewRow(self,this,r0,noise=None):
+        """Updates the phase screen by adding a new row to the end (actually, at the current update position) of the phase screen, overwriting whatever is there.
+        @param noise: The precomputed Bx.randn for this row (from makeNoiseBlock), or None to compute it here.
+        @type noise: Array
+        """
         if r0 is None:
             r0=this.r0
         dpix=this.scrnXPxls#agb: changed from dpix
@@ -612,9 +851,9 @@ class iscrn(base.aobase.aobase):
                 indx+=this.scrnYPxls
             oldPhi=this.screen[indx]
             if AZ is None:
-                AZ=matrixdot(this.Ax[:,i*this.scrnXPxls:(i+1)*this.scrnXPxls],oldPhi)
+                AZ=matrixdot(this.AxList[i],oldPhi)
             else:
-                AZ+=matrixdot(this.Ax[:,i*this.scrnXPxls:(i+1)*this.scrnXPxls],oldPhi)
+                AZ+=matrixdot(this.AxList[i],oldPhi)
 
         #oldPhi=self.screen[-self.nbCol:,:]
         ##we put it into a single vector
@@ -623,8 +862,11 @@ class iscrn(base.aobase.aobase):
         #AZ=matrixdot(self.Ax,Z2)
         ##creation of random variables with the good variances
         coeffTurb=(self.L0/r0)**(5./6)
-        rn=ra.randn(self.nbColToAdd*dpix)
-        rn=matrixdot(this.Bx,rn)*coeffTurb
+        if noise is None:
+            rn=ra.randn(self.nbColToAdd*dpix)
+            rn=matrixdot(this.Bx,rn)*coeffTurb
+        else:
+            rn=noise*coeffTurb
         rn+=AZ ##vector storing the values of the last column
         if type(this.ystep)==na.ndarray or this.ystep!=0.:
             rn+=this.ystep
@@ -644,6 +886,9 @@ class iscrn(base.aobase.aobase):
         """Updates the phase screen by adding new rows or columns
         as specified by the wind direction
         """
+        if self.archiveMode=="replay":
+            self.replayArchive()
+            return
         self.computeR0()
         if self.useCmodule:
             for id in self.layerList:
@@ -660,25 +905,50 @@ class iscrn(base.aobase.aobase):
                     this.ysteplast=this.ystep
                 this.insertPos=cmod.iscrn.run(this.cmodInfo)
         else:
-            for id in self.layerList:
+            if self.batchIters>0:
+                naddArr,noiseRows=self.nextNoiseIter()
+            for j in range(len(self.layerList)):
+                id=self.layerList[j]
                 this=self.thisObjDict[id]
                 if userr0 is None:
                     r0=this.r0
                 else:
                     r0=userr0
-                nrem,nadd,interppos=this.newRows.next()
-                nadd=int(nadd)
-                for i in range(nadd):
-                    self.addNewRow(this,r0)
+                if self.batchIters>0:
+                    nadd=int(naddArr[j])
+                    for i in range(nadd):
+                        self.addNewRow(this,r0,noiseRows[id][this.noisePos])
+                        this.noisePos+=1
+                else:
+                    nrem,nadd,interppos=this.newRows.next()
+                    nadd=int(nadd)
+                    for i in range(nadd):
+                        self.addNewRow(this,r0)
             self.prepareOutput()
+        if self.archiveMode=="record":
+            for id in self.layerList:
+                this=self.thisObjDict[id]
+                this.archive.write(self.niter-1,this.insertPos,this.screen[self.lastRows(this)])
+
+    def lastRows(self,this):
+        """Indices of the last maxRowAdd rows added to the screen"""
+        return numpy.arange(this.insertPos-this.maxRowAdd,this.insertPos)%this.scrnYPxls
+
+    def replayArchive(self):
+        """Update the screens from the archive, rather than generating"""
+        for id in self.layerList:
+            this=self.thisObjDict[id]
+            this.insertPos,rows=this.archive.read(self.niter-1)
+            this.screen[self.lastRows(this)]=rows
+        self.prepareOutput()
 
     def prepareOutput(self):
         """If not sending whole screen, copies the parts to be sent..."""
         if self.sendWholeScreen==0:
             for id in self.layerList:
                 this=self.thisObjDict[id]
-                for i in range(self.maxRowAdd):
-                    pos=this.insertPos-self.maxRowAdd+i
+                for i in range(this.maxRowAdd):
+                    pos=this.insertPos-this.maxRowAdd+i
                     if pos<0:
                         pos+=this.scrnYPxls#wrap.
                     this.rowOutput[i]=this.screen[pos]
@@ -741,6 +1011,10 @@ class iscrn(base.aobase.aobase):
         paramList.append(base.dataType.dataType(description="stepFunction",typ="eval",val="None",comment="For modelling phasesteps."))        
         paramList.append(base.dataType.dataType(description="r0Function",typ="eval",val="None",comment="R0 as a function of time."))        
         paramList.append(base.dataType.dataType(description="saveInfPhaseCovMatrix",typ="i",val="0",comment="Save the inf phase covariance matrix."))        
+        paramList.append(base.dataType.dataType(description="iscrnBatchIters",typ="i",val="0",comment="If useCmodule==0, number of iterations for which the random part of new rows is computed at once (0 to compute row by row)."))
+        paramList.append(base.dataType.dataType(description="iscrnPrefetch",typ="i",val="0",comment="If iscrnBatchIters>0, number of blocks of random rows to compute ahead in a background thread (0 for no thread)."))
+        paramList.append(base.dataType.dataType(description="screenArchive",typ="eval",val="None",comment="None, \"record\" to store the generated screens in screenArchiveDir, or \"replay\" to use screens stored previously, without running the generator."))
+        paramList.append(base.dataType.dataType(description="screenArchiveDir",typ="s",val="scrnArchive",comment="Directory for screen archives (one file per layer)."))
         paramList.append(base.dataType.dataType(description="atmosGeom",typ="code",val="import util.atmos;atmosGeom=util.atmos.geom(layerDict, sourceList,ntel,npup,telDiam)",comment="TODO: atmosGeom with arguments layerDict, sourceList,ntel,npup,telDiam.  layerDict is a dictionar with keys equal to the layer name (idstr used by iscrn object) and values equal to a tuple of (height, direction, speed, strength, initSeed), and sourceList is a list of ources equal to a tuple of (idstr (infAtmos), theta, phi, alt, nsubx or None)."))
 
         return paramList
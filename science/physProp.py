@@ -219,6 +219,12 @@ class PhysProp(base.aobase.aobase):
                 self.initialise(parent,idstr)
 
             self.vibration=self.config.getVal("vibration",raiseerror=0)#typically, a util.vibration.Vibration() instance
+            self.nthreads=self.config.getVal("physPropNthreads",default="all")#FFTW threads for the propagation.
+            if self.nthreads=="all":
+                self.nthreads=self.config.getVal("ncpu",default=1)
+            #If resource sharing, propagate all directions with the same wavelength together:
+            self.batchPropagation=self.config.getVal("batchPropagation",default=0)
+            self.batchGroups=None
 
     def newParent(self,parent,idstr=None):
         raise Exception("infAtmos - not yet able to accept new parent... (needs some extra coding)")
@@ -268,6 +274,17 @@ class PhysProp(base.aobase.aobase):
         self.doneFinalInit=1
         for this in self.thisObjList:
             this.atmosObj.initMem(self.outputData,self.interpPhs)
+        if self.batchPropagation and len(self.thisObjList)>1:
+            #group the directions that can share FFTs.
+            self.batchGroups=[]
+            for atmosList in util.atmos.groupPhysPropBatch([this.atmosObj for this in self.thisObjList]):
+                prop=util.atmos.fresnelPropagator(self.npup,len(atmosList),self.nthreads)
+                self.batchGroups.append((atmosList,prop))
+            print "INFORMATION physProp: Propagating %d directions in %d batches"%(len(self.thisObjList),len(self.batchGroups))
+        else:#resource sharers are computed in turn, so can share the buffers.
+            prop=util.atmos.fresnelPropagator(self.npup,1,self.nthreads)
+            for this in self.thisObjList:
+                this.atmosObj.propagator=prop
 
     def generateNext(self,msg=None):
         """
@@ -311,6 +328,11 @@ class PhysProp(base.aobase.aobase):
                     if self.control["cal_source"]:#calibration source
                         self.outputData[0]=0.#phase
                         self.outputData[1]=1.#amp
+                    elif self.batchGroups is not None:
+                        if self.currentIdObjCnt==0:#propagate all directions now.
+                            for atmosList,prop in self.batchGroups:
+                                util.atmos.doPhysPropBatch(atmosList,self.phaseScreens,self.interpPosCol,self.interpPosRow,prop)
+                        self.thisObjList[self.currentIdObjCnt].atmosObj.physPropOutput(self.control)
                     else:
                         self.thisObjList[self.currentIdObjCnt].atmosObj.doPhysProp(self.phaseScreens,self.interpPosCol,self.interpPosRow,self.control)
                         if self.control["profilePhase"]:#compute phase covariance and profile.  This won't work if resource sharing.
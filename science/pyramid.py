@@ -14,11 +14,16 @@
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import numpy
+import threading
 import util.FITS
 import base.aobase
+import cmod.fft
 class Pyramid(base.aobase.aobase):
     """
     pyramid wfs module.
+    Parameters pyrNthreads (default all) and pyrBatchSize (number of
+    modulation steps computed together, default to fit in 512MB) control
+    the image computation.
     """
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         if type(parent)!=type({}):
@@ -54,19 +59,45 @@ class Pyramid(base.aobase.aobase):
             self.nsteps=wfsobj.pyrSteps#probably want more steps than 8 for larger modulation amplitudes
             if self.nsteps==0:
                 self.nsteps=1
-            self.pupAmp=numpy.zeros((self.nfft,self.nfft),numpy.complex64)
-            self.tilt=numpy.zeros((self.nsteps,self.npup,self.npup),numpy.float32)
+            #The modulation tilts are separable (a*x+b*y), so are stored as
+            #x and y phasors, rather than as nsteps phase screens.
             tiltamp=0.5*self.npup/(self.nfft)*2*numpy.pi*wfsobj.pyrModAmp#this can be changed to change the modulation amplitude.
-            
-            xtiltfn=(numpy.fromfunction(lambda x,y:y,(self.npup,self.npup))-(self.npup-1)/2.)/self.npup
-            tiltfn=-0.5*self.npup/float(self.nfft)*2*numpy.pi*(xtiltfn+xtiltfn.T)#this tilt centres it on 2x2 pixels.
-            for i in range(self.nsteps):
-                #first tilt everything so that its centred on 2x2 pixels:
-                self.tilt[i]=tiltfn# (like we do with SHS images)
-                #and now add some rotating tilt.
-                if self.nsteps>1:
-                    theta=i*2*numpy.pi/float(self.nsteps)+2*numpy.pi/(2*self.nsteps)
-                    self.tilt[i]+=(tiltamp*xtiltfn*numpy.cos(theta)+tiltamp*xtiltfn.T*numpy.sin(theta))
+            a=numpy.zeros((self.nsteps,),numpy.float64)
+            a[:]=-0.5*self.npup/float(self.nfft)*2*numpy.pi#this tilt centres it on 2x2 pixels (like we do with SHS images).
+            b=a.copy()
+            if self.nsteps>1:#and now add some rotating tilt.
+                theta=numpy.arange(self.nsteps)*2*numpy.pi/float(self.nsteps)+2*numpy.pi/(2*self.nsteps)
+                a+=tiltamp*numpy.cos(theta)
+                b+=tiltamp*numpy.sin(theta)
+            x=(numpy.arange(self.npup)-(self.npup-1)/2.)/self.npup
+            self.tiltX=numpy.exp(1j*a[:,None]*x[None,:]).astype(numpy.complex64)
+            self.tiltY=numpy.exp(1j*b[:,None]*x[None,:]).astype(numpy.complex64)
+            self.pupPhasor=numpy.zeros((self.npup,self.npup),numpy.complex64)
+            self.nthreads=self.config.getVal("pyrNthreads",default="all")
+            if self.nthreads=="all":
+                self.nthreads=self.config.getVal("ncpu",default=1)
+            #Number of modulation steps FFTd together.  Requires 2*pyrBatchSize*nfft*nfft complex64.
+            self.batchSize=self.config.getVal("pyrBatchSize",default=0)
+            if self.batchSize<=0:#by default, use up to 512MB.
+                self.batchSize=max(1,2**29/(16*self.nfft*self.nfft))
+            self.batchSize=min(self.batchSize,self.nsteps)
+            self.pupAmp=numpy.zeros((self.batchSize,self.nfft,self.nfft),numpy.complex64)
+            self.focAmp=numpy.zeros((self.batchSize,self.nfft,self.nfft),numpy.complex64)
+            self.absImg=numpy.zeros((self.nfft,self.nfft),numpy.float32)
+            self.pyrAcc=numpy.zeros((self.nfft,self.nfft),numpy.float32)
+            self.fftPlans=None
+            if hasattr(cmod.fft,"PlanMany"):
+                #plans for the full batch, and the remainder (if any).  Forward
+                #transforms only - see calcPyrImg.  Note, planning destroys the arrays.
+                cmod.fft.InitialiseThreading(self.nthreads)
+                self.fftPlans={}
+                for n in set([self.batchSize,self.nsteps%self.batchSize]):
+                    if n>0:
+                        self.fftPlans[n]=(cmod.fft.PlanMany(self.pupAmp[:n],self.focAmp[:n],self.nthreads),
+                                          cmod.fft.PlanMany(self.focAmp[:n],self.focAmp[:n],self.nthreads))
+                self.pupAmp[:]=0
+            else:
+                print "WARNING pyramid: cmod.fft.PlanMany not available (rebuild cmod) - using numpy.fft"
             self.pyrImg=numpy.zeros((self.nfft,self.nfft),numpy.float32)
             #use pyrimg as temporary space to set up the pyramid phase tilt...
             s=self.nfft/2
@@ -89,23 +120,88 @@ class Pyramid(base.aobase.aobase):
 
             self.sentPlotsCnt=0
             
+    def __del__(self):
+        if getattr(self,"fftPlans",None) is not None:
+            for plans in self.fftPlans.values():
+                for plan in plans:
+                    cmod.fft.FreePlan(plan)
+            self.fftPlans=None
+
+    def parallel(self,fn,n):
+        """Split range(n) into nthreads contiguous blocks, and call fn(start,end)
+        for each, in separate threads.  Numpy releases the GIL for the large
+        array operations used here."""
+        nthr=min(self.nthreads,n)
+        if nthr<=1:
+            fn(0,n)
+            return
+        thrList=[]
+        for t in range(nthr):
+            thr=threading.Thread(target=fn,args=(t*n//nthr,(t+1)*n//nthr))
+            thr.start()
+            thrList.append(thr)
+        for thr in thrList:
+            thr.join()
+
     def calcPyrImg(self,phs):
         """Takes pupil plane, transports to focal plane (point of pyramid)
         scales for pixel scale, and then transports back to pupil plane.
+
+        The modulation steps are done batchSize at a time, with a batched
+        (threaded) FFT.  The return FFT is also a forward FFT, since
+        |ifft2(a)[n]|**2 == |fft2(a)[-n]|**2/N**2, so the index reversal
+        is applied once, to the summed image.
         """
-        self.pyrImg[:]=0
-        s=(self.nfft-self.npup)//2
-        for i in range(self.nsteps):
-            self.pupAmp.real[s:s+self.npup,s:s+self.npup]=self.pupil*numpy.cos(phs+self.tilt[i])
-            self.pupAmp.imag[s:s+self.npup,s:s+self.npup]=self.pupil*numpy.sin(phs+self.tilt[i])
+        npup=self.npup
+        nfft=self.nfft
+        s=(nfft-npup)//2
+        self.pupPhasor.real=self.pupil*numpy.cos(phs)
+        self.pupPhasor.imag=self.pupil*numpy.sin(phs)
+        self.pyrAcc[:]=0
+        for step in range(0,self.nsteps,self.batchSize):
+            n=min(self.batchSize,self.nsteps-step)
+            def fill(start,end):
+                for j in range(start,end):
+                    amp=self.pupAmp[j]
+                    amp[:s]=0#fft may destroy the input
+                    amp[s+npup:]=0
+                    amp[s:s+npup,:s]=0
+                    amp[s:s+npup,s+npup:]=0
+                    out=amp[s:s+npup,s:s+npup]
+                    numpy.multiply(self.pupPhasor,self.tiltY[step+j,:,None],out)
+                    out*=self.tiltX[step+j]
+            self.parallel(fill,n)
             #go to the focus
-            self.focAmp=(numpy.fft.fft2(self.pupAmp))
-            #multiply by pyramid phase mask (shape of pyramid)
-            self.focAmp*=self.pyrPhaseMask
-            #and now transport back to pupil plane and detect
-            pupilPlane=numpy.fft.ifft2(self.focAmp)
-            self.pyrImg[:]+=numpy.abs(pupilPlane)**2
-
+            if self.fftPlans is not None:
+                cmod.fft.ExecutePlan(self.fftPlans[n][0])
+            else:
+                self.focAmp[:n]=numpy.fft.fft2(self.pupAmp[:n])
+            #multiply by pyramid phase mask (shape of pyramid), in blocks of rows.
+            def mask(start,end):
+                self.focAmp[:n,start:end]*=self.pyrPhaseMask[start:end]
+            self.parallel(mask,nfft)
+            #and now transport back to pupil plane
+            if self.fftPlans is not None:
+                cmod.fft.ExecutePlan(self.fftPlans[n][1])
+            else:
+                self.focAmp[:n]=numpy.fft.fft2(self.focAmp[:n])
+            #and detect.
+            def detect(start,end):
+                tmp=self.absImg[start:end]
+                acc=self.pyrAcc[start:end]
+                for j in range(n):
+                    numpy.absolute(self.focAmp[j,start:end],tmp)
+                    tmp*=tmp
+                    acc+=tmp
+            self.parallel(detect,nfft)
+        #index reversal, pyrImg[n]=pyrAcc[-n], and normalisation.
+        acc=self.pyrAcc
+        img=self.pyrImg
+        img[0,0]=acc[0,0]
+        img[0,1:]=acc[0,:0:-1]
+        img[1:,0]=acc[:0:-1,0]
+        img[1:,1:]=acc[:0:-1,:0:-1]
+        img*=1./(float(nfft)*nfft)**2
         return self.pyrImg
 
     def binPyr(self):#bin down onto the detector
@@ -77,6 +77,12 @@ def phi2psf(phi,pup):
 
 
 class science(aobase.aobase):
+    #state saved when checkpointing - the long exposure accumulators:
+    checkpointThisAttrs=["sciObj.longExpImg","sciObj.n_integn","sciObj.isamp","sciObj.psfSamp","sciObj.phaseRMSsum",
+                         "sciObj.phaseRMSsum2","sciObj.phaseRMScnt","sciObj.clippedEnergy","sciObj.dictScience",
+                         "sciObj.history","sciObj.historyKeys","sciObj.historyCnt","sciObj.luckyImg","sciObj.luckyRms",
+                         "sciObj.luckyCnt","sciObj.luckyDict","sciObj.luckyHistory","sciObj.luckyHistoryKeys","sciObj.luckyHistoryCnt"]
+
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         """Create a science object which collects info such as psf, strehl etc.
         There are two parameters, science_integrate and zero_science which
@@ -119,6 +125,11 @@ class science(aobase.aobase):
         if self.nthreads=="all":#use all available CPUs...
             self.nthreads=self.config.getVal("ncpu")#getCpus()
             print "science: Using %d threads"%self.nthreads
+        #Compute the PSFs of all science objects with the same npup, nfft,
+        #nimg and phase type together, using batched FFTs.
+        self.scienceBatch=self.config.getVal("scienceBatch",default=0)
+        self.scienceBatchThreads=self.config.getVal("scienceBatchThreads",default=self.nthreads)
+        self.sciBatchList=[]
 
         for i in xrange(len(self.idstr)):
             idstr=self.idstr[i]
@@ -129,6 +140,7 @@ class science(aobase.aobase):
     def initialise(self,parent,idstr):
         this=aobase.resourceSharer(parent,self.config,idstr,self.moduleName)
         self.thisObjList.append(this)
+        this.sciBatch=None
         tstep=this.config.getVal("tstep")
         if self.sciOverview==None:
             apt=this.config.getVal("atmosPhaseType",default="phaseonly")
@@ -341,6 +353,23 @@ class science(aobase.aobase):
             else:
                 this.sciObj.instImgView=this.sciObj.instImg
             #this.sciObj.longExpPSFView=this.sciObj.longExpPSF[f:t,f:t]
+        if self.scienceBatch:
+            groups={}
+            glist=[]
+            for this in self.thisObjList:
+                so=this.sciObj
+                key=(so.npup,so.nfft,so.nimg,so.atmosPhaseType)
+                if not groups.has_key(key):
+                    groups[key]=[]
+                    glist.append(key)
+                groups[key].append(this)
+            for key in glist:
+                if len(groups[key])>1:
+                    batch=util.sci.scienceBatch([this.sciObj for this in groups[key]],self.scienceBatchThreads)
+                    self.sciBatchList.append(batch)
+                    for this in groups[key]:
+                        this.sciBatch=batch
+                    print "INFORMATION science: Computing %d PSFs together (npup %d, nfft %d, nimg %d)"%(len(groups[key]),key[0],key[1],key[2])
 
 
 
@@ -603,13 +632,15 @@ class science(aobase.aobase):
                     print "INFORMATION: Science: waiting for data from DM, but not valid"
                     self.dataValid=0
             if self.dataValid:
-                self.sciObj.doScienceCalc(self.inputData,self.control,self.thisiter)
+                self.sciObj.doScienceCalc(self.inputData,self.control,self.thisiter,batch=self.sciBatch)
         else:
             self.dataValid=0
         if self.debug!=None:
             print "Science: done generateNext() (debug=%s)"%str(self.debug)
         self.generateNextTime=time.time()-t1
         if self.currentIdObjCnt==len(self.idstr)-1:
+            for batch in self.sciBatchList:#all phases now available.
+                batch.run()
             self.thisiter+=1
             if self.control["zero_science"]>0:
                 self.control["zero_science"]-=1
@@ -700,6 +731,8 @@ else:
         paramList.append(base.dataType.dataType(description="scinSamp",typ="i",val="20",comment="Create science image parameters every this many iterations that a science image is created (ie this times sciPSFSamp)."))
         paramList.append(base.dataType.dataType(description="sciPSFSamp",typ="i",val="1",comment="Create science image every this many iterations."))
         paramList.append(base.dataType.dataType(description="hist_list_size",typ="i",val="100",comment="number of history elements to store"))
+        paramList.append(base.dataType.dataType(description="scienceBatch",typ="i",val="0",comment="Compute PSFs of science objects (in this module) sharing npup/nfft/nimg together using batched FFTs."))
+        paramList.append(base.dataType.dataType(description="scienceBatchThreads",typ="eval",val="this.globals.ncpu",comment="Number of threads for batched science PSFs."))
         return paramList
 
 
@@ -24,6 +24,8 @@ import util.FITS
 import util.blockMatrix
 import util.zernikeMod
 import util.regularisation
+import util.matrixCache
+import util.compactMatrix
 #import cmod.svd #removed from dasp because probably depreciated.
 import cmod.utils
 #import util.dot as quick
@@ -37,6 +39,10 @@ import scipy.sparse,scipy.linalg
 import util.spmatrix
 import time,types
 #import Scientific.MPI
+
+#reconTypes for which poke and control matrices can be cached (see reconCacheDir).
+cacheableReconTypes=["svd","MAP","pinv","reg","regBig","regSmall","regularised"]
+
 class recon(base.aobase.aobase):
     """A reconstructor for tomographic reconstruction.
     Sends actuator values for model DMs to the children.
@@ -53,6 +59,9 @@ class recon(base.aobase.aobase):
     able to handle the EAGLE case.
     """
     
+    #state saved when checkpointing (outputData is the integrator):
+    checkpointAttrs=["outputData","dataValid","dmCommandMulti","sumcent","noiseCovCount","mapSolverObj.y0"]
+
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         global util
         if type(parent)!=type({}):
@@ -191,6 +200,7 @@ class recon(base.aobase.aobase):
                     print("WARNING: Unable to read polc matrix %s - will cause problems if the loop is closed (but okay if just poking)"%self.globalPolc)
             self.poke=0
             self.poking=0
+            self.mapSolverObj=None#used for reconType MAP with mapSolver cg.
 
             self.control={"poke":0,"close_dm":1,"zero_dm":0,"noiseCovariance":0,"phaseCovariance":0,
                           "takeRef":0,"subtractRef":1}
@@ -290,9 +300,40 @@ class recon(base.aobase.aobase):
                 #we don't know how the modes are separated out, so just assume an equal number for each dm.
                 self.npokesList=[self.npokes//len(self.dmList)]*len(self.dmList)
                 self.npokesList[-1]+=self.npokes-sum(self.npokesList)
+            self.pokeType=self.config.getVal("pokeType",default="single")#"single" to poke actuators one at a
+            # time (or pokeSpacing groups), or "hadamard" or "random" to poke all actuators at once with +/-
+            # patterns, with the poke matrix recovered by least squares once all patterns are done.
+            # With nPokePatterns less than the number of actuators (random only), each subap is decoded from
+            # the actuators within pokeSupportRadius actuator spacings of it, so that calibration takes
+            # fewer iterations than poking individually.
+            self.pokePatterns=None
+            self.pokeResponse=None
+            if self.pokeType!="single":
+                if self.dmModeType!="poke" or self.reconType not in ["svd","MAP","pinv","reg","regBig","regSmall","regularised","pcg"]:
+                    raise Exception("tomoRecon: pokeType %s requires dmModeType poke and a dense reconType"%self.pokeType)
+                for dm in self.dmList:
+                    if dm.pokeSpacing!=None:
+                        raise Exception("tomoRecon: pokeType %s cannot be used with pokeSpacing"%self.pokeType)
+                self.pokePatterns=util.createPokeMx.multiPokePatterns(self.nactsCumList[-1],self.pokeType,
+                                      self.config.getVal("nPokePatterns",default=None,raiseerror=0),
+                                      seed=self.config.getVal("pokeSeed",default=0))
+                self.npokes=self.pokePatterns.shape[0]+self.totalLowOrderModalModes
+                self.pokeSupportRadius=self.config.getVal("pokeSupportRadius",default=2.)
+                self.pokeDecodeReg=self.config.getVal("pokeDecodeReg",default=1e-4)
+                if self.pokePatterns.shape[0]<self.nactsCumList[-1]:
+                    nmax=self.computePokeSupport().sum(0).max()
+                    print("INFORMATION:**tomoRecon**:%d poke patterns for %d actuators, up to %d actuators per subap"%(self.pokePatterns.shape[0],self.nactsCumList[-1],nmax))
+                    if self.pokePatterns.shape[0]<3*nmax:
+                        print("WARNING:**tomoRecon**:nPokePatterns should be at least %d for a well conditioned decode"%(3*nmax))
             self.compressedBits=None#used if the rmx is compressed float format
             self.compressedShape=None
             self.compressedWork=None
+            #reconmxFormat can be None, or compressed, float16, bfloat16, int8 or int16, in which case the
+            #reconstructor is stored in this compact format, and a fused decompress/MVM is used.  See util.compactMatrix
+            self.reconmxFormat=self.config.getVal("reconmxFormat",default=None,raiseerror=0)
+            self.reconmxCompressBits=self.config.getVal("reconmxCompressBits",default=15)#mantissa bits for the compressed format
+            self.compactThreads=self.config.getVal("compactThreads",default=0)#0 for all CPUs.
+            self.compactRmx=None
 
             self.outputData=numpy.zeros((self.nacts,),numpy.float64)
             self.reconmxFunction=self.config.getVal("reconmxFunction",default=None,raiseerror=0)#a function that
@@ -471,6 +512,26 @@ class recon(base.aobase.aobase):
                 self.phaseCovFilename=self.config.getVal("phaseCovFilename",raiseerror=0)
                 self.noiseCovFilename=self.config.getVal("noiseCovFilename",raiseerror=0)
                 self.computePhaseCov=self.config.getVal("computePhaseCov",default=0)
+                self.phaseCovCache=None#stores the r0=1 covariance for each L0, so that r0 changes are cheap.
+                phaseCovCacheDir=self.config.getVal("phaseCovCacheDir",default=None,raiseerror=0)
+                if phaseCovCacheDir!=None:
+                    self.phaseCovCache=util.phaseCovariance.covarianceCache(phaseCovCacheDir,self.config.getVal("phaseCovCacheSize",default=10*1024**3),interpolate=self.config.getVal("phaseCovL0Interp",default=1),maxL0Ratio=self.config.getVal("phaseCovL0Ratio",default=1.5))
+                #mapSolver "dense" inverts dense covariance matrices.  "cg" uses a structured (BTTB)
+                #phase covariance and conjugate gradients, in bounded memory - see util.mapSolver.
+                self.mapSolver=self.config.getVal("mapSolver",default="dense")
+                if self.mapSolver not in ["dense","cg"]:
+                    raise Exception("tomoRecon: mapSolver must be dense or cg")
+                self.mapOutput=self.config.getVal("mapOutput",default="matrix")#matrix or solver (on the fly).
+                if self.mapOutput not in ["matrix","solver"]:
+                    raise Exception("tomoRecon: mapOutput must be matrix or solver")
+                self.mapCompressBits=self.config.getVal("mapCompressBits",default=None,raiseerror=0)
+                self.mapCGTol=self.config.getVal("mapCGTol",default=1e-6)
+                self.mapCGMaxiter=self.config.getVal("mapCGMaxiter",default=200)
+                self.mapSparseThreshold=self.config.getVal("mapSparseThreshold",default=1e-3)#poke matrix elements below this fraction of the maximum are dropped, keeping it sparse.
+                self.mapBlockSize=self.config.getVal("mapBlockSize",default=64)
+                if self.mapSolver=="cg" and self.computePhaseCov:
+                    print("INFORMATION:**tomoRecon**:mapSolver cg - not computing dense phase covariance")
+                    self.computePhaseCov=0
                 if self.phaseCovFilename!=None and os.path.exists(self.phaseCovFilename):
                     self.phaseCov=util.FITS.loadBlockMatrix(self.phaseCovFilename)
                     print(("WARNING:tomoRecon: Loading phaseCovariance from "+
@@ -494,7 +555,7 @@ class recon(base.aobase.aobase):
                     #compute the phase covariance
                     blockList=[]
                     for dm in self.dmList:
-                        blockList.append(dm.computePhaseCovariance(self.atmosGeom,self.pupil.r2,self.r0,self.l0,nthreads=self.nthreads,mirrorSurface=dm.getMirrorSurface(),width=-1))
+                        blockList.append(dm.computePhaseCovariance(self.atmosGeom,self.pupil.r2,self.r0,self.l0,nthreads=self.nthreads,mirrorSurface=dm.getMirrorSurface(),width=-1,phaseCovCache=self.phaseCovCache))
                     self.phaseCov=util.blockMatrix.BlockMatrix()
                     self.phaseCov.assign(blockList)
                     if self.phaseCovFilename!=None:
@@ -606,6 +667,15 @@ class recon(base.aobase.aobase):
                 self.computeMirrorScale()
             
             self.abortAfterPoke=self.config.getVal("abortAfterPoke",default=0)
+            self.reconCache=None#a cache of poke and control matrices, keyed by the parameters that create them.
+            self.pmxFromCache=0
+            self.reconCacheDir=self.config.getVal("reconCacheDir",default=None,raiseerror=0)
+            if self.reconCacheDir!=None:
+                if self.reconType in cacheableReconTypes:
+                    self.reconCache=util.matrixCache.matrixCache(self.reconCacheDir,self.config.getVal("reconCacheSize",default=10*1024**3))
+                    self.reconCacheLock=self.config.getVal("reconCacheLock",default=0)#if set, simulations sharing the cache wait for each other rather than computing the same matrices.
+                else:
+                    print("WARNING:**tomoRecon**:reconCacheDir not used for reconType %s"%self.reconType)
             self.inputData=numpy.zeros(self.ncents,numpy.float32)
             #if self.reconmxFilename==None or type(self.reconmx)==numpy.ndarray:
             #    self.inputData=numpy.zeros(self.ncents,numpy.float32)
@@ -782,6 +852,18 @@ class recon(base.aobase.aobase):
                     #self.spmx.savespace(1)
             else:
                 raise Exception("Unknown reconType %s for poking"%self.reconType)
+            if self.pokePatterns is not None:
+                self.pokeResponse=numpy.zeros((self.pokePatterns.shape[0],self.ncents),numpy.float32)
+            if self.reconCache is not None:
+                if self.reconCacheLock:
+                    pmx=self.reconCache.getOrLock(self.getCacheKey("pmx"))
+                else:
+                    pmx=self.reconCache.get(self.getCacheKey("pmx"))
+                if pmx is not None and pmx.shape==self.spmx.shape:
+                    print("INFORMATION:**tomoRecon**:Using cached poke matrix - not poking")
+                    self.spmx[:]=pmx
+                    self.pmxFromCache=1
+                    self.poking=self.npokes+1
             print("INFORMATION:**tomoRecon**:"+
                           "Will be poking for %d integrations"%(self.npokes+1))
         if self.control["zero_dm"]:
@@ -806,7 +888,13 @@ class recon(base.aobase.aobase):
             #set actuator(s) to be set.
             if self.dmModeType=="poke":
                 self.outputData[:,]=0.
-                if self.poking<=self.npokes-self.totalLowOrderModalModes:
+                if self.pokePatterns is not None and self.poking<=self.pokePatterns.shape[0]:
+                    #poke all actuators at once with the next +/- pattern.
+                    nz=self.nactsCumList[-1]
+                    self.outputData[:nz]=self.pokePatterns[self.poking-1]*self.pokeval
+                    if self.reconType=="MAP":
+                        self.outputData[:nz]/=self.mirrorScale[:nz]
+                elif self.poking<=self.npokes-self.totalLowOrderModalModes:
                     # find out which DM we're poking, and whether we're poking individually 
                     # or several actuators at once:
                     dm=self.dmList[self.pokingDMNo]
@@ -879,9 +967,23 @@ class recon(base.aobase.aobase):
                         self.pokingActNo=0
                         
 
-        if self.poking>1 and self.poking<=self.npokes+1:
+        if self.poking>1 and self.poking<=self.npokes+1 and not self.pmxFromCache:
             #then use the centroid values from previous poke to fill the poke matrix.
-            if self.poking<=self.npokes-self.totalLowOrderModalModes+1:
+            if self.pokePatterns is not None and self.poking<=self.pokePatterns.shape[0]+1:
+                #store the response to this pattern, and decode once all are done.
+                pokenumber=None
+                self.pokeResponse[self.poking-2]=self.inputData
+                if self.poking==self.pokePatterns.shape[0]+1:
+                    print("INFORMATION:**tomoRecon**:Decoding %d %s poke patterns"%(self.pokePatterns.shape[0],self.pokeType))
+                    nz=self.nactsCumList[-1]
+                    support=None
+                    if self.pokePatterns.shape[0]<nz:
+                        support=self.computePokeSupport()
+                    util.createPokeMx.decodeMultiPokes(self.pokePatterns,self.pokeResponse,self.pokeType,
+                                                       support,self.pokeDecodeReg,out=self.spmx[:nz])
+                    self.spmx[:nz]/=self.pokeval
+                    self.pokeResponse=None
+            elif self.poking<=self.npokes-self.totalLowOrderModalModes+1:
                 #find out which DM we've just poked, and whether it was poked individually 
                 # or several actuators at once:
                 dm=self.dmList[self.pokingDMNoLast]
@@ -976,9 +1078,25 @@ class recon(base.aobase.aobase):
                 #util.FITS.Write(self.spmx.data,self.pmxFilename,extraHeader="SHAPE = %s"%str(self.spmx.shape))
                 #util.FITS.Write(self.spmx.rowind,self.pmxFilename,writeMode="a")
                 #util.FITS.Write(self.spmx.indptr,self.pmxFilename,writeMode="a")
+            if self.reconCache is not None and not self.pmxFromCache:
+                self.reconCache.put(self.getCacheKey("pmx"),self.spmx)
 
             if self.computeControl:
-                if self.reconType=="spmx":
+                rmxKey=None
+                rmx=None
+                if self.reconCache is not None:
+                    rmxKey=self.getCacheKey("rmx",self.spmx)
+                    if self.reconCacheLock:
+                        rmx=self.reconCache.getOrLock(rmxKey)
+                    else:
+                        rmx=self.reconCache.get(rmxKey)
+                if rmx is not None:
+                    print("INFORMATION:**tomoRecon**:Using cached control matrix")
+                    self.reconmx=rmx
+                    rmxKey=None
+                    if self.reconmxFilename!=None:
+                        util.FITS.Write(self.reconmx,self.reconmxFilename)
+                elif self.reconType=="spmx":
                     print("INFORMATION:**tomoRecon**:"+
                           "Computing sparse control matrix")
                     self.spmx=self.spmx.tocsc()
@@ -1053,12 +1171,17 @@ class recon(base.aobase.aobase):
                 else:
                     if self.reconObj!=None and hasattr(self.reconObj,"computeControl"):
                         self.reconObj.computeControl(self.spmx)
+                if rmxKey is not None and type(self.reconmx)==numpy.ndarray and self.compressedBits==None:
+                    self.reconCache.put(rmxKey,self.reconmx)
+                elif rmxKey is not None:
+                    self.reconCache.unlock(rmxKey)
                     
             print(("INFORMATION:**tomoRecon**:Poking took: %gs in CPU time, "+
                   "or %g seconds")%(
                         (time.clock()-self.pokeStartClock),
                         (time.time()-self.pokeStartTime) ))
             self.poking=0
+            self.pmxFromCache=0
             if self.abortAfterPoke:
                 print("INFORMATION:**tomoRecon**:Finished poking - aborting "+
                      "simulation")
@@ -1079,10 +1202,14 @@ class recon(base.aobase.aobase):
         if type(self.reconmxFunction)!=type(None):
             #call a function which can change the reconstructor on a per-iteration basis:
             self.reconmx=self.reconmxFunction()
-        if self.reconType not in ["pcg","dicure","fewha"] and type(self.reconmx)==type(0.):
+        if self.reconType not in ["pcg","dicure","fewha"] and type(self.reconmx)==type(0.) and self.mapSolverObj is None:
             #if self.reconmxFilename!=None:
             #    print("INFORMATION:**tomoRecon**:Attempting to load reconmx %s"%self.reconmxFilename)
             self.reconmx=self.loadReconmx(self.reconmxFilename)
+        if self.reconmxFormat!=None and type(self.reconmx)==numpy.ndarray and len(self.reconmx.shape)==2:
+            print("INFORMATION:**tomoRecon**:Converting reconmx to %s format"%self.reconmxFormat)
+            self.compactRmx=util.compactMatrix.compactMatrix(self.reconmx,self.reconmxFormat,self.compactThreads,self.reconmxCompressBits)
+            self.reconmx=self.compactRmx
         #nsubx=self.wfs_nsubx
         #wfsdata=self.wfsdata
         data=self.inputData#numpy.zeros(wfsdata*2,numpy.Float)
@@ -1132,7 +1259,7 @@ class recon(base.aobase.aobase):
             # Solve for x using the LU decomposition:
             self.outputData[:,]+=-self.gainFactor*self.LUdecomp.solve(self.pTc)
         elif self.reconType in ["spmxSVD","spmxGI"]:#SVD reconstruction...
-            if self.compressedBits!=None:#reconmx is in compressed float format.
+            if self.compressedBits!=None or self.compactRmx is not None:#reconmx is in compressed float format.
                 tmp=-self.doCompressedDot(data)
                 if tmp.dtype!=self.outputData.dtype:
                     tmp=tmp.astype(self.outputData.dtype)
@@ -1189,7 +1316,7 @@ class recon(base.aobase.aobase):
                         self.outputData[self.nactsCumList[dmno]:self.nactsCumList[dmno+1]]+=self.\
                             modalGain[mode]*tmp[mode+self.nacts]*self.modalActuatorList[dmno][mode-dmoffset]
         elif self.reconType in ["svd","pinv","reg","regularised","regBig","regSmall"]:
-            if self.compressedBits!=None:#reconmx is in compressed float format.
+            if self.compressedBits!=None or self.compactRmx is not None:#reconmx is in compressed float format.
                 if self.multirate!=0:
                     raise Exception("multirate wfs not supported here in tomoRecon")
                 #tmp=-(self.gains*self.doCompressedDot(data))
@@ -1249,8 +1376,13 @@ class recon(base.aobase.aobase):
         elif self.reconType=="MAP":
             if self.multirate!=0:
                 raise Exception("multirate wfs not supported here in tomoRecon")
-            if self.compressedBits!=None:#reconmx is in compressed float format.
+            if self.compressedBits!=None or self.compactRmx is not None:#reconmx is in compressed float format.
                 tmp=-(self.gains*self.doCompressedDot(data))
+            elif self.mapSolverObj is not None and self.mapOutput=="solver":
+                tmp=self.mapSolverObj.reconstruct(data)
+                if self.dmModeType=="poke":
+                    tmp/=self.mirrorScale[:tmp.shape[0]]
+                tmp=-(self.gains*tmp)
             else:
                 tmp=-(self.gains*quick.dot(self.reconmx,data))#.astype(self.outputData.dtype)
             if tmp.dtype!=self.outputData.dtype:
@@ -1274,6 +1406,81 @@ class recon(base.aobase.aobase):
     # END of calc2()
 
 
+    def getCacheKey(self,name,pmx=None):
+        """Get the key used for the poke/control matrix cache.  This is a hash of
+        the parameters used to create the poke matrix, and for the control
+        matrix, also the poke matrix itself and the reconstruction parameters.
+        @param name: "pmx" or "rmx"
+        @type name: String
+        @param pmx: The poke matrix (for "rmx")
+        @type pmx: Array
+        @return: The key
+        @rtype: String
+        """
+        #Only the parameters that determine the matrices are hashed - not whole objects.
+        dmParams=[]
+        for d in range(len(self.dmList)):
+            dm=self.dmList[d]
+            infFunc=dm.infFunc
+            if infFunc is not None and type(infFunc)!=type(""):
+                infFunc=numpy.asarray(infFunc)
+            dmParams.append([dm.label,dm.height,dm.nact,dm.fov,dm.zonalDM,dm.actoffset,dm.actSpacing,dm.minarea,
+                             dm.maxActDist,dm.reconstructList,self.dmPupList[d],dm.interpType,dm.actCoupling,
+                             dm.actFlattening,infFunc,dm.slaving,dm.stuckActs,dm.alignmentOffset,dm.tiltAngle,
+                             dm.tiltTheta,dm.primaryTheta,dm.primaryPhi,dm.reconLam,dm.pokeSpacing])
+        wfsParams=[]
+        for gs in self.ngsList+self.lgsList:
+            wfsParams.append([gs.idstr,gs.nsubx,gs.theta,gs.phi,gs.alt,gs.sourcelam,gs.phslam,gs.phasesize,
+                              getattr(gs,"nimg",None),getattr(gs,"nfft",None),getattr(gs,"clipsize",None),
+                              getattr(gs,"ncen",None),getattr(gs,"preBinningFactor",None),gs.getSubapFlag(),
+                              getattr(gs,"launchDist",None),getattr(gs,"launchTheta",None),
+                              getattr(gs,"correlationCentroiding",None),getattr(gs,"centWeight",None),
+                              getattr(gs,"centroidPower",None)])
+        args=[name,self.idstr[0],dmParams,wfsParams,self.atmosGeom.telDiam,self.atmosGeom.npup,self.atmosGeom.zenith,
+              self.pupil.fn,self.reconType,self.dmModeType,self.pokeval,self.pokeType,self.nmodes,self.ncents]
+        if name=="rmx":
+            args+=[pmx,getattr(self,"rcond",None),getattr(self,"minEig",None)]
+            if self.reconType=="MAP":
+                blocks=lambda m:getattr(m,"blockList",m)#util.blockMatrix.BlockMatrix
+                args+=[blocks(self.phaseCov),blocks(self.noiseCov),self.influenceScalarProd,self.mirrorScale]
+                if self.mapSolver=="cg":
+                    args+=[self.mapSolver,self.mapCGTol,self.mapCGMaxiter,self.mapSparseThreshold]
+        return util.matrixCache.makeKey(*args)
+
+    def computePokeSupport(self):
+        """Compute which actuators can affect which subaps, for decoding fewer
+        multi-actuator poke patterns than actuators.  An actuator is taken to
+        affect a subap if within pokeSupportRadius actuator spacings of it
+        (plus half the subap diagonal), at the DM conjugate height.
+        @return: The support, shape (nacts, ncents/2), ordered as the poke matrix
+        @rtype: Array of bool
+        """
+        support=numpy.zeros((self.nactsCumList[-1],self.ncents/2),numpy.bool_)
+        gsList=self.ngsList+self.lgsList
+        for d in range(len(self.dmList)):
+            dm=self.dmList[d]
+            if dm.zonalDM==0:
+                raise Exception("tomoRecon: nPokePatterns less than nacts requires zonal DMs")
+            if not hasattr(dm,"coords"):
+                dm.computeCoords(self.telDiam)
+            actCoords=dm.coords[self.dmPupList[d]==1]
+            pitch=abs(dm.coords[0,1,0]-dm.coords[0,0,0])
+            cnt=0
+            for i in range(len(self.wfsIDList)):
+                gs=gsList[i]
+                gs.computeCoords(self.telDiam,dm.height)
+                ns=self.ncentList[i]
+                subCoords=gs.coords.reshape((gs.nsubx*gs.nsubx,2))[self.centIndex[cnt:cnt+ns]/2]
+                if gs.nsubx>1:
+                    subPitch=abs(gs.coords[0,1,0]-gs.coords[0,0,0])
+                else:
+                    subPitch=self.telDiam
+                radius=self.pokeSupportRadius*pitch+subPitch/numpy.sqrt(2.)
+                support[self.nactsCumList[d]:self.nactsCumList[d+1],cnt:cnt+ns]=\
+                    util.createPokeMx.multiPokeSupport(actCoords,subCoords,radius)
+                cnt+=ns
+        return support
+
     def fillPokemx(self,dm,dmindx):
         """Here, when we've been poking multiple actuators at once, we need to decide which centroids \
            belong to which actuator, and then place them into the poke matrix.
@@ -1356,7 +1563,15 @@ class recon(base.aobase.aobase):
 
     def doCompressedDot(self,data,rmx=None,bits=None,shape=None,work=None):
         """Here, rmx is a 1D array in compressed float format, with bits bits per element.
+        If the fused cmod.utils.compactMvm is available (or reconmxFormat is set), the multiply is done
+        without decompressing the matrix, using util.compactMatrix.
         """
+        if rmx is None and self.compactRmx is None and self.compressedBits!=None and hasattr(cmod.utils,"compactMvm"):
+            self.compactRmx=util.compactMatrix.fromCompressed(self.reconmx,self.compressedShape,self.compressedBits,
+                                                              self.compressedExpMin,self.compressedExpMax,self.compactThreads)
+        if rmx is None and self.compactRmx is not None:
+            #reconmx is (ncents,nacts) if its first dimension matches the slopes (as below), otherwise (nacts,ncents).
+            return self.compactRmx.dot(data,transpose=int(self.compactRmx.shape[0]==data.shape[0]))
         if rmx==None:
             rmx=self.reconmx
         if bits==None:
@@ -1433,19 +1648,32 @@ class recon(base.aobase.aobase):
         print("INFORMATION:**tomoRecon**:tomoRecon: Loading reconstructor "+
             "(%d,%d) from file: %s"%(self.nmodes,self.ncents,reconmxFilename))
         if os.path.exists(reconmxFilename):
-            head=util.FITS.ReadHeader(reconmxFilename)["parsed"]
+            #Lazy loading memory maps the matrix, so only the parts used are
+            #read.  FITS data are big endian, so a native byte order copy
+            #is kept in fitsCacheDir (if set) for next time.
+            lazy=self.config.getVal("reconmxLazyLoad",default=1)
+            cacheDir=self.config.getVal("fitsCacheDir",default=self.config.getVal("reconCacheDir",default=None,raiseerror=0),raiseerror=0)
+            if lazy:
+                f=util.FITS.ReadLazy(reconmxFilename,cacheDir=cacheDir)
+                head=f[0]["parsed"]
+            else:
+                head=util.FITS.ReadHeader(reconmxFilename)["parsed"]
             if head.has_key("COMPBITS"):
                 print("INFORMATION:**tomoRecon**:Reconstructor in compressed "+
                      "FP format")
                 #its a compressed floating point format rmx...
-                reconmx=util.FITS.Read(reconmxFilename)[1]
+                if lazy:
+                    reconmx=f[1]
+                else:
+                    reconmx=util.FITS.Read(reconmxFilename)[1]
                 self.compressedBits=int(head["COMPBITS"])
                 self.compressedExpMin=int(head.get("EXPMIN",1))
                 self.compressedExpMax=int(head.get("EXPMAX",255))
                 self.compressedShape=eval(head["SHAPE"])
+                self.compactRmx=None
             else:
                 # f=util.FITS.Read(reconmxFilename,savespace=1)
-                reconmx=util.FITS.loadSparse(reconmxFilename)
+                reconmx=util.FITS.loadSparse(reconmxFilename,lazy=lazy,cacheDir=cacheDir)
         else:
             print("WARNING:**tomoRecon**: unable to load reconmx "+
                   "%s, using 0. instead"%reconmxFilename)
@@ -1583,7 +1811,10 @@ class recon(base.aobase.aobase):
         where C_f is influenceScalarProd, C_p is phase covariance, A is the poke matrix and C_n is noise covariance.
         input pokemx.shape is (nmodes,ncents).
         output reconmx is shape nmodes,ncents.
+        If mapSolver is cg, createMAPControlCG is used instead.
         """
+        if getattr(self,"mapSolver","dense")=="cg":
+            return self.createMAPControlCG(pokemx,noiseCov)
         pokemxT=pokemx
         pokemx=pokemx.transpose()
         phaseIsBlock=0
@@ -1654,6 +1885,74 @@ class recon(base.aobase.aobase):
             util.FITS.Write(pokemxT,self.reconmxFilename,writeMode="a",extraHeader="pokemx")
             if type(self.mirrorScale)!=type(None):
                 util.FITS.Write(self.mirrorScale,self.reconmxFilename,writeMode="a",extraHeader="mirScale")
+    def createMAPControlCG(self,pokemx,noiseCov=None):
+        """Create a MAP reconstructor without forming dense covariance
+        matrices.  The phase covariance of each zonal DM is kept in BTTB
+        form, and (AC_pA^t + C_n) is solved using preconditioned conjugate
+        gradients (see util.mapSolver).  If mapOutput is "matrix", the
+        control matrix is built a block of rows at a time (and compressed
+        if mapCompressBits is set), otherwise the solver is used every
+        iteration.
+        input pokemx.shape is (nmodes,ncents).
+        """
+        import util.mapSolver
+        if noiseCov==None:
+            noiseCov=self.noiseCov
+        if self.nmodes!=self.nactsCumList[-1]:
+            raise Exception("tomoRecon: mapSolver cg does not support modal or extra actuators")
+        if self.dmModeType=="poke" and self.mirrorScale is None:
+            #not computed if computeInfluenceScalarProd is set, but needed to scale the solver output.
+            self.computeMirrorScale()
+        l0=self.l0
+        if l0<=0:
+            print("WARNING:**tomoRecon**:mapSolver cg requires a finite outer scale - using 100m")
+            l0=100.
+        blockList=[]
+        for i in range(len(self.dmList)):
+            dm=self.dmList[i]
+            if not dm.zonalDM:
+                raise Exception("tomoRecon: mapSolver cg only supports zonal DMs")
+            modeScale=None
+            if self.dmModeType=="poke" and dm.mirrorModes is not None and dm.mirrorModes.shape[0]==self.nactsList[i]:
+                #covariance of (orthonormal) local mirror modes is approx sum(mode_i)sum(mode_j)C(r_ij).
+                modeScale=dm.mirrorModes.reshape(dm.mirrorModes.shape[0],-1).sum(1)
+            lam=dm.reconLam
+            if lam is None:
+                lam=500.
+            blockList.append(util.mapSolver.bttbCovariance(dm.nact,dm.actSpacing,self.r0,l0,self.dmPupList[i],modeScale,lam))
+        cov=util.mapSolver.blockDiagonalCovariance(blockList)
+        self.mapSolverObj=util.mapSolver.mapSolver(pokemx,cov,noiseCov,self.mapCGTol,self.mapCGMaxiter,self.mapSparseThreshold)
+        if self.mapOutput=="solver":
+            self.reconmx=0.
+            return
+        self.reconmx=self.mapSolverObj.makeControlMatrix(dtype=numpy.float32,blockSize=self.mapBlockSize)
+        self.mapSolverObj=None
+        if self.dmModeType=="poke":
+            for i in range(self.nmodes):
+                self.reconmx[i]/=self.mirrorScale[i]
+        if self.mapCompressBits!=None:
+            shape=self.reconmx.shape
+            mbits=self.mapCompressBits
+            r=self.reconmx.ravel()
+            self.compressedExpMin,self.compressedExpMax=cmod.utils.compressFloatArrayAll(r,mbits)
+            ebits=1
+            while ((self.compressedExpMax-self.compressedExpMin+1)>>ebits)>0:
+                ebits+=1
+            words=(r.size*(mbits+ebits+1)+31)/32
+            self.reconmx=r[:words].copy()
+            self.compressedBits=mbits
+            self.compressedShape=shape
+            self.compressedWork=None
+            self.compactRmx=None
+            print("INFORMATION:**tomoRecon**:Compressed MAP reconmx to %d bits per element"%(mbits+ebits+1))
+        if self.reconmxFilename!=None:
+            print("INFORMATION:**tomoRecon**:Writing MAP reconmx to file "+
+                  "%s"%self.reconmxFilename)
+            if self.compressedBits!=None:
+                util.FITS.Write(self.reconmx,self.reconmxFilename,extraHeader=["COMPBITS= %d"%self.compressedBits,"SHAPE   = %s"%str(self.compressedShape),"EXPMIN  = %d"%self.compressedExpMin,"EXPMAX  = %d"%self.compressedExpMax],doByteSwap=0)
+            else:
+                util.FITS.Write(self.reconmx,self.reconmxFilename,extraHeader="reconmx")
+
     def computeMonteNoiseCovariance(self):
         """Note, this isn't a proper way of computing noise
         covariance, as it doesn't take into account the spot
@@ -23,6 +23,7 @@ import numpy,numpy.random
 #import cmod.imgnoise
 #from imgnoise import *
 import util.centroid
+import util.centcmod
 import util.guideStar
 #import cmod.binimg
 #import cmod.mkimg
@@ -72,6 +73,10 @@ class wfscent(base.aobase.aobase):
     
     """
 
+    #state saved when checkpointing (curInteg is also passed to cmod in setState):
+    checkpointThisAttrs=["wfscentObj.curInteg","wfscentObj.outputData","wfscentObj.cmodbimg","wfscentObj.outSquare",
+                         "wfscentObj.outSum","wfscentObj.outN","batchDataValid"]
+
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         """Initialise the WFS simulation object
         Parent - parent object to obtain SH images from
@@ -202,6 +207,9 @@ class wfscent(base.aobase.aobase):
                 self.nthreads=self.config.getVal("ncpu")#getCpus()
                 print("INFORMATION:wfscent: Using {0:d} threads".format(self.nthreads))
 ##(old)                print("INFORMATION:wfscent: Using %d threads"%self.nthreads)
+            #If resource sharing, compute all the WFSs in one call, dividing the threads between them:
+            self.batchCentroiding=self.config.getVal("batchCentroiding",default=0)
+            self.batch=0
             self.imgmask=1#value used when creating sh img in drawCents()
             self.showspot=0#used in drawCents() - whether to show the spots overlaid.
             self.control={"cal_source":calSource,"useCmod":useCmod,"zeroOutput":0,"parentType":"closed","calcCovariance":self.config.getVal("calcWFSCovariance",default=0)}#ZeroOutput can be used when calibrating a pseudo-open loop system.
@@ -580,6 +588,21 @@ class wfscent(base.aobase.aobase):
             pupsubMem=numpy.zeros((maxnpup*maxnpup),self.fpDataType)
         else:
             pupsubMem=None
+        nthreads=self.nthreads
+        if self.batchCentroiding and len(self.thisObjList)>1:
+            reason=self.checkBatchParents()
+            if reason is not None:
+                print("WARNING:wfscent: Not batch centroiding - {0:s}".format(reason))
+                self.batchCentroiding=0
+        if (self.batchCentroiding and len(self.thisObjList)>1 and self.control["useCmod"] and
+                not [1 for this in self.thisObjList if this.wfscentObj.inputImage is not None]):
+            #WFSs run concurrently, so each needs its own image and output.
+            self.batch=1
+            nobj=len(self.thisObjList)
+            nthreads=max(1,(self.nthreads+nobj-1)//nobj)
+            bimgMem=None
+            outputDataMem=None
+            print("INFORMATION:wfscent: Batch centroiding %d WFSs with %d threads each"%(nobj,nthreads))
 
         #now init each wfscentObj with this mem.
         for this in self.thisObjList:
@@ -587,7 +610,7 @@ class wfscent(base.aobase.aobase):
             #set up the memories
             wfs.initMem(subimgMem=subimgMem,bimgMem=bimgMem,pupsubMem=pupsubMem,outputDataMem=outputDataMem)
             wfs.finishInit()
-            wfs.initialiseCmod(self.nthreads,self.control["cal_source"],wfs.seed)
+            wfs.initialiseCmod(nthreads,self.control["cal_source"],wfs.seed)
             #Take correlation image, if don't yet have one, and if doing correlationCentroiding.
             wfs.takeCorrImage(self.control)
             #Take the centroid weighting if we're using it...
@@ -598,8 +621,12 @@ class wfscent(base.aobase.aobase):
             wfs.takeReference(self.control)
             #and reset the output.
             wfs.outputData[:]=0
+            this.batchDataValid=0
+            this.batchParentIterCnt=dict([(key,getattr(p,"nextIterCnt",None)) for key,p in this.parent.items()])
         if self.fullOutput:
             self.outputData=self.thisObjList[0].wfscentObj.outputData
+        elif self.batch:#don't overwrite the first WFS slopes.
+            self.outputData=self.thisObjList[0].wfscentObj.outputData.copy()
         else:
             #self.outputData=numpy.zeros((self.thisObjList[0].wfscentObj.nsubaps,2),numpy.float32)
             self.outputData=self.thisObjList[0].wfscentObj.outputData
@@ -638,6 +665,13 @@ class wfscent(base.aobase.aobase):
 ##(old)            print "wfs: Doing generateNext (debug=%s)"%str(self.debug)
         current=self.control["parentType"]
         if self.generate==1:
+            if self.batch and self.currentIdObjCnt==0:
+                reason=self.checkBatchParentsRun()
+                if reason is None:
+                    self.runBatch()#all the WFSs computed together, checking their own parents.
+                else:#compList interleaves parents and WFSs - so compute each WFS in turn from now on.
+                    print("WARNING:wfscent: Stopping batch centroiding - {0:s}".format(reason))
+                    self.batch=0
             if self.newDataWaiting:#this is always 1
                 if self.parent[current].dataValid==1:
                     #self.inputData=self.parent.outputData
@@ -649,28 +683,12 @@ class wfscent(base.aobase.aobase):
                     self.dataValid=0
             if self.inputInvalid==0: # there was an input, so we can integrate...
                 wfs=self.wfscentObj # has been copied from thisObjList before generateNext is called...
-                if wfs.inputImage is None:#input is phase screen.
+                if self.batch:#already computed, in runBatch.
+                    self.dataValid=self.thisObjList[self.currentIdObjCnt].batchDataValid
+                elif wfs.inputImage is None:#input is phase screen.
                     phs=self.parent[current].outputData
                     self.dataValid=0
-                    if wfs.integstepFn!=None and wfs.texp==0 and self.control["useCmod"]:
-                        raise Exception("No longer implemented")
-                        wfs.updateIntegTime(wfs.integstepFn())
-
-                    if wfs.curInteg==0:#start of exposure
-                        if wfs.nintegrations+wfs.nlatency==1:#also end of exposure
-                            additive=-1
-                        else:
-                            additive=0
-                    elif wfs.curInteg+1<wfs.nintegrations:#mid exposure
-                        additive=1
-                    elif wfs.curInteg+1<wfs.nintegrations+wfs.nlatency:#frame transfer
-                        additive=3#do owt
-                    else:#exposure complete.
-                        additive=2
-                    #increment the counter.
-                    wfs.curInteg+=1
-                    if wfs.curInteg>=wfs.nintegrations+wfs.nlatency:
-                        wfs.curInteg=0
+                    additive=self.nextIntegration(wfs)
                     if self.control["zeroOutput"]:
                         wfs.outputData[:]=0
                         if wfs.nintegrations+wfs.nlatency>1:
@@ -682,23 +700,7 @@ class wfscent(base.aobase.aobase):
                             wfs.phase[:]=phs
                         wfs.runCalc(self.control)
                         if additive==2 or additive==-1:#readout.
-                            # this should be used for LGS sensors:
-                            if wfs.subtractTipTilt==-1 or (
-                                    wfs.subtractTipTilt==1 and self.control["cal_source"]==0 and self.imageOnly==0):
-                                N=wfs.nsubaps
-                                # subtract average x centroid:
-                                wfs.outputData[:,:,0]-=wfs.outputData[:,:,0].sum()/N
-                                # subtract average y centroid:
-                                wfs.outputData[:,:,1]-=wfs.outputData[:,:,1].sum()/N
-                            if self.control["calcCovariance"]:
-                                if wfs.outSquare is None:
-                                    wfs.outSquare=wfs.outputData**2
-                                    wfs.outSum=wfs.outputData.copy()
-                                    wfs.outN=1
-                                else:
-                                    wfs.outSquare+=wfs.outputData**2
-                                    wfs.outSum+=wfs.outputData
-                                    wfs.outN+=1
+                            self.processSlopes(wfs)
                             self.dataValid=1
                 else:#input data is an image, rather than phase.
                     self.dataValid=1
@@ -706,22 +708,7 @@ class wfscent(base.aobase.aobase):
                         wfs.outputData[:]=0
                     else:
                         wfs.runSlopeCalc(self.control)
-                        if wfs.subtractTipTilt==-1 or (
-                                wfs.subtractTipTilt==1 and self.control["cal_source"]==0 and self.imageOnly==0):
-                            N=wfs.nsubaps
-                            # subtract average x centroid:
-                            wfs.outputData[:,:,0]-=wfs.outputData[:,:,0].sum()/N
-                            # subtract average y centroid:
-                            wfs.outputData[:,:,1]-=wfs.outputData[:,:,1].sum()/N
-                        if self.control["calcCovariance"]:
-                            if wfs.outSquare is None:
-                                wfs.outSquare=wfs.outputData**2
-                                wfs.outSum=wfs.outputData.copy()
-                                wfs.outN=1
-                            else:
-                                wfs.outSquare+=wfs.outputData**2
-                                wfs.outSum+=wfs.outputData
-                                wfs.outN+=1
+                        self.processSlopes(wfs)
                         
                 if self.timing:
                     print("INFORMATION:wfscent: time:{0:s}".format( str(time.time()-t1) ))
@@ -733,6 +720,131 @@ class wfscent(base.aobase.aobase):
         self.generateNextTime=time.time()-t1
 
 
+    def nextIntegration(self,wfs):
+        """Work out where we are in the exposure, and increment the counter.
+        Returns 0 for first integration, 1 for intermediate, 2 for readout,
+        3 for frame transfer (do nothing), or -1 for first integration and readout.
+        """
+        if wfs.integstepFn!=None and wfs.texp==0 and self.control["useCmod"]:
+            raise Exception("No longer implemented")
+            wfs.updateIntegTime(wfs.integstepFn())
+
+        if wfs.curInteg==0:#start of exposure
+            if wfs.nintegrations+wfs.nlatency==1:#also end of exposure
+                additive=-1
+            else:
+                additive=0
+        elif wfs.curInteg+1<wfs.nintegrations:#mid exposure
+            additive=1
+        elif wfs.curInteg+1<wfs.nintegrations+wfs.nlatency:#frame transfer
+            additive=3#do owt
+        else:#exposure complete.
+            additive=2
+        #increment the counter.
+        wfs.curInteg+=1
+        if wfs.curInteg>=wfs.nintegrations+wfs.nlatency:
+            wfs.curInteg=0
+        return additive
+
+    def processSlopes(self,wfs):
+        """Tip-tilt removal and covariance accumulation, once slopes have been read out."""
+        # this should be used for LGS sensors:
+        if wfs.subtractTipTilt==-1 or (
+                wfs.subtractTipTilt==1 and self.control["cal_source"]==0 and self.imageOnly==0):
+            N=wfs.nsubaps
+            # subtract average x centroid:
+            wfs.outputData[:,:,0]-=wfs.outputData[:,:,0].sum()/N
+            # subtract average y centroid:
+            wfs.outputData[:,:,1]-=wfs.outputData[:,:,1].sum()/N
+        if self.control["calcCovariance"]:
+            if wfs.outSquare is None:
+                wfs.outSquare=wfs.outputData**2
+                wfs.outSum=wfs.outputData.copy()
+                wfs.outN=1
+            else:
+                wfs.outSquare+=wfs.outputData**2
+                wfs.outSum+=wfs.outputData
+                wfs.outN+=1
+
+    def checkBatchParents(self):
+        """Check that the WFSs can be batched: all the phases are read on the
+        first idstr of the iteration, so each WFS needs its own parent, which
+        isn't itself resource shared (e.g. a shared iatmos or xinterp_dm
+        overwrites its single outputData for each direction).
+        @return: None if batching is possible, or the reason why not.
+        @rtype: None or String
+        """
+        objs={}
+        outs={}
+        for this in self.thisObjList:
+            for key,p in this.parent.items():
+                if len(getattr(p,"idstr",[None]))>1 or len(getattr(p,"thisObjList",[]))>1:
+                    return "parent %s of %s is resource shared"%(getattr(p,"objID",key),this.idstr)
+                if objs.has_key(id(p)):
+                    return "%s and %s have the same parent"%(objs[id(p)],this.idstr)
+                objs[id(p)]=this.idstr
+                out=getattr(p,"outputData",None)
+                if isinstance(out,numpy.ndarray):
+                    if outs.has_key(id(out)):
+                        return "%s and %s have the same parent outputData"%(outs[id(out)],this.idstr)
+                    outs[id(out)]=this.idstr
+        return None
+
+    def checkBatchParentsRun(self):
+        """Check that the parents of all the WFSs have been computed since the
+        last batch, i.e. that they all come before this module first appears
+        in the compList.  If not (e.g. atmos1, wfs, atmos2, wfs), the batch
+        would centroid the previous iteration's phase for some WFSs.
+        @return: None if the parents are up to date, or the reason why not.
+        @rtype: None or String
+        """
+        current=self.control["parentType"]
+        for this in self.thisObjList:
+            p=this.parent[current]
+            cnt=getattr(p,"nextIterCnt",None)
+            if cnt is None:#not an aobase object, so can't tell.
+                continue
+            if cnt==this.batchParentIterCnt[current]:
+                return "parent %s of %s has not been computed before the batch"%(getattr(p,"objID",current),this.idstr)
+        for this in self.thisObjList:
+            for key,p in this.parent.items():
+                this.batchParentIterCnt[key]=getattr(p,"nextIterCnt",None)
+        return None
+
+    def runBatch(self):
+        """Compute slopes for all the resource shared WFSs in a single call to
+        the centroid module.  Called on the first idstr of each iteration, so
+        the parents of all the WFSs must have been computed before this module
+        first appears in the compList (checked by checkBatchParentsRun), and
+        must not be resource shared (checked by checkBatchParents).  Each WFS
+        then has its own outputData, and batchDataValid flag.
+        """
+        current=self.control["parentType"]
+        todo=[]
+        readout=[]
+        for this in self.thisObjList:
+            wfs=this.wfscentObj
+            this.batchDataValid=0
+            if this.parent[current].dataValid!=1:#message printed by generateNext
+                continue
+            additive=self.nextIntegration(wfs)
+            if self.control["zeroOutput"]:
+                wfs.outputData[:]=0
+                if wfs.nintegrations+wfs.nlatency>1:
+                    print "Warning - centmodule not called by wfscent when zeroOutput set"
+                this.batchDataValid=1
+                continue
+            phs=this.parent[current].outputData
+            if phs is not wfs.phase:
+                wfs.phase[:]=phs
+            todo.append(wfs)
+            if additive==2 or additive==-1:#readout
+                readout.append((this,wfs))
+        util.centroid.runBatch(todo,self.control)
+        for this,wfs in readout:
+            self.processSlopes(wfs)
+            this.batchDataValid=1
+
     def endSim(self):
         for obj in self.thisObjList:
             wfs=obj.wfscentObj
@@ -747,6 +859,14 @@ class wfscent(base.aobase.aobase):
                 readnoise=wfsobj.readoutNoise
                 util.FITS.Write(cov,"wfsCovariance_%s%s_%g_%g.fits"%(obj.covTag,obj.idstr,sig,readnoise))
 
+    def setState(self,state):
+        """Restore checkpointed state, and pass the integration counter to cmod."""
+        base.aobase.aobase.setState(self,state)
+        for this in self.thisObjList:
+            wfs=this.wfscentObj
+            if getattr(wfs,"centcmod",None) is not None:
+                wfs.centcmod.update(util.centcmod.CURINTEG,int(wfs.curInteg))
+
     def newCorrRef(self,doThreshold=0):
         """Grabs current SHS images and sets these as the correlation reference.  Then computes new reference slopes too.
         If doThreshold is 0, then thresholding won't be done.
@@ -996,6 +1116,7 @@ class wfscent(base.aobase.aobase):
         paramList.append(base.dataType.dataType(description="pupil",typ="code",val="import util.tel;pupil=util.tel.Pupil(npup,ntel/2,ntel/2*telSec/telDiam,wfs_nsubx,wfs_minarea)",comment="Telescope pupil"))
         paramList.append(base.dataType.dataType(description="atmosGeom",typ="code",val="import util.atmos;atmosGeom=util.atmos.geom(layerDict, sourceList,ntel,npup,telDiam)",comment="TODO: atmosGeom with arguments layerDict, sourceList,ntel,npup,telDiam.  layerDict is a dictionar with keys equal to the layer name (idstr used by infScrn object) and values equal to a tuple of (height, direction, speed, strength, initSeed), and sourceList is a list of ources equal to a tuple of (idstr (infAtmos), theta, phi, alt, nsubx or None)."))
         paramList.append(base.dataType.dataType(description="tstep",typ="f",val="0.005",comment="TODO: timestep."))        
+        paramList.append(base.dataType.dataType(description="batchCentroiding",typ="i",val="0",comment="If resource sharing, compute slopes for all WFSs in a single concurrent call, with nthreads divided between them.  Each WFS must have its own (not resource shared) parent, computed before this module in the compList (if not, batching is stopped at the first iteration)."))
         return paramList
 
 
@@ -36,6 +36,7 @@ import time,types
 import iscrn
 import wfscent
 import util.atmos
+import cmod.iscrn
 import scipy.signal
 #import util.dist,util.zernikeMod
 
@@ -79,6 +80,12 @@ class WideField(base.aobase.aobase):
 
     fieldAlt: None, or an array of shape nfieldY,nfieldX, containing the source heights for this part of the field (e.g. for differential cone effect using LGSs).
 
+    batchFields: 1 (default) to compute the pupil phase for all field directions together, each thread doing whole directions, or 0 to compute them one at a time.  Requires nFieldY*nFieldX*npup*npup float32.
+
+    fieldNthreads: Number of threads used when batchFields is set.  Default "all" (ncpu).
+
+    precomputeYGradient: 1 to store the y gradients of the phase screens (faster, but doubles the memory needed for the screens), 0 not to, or "auto" to do so if the screens and gradients use less than half the available memory.
+
     """
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         """Initialise the object.  The parent object here should be a dictionary with values for each atmospheric layer, ie instances of iscrn, or DMs which are sending their full surface.  """
@@ -203,6 +210,14 @@ class WideField(base.aobase.aobase):
             self.psf=numpy.zeros((self.nsubx,self.nsubx,self.psfsize,self.psfsize),numpy.float32)
             self.interpNthreads=self.config.getVal("interpolationNthreads",default=0
 )
+            self.batchFields=self.config.getVal("batchFields",default=1)
+            if self.batchFields and not hasattr(cmod.iscrn,"rotShiftWrapSplineImageMany"):
+                print "WARNING wideField: cmod.iscrn.rotShiftWrapSplineImageMany not available (rebuild cmod) - computing field directions one at a time"
+                self.batchFields=0
+            self.fieldNthreads=self.config.getVal("fieldNthreads",default="all")
+            if self.fieldNthreads=="all":
+                self.fieldNthreads=self.config.getVal("ncpu",default=1)
+            self.fieldPhs=None#pupil phase for all field directions, if batchFields.
 
             self.directPhaseScreen=self.config.getVal("directPhaseScreen",default=1)#are we allowed to access parent.screen if parent is an iscrn object?  
             self.telDiam=self.config.getVal("telDiam")
@@ -237,7 +252,16 @@ class WideField(base.aobase.aobase):
             self.coeffsZernike=None
             self.coeffsZernike2=None
             self.zernikeIters=0
-            if self.config.getVal("precomputeYGradient",default=0):#set to 1 for faster operation with larger memory comsumption
+            precomputeYGradient=self.config.getVal("precomputeYGradient",default=0)#set to 1 for faster operation with larger memory comsumption
+            if precomputeYGradient=="auto":
+                nbytes=0
+                for pkey in self.scrnParentDict.keys():
+                    for key in self.config.getVal("layerList",{},searchOrder=["iscrn_%s","iscrn","globals"]).get(pkey,[pkey]):
+                        nbytes+=self.atmosGeom.getScrnYPxls(key,rotateDirections=1)*self.atmosGeom.getScrnXPxls(key,rotateDirections=1)*numpy.dtype(self.scrnDataType).itemsize
+                from util.computeRecon import getMem
+                precomputeYGradient=(2*nbytes<getMem("MemAvailable:")/2)
+                print "INFORMATION wideField: %s y gradients (%d bytes)"%(["Not precomputing","Precomputing"][precomputeYGradient],nbytes)
+            if precomputeYGradient:
                 self.ygradient={}
             else:
                 self.ygradient=None
@@ -434,24 +458,28 @@ class WideField(base.aobase.aobase):
                     altOrig=atmosObj.sourceAlt
                     thetaOrig=atmosObj.sourceTheta
                     phiOrig=atmosObj.sourcePhi
+                    batch=self.batchFields and not atmosObj.computeUplinkTT and not self.control["cal_source"]
+                    if batch:#compute the pupil phase for all field directions now.
+                        if self.fieldPhs is None:
+                            self.fieldPhs=numpy.zeros((self.nFieldY*self.nFieldX,self.npup,self.npup),numpy.float32)
+                        posList=[]
+                        for fieldY in range(self.nFieldY):
+                            for fieldX in range(self.nFieldX):
+                                atmosObj.sourceTheta,atmosObj.sourcePhi=self.fieldDirection(sourceTheta,sourcePhi,fovpitchX,fovpitchY,fieldX,fieldY)
+                                if self.fieldAlt!=None:
+                                    atmosObj.sourceAlt=self.fieldAlt[fieldY,fieldX]
+                                atmosObj.updatePositionDict()
+                                posList.append(atmosObj.positionDict)
+                        atmosObj.createPupilPhsMany(posList,self.interpPosRow,self.insertPos,self.control,self.fieldPhs,self.fieldNthreads)
                     for fieldY in range(self.nFieldY):
                         for fieldX in range(self.nFieldX):
                             if self.control["cal_source"]:#calibration source
                                 self.pupilphs[:]=0.
+                            elif batch:
+                                self.pupilphs[:]=self.fieldPhs[fieldY*self.nFieldX+fieldX]
                             else:
                                 #update for field
-                                #We have nFieldX/Y covering this field, and each sub-field overlaps by 50%.  Therefore, (nFieldX+1)/2*subfov - which should equal the full fov.  
-                                ydiff=(-(self.nFieldY-1)/2.+fieldY)*fovpitchY/2.
-                                xdiff=(-(self.nFieldX-1)/2.+fieldX)*fovpitchX/2.
-
-                                xcentre=sourceTheta*numpy.cos(sourcePhi*numpy.pi/180.)
-                                ycentre=sourceTheta*numpy.sin(sourcePhi*numpy.pi/180.)
-                                xnew=xcentre+xdiff
-                                ynew=ycentre+ydiff
-                                thetanew=numpy.sqrt(xnew*xnew+ynew*ynew)
-                                phinew=numpy.arctan2(ynew,xnew)*180/numpy.pi
-                                atmosObj.sourceTheta=thetanew
-                                atmosObj.sourcePhi=phinew
+                                atmosObj.sourceTheta,atmosObj.sourcePhi=self.fieldDirection(sourceTheta,sourcePhi,fovpitchX,fovpitchY,fieldX,fieldY)
                                 if self.fieldAlt!=None:
                                     atmosObj.sourceAlt=self.fieldAlt[fieldY,fieldX]
                                 #print "%g diff %g, %g, pitch %g, %g, dir: %g, %g"%(atmosObj.fov, xdiff,ydiff,fovpitchX,fovpitchY,thetanew,phinew)
@@ -523,6 +551,20 @@ class WideField(base.aobase.aobase):
             print "wideField: done generateNext (debug=%s)"%str(self.debug)
         self.generateNextTime=time.time()-t1
 
+    def fieldDirection(self,sourceTheta,sourcePhi,fovpitchX,fovpitchY,fieldX,fieldY):
+        """Return the direction (theta in arcsec, phi in degrees) of a field position."""
+        #We have nFieldX/Y covering this field, and each sub-field overlaps by 50%.  Therefore, (nFieldX+1)/2*subfov - which should equal the full fov.  
+        ydiff=(-(self.nFieldY-1)/2.+fieldY)*fovpitchY/2.
+        xdiff=(-(self.nFieldX-1)/2.+fieldX)*fovpitchX/2.
+
+        xcentre=sourceTheta*numpy.cos(sourcePhi*numpy.pi/180.)
+        ycentre=sourceTheta*numpy.sin(sourcePhi*numpy.pi/180.)
+        xnew=xcentre+xdiff
+        ynew=ycentre+ydiff
+        thetanew=numpy.sqrt(xnew*xnew+ynew*ynew)
+        phinew=numpy.arctan2(ynew,xnew)*180/numpy.pi
+        return thetanew,phinew
+
     def addDmPhase(self,pupilphs,fieldX,fieldY):
         for i in range(self.ndm):
             #select the line of sight object for this DM.
@@ -33,6 +33,8 @@ import string
 import base.aobase
 import scipy.ndimage as ndimg
 import math
+import threading
+import util.parabolicFit
 
 class xcross(base.aobase.aobase):
     def __init__(self,parentDict,config,args={},forGUISetup=0,debug=None,idstr=None):
@@ -103,6 +105,8 @@ class xcross(base.aobase.aobase):
         w1y[:,0]=self.liney
         self.xgrid=numpy.dot((w1y*0+1),w1x)
         self.ygrid=numpy.dot(w1y,(w1x*0+1))
+        #all subapertures are processed together, split between this many threads.
+        self.nthreads=self.config.getVal("xcrossThreads",default=1)
         
     def generateNext(self):
         """Compression main loop - compress along a line of sight to get WFS images values."""
@@ -150,15 +154,31 @@ class xcross(base.aobase.aobase):
             self.ref=self.load_ref(ref)
             self.ref_shift=[0,0]
             self.slope_shift=self.parentDict.outputData[ref_pos[0],ref_pos[1],:]
+            self.fullIndex=numpy.array(self.full,numpy.intp).reshape(len(self.full),2)
         self.iter +=1
         
         allslope=numpy.zeros([self.nsuby,self.nsubx,2])
-        for i in range(len(self.full)):
-            pos=self.full[i]
-            img=inputimg[pos[0]*nimg:(pos[0]+1)*nimg,pos[1]*nimg:(pos[1]+1)*nimg]
-            s1=self.f_subpixel(self.initial_img(img))
-
-            allslope[pos[0],pos[1],:]=s1+self.slope_shift
+        #stack the used subimages, and compute their slopes together.
+        imgs=inputimg[:self.nsuby*nimg,:self.nsubx*nimg].reshape(self.nsuby,nimg,self.nsubx,nimg).transpose(0,2,1,3)
+        imgs=imgs[self.fullIndex[:,0],self.fullIndex[:,1]]
+        slopes=numpy.zeros((imgs.shape[0],2))
+        def run(start,end):
+            x2,y2=self.f_subpixel_batch(self.initial_img_batch(imgs[start:end]))
+            slopes[start:end,0]=x2
+            slopes[start:end,1]=y2
+        n=imgs.shape[0]
+        nthr=min(self.nthreads,n)
+        if nthr<=1:
+            run(0,n)
+        else:
+            thrList=[]
+            for t in range(nthr):
+                thr=threading.Thread(target=run,args=(t*n//nthr,(t+1)*n//nthr))
+                thr.start()
+                thrList.append(thr)
+            for thr in thrList:
+                thr.join()
+        allslope[self.fullIndex[:,0],self.fullIndex[:,1],:]=slopes+self.slope_shift
 
         #print allslope[:,:,0]
         #print self.parentDict.outputData[:,:,0]
@@ -179,9 +199,19 @@ class xcross(base.aobase.aobase):
         return array.sum()/array.size
         
     def f_subpixel(self,img):
+        x2,y2=self.f_subpixel_batch(img[None])
+        return [x2[0],y2[0]]
 
+    def f_subpixel_batch(self,imgs):
+        """Compute the (subpixel) shifts of a stack of subimages relative to the reference.
+        @param imgs: The subimages (after initial_img), shape (n,ny,nx)
+        @type imgs: Array
+        @return: x and y shifts, each shape (n,)
+        @rtype: Tuple of Array
+        """
         nx=self.sz_img[1]
         ny=self.sz_img[0]
+        n=imgs.shape[0]
 
         amp=int(min(nx/4.,ny/4.,10.))
         if self.cor_mode != 1:
@@ -191,109 +221,86 @@ class xcross(base.aobase.aobase):
             j0=int((ny-bxsz)/2.);
             j1=j0+bxsz-1;
             sm_ref=self.ref[i0:i1,j0:j1]
+            if self.cor_mode == 5:
+                sm_ref0=sm_ref-self.avg(sm_ref)
+                sm_ref2=(sm_ref0**2).sum()
             
-            cor=numpy.zeros([2*amp+1,2*amp+1])
+            cor=numpy.zeros([n,2*amp+1,2*amp+1])
             
             for di in range(-amp,amp+1):
                 for dj in range(-amp,amp+1):
-                    im=img[i0+di:i1+di,j0+dj:j1+dj]
+                    im=imgs[:,i0+di:i1+di,j0+dj:j1+dj]
                     if self.cor_mode == 0:
-                        cor[di+amp,dj+amp]=((im-sm_ref)**2).sum()
-                        #if di==0 and dj ==0:
-                            #print "%f"%((im-sm_ref)**2).sum()
-                            
+                        cor[:,di+amp,dj+amp]=((im-sm_ref)**2).sum(2).sum(1)
                     elif self.cor_mode == 2:
-                        cor[di+amp,dj+amp]=-(im*sm_ref).sum()
+                        cor[:,di+amp,dj+amp]=-(im*sm_ref).sum(2).sum(1)
                     elif self.cor_mode == 3 or self.cor_mode == 4:
-                        cor[di+amp,dj+amp]=(abs(im-sm_ref)).sum()
+                        cor[:,di+amp,dj+amp]=(abs(im-sm_ref)).sum(2).sum(1)
                     elif self.cor_mode == 5:
-                        down=((im-self.avg(im))**2).sum()*((sm_ref-self.avg(sm_ref))**2).sum()
-                        cor[di+amp,dj+amp]=-((im-self.avg(im))*(sm_ref-self.avg(sm_ref))).sum()/math.sqrt(down)
+                        im0=im-(im.sum(2).sum(1)/(im.shape[1]*im.shape[2]))[:,None,None]
+                        down=(im0**2).sum(2).sum(1)*sm_ref2
+                        cor[:,di+amp,dj+amp]=-(im0*sm_ref0).sum(2).sum(1)/numpy.sqrt(down)
 
-            s=cor.argmin()
-            y0=int(s/cor.shape[1])
-            x0=s%cor.shape[1]
+            s=cor.reshape(n,-1).argmin(1)
+            y0=s//cor.shape[2]
+            x0=s%cor.shape[2]
 
             y1=y0-amp
             x1=x0-amp
 
         elif self.cor_mode == 1:
 
-            cor=fft.ifft2(fft.fft2(img*self.wdw) * self.ref)
-            #cor=fft.ifft2(numpy.conjugate(self.ref) * self.ref)
+            cor=fft.ifft2(fft.fft2(imgs*self.wdw) * self.ref)
 
             cor=-abs(cor)**2
 
-            s=cor.argmin()
-            y0=int(s/cor.shape[1])
-            x0=s%cor.shape[1]
+            s=cor.reshape(n,-1).argmin(1)
+            y0=s//cor.shape[2]
+            x0=s%cor.shape[2]
 
-            if x0<nx/2:
-                x1=x0
-            else:
-                x1=-nx+x0
+            x1=numpy.where(x0<nx/2,x0,-nx+x0)
+            y1=numpy.where(y0<ny/2,y0,-ny+y0)
 
-            if y0<ny/2:
-                y1=y0
-            else:
-                y1=-ny+y0
-
-        cc=numpy.zeros([3,3])
-        cx=cor.shape[1]
-        cy=cor.shape[0]
-
-        for i in range(3):
-            for j in range(3):
-                cc[j,i]=cor[(y0-1+j)%cy,(x0-1+i)%cx]
+        #the 3x3 region around the minimum (wrapping at the edges).
+        cy=cor.shape[1]
+        cx=cor.shape[2]
+        offset=numpy.arange(-1,2)
+        yy=(y0[:,None]+offset)%cy
+        xx=(x0[:,None]+offset)%cx
+        cc=cor[numpy.arange(n)[:,None,None],yy[:,:,None],xx[:,None,:]]
         
         if self.cor_mode == 4:
             cc=cc**2
         
-        if self.intp_mode == 0 or self.intp_mode ==2:
-
-            a2=(sum(cc[2,:])-sum(cc[0,:]))/6.
-            a3=(sum(cc[2,:])-2*sum(cc[1,:])+sum(cc[0,:]))/6.
-            a4=(sum(cc[:,2])-sum(cc[:,0]))/6.
-            a5=(sum(cc[:,2])-2*sum(cc[:,1])+sum(cc[:,0]))/6.
-            a6=(cc[2,2]-cc[0,2]-cc[2,0]+cc[0,0])/4.
-
-        elif self.intp_mode == 1 or self.intp_mode ==3:
-
-            a2=(cc[2,1]-cc[0,1])/2.
-            a3=(cc[2,1]-2*cc[1,1]+cc[0,1])/2.
-            a4=(cc[1,2]-cc[1,0])/2.
-            a5=(cc[1,2]-2*cc[1,1]+cc[1,0])/2.
-            a6=(cc[2,2]-cc[0,2]-cc[2,0]+cc[0,0])/4.
+        a2,a3,a4,a5,a6=util.parabolicFit.quadInterpCoeffs(cc,allPoints=(self.intp_mode == 0 or self.intp_mode == 2))
             
-        if self.intp_mode == 0 or self.intp_mode == 1: 
-            a6635=(a6*a6-4.*a3*a5)
-            addy=(2.*a2*a5-a4*a6)/a6635
-            addx=(2.*a3*a4-a2*a6)/a6635
-            
-            if abs(addy) <= 1:
-                y2=y1+addy
+        #both branches of the where are evaluated for all subaps, so zero divisors are expected.
+        with numpy.errstate(divide="ignore",invalid="ignore"):
+            if self.intp_mode == 0 or self.intp_mode == 1: 
+                a6635=(a6*a6-4.*a3*a5)
+                addy=(2.*a2*a5-a4*a6)/a6635
+                addx=(2.*a3*a4-a2*a6)/a6635
+                y2=numpy.where(abs(addy)<=1,y1+addy,y1-a2/a3/2.)
+                x2=numpy.where(abs(addx)<=1,x1+addx,x1-a4/a5/2.)
             else:
                 y2=y1-a2/a3/2.
-            
-            if abs(addx) <= 1:
-                x2=x1+addx
-            else:
                 x2=x1-a4/a5/2.
-        else:
-            y2=y1-a2/a3/2.
-            x2=x1-a4/a5/2.
         
-        return [x2,y2]
+        return x2,y2
         
     def initial_img(self,ref):
-        ref1=ref/self.avg(ref)
+        return self.initial_img_batch(ref[None])[0]
+
+    def initial_img_batch(self,refs):
+        """Normalise (and remove the mean or a linear fit from) a stack of subimages, shape (n,ny,nx)"""
+        ref1=refs/(refs.sum(2).sum(1)/(refs.shape[1]*refs.shape[2]))[:,None,None]
         if self.init_mode == 0:
-            ref1-=self.avg(ref1)
+            ref1-=(ref1.sum(2).sum(1)/(ref1.shape[1]*ref1.shape[2]))[:,None,None]
         elif self.init_mode == 1:
-            bx=numpy.polyfit(self.linex,ref1.sum(axis=0)/self.sz_img[0],1)
-            ref1 -= bx[1]+bx[0]*self.xgrid
-            by=numpy.polyfit(self.liney,ref1.sum(axis=1)/self.sz_img[1],1)
-            ref1 -= by[1]+by[0]*self.ygrid
+            bx=numpy.polyfit(self.linex,(ref1.sum(axis=1)/self.sz_img[0]).T,1)
+            ref1 -= bx[1][:,None,None]+bx[0][:,None,None]*self.xgrid
+            by=numpy.polyfit(self.liney,(ref1.sum(axis=2)/self.sz_img[1]).T,1)
+            ref1 -= by[1][:,None,None]+by[0][:,None,None]*self.ygrid
         return ref1
         
     def load_ref(self,ref):
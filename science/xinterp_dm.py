@@ -36,6 +36,9 @@ class dm(base.aobase.aobase):
     otherwise it would be unphysical...
 
     """
+    #state saved when checkpointing:
+    checkpointAttrs=["outputData","dataValid","actmap","lastactmap","dmphs","allZero","dynamicStep","monteNoll","navNoll"]
+
     def __init__(self,parent,config,args={},forGUISetup=0,debug=None,idstr=None):
         if type(parent)!=type({}):
             parent={"1":parent}
@@ -74,6 +77,8 @@ class dm(base.aobase.aobase):
             self.npup=self.config.getVal("npup")
             self.pupil=self.config.getVal("pupil",raiseerror=0)
             self.interpolationNthreads=self.config.getVal("interpolationNthreads", default=0)
+            self.precomputeSurface=self.config.getVal("dmPrecomputeSurface",default=0)#compute the actuator->surface operator once.
+            self.surfaceCacheDir=self.config.getVal("dmSurfaceCacheDir",default=None,raiseerror=0)
             self.subtractTipTilt=self.config.getVal("subtractTipTilt",default=0)
             self.monteNoll=None
             self.mirrorModes=None
@@ -109,7 +114,8 @@ class dm(base.aobase.aobase):
                 self.actFlattening=config.getVal("actFlattening",default=1.)#flattening of gradients, default 1., should be between 0-1.
                 self.mirrorSurface=MirrorSurface(self.interpType,self.dmpup,self.nact,1,
                                                  self.actoffset,self.actCoupling,self.actFlattening,
-                                                 interpolationNthreads = self.interpolationNthreads,stuckActs=self.stuckActs)
+                                                 interpolationNthreads = self.interpolationNthreads,stuckActs=self.stuckActs,
+                                                 precompute=self.precomputeSurface,operatorCacheDir=self.surfaceCacheDir)
                 self.maxStroke=0#deprecated mode dones't have max stroke.
                 self.dmDynamics=None
             else:
@@ -137,7 +143,8 @@ class dm(base.aobase.aobase):
                 self.dmflag=self.dmObj.computeDMPupil(self.idstr[0],centObscuration=r2,retPupil=0)[0]
                 self.actCoupling=self.dmObj.getcoupling(self.idstr[0])
                 self.actSlaves=self.thisdm.getSlaving()
-                self.mirrorSurface = self.thisdm.getMirrorSurface(phsOut = 1,                                                                interpolationNthreads = self.interpolationNthreads)
+                self.mirrorSurface = self.thisdm.getMirrorSurface(phsOut = 1,                                                                interpolationNthreads = self.interpolationNthreads,
+                                                                  precompute=self.precomputeSurface,operatorCacheDir=self.surfaceCacheDir)
                 self.dmDynamics=self.thisdm.dmDynamics#an array of the fraction of shift to new position that occur each timestep, e.g. for a simulation with the WFS updating every 4 frames, this could be [0.5,0.5,0.5,1.] would move 50% after 1 step, 75% after 2 steps, 87.5% after 3 steps, and arrive after 4 steps.
             self.lastactmap=None#only used if dmDynamics are in use.
             self.dynamicStep=0#only used if dmDynamics are in use.
@@ -721,6 +728,8 @@ class dm(base.aobase.aobase):
         paramList.append(base.dataType.dataType(description="dmObj",typ="code",val="import util.dm;dmObj=util.dm.dmOverview(dmInfoList,atmosGeom=atmosGeom)",comment="TODO: dmInfoList is a list of util.dm.dmInfo objects, initialised with (label (for this dm), idlist (list of (dm ID,source ID) or just sourceID, the idstr for a particular DM object (height and direction) and the idstr for a given source direction), height, nact, and various other things for which the defaults may be okay (see the source code))"))
         
         paramList.append(base.dataType.dataType(description="pupil",typ="code",val="import util.tel;pupil=util.tel.Pupil(npup,npup/2,npup/2*telSec/telDiam,wfs_nsubx,wfs_minarea)",comment="Telescope pupil object"))
+        paramList.append(base.dataType.dataType(description="dmPrecomputeSurface",typ="i",val="0",comment="Compute the actuator to DM surface operator once (separable or sparse), rather than interpolating every iteration"))
+        paramList.append(base.dataType.dataType(description="dmSurfaceCacheDir",typ="eval",val="None",comment="Directory in which to cache the DM surface operators, or None"))
         #paramList.append(base.dataType.dataType(description="sourceLam",typ="f",val="1650.",comment="source wavelength"))
         #paramList.append(base.dataType.dataType(description="wfslam",typ="f",val="1650.",comment="source wavelength"))
         #paramList.append(base.dataType.dataType(description="dmInterpType",typ="s",val="spline",comment="interpolation for DM surface"))
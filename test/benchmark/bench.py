@@ -0,0 +1,259 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Benchmark suite, built from the simulations in the test directory.
+
+Runs each configuration for a fixed number of iterations at a given size
+preset (small, medium or elt), collecting the per-module timings (as
+shown in the Timings plot, i.e. Ctrl.meanTiming), startup time and peak
+memory (written by util.Ctrl using the timingFile parameter), and the
+cmod kernel micro-benchmarks (micro.py).  Results are written as json,
+and can be compared against a stored baseline, with a tolerance.
+
+Simulations are run with --user=nopoke, so that only the main loop is
+timed (the reconstructor has no control matrix).
+
+Usage:
+python bench.py --preset=small --results=results.json
+python bench.py --preset=small --baseline=baseline.json --tolerance=0.1
+python bench.py --preset=medium --configs=scao,pyr --no-micro
+
+Exits with status 1 if there are regressions compared with the baseline.
+"""
+import sys,os,re,time,json,getopt,socket,subprocess
+import micro
+
+testdir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#For each configuration, the test directory, simulation script, and for
+#each preset, the parameter file and parameters to override within it
+#(None if the configuration isn't run for this preset).
+configs={
+    "scao":{"dir":"scao","script":"scao.py",
+            "presets":{"small":("params.py",{}),
+                       "medium":("params.py",{"wfs_nsubx":20}),
+                       "elt":("params74x74.py",{})}},
+    "iatmos":{"dir":"iatmos","script":"testiatmos.py",
+              "presets":{"small":("params.xml",{"lgs_nsubx":10}),
+                         "medium":("params.xml",{"lgs_nsubx":40}),
+                         "elt":("params.xml",{})}},
+    "pyr":{"dir":"pyr","script":"scao.py",
+           "presets":{"small":("params.py",{}),
+                      "medium":("params.py",{"wfs_nsubx":20}),
+                      "elt":("params.py",{"wfs_nsubx":74})}},
+    "widefov":{"dir":"widefov","script":"testwidefieldcentroid.py",
+               "presets":{"small":("params.xml",{}),
+                          "medium":("params.xml",{"npup":160,"wfs_nsubx":20}),
+                          "elt":None}},
+    "fresnel":{"dir":"fresnel","script":"testFresnel.py",
+               "presets":{"small":("params.py",{}),
+                          "medium":None,
+                          "elt":None}},
+    }
+configOrder=["scao","iatmos","pyr","widefov","fresnel"]
+iterations={"small":100,"medium":50,"elt":20}
+
+def overrideParams(txt,ext,overrides):
+    """Change the values of variables in the text of a parameter file.
+    @param txt: The parameter file contents
+    @type txt: String
+    @param ext: The file type, .py or .xml
+    @type ext: String
+    @param overrides: Dict of variable name to value
+    @type overrides: Dict
+    @return: The new parameter file contents
+    @rtype: String
+    """
+    for name,val in overrides.items():
+        if ext==".py":
+            txt,n=re.subn(r"^%s\s*=.*$"%re.escape(name),"%s=%r"%(name,val),txt,flags=re.M)
+        else:
+            def repl(m):
+                return re.sub(r'\bvalue="[^"]*"','value="%s"'%str(val),m.group(0))
+            txt,n=re.subn(r'<var\b[^>]*\bname="%s"[^>]*>'%re.escape(name),repl,txt)
+        if n==0:
+            raise Exception("bench: Parameter %s not found"%name)
+    return txt
+
+def runConfig(name,preset,niters,outdir,extraArgs=[]):
+    """Run a simulation and return its timing report.
+    @param name: The configuration name (a key of configs)
+    @type name: String
+    @param preset: small, medium or elt
+    @type preset: String
+    @param niters: Number of iterations
+    @type niters: Int
+    @param outdir: Directory for parameter files, logs and timing reports
+    @type outdir: String
+    @return: The timing report (from util.Ctrl) plus exit status and wall time, or None if not run for this preset
+    @rtype: Dict
+    """
+    cfg=configs[name]
+    p=cfg["presets"].get(preset)
+    if p is None:
+        return None
+    paramfile,overrides=p
+    cwd=os.path.join(testdir,cfg["dir"])
+    paramfile=os.path.join(cwd,paramfile)
+    tag="%s_%s"%(name,preset)
+    if len(overrides)>0:
+        ext=os.path.splitext(paramfile)[1]
+        txt=overrideParams(open(paramfile).read(),ext,overrides)
+        paramfile=os.path.join(outdir,tag+ext)
+        open(paramfile,"w").write(txt)
+    timingFile=os.path.join(outdir,tag+"_timing%d.json")
+    if os.path.exists(timingFile%0):
+        os.unlink(timingFile%0)
+    cmd=[sys.executable,cfg["script"],paramfile,"--iterations=%d"%niters,"--nostdin","--user=nopoke",
+         "--param=this.globals.timingFile=%r"%timingFile]+extraArgs
+    print "INFORMATION bench: Running %s (%s)"%(tag," ".join(cmd))
+    log=open(os.path.join(outdir,tag+".log"),"w")
+    t1=time.time()
+    status=subprocess.call(cmd,cwd=cwd,stdout=log,stderr=subprocess.STDOUT)
+    t2=time.time()-t1
+    log.close()
+    if os.path.exists(timingFile%0):
+        res=json.load(open(timingFile%0))
+    else:
+        print "WARNING bench: %s produced no timing report - see %s"%(tag,os.path.join(outdir,tag+".log"))
+        res={}
+    res["status"]=status
+    res["wallTime"]=t2
+    print "INFORMATION bench: %s status %d, frame time %s, init time %s, peak memory %sMB"%(tag,status,str(res.get("frameTime")),str(res.get("initTime")),str(res.get("maxRSS")))
+    return res
+
+def getMetrics(results):
+    """Return a dict of metric name to value (lower is better) from a results dict"""
+    m={}
+    for name,res in results.get("configs",{}).items():
+        if res is None or res.get("status")!=0:
+            continue
+        for key in ["frameTime","initTime","maxRSS"]:
+            if res.get(key) is not None:
+                m["%s.%s"%(name,key)]=res[key]
+        for mod in res.get("modules",[]):
+            m["%s.%s"%(name,mod["name"])]=mod["mean"]
+    for name,t in results.get("micro",{}).items():
+        if t is not None:
+            m["micro.%s"%name]=t
+    return m
+
+def compare(results,baseline,tolerance=0.1,minTime=1e-4):
+    """Compare results with a baseline.
+    @param tolerance: Fractional increase allowed before a regression is reported
+    @type tolerance: Float
+    @param minTime: Module timings smaller than this (s) in the baseline are not compared, since dominated by noise
+    @type minTime: Float
+    @return: List of (metric, baseline value, new value) for the regressions
+    @rtype: List
+    """
+    if baseline.get("preset")!=results.get("preset"):
+        print "WARNING bench: Baseline preset %s differs from %s"%(baseline.get("preset"),results.get("preset"))
+    new=getMetrics(results)
+    base=getMetrics(baseline)
+    keys=base.keys()
+    keys.sort()
+    regressions=[]
+    print "%-50s %12s %12s %8s"%("Metric","Baseline","New","Change")
+    for key in keys:
+        if not new.has_key(key):
+            print "%-50s %12.4g %12s"%(key,base[key],"missing")
+            continue
+        b=base[key]
+        n=new[key]
+        change=(n-b)/b if b>0 else 0.
+        flag=""
+        if change>tolerance and (key.endswith(".maxRSS") or b>=minTime):
+            flag=" REGRESSION"
+            regressions.append((key,b,n))
+        elif change<-tolerance:
+            flag=" improved"
+        print "%-50s %12.4g %12.4g %+7.1f%%%s"%(key,b,n,change*100,flag)
+    return regressions
+
+def usage():
+    print __doc__
+    print "Options:\n--preset=small|medium|elt\n--configs=name,name (from %s)\n--iterations=niters (default %s)\n--outdir=directory for logs etc (default benchout)\n--results=results.json\n--baseline=baseline.json (to compare against)\n--tolerance=fraction (default 0.1)\n--nthreads=threads for micro-benchmarks\n--no-micro\n--micro-only\nAny arguments after -- are passed to the simulations."%(",".join(configOrder),str(iterations))
+
+def main():
+    extraArgs=[]
+    argv=sys.argv[1:]
+    if "--" in argv:
+        extraArgs=argv[argv.index("--")+1:]
+        argv=argv[:argv.index("--")]
+    optlist,arglist=getopt.gnu_getopt(argv,"h",["preset=","configs=","iterations=","outdir=","results=","baseline=","tolerance=","nthreads=","no-micro","micro-only","help"])
+    preset="small"
+    names=configOrder
+    niters=None
+    outdir="benchout"
+    resultsFile="results.json"
+    baselineFile=None
+    tolerance=0.1
+    nthreads=1
+    doMicro=1
+    doSims=1
+    for o,a in optlist:
+        if o=="--preset":
+            preset=a
+        elif o=="--configs":
+            names=a.split(",")
+        elif o=="--iterations":
+            niters=int(a)
+        elif o=="--outdir":
+            outdir=a
+        elif o=="--results":
+            resultsFile=a
+        elif o=="--baseline":
+            baselineFile=a
+        elif o=="--tolerance":
+            tolerance=float(a)
+        elif o=="--nthreads":
+            nthreads=int(a)
+        elif o=="--no-micro":
+            doMicro=0
+        elif o=="--micro-only":
+            doSims=0
+        elif o in ["-h","--help"]:
+            usage()
+            sys.exit(0)
+    if preset not in iterations:
+        raise Exception("bench: Unknown preset %s"%preset)
+    for name in names:
+        if name not in configs:
+            raise Exception("bench: Unknown configuration %s"%name)
+    if niters is None:
+        niters=iterations[preset]
+    outdir=os.path.abspath(outdir)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    results={"preset":preset,"iterations":niters,"host":socket.gethostname(),
+             "date":time.strftime("%Y-%m-%d %H:%M:%S"),"configs":{},"micro":{}}
+    if doSims:
+        for name in names:
+            results["configs"][name]=runConfig(name,preset,niters,outdir,extraArgs)
+    if doMicro:
+        results["micro"]=micro.run(preset,nthreads)
+    f=open(resultsFile,"w")
+    json.dump(results,f,indent=1,sort_keys=True)
+    f.close()
+    print "INFORMATION bench: Written results to %s"%resultsFile
+    if baselineFile is not None:
+        regressions=compare(results,json.load(open(baselineFile)),tolerance)
+        if len(regressions)>0:
+            print "ERROR bench: %d regressions compared with %s"%(len(regressions),baselineFile)
+            sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,144 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Micro-benchmarks of the cmod kernels that dominate simulation time:
+cent (Shack-Hartmann image formation and centroiding), iscrn (screen
+interpolation, as used by iatmos), interp (spline interpolation, as
+used by the DMs), fft (FFTW, as used by science) and utils.dot (matrix
+vector multiplication, as used by the reconstructors).
+
+Can be run standalone (python micro.py [small|medium|elt]), or from
+bench.py.  Times are seconds per call (the minimum of several repeats).
+"""
+import sys,time
+import numpy
+
+#sizes for each preset: (nsubx for cent, npup for iscrn/interp, nfft, nacts for dot).
+presets={"small":(8,64,128,1000),
+         "medium":(20,160,256,5000),
+         "elt":(74,592,512,10000)}
+
+def timeFunc(func,nrepeat=5,minTime=0.05):
+    """Time a function call.
+    @param func: The function (no arguments)
+    @type func: Function
+    @param nrepeat: Number of repeats
+    @type nrepeat: Int
+    @param minTime: Minimum duration of each repeat (s)
+    @type minTime: Float
+    @return: Seconds per call (minimum over the repeats)
+    @rtype: Float
+    """
+    func()#warm up.
+    n=1
+    while 1:
+        t1=time.time()
+        for i in xrange(n):
+            func()
+        t=time.time()-t1
+        if t>=minTime:
+            break
+        n*=2
+    best=t/n
+    for r in range(nrepeat-1):
+        t1=time.time()
+        for i in xrange(n):
+            func()
+        best=min(best,(time.time()-t1)/n)
+    return best
+
+def benchCent(nsubx,nthreads):
+    import util.tel,util.centroid
+    phasesize=8
+    npup=nsubx*phasesize
+    pup=util.tel.Pupil(npup,npup/2.,0)
+    phs=numpy.random.normal(0,1,(npup,npup)).astype(numpy.float32)
+    c=util.centroid.centroid(nsubx,pup,phase=phs,phasesize=phasesize,fftsize=phasesize*2,clipsize=phasesize*2,
+                             nimg=phasesize,ncen=phasesize,sig=1e6,addPoisson=1,readnoise=1.)
+    c.initMem()
+    c.finishInit()
+    c.initialiseCmod(nthreads,0,1)
+    control={"cal_source":0}
+    t=timeFunc(lambda:c.runCalc(control))
+    c.closeCmod()
+    return t
+
+def benchIscrn(npup,nthreads):
+    import cmod.iscrn
+    scrn=numpy.random.normal(0,1,(npup*2,npup*2))
+    out=numpy.zeros((npup,npup),numpy.float32)
+    interpStruct=cmod.iscrn.initialiseInterp(scrn,None,30.,out,1.,None,nthreads,1,1)
+    return timeFunc(lambda:cmod.iscrn.rotShiftWrapSplineImageThreaded(interpStruct,0.3,0.7,0))
+
+def benchInterp(npup,nthreads):
+    import cmod.interp
+    nact=npup/8+1
+    acts=numpy.random.normal(0,1,(nact,nact)).astype(numpy.float32)
+    x2=(numpy.arange(nact)*(npup-1.)/(nact-1)).astype(numpy.float64)
+    x=numpy.arange(npup).astype(numpy.float64)
+    out=numpy.zeros((npup,npup),numpy.float32)
+    return timeFunc(lambda:cmod.interp.gslCubSplineInterp(acts,x2,x2,x,x,out,0,nthreads))
+
+def benchFFT(nfft,nthreads):
+    import cmod.fft
+    inarr=numpy.random.normal(0,1,(nfft,nfft)).astype(numpy.complex64)
+    outarr=numpy.zeros((nfft,nfft),numpy.complex64)
+    cmod.fft.InitialiseThreading(nthreads)
+    plan=cmod.fft.Plan(inarr,outarr)
+    t=timeFunc(lambda:cmod.fft.ExecutePlan(plan))
+    cmod.fft.FreePlan(plan)
+    return t
+
+def benchDot(nacts,nthreads):
+    import cmod.utils
+    rmx=numpy.random.normal(0,1,(nacts,nacts*2)).astype(numpy.float32)
+    cents=numpy.random.normal(0,1,(nacts*2,)).astype(numpy.float32)
+    out=numpy.zeros((nacts,),numpy.float32)
+    return timeFunc(lambda:cmod.utils.dot(rmx,cents,out,nthreads))
+
+def run(preset="small",nthreads=1,kernels=None):
+    """Run the micro-benchmarks.
+    @param preset: small, medium or elt
+    @type preset: String
+    @param nthreads: Number of threads to give the kernels
+    @type nthreads: Int
+    @param kernels: List of kernels to run, or None for all
+    @type kernels: List of String
+    @return: Dict of kernel name to seconds per call (None if it failed)
+    @rtype: Dict
+    """
+    nsubx,npup,nfft,nacts=presets[preset]
+    funcs=[("cent",benchCent,nsubx),("iscrn",benchIscrn,npup),("interp",benchInterp,npup),
+           ("fft",benchFFT,nfft),("utils.dot",benchDot,nacts)]
+    res={}
+    for name,func,size in funcs:
+        if kernels is not None and name not in kernels:
+            continue
+        try:
+            res[name]=func(size,nthreads)
+            print "INFORMATION micro: %s (%d): %gs"%(name,size,res[name])
+        except:
+            print "WARNING micro: %s failed: %s"%(name,str(sys.exc_info()[1]))
+            res[name]=None
+    return res
+
+if __name__=="__main__":
+    preset="small"
+    if len(sys.argv)>1:
+        preset=sys.argv[1]
+    nthreads=1
+    if len(sys.argv)>2:
+        nthreads=int(sys.argv[2])
+    run(preset,nthreads)
@@ -9,7 +9,7 @@ import util.Ctrl
 #Demonstration of physical optics propagation for the atmosphere.
 
 ctrl=util.Ctrl.Ctrl(globals=globals())
-ctrl.doInitialPokeThenRun()
+if not "nopoke" in ctrl.userArgList:ctrl.doInitialPokeThenRun()
 nlayer=ctrl.config.getVal("nlayer")
 scrnList=[]
 lDict={}
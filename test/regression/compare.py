@@ -0,0 +1,35 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Comparison used by the regression checks in this directory."""
+import numpy
+
+def check(name,res,ref,tol):
+    """Compare res with ref, printing PASS or FAIL.
+    @param name: Description of the check
+    @type name: String
+    @param res: Result of the optimised implementation
+    @type res: numpy array
+    @param ref: Result of the simple implementation
+    @type ref: numpy array
+    @param tol: Maximum allowed error, relative to the largest value in ref
+    @type tol: Float
+    @return: 1 if passed, 0 otherwise
+    @rtype: Int
+    """
+    err=numpy.abs(res-ref).max()/numpy.abs(ref).max()
+    ok=int(err<tol)
+    print "%s %s: max relative error %g (tolerance %g)"%("PASS" if ok else "FAIL",name,err,tol)
+    return ok
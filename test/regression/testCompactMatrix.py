@@ -0,0 +1,65 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check util.compactMatrix.dot (the fused decompress and multiply,
+cmod.utils.compactMvm) against a dense numpy multiply, for each format,
+both orientations, and a square matrix."""
+import sys
+import numpy
+try:
+    import cmod.utils
+except ImportError:
+    print "cmod.utils not built - not testing compactMatrix"
+    sys.exit(0)
+import util.compactMatrix
+from compare import check
+
+#relative tolerance against the original matrix, for each format.
+tolerances={"compressed":1e-3,"float16":2e-3,"bfloat16":2e-2,"int8":3e-2,"int16":1e-3}
+
+def test():
+    if not hasattr(cmod.utils,"compactMvm"):
+        print "WARNING cmod.utils.compactMvm not built - testing the blockwise fallback"
+    r=numpy.random.RandomState(0)
+    ok=1
+    for shape in [(300,200),(200,300),(250,250)]:
+        mx=r.normal(size=shape).astype(numpy.float32)
+        vrow=r.normal(size=(shape[0],)).astype(numpy.float32)#for vrow.mx
+        vcol=r.normal(size=(shape[1],)).astype(numpy.float32)#for mx.vcol
+        for fmt in util.compactMatrix.formats.keys():
+            m=util.compactMatrix.compactMatrix(mx,fmt,nthreads=2,mbits=15)
+            dec=m.toFloat()
+            name="%s %s"%(fmt,str(shape))
+            res=m.dot(vcol,transpose=0)
+            ok&=check(name+" mx.v vs decompressed",res,numpy.dot(dec,vcol),1e-5)
+            ok&=check(name+" mx.v vs dense",res,numpy.dot(mx,vcol),tolerances[fmt])
+            res=m.dot(vrow,transpose=1)
+            ok&=check(name+" v.mx vs decompressed",res,numpy.dot(vrow,dec),1e-5)
+            ok&=check(name+" v.mx vs dense",res,numpy.dot(vrow,mx),tolerances[fmt])
+            if shape[0]!=shape[1]:#orientation deduced from the vector size.
+                ok&=check(name+" deduced v.mx",m.dot(vrow),numpy.dot(vrow,dec),1e-5)
+                ok&=check(name+" deduced mx.v",m.dot(vcol),numpy.dot(dec,vcol),1e-5)
+            else:
+                try:
+                    m.dot(vcol)
+                except Exception:
+                    print "PASS %s square matrix without transpose raises"%name
+                else:
+                    print "FAIL %s square matrix without transpose should raise"%name
+                    ok=0
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
@@ -0,0 +1,168 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check the batched Fresnel propagation (util.atmos.fresnelPropagator,
+with the cached factors from getFresnelPropFactor) against propagating
+each direction on its own in complex128, with numpy.fft and the kernel
+from computeFresnelKernel, through several layers, including a LGS
+which is below the top layer.  Then check util.atmos.doPhysPropBatch on
+several util.atmos.atmos objects, grouped by groupPhysPropBatch as in
+physProp, against propagating each direction on its own."""
+import sys
+import numpy
+try:
+    import cmod.fft
+    import util.atmos
+except ImportError,msg:
+    print "%s - not testing Fresnel propagation"%str(msg)
+    sys.exit(0)
+from compare import check
+
+n=64
+scale=4.2/16
+lam=1650e-9
+layerAlt=[10000.,4000.,0.]#from the top.
+#the layers seen by each direction (the last is a LGS at 5km).
+dirLayers=[[0,1,2],[0,1,2],[1,2]]
+
+def propDist(j):
+    """Distance from layer j down to the next layer, or the ground."""
+    if j==len(layerAlt)-1:
+        return layerAlt[j]
+    return layerAlt[j]-layerAlt[j+1]
+
+def refPropagate(phsList,layers):
+    """Propagate a single direction, one layer at a time."""
+    amp=None
+    for j in range(len(layerAlt)):
+        if j not in layers:
+            continue
+        if amp is None:
+            amp=numpy.exp(1j*phsList[j])
+        else:
+            amp=amp*numpy.exp(1j*phsList[j])
+        if layerAlt[j]!=0:
+            kernel=util.atmos.computeFresnelKernel(n,propDist(j),scale,lam)
+            amp=numpy.fft.ifft2(numpy.fft.fft2(amp)*kernel)
+    return amp
+
+#for the atmos objects.
+npup=64
+telDiam=4.2
+pad=8#margin around the pupil in the phase screens
+atmosAlt={"low":4000.,"ground":0.,"high":10000.}
+#source altitude (-1 for NGS), wavelength (nm), theta, phi.
+sources=[(-1,1650.,0.,0.),(-1,1650.,5.,30.),(5000.,1650.,0.,0.),(-1,500.,0.,0.)]
+groupsExpected=[[0,1,2],[3]]
+
+def makeAtmos(screens):
+    keys=atmosAlt.keys()
+    parent={}
+    colAdd={}
+    rowAdd={}
+    offset={}
+    for key in keys:
+        parent[key]=None
+        colAdd[key]=1
+        rowAdd[key]=1
+        offset[key]=npup/2+pad
+    interpPhs=numpy.zeros((npup,npup),numpy.float64)#shared, as in physProp
+    atmosList=[]
+    for alt,lam,theta,phi in sources:
+        atm=util.atmos.atmos(parent,alt,lam,theta,phi,npup,None,colAdd,rowAdd,atmosAlt,screens,telDiam/npup,offset,offset,telDiam=telDiam)
+        atm.initMem(None,interpPhs)
+        atmosList.append(atm)
+    return atmosList
+
+def refPhysProp(atm,screens,posDict):
+    """Propagate a single direction, one layer at a time, starting once
+    a layer is seen."""
+    keys=sorted(atmosAlt.keys(),key=lambda k:-atmosAlt[k])
+    amp=None
+    for j in range(len(keys)):
+        alt=atmosAlt[keys[j]]
+        if 0<atm.sourceAlt<alt:
+            continue
+        phs=atm.getLayerPhase(keys[j],screens,posDict,posDict).astype(numpy.float64)
+        if amp is None:
+            amp=numpy.exp(1j*phs)
+        else:
+            amp=amp*numpy.exp(1j*phs)
+        if alt!=0:
+            if j==len(keys)-1:
+                dist=alt
+            else:
+                dist=alt-atmosAlt[keys[j+1]]
+            kernel=util.atmos.computeFresnelKernel(npup,dist,telDiam/npup,atm.sourceLam*1e-9)
+            amp=numpy.fft.ifft2(numpy.fft.fft2(amp)*kernel)
+    return amp
+
+def testAtmos(r):
+    ok=1
+    ns=npup+2*pad+2
+    screens={}
+    posDict={}
+    for key in atmosAlt.keys():
+        screens[key]=r.normal(scale=2.,size=(ns,ns))
+        posDict[key]=0.
+    atmosList=makeAtmos(screens)
+    groups=util.atmos.groupPhysPropBatch(atmosList)
+    if [[atmosList.index(atm) for atm in g] for g in groups]==groupsExpected:
+        print "PASS atmos objects grouped by wavelength"
+    else:
+        print "FAIL atmos grouping %s, expected %s"%(str([[atmosList.index(atm) for atm in g] for g in groups]),str(groupsExpected))
+        return 0
+    phs=atmosList[0].getLayerPhase("high",screens,posDict,posDict)
+    ok&=check("on-axis layer phase",phs,screens["high"][pad:pad+npup,pad:pad+npup]*500./1650,1e-12)
+    for nthreads in [1,2]:
+        for g in groups:
+            prop=util.atmos.fresnelPropagator(npup,len(g),nthreads)
+            util.atmos.doPhysPropBatch(g,screens,posDict,posDict,prop)
+        for i in range(len(atmosList)):
+            atm=atmosList[i]
+            ref=refPhysProp(atm,screens,posDict)
+            ok&=check("%d threads, atmos direction %d"%(nthreads,i),atm.amp*numpy.exp(1j*atm.phs),ref,1e-5)
+    return ok
+
+def test():
+    if not hasattr(cmod.fft,"PlanMany"):
+        print "WARNING cmod.fft.PlanMany not built - testing the numpy.fft fallback"
+    r=numpy.random.RandomState(0)
+    ok=1
+    for nthreads in [1,2]:
+        prop=util.atmos.fresnelPropagator(n,len(dirLayers),nthreads)
+        for it in range(2):
+            phs=r.normal(scale=0.5,size=(len(dirLayers),len(layerAlt),n,n)).astype(numpy.float32)
+            prop.reset()
+            for j in range(len(layerAlt)):
+                for i in range(len(dirLayers)):
+                    if j in dirLayers[i]:
+                        prop.addPhase(i,phs[i,j])
+                if layerAlt[j]!=0:
+                    prop.propagate(util.atmos.getFresnelPropFactor(n,propDist(j),scale,lam))
+            for i in range(len(dirLayers)):
+                ref=refPropagate(phs[i].astype(numpy.float64),dirLayers[i])
+                ok&=check("%d threads, iteration %d, direction %d"%(nthreads,it,i),prop.amp[i],ref,1e-5)
+    fac=util.atmos.getFresnelPropFactor(n,propDist(0),scale,lam)
+    if fac is util.atmos.getFresnelPropFactor(n,propDist(0),scale,lam) and not fac.flags.writeable:
+        print "PASS propagation factor cached and read only"
+    else:
+        print "FAIL propagation factor should be cached and read only"
+        ok=0
+    ok&=testAtmos(r)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
@@ -0,0 +1,105 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check the batched pupil phase computation (util.atmos.createPupilPhsBatch
+and iatmos.createPupilPhsMany, using cmod.iscrn.rotShiftWrapSplineImageMany)
+against iatmos.createPupilPhs for each direction, for NGS and LGS (cone
+effect) at different wavelengths and layer lists."""
+import sys
+import numpy
+try:
+    import cmod.iscrn
+    import util.atmos
+    import util.tel
+except ImportError,msg:
+    print "%s - not testing batched pupil phase"%str(msg)
+    sys.exit(0)
+from compare import check
+
+def makeAtmos(npup=64):
+    """Make iatmos objects for a few directions, all writing to one outputData"""
+    r=numpy.random.RandomState(1)
+    layers={"L0":0.,"L1":4000.,"L2":10000.}
+    wind={"L0":10.,"L1":75.,"L2":200.}
+    scrns={}
+    ygrad={}
+    xoff={}
+    yoff={}
+    for k in layers.keys():
+        scrns[k]=r.normal(size=(160,170))
+        ygrad[k]=numpy.gradient(scrns[k])[0].copy()
+        xoff[k]=85.
+        yoff[k]=80.
+    pup=util.tel.Pupil(npup,npup/2,0)
+    out=numpy.zeros((npup,npup),numpy.float32)
+    #alt, wavelength, theta, phi, layers.
+    sources=[(-1,500.,0.,0.,["L0","L1","L2"]),
+             (-1,1650.,20.,45.,["L0","L1","L2"]),
+             (90000.,589.,10.,120.,["L0","L1","L2"]),
+             (8000.,589.,15.,200.,["L0","L1","L2"]),
+             (-1,500.,30.,300.,["L0","L2"])]
+    atmosList=[]
+    for alt,lam,theta,phi,layerList in sources:
+        atmosList.append(util.atmos.iatmos(alt,lam,theta,phi,npup,pup,0,layers,wind,scrns,ygrad,0.1,xoff,yoff,
+                                           layerList,interpolationNthreads=(2,2,1),outputData=out))
+    interpPosRow={}
+    insertPos={}
+    for k in layers.keys():
+        interpPosRow[k]=0.3
+        insertPos[k]=5
+    return atmosList,out,interpPosRow,insertPos
+
+def test():
+    if not hasattr(cmod.iscrn,"rotShiftWrapSplineImageMany"):
+        print "cmod.iscrn.rotShiftWrapSplineImageMany not built - not testing batched pupil phase"
+        return 1
+    atmosList,out,interpPosRow,insertPos=makeAtmos()
+    npup=out.shape[0]
+    ok=1
+    for control in [{"fullPupil":0,"removePiston":1},{"fullPupil":1,"removePiston":0},{"fullPupil":1,"removePiston":1}]:
+        ref=[]
+        for a in atmosList:
+            a.createPupilPhs(interpPosRow,insertPos,control)
+            ref.append(out.copy())
+        for nthreads in [1,3,8]:
+            res=numpy.zeros((len(atmosList),npup,npup),numpy.float32)
+            util.atmos.createPupilPhsBatch(atmosList,[a.positionDict for a in atmosList],interpPosRow,insertPos,control,res,nthreads)
+            for i in range(len(atmosList)):
+                ok&=check("batch %s, %d threads, direction %d"%(str(control),nthreads,i),res[i],ref[i],1e-4)
+        #NGS only, so the ground layer is shared between directions.
+        ngs=[atmosList[0],atmosList[4]]
+        res=numpy.zeros((2,npup,npup),numpy.float32)
+        util.atmos.createPupilPhsBatch(ngs,[a.positionDict for a in ngs],interpPosRow,insertPos,control,res,2)
+        ok&=check("batch NGS %s, direction 0"%str(control),res[0],ref[0],1e-4)
+        ok&=check("batch NGS %s, direction 4"%str(control),res[1],ref[4],1e-4)
+    #One object, several directions (as used by wideField).
+    control={"fullPupil":1,"removePiston":1}
+    a=atmosList[0]
+    positionDictList=[]
+    ref=[]
+    for theta in [0.,5.,10.]:
+        a.sourceTheta=theta
+        a.updatePositionDict()
+        positionDictList.append(a.positionDict)
+        a.createPupilPhs(interpPosRow,insertPos,control)
+        ref.append(out.copy())
+    res=numpy.zeros((3,npup,npup),numpy.float32)
+    a.createPupilPhsMany(positionDictList,interpPosRow,insertPos,control,res,2)
+    for i in range(3):
+        ok&=check("many, direction %d"%i,res[i],ref[i],1e-4)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
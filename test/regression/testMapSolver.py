@@ -0,0 +1,75 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check the CG MAP reconstructor build (util.mapSolver) against a dense
+MAP reconstructor, C_p A^T (A C_p A^T + C_n)^-1, for two DMs with
+partially used actuators: the BTTB covariance product, the diagonal
+used by the preconditioner, the control matrix, and the on the fly
+reconstruction."""
+import sys
+import numpy
+try:
+    import util.mapSolver
+    import util.tel
+except ImportError,msg:
+    print "%s - not testing mapSolver"%str(msg)
+    sys.exit(0)
+from compare import check
+
+def denseCovariance(cov):
+    """The dense matrix of a covariance operator, from its entries."""
+    i,j=numpy.indices((cov.n,cov.n))
+    return cov.entries(i.ravel(),j.ravel()).reshape(cov.n,cov.n)
+
+def makePokeMx(nmodes,ncents,nlocal,seed=1):
+    """A random poke matrix, each mode affecting nlocal neighbouring slopes."""
+    r=numpy.random.RandomState(seed)
+    pmx=numpy.zeros((nmodes,ncents),numpy.float32)
+    for m in range(nmodes):
+        s=(m*ncents)//nmodes
+        pmx[m,s:s+nlocal]=r.normal(size=pmx[m,s:s+nlocal].shape)
+    return pmx
+
+def test():
+    r=numpy.random.RandomState(0)
+    covList=[]
+    for nact,spacing,scale in [(9,0.5,None),(6,1.,"random")]:
+        dmflag=util.tel.Pupil(nact,nact/2.,0).fn
+        n=int(dmflag.sum())
+        modeScale=None
+        if scale is not None:
+            modeScale=r.uniform(0.5,1.5,size=n)
+        covList.append(util.mapSolver.bttbCovariance(nact,spacing,0.15,30.,dmflag,modeScale,lam=1650.))
+    cov=util.mapSolver.blockDiagonalCovariance(covList)
+    Cp=denseCovariance(cov)
+    ok=1
+    x=r.normal(size=(cov.n,3))
+    ok&=check("covariance product",cov.matvec(x),numpy.dot(Cp,x),1e-10)
+    ncents=2*cov.n
+    pmx=makePokeMx(cov.n,ncents,6)
+    A=pmx.T.astype(numpy.float64)
+    noise=r.uniform(0.01,0.1,size=ncents)
+    solver=util.mapSolver.mapSolver(pmx,cov,noise,tol=1e-10,maxiter=1000,sparseThreshold=0.)
+    ACA=numpy.dot(A,numpy.dot(Cp,A.T))
+    ok&=check("diagonal of A C_p A^T",solver.computeDiagonal(),ACA.diagonal(),1e-10)
+    rmx=numpy.dot(numpy.dot(Cp,A.T),numpy.linalg.inv(ACA+numpy.diag(noise)))
+    ok&=check("control matrix",solver.makeControlMatrix(dtype=numpy.float64,blockSize=7),rmx,1e-6)
+    for i in range(3):#warm started from the previous solution.
+        slopes=r.normal(size=ncents)
+        ok&=check("reconstruction %d"%i,solver.reconstruct(slopes),numpy.dot(rmx,slopes),1e-6)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
@@ -0,0 +1,65 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check the precomputed actuator to surface operator of
+util.dm.MirrorSurface (precompute set) against direct interpolation, for
+each interpolation type, with stuck actuators, and when the operator is
+read back from operatorCacheDir."""
+import sys,tempfile,shutil
+import numpy
+try:
+    import util.dm
+except ImportError,msg:
+    print "%s - not testing MirrorSurface operator"%str(msg)
+    sys.exit(0)
+from compare import check
+
+def test():
+    npup=40
+    nact=9
+    r=numpy.random.RandomState(0)
+    actmaps=[r.normal(size=(nact,nact)).astype(numpy.float32) for i in range(3)]
+    #influence functions for the influence type, each a random patch.
+    infFunc=numpy.zeros((nact*nact,npup,npup),numpy.float32)
+    for i in range(nact*nact):
+        y=(i/nact)*npup/nact
+        x=(i%nact)*npup/nact
+        infFunc[i,y:y+npup/nact+2,x:x+npup/nact+2]=r.random_sample((npup/nact+2,npup/nact+2))[:npup-y,:npup-x]
+    cacheDir=tempfile.mkdtemp()
+    ok=1
+    try:
+        for typ in ["spline","linear","bicubic","gaussian","pspline","influence"]:
+            for stuckActs in [None,(3,1,None,0,5)]:
+                args=dict(typ=typ,npup=npup,nact=nact,stuckActs=stuckActs,infFunc=infFunc.copy())
+                ref=util.dm.MirrorSurface(**args)
+                for cache in [None,cacheDir,cacheDir]:#the second use of cacheDir reads the operator back.
+                    op=util.dm.MirrorSurface(precompute=1,operatorCacheDir=cache,**args)
+                    for i in range(len(actmaps)):
+                        res=op.fit(actmaps[i].copy()).copy()
+                        exp=ref.fit(actmaps[i].copy()).copy()
+                        ok&=check("%s (%s operator), stuck %s, cache %s, actmap %d"%(typ,op.operator,str(stuckActs),cache is not None,i),res,exp,1e-4)
+        #A change to a single influence function must not reuse the cached operator.
+        changed=infFunc.copy()
+        changed[nact*nact/2+1]*=2
+        op=util.dm.MirrorSurface("influence",npup,nact,infFunc=changed,precompute=1,operatorCacheDir=cacheDir)
+        ref=util.dm.MirrorSurface("influence",npup,nact,infFunc=changed.copy())
+        a=numpy.ones((nact,nact),numpy.float32)
+        ok&=check("influence, one influence function changed, cached",op.fit(a.copy()).copy(),ref.fit(a.copy()).copy(),1e-4)
+    finally:
+        shutil.rmtree(cacheDir)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
@@ -0,0 +1,83 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check that multi-actuator poke patterns (util.createPokeMx.multiPokePatterns)
+decode to a known poke matrix (decodeMultiPokes), both with at least as
+many patterns as actuators, and with fewer, using the poke matrix support."""
+import sys
+import numpy
+import util.createPokeMx
+from compare import check
+
+def makeGeometry(nact=16,nsubx=15):
+    """Actuator and subap coordinates (units of actuator spacing), fried geometry."""
+    a=numpy.arange(nact)-(nact-1)/2.
+    actCoords=numpy.array([(x,y) for y in a for x in a])
+    s=numpy.arange(nsubx)-(nsubx-1)/2.
+    subapCoords=numpy.array([(x,y) for y in s for x in s])
+    return actCoords,subapCoords
+
+def makePokeMx(actCoords,subapCoords,radius,seed=1):
+    """A random poke matrix, non-zero only within radius of each subap."""
+    support=util.createPokeMx.multiPokeSupport(actCoords,subapCoords,radius)
+    r=numpy.random.RandomState(seed)
+    pmx=numpy.zeros((actCoords.shape[0],subapCoords.shape[0]*2),numpy.float32)
+    pmx[:,:subapCoords.shape[0]]=r.normal(size=support.shape)*support
+    pmx[:,subapCoords.shape[0]:]=r.normal(size=support.shape)*support
+    return pmx
+
+def test():
+    actCoords,subapCoords=makeGeometry()
+    nact=actCoords.shape[0]
+    pmx=makePokeMx(actCoords,subapCoords,1.6)
+    ok=1
+    #Full sets of patterns - exact decode.
+    for pokeType in ["hadamard","random"]:
+        patterns=util.createPokeMx.multiPokePatterns(nact,pokeType,seed=2)
+        response=numpy.dot(patterns,pmx)
+        res=util.createPokeMx.decodeMultiPokes(patterns,response,pokeType)
+        ok&=check("%s, %d patterns for %d actuators"%(pokeType,patterns.shape[0],nact),res,pmx,1e-4)
+    #Fewer patterns than actuators, decoded using the support (a larger radius than the true one).
+    support=util.createPokeMx.multiPokeSupport(actCoords,subapCoords,2.5)
+    npatterns=3*support.sum(0).max()
+    patterns=util.createPokeMx.multiPokePatterns(nact,"random",npatterns,seed=3)
+    response=numpy.dot(patterns,pmx)
+    res=util.createPokeMx.decodeMultiPokes(patterns,response,"random",support,reg=0.)
+    ok&=check("random, %d patterns for %d actuators, using support"%(npatterns,nact),res,pmx,1e-4)
+    out=numpy.zeros(pmx.shape,numpy.float32)
+    util.createPokeMx.decodeMultiPokes(patterns,response,"random",support,reg=1e-4,out=out)
+    ok&=check("random, %d patterns, regularised, into out"%npatterns,out,pmx,1e-2)
+    #With noise, the multi-actuator decode should beat single pokes with the same number of iterations.
+    r=numpy.random.RandomState(4)
+    noise=0.1
+    patterns=util.createPokeMx.multiPokePatterns(nact,"hadamard")
+    response=numpy.dot(patterns,pmx)+r.normal(scale=noise,size=(patterns.shape[0],pmx.shape[1]))
+    res=util.createPokeMx.decodeMultiPokes(patterns,response,"hadamard")
+    errMulti=numpy.std(res-pmx)
+    ok&=check("hadamard with noise (rms %g, single pokes %g)"%(errMulti,noise),res,pmx,0.1)
+    if errMulti>noise/2:
+        print "FAIL hadamard noise rms %g not better than single pokes %g"%(errMulti,noise)
+        ok=0
+    try:
+        util.createPokeMx.decodeMultiPokes(patterns[:nact/2],response[:nact/2],"random")
+    except Exception:
+        print "PASS fewer patterns than actuators without a support raises"
+    else:
+        print "FAIL fewer patterns than actuators without a support should raise"
+        ok=0
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
@@ -0,0 +1,100 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check the batched pyramid image (science.pyramid.Pyramid.calcPyrImg,
+with the modulation steps FFTd pyrBatchSize at a time in pyrNthreads
+threads) against computing each modulation step in turn, with a
+tilted phase screen, an inverse FFT and full complex128 precision."""
+import sys
+import numpy
+try:
+    import cmod.fft
+    import util.tel
+    import science.pyramid
+except ImportError,msg:
+    print "%s - not testing batched pyramid"%str(msg)
+    sys.exit(0)
+from compare import check
+
+npup=32
+nfft=64
+nsteps=8
+modAmp=2.
+
+class WfsInfo:
+    pupil=util.tel.Pupil(npup,npup/2,npup/8).fn
+    nfft=nfft
+    clipsize=nfft
+    nimg=16
+    pyrSteps=nsteps
+    pyrModAmp=modAmp
+    sig=1e6
+    bglevel=0.
+    readoutNoise=0.
+    skyBrightness=0.
+    floor=None
+    addPoisson=0
+
+class Overview:
+    def getWfsByID(self,name):
+        return WfsInfo()
+
+class Config:
+    def __init__(self,vals):
+        self.dict={"npup":npup,"wfsOverview":Overview(),"imageOnly":0}
+        self.dict.update(vals)
+        self.rank=0
+    def setSearchOrder(self,o=None):
+        pass
+    def getVal(self,name,default=None,raiseerror=0):
+        if self.dict.has_key(name):
+            return self.dict[name]
+        return default
+
+class Parent:
+    dataValid=1
+    outputData=numpy.zeros((npup,npup),numpy.float32)
+
+def refPyrImg(phs,pupil,pyrPhaseMask):
+    """The pyramid image computed one modulation step at a time."""
+    xtiltfn=(numpy.fromfunction(lambda x,y:y,(npup,npup))-(npup-1)/2.)/npup
+    tiltfn=-0.5*npup/float(nfft)*2*numpy.pi*(xtiltfn+xtiltfn.T)
+    tiltamp=0.5*npup/float(nfft)*2*numpy.pi*modAmp
+    s=(nfft-npup)//2
+    img=numpy.zeros((nfft,nfft),numpy.float64)
+    pupAmp=numpy.zeros((nfft,nfft),numpy.complex128)
+    for i in range(nsteps):
+        theta=i*2*numpy.pi/float(nsteps)+2*numpy.pi/(2*nsteps)
+        tilt=tiltfn+tiltamp*xtiltfn*numpy.cos(theta)+tiltamp*xtiltfn.T*numpy.sin(theta)
+        pupAmp[s:s+npup,s:s+npup]=pupil*numpy.exp(1j*(phs+tilt))
+        img+=numpy.abs(numpy.fft.ifft2(numpy.fft.fft2(pupAmp)*pyrPhaseMask))**2
+    return img
+
+def test():
+    if not hasattr(cmod.fft,"PlanMany"):
+        print "WARNING cmod.fft.PlanMany not built - testing the numpy.fft fallback"
+    r=numpy.random.RandomState(0)
+    ok=1
+    for batchSize in [1,3,nsteps]:#3 leaves a remainder batch.
+        for nthreads in [1,3]:
+            p=science.pyramid.Pyramid({"closed":Parent()},Config({"pyrBatchSize":batchSize,"pyrNthreads":nthreads}))
+            for i in range(2):
+                phs=r.normal(scale=0.5,size=(npup,npup)).astype(numpy.float32)
+                ref=refPyrImg(phs.astype(numpy.float64),WfsInfo.pupil,p.pyrPhaseMask.astype(numpy.complex128))
+                ok&=check("batch size %d, %d threads, phase %d"%(batchSize,nthreads,i),p.calcPyrImg(phs),ref,1e-4)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
@@ -0,0 +1,60 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check the batched science PSFs (util.sci.scienceBatch, using
+cmod.fft.PlanMany) against computing each science object on its own
+(computeShortExposurePSF), with and without binning of the image, for
+the instantaneous and long exposure images."""
+import sys
+import numpy
+try:
+    import cmod.fft
+    import util.sci
+    import util.tel
+except ImportError,msg:
+    print "%s - not testing scienceBatch"%str(msg)
+    sys.exit(0)
+from compare import check
+
+def test():
+    if not hasattr(cmod.fft,"PlanMany"):
+        print "WARNING cmod.fft.PlanMany not built - testing the numpy.fft fallback"
+    npup=32
+    nfft=64
+    pup=util.tel.Pupil(npup,npup/2,npup/8).fn
+    control={"calcRMS":1,"zero_science":0,"science_integrate":1,"lucky_integrate":0}
+    r=numpy.random.RandomState(0)
+    ok=1
+    for nimg in [64,32,16]:
+        #offsets give each object a different phase tilt.
+        offsets=[(0.,0.),(1.,0.),(0.,-2.),(0.5,1.5)]
+        single=[util.sci.science(npup,nfft,pup,nimg,offsetx=ox,offsety=oy) for ox,oy in offsets]
+        batchObjs=[util.sci.science(npup,nfft,pup,nimg,offsetx=ox,offsety=oy) for ox,oy in offsets]
+        for nthreads in [1,3]:
+            batch=util.sci.scienceBatch(batchObjs,nthreads)
+            for frame in range(3):
+                for i in range(len(offsets)):
+                    phs=r.normal(scale=0.5,size=(npup,npup)).astype(numpy.float32)
+                    single[i].doScienceCalc(phs,control)
+                    batchObjs[i].doScienceCalc(phs,control,batch=batch)
+                batch.run()
+                for i in range(len(offsets)):
+                    name="nimg %d, %d threads, frame %d, object %d"%(nimg,nthreads,frame,i)
+                    ok&=check(name+" instantaneous",batchObjs[i].instImg,single[i].instImg,1e-5)
+                    ok&=check(name+" long exposure",batchObjs[i].longExpImg,single[i].longExpImg,1e-5)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
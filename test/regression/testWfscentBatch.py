@@ -0,0 +1,70 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check batch centroiding (util.centroid.runBatch, as used by wfscent with
+batchCentroiding set) against running each centroid object on its own
+(runCalc).  Photon and read noise are included, so this also checks that
+each WFS keeps its own random number stream when batched."""
+import sys
+import numpy
+try:
+    import cmod.cent
+    import util.centroid
+    import util.tel
+except ImportError,msg:
+    print "%s - not testing batch centroiding"%str(msg)
+    sys.exit(0)
+from compare import check
+
+def makeCentroid(nsubx,phasesize,sig,seed,nthreads):
+    """A centroid object set up as wfscent does, with its own phase array"""
+    npup=nsubx*phasesize
+    phase=numpy.zeros((npup,npup),numpy.float32)
+    c=util.centroid.centroid(nsubx,util.tel.Pupil(npup,npup/2,0,nsubx),phase=phase,fftsize=phasesize*2,
+                             binfactor=None,phasesize=phasesize,nimg=phasesize,ncen=phasesize,
+                             readnoise=1.,readbg=0.,addPoisson=1,sig=sig,seed=seed)
+    c.initMem()
+    c.finishInit()
+    c.initialiseCmod(nthreads,0,seed)
+    c.takeReference({"cal_source":0})
+    c.outputData[:]=0
+    return c
+
+def test():
+    if not hasattr(cmod.cent,"runBatch"):
+        print "cmod.cent.runBatch not built - not testing batch centroiding"
+        return 1
+    nsubx=8
+    phasesize=8
+    #signal and seed for each WFS.
+    wfsParams=[(1000.,1),(300.,2),(5000.,3)]
+    #one thread each, since cmod.cent has a random number stream per thread.
+    single=[makeCentroid(nsubx,phasesize,sig,seed,1) for sig,seed in wfsParams]
+    batch=[makeCentroid(nsubx,phasesize,sig,seed,1) for sig,seed in wfsParams]
+    r=numpy.random.RandomState(0)
+    ok=1
+    for frame in range(3):
+        for i in range(len(wfsParams)):
+            phs=r.normal(scale=0.5,size=single[i].phase.shape).astype(numpy.float32)
+            single[i].phase[:]=phs
+            batch[i].phase[:]=phs
+            single[i].runCalc({"cal_source":0})
+        util.centroid.runBatch(batch,{"cal_source":0})
+        for i in range(len(wfsParams)):
+            ok&=check("frame %d, WFS %d"%(frame,i),batch[i].outputData,single[i].outputData,1e-5)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
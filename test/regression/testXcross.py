@@ -0,0 +1,147 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check the vectorised cross-correlation centroiding of science.xcross
+(initial_img_batch and f_subpixel_batch, all subapertures at once)
+against the per-subaperture computation, for each correlation algorithm
+(CA_mode) and subpixel interpolation method, on shifted extended
+source images."""
+import sys
+import numpy
+import numpy.fft as fft
+try:
+    import scipy.ndimage
+    import science.xcross
+except ImportError,msg:
+    print "%s - not testing xcross"%str(msg)
+    sys.exit(0)
+from compare import check
+
+class Config:
+    def __init__(self,vals):
+        self.dict=vals
+        self.rank=0
+    def setSearchOrder(self,o=None):
+        pass
+    def getVal(self,name,default=None,raiseerror=0):
+        if self.dict.has_key(name):
+            return self.dict[name]
+        return default
+
+def refInitialImg(xc,ref):
+    """Normalise a single subimage."""
+    ref1=ref/xc.avg(ref)
+    if xc.init_mode == 0:
+        ref1-=xc.avg(ref1)
+    elif xc.init_mode == 1:
+        bx=numpy.polyfit(xc.linex,ref1.sum(axis=0)/xc.sz_img[0],1)
+        ref1 -= bx[1]+bx[0]*xc.xgrid
+        by=numpy.polyfit(xc.liney,ref1.sum(axis=1)/xc.sz_img[1],1)
+        ref1 -= by[1]+by[0]*xc.ygrid
+    return ref1
+
+def refSubpixel(xc,img):
+    """The shift of a single subimage, one correlation at a time."""
+    nx=xc.sz_img[1]
+    ny=xc.sz_img[0]
+    amp=int(min(nx/4.,ny/4.,10.))
+    if xc.cor_mode != 1:
+        bxsz=int(min(nx/2,ny/2))
+        i0=int((nx-bxsz)/2.)
+        i1=i0+bxsz-1
+        j0=int((ny-bxsz)/2.)
+        j1=j0+bxsz-1
+        sm_ref=xc.ref[i0:i1,j0:j1]
+        cor=numpy.zeros([2*amp+1,2*amp+1])
+        for di in range(-amp,amp+1):
+            for dj in range(-amp,amp+1):
+                im=img[i0+di:i1+di,j0+dj:j1+dj]
+                if xc.cor_mode == 0:
+                    cor[di+amp,dj+amp]=((im-sm_ref)**2).sum()
+                elif xc.cor_mode == 2:
+                    cor[di+amp,dj+amp]=-(im*sm_ref).sum()
+                elif xc.cor_mode == 3 or xc.cor_mode == 4:
+                    cor[di+amp,dj+amp]=(abs(im-sm_ref)).sum()
+                elif xc.cor_mode == 5:
+                    down=((im-xc.avg(im))**2).sum()*((sm_ref-xc.avg(sm_ref))**2).sum()
+                    cor[di+amp,dj+amp]=-((im-xc.avg(im))*(sm_ref-xc.avg(sm_ref))).sum()/numpy.sqrt(down)
+        s=cor.argmin()
+        y0=int(s/cor.shape[1])
+        x0=s%cor.shape[1]
+        y1=y0-amp
+        x1=x0-amp
+    else:
+        cor=-abs(fft.ifft2(fft.fft2(img*xc.wdw)*xc.ref))**2
+        s=cor.argmin()
+        y0=int(s/cor.shape[1])
+        x0=s%cor.shape[1]
+        x1=x0 if x0<nx/2 else -nx+x0
+        y1=y0 if y0<ny/2 else -ny+y0
+    cc=numpy.zeros([3,3])
+    for i in range(3):
+        for j in range(3):
+            cc[j,i]=cor[(y0-1+j)%cor.shape[0],(x0-1+i)%cor.shape[1]]
+    if xc.cor_mode == 4:
+        cc=cc**2
+    if xc.intp_mode == 0 or xc.intp_mode == 2:
+        a2=(sum(cc[2,:])-sum(cc[0,:]))/6.
+        a3=(sum(cc[2,:])-2*sum(cc[1,:])+sum(cc[0,:]))/6.
+        a4=(sum(cc[:,2])-sum(cc[:,0]))/6.
+        a5=(sum(cc[:,2])-2*sum(cc[:,1])+sum(cc[:,0]))/6.
+    else:
+        a2=(cc[2,1]-cc[0,1])/2.
+        a3=(cc[2,1]-2*cc[1,1]+cc[0,1])/2.
+        a4=(cc[1,2]-cc[1,0])/2.
+        a5=(cc[1,2]-2*cc[1,1]+cc[1,0])/2.
+    a6=(cc[2,2]-cc[0,2]-cc[2,0]+cc[0,0])/4.
+    if xc.intp_mode == 0 or xc.intp_mode == 1:
+        a6635=(a6*a6-4.*a3*a5)
+        addy=(2.*a2*a5-a4*a6)/a6635
+        addx=(2.*a3*a4-a2*a6)/a6635
+        y2=y1+addy if abs(addy)<=1 else y1-a2/a3/2.
+        x2=x1+addx if abs(addx)<=1 else x1-a4/a5/2.
+    else:
+        y2=y1-a2/a3/2.
+        x2=x1-a4/a5/2.
+    return x2,y2
+
+def makeImages(nimg,n,seed=0):
+    """An extended source, and n randomly shifted (and noisy) copies."""
+    r=numpy.random.RandomState(seed)
+    src=scipy.ndimage.gaussian_filter(r.random_sample((nimg,nimg)),2.)+0.1
+    imgs=numpy.array([scipy.ndimage.shift(src,r.uniform(-2,2,size=2),mode="wrap") for i in range(n)])
+    imgs+=r.normal(scale=0.001,size=imgs.shape)
+    return src,imgs
+
+def test():
+    nimg=16
+    src,imgs=makeImages(nimg,12)
+    ok=1
+    for mode in ["SDF","CFI","CFF","ADF","ADS","NCF"]:
+        for intp in range(4):
+            xc=science.xcross.xcross(None,Config({"n_wfs_subapt":nimg,"wfs_nsubx":4,"CA_mode":"%s%d"%(mode,intp)}))
+            xc.ref=xc.load_ref(src)
+            init=xc.initial_img_batch(imgs)
+            refInit=numpy.array([refInitialImg(xc,img) for img in imgs])
+            ok&=check("%s%d initial_img"%(mode,intp),init,refInit,1e-12)
+            x2,y2=xc.f_subpixel_batch(init)
+            old=numpy.seterr(divide="ignore",invalid="ignore")
+            ref=numpy.array([refSubpixel(xc,img) for img in refInit])
+            numpy.seterr(**old)
+            ok&=check("%s%d shifts"%(mode,intp),numpy.array([x2,y2]).T,ref,1e-10)
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if test() else 1)
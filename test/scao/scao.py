@@ -44,7 +44,7 @@ dmList=[]
 wfscentList=[]
 reconList=[]
 scienceList=[]
-ctrl.doInitialPokeThenRun()
+if not "nopoke" in ctrl.userArgList:ctrl.doInitialPokeThenRun()
 #Add any personal code after this line and before the next, and it won't get overwritten
 if ctrl.rank==0:
     infScrnList.append(science.infScrn.infScrn(None,ctrl.config,args={},idstr="L0"))
@@ -29,7 +29,7 @@ ctrl=util.Ctrl.Ctrl(globals=globals())
 ctrl.initialCommand("wf.control['cal_source']=1",freq=-1,startiter=0)
 ctrl.initialCommand("wf.control['cal_source']=0",freq=-1,startiter=1)
 ctrl.initialCommand("c.newCorrRef();print 'Done new corr ref'",freq=-1,startiter=1)
-ctrl.doInitialPokeThenRun(startiter=2)
+if not "nopoke" in ctrl.userArgList:ctrl.doInitialPokeThenRun(startiter=2)
 iscrn=science.iscrn.iscrn(None,ctrl.config,idstr="L0-2")
 iatmos=science.iatmos.iatmos({"L0-2":iscrn},ctrl.config,idstr="b")
 dm=science.xinterp_dm.dm(None,ctrl.config,idstr="dma")#this one (with no phase) for the widefield object (which adds the phase)
@@ -75,11 +75,11 @@ class ConnMsg:
         if dataList!=None:
             self.unpickle(dataList)
     def pickle(self):
-        """Create a list of strings from self.
-        @return: A list of [command, action, ret, tag]
+        """Create a list of strings from self, in the order expected by unpickle.
+        @return: A list of [action, command, ret, tag]
         @rtype: List
         """
-        return [self.command,self.action,self.ret,self.tag]
+        return [self.action,self.command,self.ret,self.tag]
     def unpickle(self,data):
         """Populate self from a list of length 4.
         @param data: A list to use to populate self
@@ -132,6 +132,31 @@ class ConnObj:
         #serialise.Send([str],self.sock)
         serialise.Send(connMsg.pickle(),self.sock)
 
+    def subscribe(self,name,decimate=1,roi=None,maxRate=None,mode="latest",nslots=4,tag=None):
+        """Subscribe to telemetry from a module output (see util.telemetry).
+        Data then arrive (use recv) as ["data",tag,{"name":name,"iter":iter,"data":data}].
+        @param name: Module objID, optionally followed by .attribute (default outputData)
+        @type name: String
+        @param decimate: Take a snapshot every decimate iterations
+        @type decimate: Int
+        @param roi: Region of interest, list of (start,stop[,step]) or None for each dimension
+        @type roi: List
+        @param maxRate: Max messages per second
+        @type maxRate: Float
+        @param mode: "latest" or "all"
+        @type mode: String
+        @param nslots: Ring buffer size
+        @type nslots: Int
+        @param tag: The tag for returned data
+        @type tag: String
+        """
+        spec={"name":name,"decimate":decimate,"roi":roi,"maxRate":maxRate,"mode":mode,"nslots":nslots}
+        self.send(ConnMsg(spec,"sub",tag=tag))
+
+    def unsubscribe(self,tag=None):
+        """Remove telemetry subscriptions with tag (or all if None)"""
+        self.send(ConnMsg(None,"unsub",tag=tag))
+
     def recv(self):
         """Receive data from a socket.  
         Expecting data=[info,tag,whatever]
@@ -18,8 +18,8 @@ import types,time,string,select
 
 import numpy
 import sys,thread,threading,os,socket
-import getopt,re
-import base.readConfig,util.SockConn,cmod.shmem,util.serialise
+import getopt,re,zlib
+import base.readConfig,util.SockConn,cmod.shmem,util.serialise,util.profiler,util.scheduler,util.checkpoint
 #import Scientific.MPI
 import base.mpiWrapper
 """
@@ -53,6 +53,8 @@ class Ctrl:
     @type niter: Int
     @cvar thisiter: Current iteration number
     @type thisiter: Int
+    @cvar startiter: Iteration at which the module timings started (the restored iteration, if restored from a checkpoint)
+    @type startiter: Int
     @cvar frametime: Time to compute last iteration
     @type frametime: Float
     @cvar paused: Whether simulation paused or running
@@ -73,6 +75,14 @@ class Ctrl:
     @type config: AOXml instance
     @cvar sockConn: A SockConn object which is listening for external instructions (e.g. from a GUI).
     @type sockConn: SockConn instance
+    @cvar profiler: If the profile parameter is set, a util.profiler.Profiler object, otherwise None.
+    @type profiler: None or Profiler instance
+    @cvar scheduler: If schedulerThreads>1, a util.scheduler.dagScheduler object used to run independent modules concurrently, otherwise None.
+    @type scheduler: None or dagScheduler instance
+    @cvar checkpointer: A util.checkpoint.Checkpointer object, which writes the simulation state every checkpointInterval iterations, and restores from checkpointRestore.
+    @type checkpointer: Checkpointer instance
+    @cvar timingFile: If set (timingFile parameter), a json file to which the module timings, startup time and peak memory are written at the end of the simulation (e.g. for test/benchmark).  Any %d is replaced by the MPI rank.
+    @type timingFile: None or String
     """
     def __init__(self,globals=None,paramfile=[],debug=None):
         """Initialise the Ctrl object.
@@ -89,6 +99,7 @@ class Ctrl:
         self.go=1
         self.niter=-1
         self.thisiter=0
+        self.startiter=0#iteration at which timing started (non-zero if restored from a checkpoint)
         self.frametime=0
         self.paused=0
         self.nextniters=None
@@ -208,6 +219,7 @@ class Ctrl:
         if port is not None:
             port+=self.rank
         self.sockConn=util.SockConn.SockConn(port,globals=self.globals,startThread=1,listenSTDIN=self.listenSTDIN,mpiWorldSize=self.mpiComm.size)
+        self.sockConn.telemetry.maxRate=self.config.getVal("telemetryMaxRate",default=10.,warn=0)#max rate of telemetry messages to each subscriber (Hz).
         os.nice(self.config.getVal("nice",default=nice))
         if self.config.getVal("connectPortDict",default=0,warn=0):
             try:
@@ -217,6 +229,17 @@ class Ctrl:
                 #self.connectPortDict()
             except:
                 print "INFORMATION Unable to connect to portdict.py"
+        base.mpiWrapper.shmtag=self.shmtag
+        if self.config.getVal("mpiAutoShm",default=0,warn=0) and self.mpiComm.size>1:
+            #all ranks must agree on this, since getHostIDs is collective.
+            base.mpiWrapper.hostIDs=self.getHostIDs()
+            base.mpiWrapper.autoShm=1
+        base.mpiWrapper.pipelineDepth=self.config.getVal("mpiPipelineDepth",default=0,warn=0)
+        base.mpiWrapper.pipelineLatency=self.config.getVal("mpiPipelineLatency",default=0,warn=0)
+        self.profiler=None
+        if self.config.getVal("profile",default=0,warn=0):
+            self.profiler=util.profiler.Profiler(self.rank,traceFile=self.config.getVal("profileTraceFile",default="profile%d.json",warn=0),maxEvents=self.config.getVal("profileMaxEvents",default=100000,warn=0))
+        self.timingFile=self.config.getVal("timingFile",default=None,raiseerror=0,warn=0)
         if self.niter==-1:
             try:
                 exptime=self.config.getVal("AOExpTime")
@@ -246,6 +269,22 @@ class Ctrl:
             pass
             #cmod.shmem.cleanUp()
 
+    def getHostIDs(self):
+        """Share an identifier of the node (from the hostname) between all
+        ranks.  Must be called by all ranks.
+        @return: The node identifier for each rank
+        @rtype: List of Int
+        """
+        hostIDs=[]
+        myid=zlib.crc32(socket.gethostname())&0x7fffffff
+        for i in range(self.mpiComm.size):
+            arr=numpy.zeros((1,),numpy.int64)
+            if i==self.rank:
+                arr[0]=myid
+            self.mpiComm.broadcast(arr,i)
+            hostIDs.append(int(arr[0]))
+        return hostIDs
+
     def abort(self,rt=0):
         if self.mpiComm.size==1:
             self.mpiComm.abort()
@@ -455,12 +494,27 @@ class Ctrl:
         for module in compList:
             self.compListNames.append(module.objID)
             module.finalInitialisation()
+            if self.profiler is not None:
+                module.profiler=self.profiler
+        self.scheduler=None
+        nthreads=self.config.getVal("schedulerThreads",default=1,warn=0)
+        if nthreads=="all":
+            nthreads=self.config.getVal("ncpu")
+        if nthreads>1:
+            self.scheduler=util.scheduler.dagScheduler(compList,nthreads,running=self.running)
+            print "INFORMATION Using dataflow scheduler with %d threads.  Dependencies:\n%s"%(nthreads,self.scheduler.describe())
+        self.checkpointer=util.checkpoint.Checkpointer(self.config,self.rank,self.mpiComm)
+        if self.checkpointer.restoreFrom is not None:
+            it=self.checkpointer.restore(compList)
+            if it is not None:
+                self.thisiter=it
         self.simStartTime=time.time()
         print "INFORMATION Took %g seconds to initialise"%(self.simStartTime-self.simInitTime)
         self.thisIterTiming=numpy.zeros((len(compList),),numpy.float64)
         self.meanTiming=numpy.zeros((len(compList),),numpy.float64)
         self.meanTiming2=numpy.zeros((len(compList),),numpy.float64)
         self.meanClock=numpy.zeros((len(compList),),numpy.float64)
+        self.startiter=self.thisiter#the timings are for iterations from here.
         rangeLenCompList=range(len(self.compList))
         self.simctrlXML=self.createQueryObjs()
         self.simctrlXMLRestricted=self.createQueryObjs(addDir=0)
@@ -504,29 +558,46 @@ class Ctrl:
                     print "INFORMATION Ctrl: rank %d (debug=%s) doing iteration %d"%(self.rank,str(self.debug),self.thisiter)
                 pausedMsg=0
                 #t=time.time()
-                for i in rangeLenCompList:
-                    self.compListPos=i
-                    module=compList[i]
-                    if self.running():
-                        if self.debug!=None:
-                            print "INFORMATION Ctrl: starting %s"%module.objID
-                        t1=time.time()
-                        c1=time.clock()
-                        try:
-                            module.doNextIter()#generateNext()
-                        except:
-                            print "ERROR in generate next for %dth module (iter %d)"%(self.compListPos,self.thisiter)
-                            raise
-                        c2=time.clock()-c1#get the CPU time... (resolution typically 0.01s).
-                        t2=time.time()-t1
+                if self.scheduler is not None:
+                    times=self.scheduler.runIter()
+                    for i in rangeLenCompList:
+                        if times[i] is None:#skipped, since no longer running.
+                            continue
+                        t1,t2,c2=times[i]
                         self.thisIterTiming[i]=t2
                         self.meanTiming[i]+=t2
                         self.meanTiming2[i]+=t2*t2
                         self.meanClock[i]+=c2
+                        if self.profiler is not None:
+                            self.profiler.add(compList[i].objID,"iter",t1,t2,c2)
                         if self.debug!=None:
-                            print "INFORMATION Ctrl: Time taken for %s was %g seconds"%(module.objID,t2)
-                    else:
-                        break
+                            print "INFORMATION Ctrl: Time taken for %s was %g seconds"%(compList[i].objID,t2)
+                else:
+                    for i in rangeLenCompList:
+                        self.compListPos=i
+                        module=compList[i]
+                        if self.running():
+                            if self.debug!=None:
+                                print "INFORMATION Ctrl: starting %s"%module.objID
+                            t1=time.time()
+                            c1=time.clock()
+                            try:
+                                module.doNextIter()#generateNext()
+                            except:
+                                print "ERROR in generate next for %dth module (iter %d)"%(self.compListPos,self.thisiter)
+                                raise
+                            c2=time.clock()-c1#get the CPU time... (resolution typically 0.01s).
+                            t2=time.time()-t1
+                            self.thisIterTiming[i]=t2
+                            self.meanTiming[i]+=t2
+                            self.meanTiming2[i]+=t2*t2
+                            self.meanClock[i]+=c2
+                            if self.profiler is not None:
+                                self.profiler.add(module.objID,"iter",t1,t2,c2)
+                            if self.debug!=None:
+                                print "INFORMATION Ctrl: Time taken for %s was %g seconds"%(module.objID,t2)
+                        else:
+                            break
                 #data=parent.next("stickman")
                 #self.frametime=time.time()-t
                 t=time.time()
@@ -534,6 +605,9 @@ class Ctrl:
                 tlast=t
                 self.thisiter+=1
                 #print "Done %d iterations"%self.thisiter
+                sockConn.telemetry.snapshot(self.thisiter,compList)
+                if self.checkpointer.due(self.thisiter):
+                    self.checkpointer.write(self.thisiter,compList)
                 if self.nextniters!=None:
                     self.nextniters-=1
                     if self.nextniters==0:
@@ -560,6 +634,8 @@ class Ctrl:
 ##         for t in tlist:
 ##             if t.getName()!="MainThread":
 ##                 t._Thread__stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
         print "INFORMATION ^^Finished^^ - calling endSim for each module"
         #Sum = sum(self.meanTiming) # UB: to sum up the time spent at modules
         for i in rangeLenCompList:
@@ -569,14 +645,58 @@ class Ctrl:
            #                               self.meanTiming[i]/Sum*100) # UB 2012Jul23
             module.endSim()
         #print "Sum over modules: {0} s".format(Sum) # UB
+        if self.profiler is not None:
+            print "INFORMATION Profile for rank %d:\n%s"%(self.rank,self.profiler.summary())
+            try:
+                self.profiler.writeTrace()
+            except:
+                print "ERROR writing profile timeline %s"%str(self.profiler.traceFile)
         print "INFORMATION waiting at mpi barrier for all other processes to finish"
         self.mpiComm.barrier()#wait til they're all ready to finish - not essential, but nice...
         if cleanShmem:
             cmod.shmem.cleanUp()
         t=time.time()
         print "INFORMATION Total time %gs, running time %gs"%(t-self.simInitTime,t-self.simStartTime)
+        if self.timingFile is not None:
+            try:
+                self.writeTimingReport(self.timingFile,t)
+            except:
+                print "ERROR writing timing report %s"%str(self.timingFile)
         time.sleep(1)#allow a bit of time before abort is called - to allow all semaphores to be cleaned up.
 
+    def writeTimingReport(self,fname,tend=None):
+        """Write the mean module timings (as shown by the Timings plot),
+        startup time and peak memory use, as json.
+        @param fname: The filename.  Any %d is replaced by the MPI rank.
+        @type fname: String
+        @param tend: Time at which the simulation ended, or None for now.
+        @type tend: Float
+        """
+        import json,resource
+        if tend is None:
+            tend=time.time()
+        if "%d" in fname:
+            fname=fname%self.rank
+        n=max(self.thisiter-self.startiter,1)
+        modules=[]
+        for i in range(len(self.compListNames)):
+            mean=self.meanTiming[i]/n
+            modules.append({"name":self.compListNames[i],"mean":mean,
+                            "stdev":numpy.sqrt(max(self.meanTiming2[i]/n-mean*mean,0.)),"total":self.meanTiming[i]})
+        d={"rank":self.rank,"batchno":self.batchno,"simID":self.simID,"niter":self.thisiter,"ntimed":self.thisiter-self.startiter,
+           "initTime":self.simStartTime-self.simInitTime,"runTime":tend-self.simStartTime,
+           "frameTime":sum([m["mean"] for m in modules]),
+           "maxRSS":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.,#MB (linux).
+           "modules":modules}
+        f=open(fname,"w")
+        json.dump(d,f,indent=1)
+        f.close()
+        print "INFORMATION Written timing report to %s"%fname
+
+    def checkpoint(self):
+        """Write a checkpoint of the current state.  Must be called on all ranks."""
+        self.checkpointer.write(self.thisiter,self.compList)
+
     def createQueryObjs(self,addHeader=1,addDir=1):
         """Create XML for all the science objects, such that it can be used
         by a GUI for querying..."""
@@ -616,7 +736,7 @@ class Ctrl:
         s+='<plot title="Reset science" ret="data" when="cmd" texttype="1" wintype="mainwindow">\n<cmd>\nfor obj in ctrl.compList:\n if obj.control.has_key("zero_science"):\n  obj.control["zero_science"]=1\n print obj.control\ndata="Zeroing science"\nprint data</cmd>\n</plot>\n'
         s+="""<plot title="Calibration mode" ret="data" when="cmd" texttype="1" wintype="mainwindow">\n<cmd>\nfor obj in ctrl.compList:\n if obj.control.has_key("cal_source"):\n  obj.control["cal_source"]=1\ndata="Setting cal_source to 1"</cmd>\n</plot>\n"""
         s+="""<plot title="Control status" ret="data" when="cmd" texttype="1" wintype="mainwindow">\n<cmd>\ndata=""\nfor obj in ctrl.compList:\n print '%s: %s'%(obj.objID,str(obj.control))\n data+=obj.objID+": "+str(obj.control)+"\\n"\n</cmd>\n</plot>\n"""
-        s+='<plot title="Timings" ret="data" when="rpt" texttype="1" wintype="ownwindow" textreplace="1">\n<cmd>\ndata=(ctrl.compListNames,ctrl.thisIterTiming,ctrl.meanTiming,ctrl.meanTiming2,ctrl.thisiter,ctrl.frametime,ctrl.meanClock)\n</cmd>\nimport numpy\nres="\tmean\tstdev\tmean cpu clocks\tThis iter\\n"\nfor i in range(len(data[0])):\n  res+="%s:\t%g\t%g\t%g\t%g\\n"%(data[0][i],data[2][i]/data[4],numpy.sqrt(data[3][i]/data[4]-(data[2][i]/data[4])**2),data[6][i]/data[4],data[1][i])\ndata=res+"Frame %d (%g fps, %g spf)"%(data[4],1./data[5],data[5])\n</plot>\n<plot title="Iteration counter" cmd="data=(ctrl.thisiter,ctrl.frametime)" ret="data" when="rpt" texttype="1" wintype="ownwindow" textreplace="1">\ndata="Frame %d (%g fps, %g spf)"%(data[0],1.0/data[1],data[1])\n</plot>\n'
+        s+='<plot title="Timings" ret="data" when="rpt" texttype="1" wintype="ownwindow" textreplace="1">\n<cmd>\ndata=(ctrl.compListNames,ctrl.thisIterTiming,ctrl.meanTiming,ctrl.meanTiming2,ctrl.thisiter,ctrl.frametime,ctrl.meanClock,max(ctrl.thisiter-ctrl.startiter,1))\n</cmd>\nimport numpy\nres="\tmean\tstdev\tmean cpu clocks\tThis iter\\n"\nfor i in range(len(data[0])):\n  res+="%s:\t%g\t%g\t%g\t%g\\n"%(data[0][i],data[2][i]/data[7],numpy.sqrt(data[3][i]/data[7]-(data[2][i]/data[7])**2),data[6][i]/data[7],data[1][i])\ndata=res+"Frame %d (%g fps, %g spf)"%(data[4],1./data[5],data[5])\n</plot>\n<plot title="Iteration counter" cmd="data=(ctrl.thisiter,ctrl.frametime)" ret="data" when="rpt" texttype="1" wintype="ownwindow" textreplace="1">\ndata="Frame %d (%g fps, %g spf)"%(data[0],1.0/data[1],data[1])\n</plot>\n'
         if addHeader:
             s+="</simdata>\n"
         #self.simctrlXML=s#save the XML for the simctrl gui.
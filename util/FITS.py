@@ -18,7 +18,9 @@
 # Functions to read and write FITS image files
 import string
 import numpy
+import numpy.lib.format
 import os.path,os
+import hashlib
 import fcntl
 import traceback
 import distutils.version
@@ -429,14 +431,19 @@ def saveSparse(sp,filename,writeMode="w",hdr=None,doByteSwap=1):
     Write(ind.view(numpy.int32),filename,writeMode="a",doByteSwap=doByteSwap)
     Write(sp.indptr.view(numpy.int32),filename,writeMode="a",doByteSwap=doByteSwap)
 
-def loadSparse(filename,matrixNum=0,doByteSwap=1):
-    """load a scipy.sparse matrix - csc or csr."""
-    f=Read(filename,savespace=1,doByteSwap=doByteSwap)
+def loadSparse(filename,matrixNum=0,doByteSwap=1,lazy=0,cacheDir=None):
+    """load a scipy.sparse matrix - csc or csr.
+    If lazy is set, the file is read with ReadLazy, so only the HDUs of
+    matrixNum are mapped, and the matrix data may be read only."""
+    if lazy:
+        f=ReadLazy(filename,doByteSwap=doByteSwap,cacheDir=cacheDir)
+    else:
+        f=Read(filename,savespace=1,doByteSwap=doByteSwap)
     knownForms=('csr','csc')
     if len(f)==2:
         print "WARNING - loadSparse - %s is not a sparse matrix"%filename
         mx=f[1]
-    elif len(f)%6==0 and len(f[1].shape)==1:
+    elif len(f)%6==0 and int(f[0]["parsed"]["NAXIS"])==1:
         # presuming 1 or more sparse matrices
         numMatrices=len(f)//6
         if matrixNum>=numMatrices:
@@ -474,7 +481,11 @@ def loadSparse(filename,matrixNum=0,doByteSwap=1):
        
         # n.b. the following astype's were view's, but they no longer worked,
         #  perhaps because of a change in the Read function?
-        data=f[1+f_offset] ; indices=f[3+f_offset].astype(numpy.uint32)
+        data=f[1+f_offset]
+        if lazy:#native byte order, so a view is possible.
+            indices=f[3+f_offset].view(numpy.uint32)
+        else:
+            indices=f[3+f_offset].astype(numpy.uint32)
         indptr=f[5+f_offset].astype(numpy.uint32)
         if indptr.shape[0]==(mxShape[int(fmt=='csc')]+1)*2:
            indptr=indptr.astype(numpy.uint64)
@@ -484,8 +495,11 @@ def loadSparse(filename,matrixNum=0,doByteSwap=1):
         print "util.FITS.loadSparse - matrix style not known %s, assuming dense matrix"%filename
     return mx
 
-def loadBlockMatrix(filename,doByteSwap=1):
-    f=Read(filename,savespace=1,doByteSwap=doByteSwap)
+def loadBlockMatrix(filename,doByteSwap=1,lazy=0,cacheDir=None):
+    if lazy:
+        f=ReadLazy(filename,doByteSwap=doByteSwap,cacheDir=cacheDir)
+    else:
+        f=Read(filename,savespace=1,doByteSwap=doByteSwap)
     #if len(f)==2:
     #    mx=f[1]
     #else:
@@ -499,6 +513,233 @@ def saveBlockMatrix(mx,filename,extraHeader=None,doByteSwap=1):
         Write(b,filename,writeMode=wm,extraHeader=extraHeader,doByteSwap=doByteSwap)
         wm="a"
     
+bitpixTypes={8:numpy.uint8,16:numpy.int16,32:numpy.int32,64:numpy.int64,-32:numpy.float32,-64:numpy.float64}
+
+class HDUIndex:
+    """Random access to the HDUs of a FITS file.  The headers are read once
+    (without reading the data), and the data are then memory mapped on
+    request, so that only the pages actually used are read from disk.
+
+    Standard FITS data are big endian, and so need byteswapping.  This can
+    be done:
+     - lazily, using rawData, which returns a memory mapped array with a
+       non-native byte order (numpy swaps elements as they are used).
+     - for a range of rows only, using rows.
+     - for the whole HDU, using data.  If cacheDir is set, a native byte
+       order copy is written there on first access, and memory mapped, so
+       that subsequent calls (and simulations) get the data immediately.
+
+    Use getIndex rather than creating directly, so that the index is reused.
+    Arrays returned by data and rows may be read only.
+    @cvar filename: The FITS file
+    @type filename: String
+    @cvar hdus: For each HDU, a dict with header, raw, offset, shape, dtype and swap
+    @type hdus: List
+    @cvar cacheDir: Directory for native byte order copies, or None
+    @type cacheDir: String
+    """
+    def __init__(self,filename,doByteSwap=1,cacheDir=None):
+        """
+        @param filename: The FITS file
+        @type filename: String
+        @param doByteSwap: As for Read - if zero, data are assumed to be in native byte order
+        @type doByteSwap: Int
+        @param cacheDir: Directory for native byte order copies, or None
+        @type cacheDir: String
+        """
+        self.filename=filename
+        self.doByteSwap=doByteSwap
+        self.cacheDir=cacheDir
+        st=os.stat(filename)
+        self.stamp=(st.st_size,st.st_mtime)
+        self.hdus=[]
+        f=open(filename,"rb")
+        try:
+            pos=0
+            while pos<st.st_size:
+                f.seek(pos)
+                hdr=ReadHeader(f)
+                parsed=hdr["parsed"]
+                bitpix=int(parsed["BITPIX"])
+                if not bitpixTypes.has_key(bitpix):
+                    raise Exception(error+" BITPIX %d not known in %s"%(bitpix,filename))
+                shape=[]
+                for i in range(int(parsed["NAXIS"])):
+                    shape.insert(0,int(parsed["NAXIS%d"%(i+1)]))
+                swap=numpy.little_endian and doByteSwap and parsed.get("UNORDERD")!="T"
+                dtype=numpy.dtype(bitpixTypes[bitpix])
+                self.hdus.append({"header":parsed,"raw":hdr["raw"],"offset":pos+len(hdr["raw"])*80,
+                                  "shape":tuple(shape),"dtype":dtype,"swap":swap,"map":None})
+                pos=f.tell()#ReadHeader has moved to the next HDU.
+        finally:
+            f.close()
+
+    def __len__(self):
+        return len(self.hdus)
+
+    def header(self,hdu):
+        """Return the header of an HDU, as returned by Read"""
+        h=self.hdus[hdu]
+        return {"raw":h["raw"],"parsed":h["header"]}
+
+    def rawData(self,hdu):
+        """Return a read only memory map of the data of an HDU, in the byte
+        order of the file (so no data is read until used).  BSCALE and
+        BZERO are not applied."""
+        h=self.hdus[hdu]
+        if h["map"] is None:
+            dtype=h["dtype"]
+            if h["swap"]:
+                dtype=dtype.newbyteorder()
+            if reduce(lambda x,y:x*y,h["shape"],1)==0:
+                h["map"]=numpy.zeros(h["shape"],dtype)
+            else:
+                #asarray, so that type(data)==numpy.ndarray checks still work.
+                h["map"]=numpy.asarray(numpy.memmap(self.filename,dtype=dtype,mode="r",offset=h["offset"],shape=h["shape"]))
+        return h["map"]
+
+    def scale(self,hdu,data):
+        """Apply BSCALE and BZERO (if present) to data, returning a new array if needed"""
+        hdr=self.hdus[hdu]["header"]
+        bscale=float(hdr.get("BSCALE","1.0"))
+        bzero=float(hdr.get("BZERO","0.0"))
+        if bscale!=1 or bzero!=0:
+            if data.dtype.char in ["b","i","H","h","I","B","l","L"]:
+                data=data*int(bscale)+int(bzero)
+            else:
+                data=data*bscale+bzero
+        return data
+
+    def native(self,arr):
+        """Return arr in native byte order (a copy, if swapped)"""
+        if arr.dtype.isnative:
+            return arr
+        return arr.astype(arr.dtype.newbyteorder())
+
+    def rows(self,hdu,start,end=None):
+        """Return rows start:end (first dimension) of an HDU, reading only
+        these from the file.
+        @param hdu: The HDU number (from 0)
+        @type hdu: Int
+        @param start: First row
+        @type start: Int
+        @param end: Last row (exclusive), or None for start+1
+        @type end: Int
+        @return: The rows, native byte order
+        @rtype: Array
+        """
+        if end==None:
+            end=start+1
+        if self.hdus[hdu]["swap"] and self.cacheDir!=None and self.cacheExists(hdu):
+            return self.scale(hdu,self.data(hdu,scaled=0)[start:end])
+        return self.scale(hdu,self.native(self.rawData(hdu)[start:end]))
+
+    def cacheFilename(self,hdu):
+        key=hashlib.sha1("%s:%d:%r:%d"%(os.path.abspath(self.filename),self.stamp[0],self.stamp[1],hdu)).hexdigest()
+        return os.path.join(self.cacheDir,"fits%s.npy"%key)
+
+    def cacheExists(self,hdu):
+        return os.path.exists(self.cacheFilename(hdu))
+
+    def data(self,hdu,scaled=1):
+        """Return the data of an HDU, in native byte order.  If the data
+        don't need swapping, this is a read only memory map.  Otherwise, if
+        cacheDir is set, a native byte order copy is memory mapped
+        (written on first access), or if not, the data are read and
+        swapped.
+        @param hdu: The HDU number (from 0)
+        @type hdu: Int
+        @param scaled: Whether to apply BSCALE and BZERO
+        @type scaled: Int
+        @return: The data
+        @rtype: Array
+        """
+        h=self.hdus[hdu]
+        raw=self.rawData(hdu)
+        if not h["swap"] or raw.size==0:
+            data=raw
+        elif self.cacheDir!=None:
+            fname=self.cacheFilename(hdu)
+            if not os.path.exists(fname):
+                self.writeCache(hdu,fname)
+            data=numpy.asarray(numpy.load(fname,mmap_mode="r"))
+        else:
+            data=self.native(raw)
+        if scaled:
+            data=self.scale(hdu,data)
+        return data
+
+    def writeCache(self,hdu,fname):
+        """Write a native byte order copy of an HDU, a block at a time"""
+        if not os.path.exists(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                if not os.path.isdir(self.cacheDir):
+                    raise
+        raw=self.rawData(hdu)
+        tmpname="%s.%d.tmp"%(fname,os.getpid())
+        out=numpy.lib.format.open_memmap(tmpname,mode="w+",dtype=self.hdus[hdu]["dtype"],shape=raw.shape)
+        flat=raw.reshape(raw.size)
+        oflat=out.reshape(out.size)
+        step=max(1,(64*1024*1024)//raw.itemsize)
+        for i in range(0,raw.size,step):
+            oflat[i:i+step]=flat[i:i+step]#swaps as it copies.
+        out.flush()
+        del(out,oflat)
+        os.rename(tmpname,fname)
+        print "INFORMATION FITS: Cached native byte order copy of %s HDU %d in %s"%(self.filename,hdu,fname)
+
+indexCache={}
+
+def getIndex(filename,doByteSwap=1,cacheDir=None):
+    """Return the HDUIndex for filename, reusing a previous one if the file
+    hasn't changed.
+    @param filename: The FITS file
+    @type filename: String
+    @param doByteSwap: As for Read
+    @type doByteSwap: Int
+    @param cacheDir: Directory for native byte order copies, or None
+    @type cacheDir: String
+    @return: The index
+    @rtype: HDUIndex
+    """
+    key=(os.path.abspath(filename),doByteSwap,cacheDir)
+    idx=indexCache.get(key)
+    st=os.stat(filename)
+    if idx is None or idx.stamp!=(st.st_size,st.st_mtime):
+        idx=HDUIndex(filename,doByteSwap,cacheDir)
+        indexCache[key]=idx
+    return idx
+
+class HDUList:
+    """A list of header, data, header, data... as returned by Read, but
+    with the data only mapped (see HDUIndex.data) when an entry is used."""
+    def __init__(self,idx):
+        self.idx=idx
+    def __len__(self):
+        return len(self.idx)*2
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i<0:
+            i+=len(self)
+        if i<0 or i>=len(self):
+            raise IndexError("HDUList index out of range")
+        if i%2==0:
+            return self.idx.header(i//2)
+        return self.idx.data(i//2)
+
+def ReadLazy(filename,doByteSwap=1,cacheDir=None):
+    """As Read, but the headers are indexed once (and cached), and data are
+    memory mapped when used, and may be read only.
+    @param cacheDir: Directory for native byte order copies, or None (see HDUIndex)
+    @type cacheDir: String
+    @return: List of header, data, header, data...
+    @rtype: HDUList
+    """
+    return HDUList(getIndex(filename,doByteSwap,cacheDir))
+
 def extractHDU(filename,hduno,outname,overwrite=0):
     """Extracts a given HDU from a fits file, writing it to a new fits file.
     Numbering from 0 - so first HDU is 0."""
@@ -17,6 +17,7 @@
 import socket,serialise,types,os,select,cPickle,thread,time
 import traceback
 import util.ConnObj as ConnObj
+import util.telemetry
 #import Scientific.MPI
 import sys
 class SockConn:
@@ -53,6 +54,7 @@ class SockConn:
      - cmdList - list, of commands to be executed
      - rptCmdList - list, of commands to be executed every iteration
      - fsock - forwading socket
+     - telemetry - util.telemetry.Telemetry, subscriptions to module outputs
 
     @cvar port: port number to listen on
     @type port: int
@@ -78,6 +80,8 @@ class SockConn:
     @type fsock: socket.socket instance
     @cvar globals: global dictionary
     @type globals: Dict
+    @cvar telemetry: Subscriptions to module outputs (actions "sub" and "unsub")
+    @type telemetry: util.telemetry.Telemetry instance
     """
     def __init__(self, port, host="", fwd=None,globals=None,startThread=1,listenSTDIN=1,mpiWorldSize=1):
         """Opens a listening port, and either acts on commands send, or if
@@ -130,6 +134,9 @@ class SockConn:
         self.rptCmdList=[]
         self.fsock=None
         self.globals=globals
+        self.sockLocks={}#so that messages from different threads aren't interleaved.
+        self.sockLocksLock=thread.allocate_lock()
+        self.telemetry=util.telemetry.Telemetry(self)
         if self.fwd!=None:
             self.fsock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.fsock.connect(self.fwd)
@@ -244,8 +251,40 @@ class SockConn:
         @param sock: Socket
         @type sock: socket.socket instance
         """
+        self.telemetry.unsubscribe(sock)
         sock.close()
         self.selIn.remove(sock)
+        self.sockLocksLock.acquire()
+        if self.sockLocks.has_key(sock):
+            del(self.sockLocks[sock])
+        self.sockLocksLock.release()
+
+    def sendMessage(self,msg,sock):
+        """Serialise and send msg to sock, holding a lock for the socket, so
+        that messages sent from different threads (e.g. telemetry) are not
+        interleaved.
+        @param msg: The message, e.g. ["data",tag,dict]
+        @type msg: List
+        @param sock: Socket
+        @type sock: socket.socket instance
+        @return: 0 on success, 1 on failure
+        @rtype: Int
+        """
+        self.sockLocksLock.acquire()
+        lock=self.sockLocks.get(sock)
+        if lock is None:
+            lock=thread.allocate_lock()
+            self.sockLocks[sock]=lock
+        self.sockLocksLock.release()
+        lock.acquire()
+        try:
+            try:
+                serialise.Send(msg,sock)
+            except:
+                return 1
+        finally:
+            lock.release()
+        return 0
         #print "Closed ",sock
 
     def readsock(self,sock):
@@ -262,6 +301,9 @@ class SockConn:
         data.ret (if present) will be list of things to return.
         If data.action=='del':#delete command from regular/cmd list
         this will be deleted...
+        If data.action=='sub':#subscribe to telemetry (see util.telemetry)
+        data.command will be the name of the output, or a dict specifying it.
+        If data.action=='unsub':#remove telemetry subscriptions with data.tag
         @param sock: Socket to read
         @type sock: socket.socket instance
         """
@@ -312,6 +354,14 @@ class SockConn:
             while [data,sock] in self.cmdList:
                 print "Deleting action:",[data,sock]
                 self.cmdList.remove([data,sock])
+        elif action=="sub":
+            try:
+                self.telemetry.subscribe(sock,tag,data.command)
+            except Exception,msg:
+                print "ERROR SockConn - telemetry subscription failed: %s"%str(msg)
+                self.sendMessage(["error",tag,"Subscription failed: %s"%str(msg)],sock)
+        elif action=="unsub":
+            self.telemetry.unsubscribe(sock,tag)
         elif action=="add":
             #prepend data.command to config.postList...
             print "INFORMATION SockConn - got data action add"
@@ -363,9 +413,7 @@ class SockConn:
             #print str(sys.exc_info()),str(sys.exc_info()[1].args)
             #print self.globals
             if sock!=None:
-                try:
-                    serialise.Send(["error",tag,"Command execution failed (%s): %s %s"%(txt,command,msg)],sock)
-                except:
+                if self.sendMessage(["error",tag,"Command execution failed (%s): %s %s"%(txt,command,msg)],sock)!=0:
                     print "ERROR Serialise failed in SockConn.execCmd - couldn't send error message"
         except:
             data.retryCnt+=1
@@ -375,9 +423,7 @@ class SockConn:
                 txt="Cancelling"
             print "ERROR Command exec failed2:",command
             if sock!=None:
-                try:
-                    serialise.Send(["error",tag,"Command execution failed (%s): %s"%(txt,command)],sock)
-                except:
+                if self.sendMessage(["error",tag,"Command execution failed (%s): %s"%(txt,command)],sock)!=0:
                     print "ERROR Serialise failed in SockConn.execCmd - couldn't send error message"
         else:
             rt={}#will return rt to the user.
@@ -397,11 +443,9 @@ class SockConn:
                 if sock!=None:
                     if self.printmsg:
                         print "INFORMATION Sending data over socket"
-                    try:
-                        serialise.Send(["data",tag,rt],sock)
-                    except:
+                    if self.sendMessage(["data",tag,rt],sock)!=0:
                         rtval=1
-                        print "ERROR Serialise failed in SockConn.execCmd for tag %s with keys %s (error: %s %s)"%(str(tag),str(rt.keys()),str(sys.exc_info()),str(sys.exc_info()[1].args))
+                        print "ERROR Serialise failed in SockConn.execCmd for tag %s with keys %s"%(str(tag),str(rt.keys()))
 
         return rtval
     def doCmdList(self,thisiter):
@@ -244,6 +244,43 @@ class analyse:
         for c in remlist:
             connList.remove(c)
         return tag
+    def subscribe(self,name,decimate=1,roi=None,maxRate=None,mode="latest",tag="NOTAG",connList=None):
+        """Subscribe to telemetry of a module output (see util.telemetry),
+        rather than polling with a rpt command.  The data arrive with tag,
+        as {"name":name,"iter":iter,"data":data}.
+        @param name: Module objID, optionally followed by .attribute (default outputData)
+        @type name: String
+        @param decimate: Take a snapshot every decimate iterations
+        @type decimate: Int
+        @param roi: Region of interest, list of (start,stop[,step]) or None for each dimension
+        @type roi: List
+        @param maxRate: Max messages per second
+        @type maxRate: Float
+        @param mode: "latest" or "all"
+        @type mode: String
+        @return: The tag
+        @rtype: String
+        """
+        connList=self.parseConnList(connList)
+        if tag=="NOTAG":
+            tag=self.getTag()
+        spec={"name":name,"decimate":decimate,"roi":roi,"maxRate":maxRate,"mode":mode}
+        for conn in connList[:]:
+            try:
+                serialise.Send(["sub",spec,None,tag],conn)
+            except:
+                connList.remove(conn)
+        return tag
+
+    def unsubscribe(self,tag=None,connList=None):
+        """Remove telemetry subscriptions with tag (all if None)"""
+        connList=self.parseConnList(connList)
+        for conn in connList[:]:
+            try:
+                serialise.Send(["unsub",None,None,tag],conn)
+            except:
+                connList.remove(conn)
+
     def process(self,connList=None,readSocks=1):
         """Process any input data which has an entry in the
         self.dataProcessDict
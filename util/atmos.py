@@ -15,6 +15,7 @@
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from cmod.interp import gslCubSplineInterp,linearshift
 import cmod.iscrn
+import cmod.fft
 import time
 import numpy
 import util.dm
@@ -548,7 +549,7 @@ class atmos:
         self.zenithOld=0.#used to be used when stretching screens - now no longer.
         self.layerAltitude=layerAltitude#these are pre-scaled by zenith.
         self.sortedLayerList=[]
-        self.fresnelKernels={}
+        self.propagator=None#a fresnelPropagator, used by doPhysProp.
         hh=sorted(self.layerAltitude.values())
         for h in hh:
             for key in self.layerList:
@@ -896,90 +897,90 @@ class atmos:
 
 
 
-    def doPhysProp(self,phaseScreens,interpPosColDict,interpPosRowDict,control):
-        """Do a physical (Fresnel) propagation of the phase screens down to telescope pupil.
-        Here, the layers really need to be oversized by approx 4x.  Then, at the end, clip out the middle part...
-        i.e. npup*4.
+    def getLayerPhase(self,key,phaseScreens,interpPosColDict,interpPosRowDict):
+        """Interpolate the phase of a layer along this line of sight into
+        self.interpPhs, scaled to the source wavelength, and expanded to
+        the full pupil for a LGS.
+        @param key: The layer
+        @type key: Anything
+        @return: self.interpPhs
+        @rtype: Array
         """
-        
-        nlayer=len(self.sortedLayerList)
-        complexAmp=None
-        for ii in range(nlayer):#for each atmosphere layer... (increasing in height, but inverted, so start at top.)
-            key=self.sortedLayerList[nlayer-1-ii]#reverse order
-            posDict=self.positionDict[key]
-            if len(posDict)>0:#this layer is used (ie below star height)
-                #print "atmos time2 %g"%(time.time()-t1)
-                interpPosCol=posDict[4]#static offset due to source direction.
-                interpPosRow=posDict[5]#static offset due to source direction.
-                if self.colAdd[key]>=0:#add on to start...
-                    if interpPosColDict[key]>0:
-                        interpPosCol+=1-interpPosColDict[key]
-                else:
-                    if interpPosColDict[key]>0:
-                        interpPosCol+=interpPosColDict[key]
-                    else:
-                        interpPosCol+=1
-                phsShiftY=int(numpy.floor(interpPosCol))
-                tmpcol=interpPosCol
-                interpPosCol-=phsShiftY
+        posDict=self.positionDict[key]
+        interpPosCol=posDict[4]#static offset due to source direction.
+        interpPosRow=posDict[5]#static offset due to source direction.
+        if self.colAdd[key]>=0:#add on to start...
+            if interpPosColDict[key]>0:
+                interpPosCol+=1-interpPosColDict[key]
+        else:
+            if interpPosColDict[key]>0:
+                interpPosCol+=interpPosColDict[key]
+            else:
+                interpPosCol+=1
+        phsShiftY=int(numpy.floor(interpPosCol))
+        interpPosCol-=phsShiftY
 
-                if self.rowAdd[key]>=0:#add on to start
-                    if interpPosRowDict[key]>0:
-                        interpPosRow+=1-interpPosRowDict[key]
-                else:
-                    if interpPosRowDict[key]>0:
-                        interpPosRow+=interpPosRowDict[key]
-                    else:
-                        interpPosRow+=1
-                phsShiftX=int(numpy.floor(interpPosRow))
-                tmprow=interpPosRow
-                interpPosRow-=phsShiftX
+        if self.rowAdd[key]>=0:#add on to start
+            if interpPosRowDict[key]>0:
+                interpPosRow+=1-interpPosRowDict[key]
+        else:
+            if interpPosRowDict[key]>0:
+                interpPosRow+=interpPosRowDict[key]
+            else:
+                interpPosRow+=1
+        phsShiftX=int(numpy.floor(interpPosRow))
+        interpPosRow-=phsShiftX
 
-                #now select the area we're interested in for this target...
-                phs=phaseScreens[key][posDict[1]+phsShiftX:posDict[1]+posDict[3]+1+phsShiftX,
-                                      posDict[0]+phsShiftY:posDict[0]+posDict[2]+1+phsShiftY]
+        #now select the area we're interested in for this target...
+        phs=phaseScreens[key][posDict[1]+phsShiftX:posDict[1]+posDict[3]+1+phsShiftX,
+                              posDict[0]+phsShiftY:posDict[0]+posDict[2]+1+phsShiftY]
 
 
-                linearshift(phs,interpPosCol,interpPosRow,self.interpPhs[:posDict[3],:posDict[2]])
+        linearshift(phs,interpPosCol,interpPosRow,self.interpPhs[:posDict[3],:posDict[2]])
 
 
-                if self.sourceAlt>0:
-                    #this is a LGS... need to project (interpolate/expand up to the full npup sized array.)
-                    x2=posDict[6]
-                    x=posDict[7]
-                    gslCubSplineInterp(self.interpPhs[:posDict[3],:posDict[3]],x2,x2,x,x,self.interpPhs,0,self.interpolationNthreads)
-                #So, now, in interpPhs, we have the phase for this layer.
-                #Add it to the existing complex phase, and propagate to the next layer.
-                if self.sourceLam!=500.:
-                    self.interpPhs*=500./self.sourceLam
-                #if key==self.sortedLayerList[-1]:#first layer
-                if complexAmp is None:
-                    complexAmp=numpy.exp(1j*self.interpPhs)
-                else:#modify phase of existing signal by the new layer phase.
-                    phs=numpy.angle(complexAmp)
-                    phs+=self.interpPhs
-                    amp=numpy.absolute(complexAmp)
-                    complexAmp=amp*numpy.exp(1j*phs)
-                if self.layerAltitude[key]!=0:
-                    if not self.fresnelKernels.has_key(key):
-                        if ii!=nlayer-1:
-                            propagationDist=self.layerAltitude[key]-self.layerAltitude[self.sortedLayerList[nlayer-2-ii]]
-                        else:
-                            propagationDist=self.layerAltitude[key]
-                        print "Computing kernel to propagate %gm"%propagationDist
-                        self.fresnelKernels[key]=self.computeFresnelKernel(complexAmp.shape[0],propagationDist,self.telDiam/self.npup,self.sourceLam*1e-9)#n should be approx 4x or more npup. 
-                    kernel=self.fresnelKernels[key]
-                    #now propagate the phase
-                    temp1=numpy.fft.fft2(complexAmp,s=(kernel.shape[0],kernel.shape[1]))
-                    temp1*=kernel
-                    complexAmp=numpy.fft.ifft2(temp1)#/float(n*n)
-                else:#for the ground layer, no further propagation is needed.
-                     pass
-            else:
-                print "Skipping layer %s"%key
-        #Now get the phase and amplitude.
-        self.phs=numpy.angle(complexAmp)
-        self.amp=numpy.absolute(complexAmp)
+        if self.sourceAlt>0:
+            #this is a LGS... need to project (interpolate/expand up to the full npup sized array.)
+            x2=posDict[6]
+            x=posDict[7]
+            gslCubSplineInterp(self.interpPhs[:posDict[3],:posDict[3]],x2,x2,x,x,self.interpPhs,0,self.interpolationNthreads)
+        if self.sourceLam!=500.:
+            self.interpPhs*=500./self.sourceLam
+        return self.interpPhs
+
+    def getFresnelPropFactor(self,key):
+        """Return the factor (see getFresnelPropFactor) to propagate from
+        layer key down to the next layer, or to the ground.
+        @param key: The layer
+        @type key: Anything
+        @return: The factor, or None for a ground layer
+        @rtype: Array
+        """
+        i=self.sortedLayerList.index(key)
+        if i>0:
+            propagationDist=self.layerAltitude[key]-self.layerAltitude[self.sortedLayerList[i-1]]
+        else:
+            propagationDist=self.layerAltitude[key]
+        if self.layerAltitude[key]==0:#for the ground layer, no further propagation is needed.
+            return None
+        #n should be approx 4x or more npup.
+        return getFresnelPropFactor(self.interpPhs.shape[0],propagationDist,self.telDiam/self.npup,self.sourceLam*1e-9)
+
+    def doPhysProp(self,phaseScreens,interpPosColDict,interpPosRowDict,control):
+        """Do a physical (Fresnel) propagation of the phase screens down to telescope pupil.
+        Here, the layers really need to be oversized by approx 4x.  Then, at the end, clip out the middle part...
+        i.e. npup*4.
+        If self.propagator has not been set (e.g. shared between atmos
+        objects), a single threaded one is created.
+        """
+        if self.propagator is None:
+            self.propagator=fresnelPropagator(self.interpPhs.shape[0])
+        doPhysPropBatch([self],phaseScreens,interpPosColDict,interpPosRowDict,self.propagator)
+        self.physPropOutput(control)
+
+    def physPropOutput(self,control):
+        """Clip the propagated phase and amplitude (self.phs and self.amp)
+        into outputData, removing piston and applying the pupil as required."""
         f=(self.phs.shape[0]-self.outputData.shape[1])//2
         t=f+self.outputData.shape[1]
         phs=self.phs[f:t,f:t]
@@ -1003,19 +1004,156 @@ class atmos:
         #self.outputData[1]/=pfnArea - not needed, this is done in wfscent.
                     
     def computeFresnelKernel(self,n,z,scale,L=500e-9):
-        """n is number of pixels.
-        z is the propagation distance.
-        scale is telDiam/npup
-        L is wavelength in m.
+        return computeFresnelKernel(n,z,scale,L)
+
+
+def computeFresnelKernel(n,z,scale,L=500e-9):
+    """n is number of pixels.
+    z is the propagation distance.
+    scale is telDiam/npup
+    L is wavelength in m.
+    """
+    PropDefocus = numpy.arange(-n/2.0 , n/2.0)**2
+    PropDefocus = numpy.add.outer(PropDefocus,PropDefocus)
+    PropDefocus *= numpy.pi*L*z/(float(n)*scale)**2
+    PropDefocus = numpy.cos(PropDefocus) + 1.0j*numpy.sin(PropDefocus)
+    #PropDefocus = fliparrayc(PropDefocus)
+    PropDefocus=numpy.fft.fftshift(PropDefocus)
+    return PropDefocus
+
+fresnelPropCache={}#shared by all atmos objects, keyed by (n,z,scale,L).
+
+def getFresnelPropFactor(n,z,scale,L=500e-9):
+    """Return the (cached, read only) factor used by fresnelPropagator to
+    propagate a distance z.  This is conj(kernel)/n**2 as complex64, where
+    kernel is from computeFresnelKernel, since the inverse FFT is done as
+    a conjugated forward FFT.  The geometry doesn't change during a
+    simulation, so this is computed once for each layer spacing and
+    wavelength.
+    """
+    key=(n,float(z),float(scale),float(L))
+    fac=fresnelPropCache.get(key)
+    if fac is None:
+        print "INFORMATION atmos: Computing kernel to propagate %gm at %gnm"%(z,L*1e9)
+        fac=(numpy.conjugate(computeFresnelKernel(n,z,scale,L))/float(n*n)).astype(numpy.complex64)
+        fac.flags.writeable=False
+        fresnelPropCache[key]=fac
+    return fac
+
+class fresnelPropagator:
+    """Fresnel (angular spectrum) propagation of a batch of complex
+    amplitudes, in place in a complex64 buffer.  The FFTs for the whole
+    batch are done in one call to a threaded FFTW plan, if cmod.fft
+    supports it.  Only forward plans are needed, the inverse being done as
+    conj(fft(conj(x))).
+    @cvar amp: The complex amplitudes, shape (nbatch,n,n)
+    @type amp: Array
+    @cvar nthreads: Number of FFTW threads
+    @type nthreads: Int
+    """
+    def __init__(self,n,nbatch=1,nthreads=1):
+        """
+        @param n: Size of the (square) complex amplitudes
+        @type n: Int
+        @param nbatch: Number of amplitudes propagated together
+        @type nbatch: Int
+        @param nthreads: Number of FFTW threads
+        @type nthreads: Int
         """
-        PropDefocus = numpy.arange(-n/2.0 , n/2.0)**2
-        PropDefocus = numpy.add.outer(PropDefocus,PropDefocus)
-        PropDefocus *= numpy.pi*L*z/(float(n)*scale)**2
-        PropDefocus = numpy.cos(PropDefocus) + 1.0j*numpy.sin(PropDefocus)
-        #PropDefocus = fliparrayc(PropDefocus)
-        PropDefocus=numpy.fft.fftshift(PropDefocus)
-        return PropDefocus
-                
+        self.n=n
+        self.nbatch=nbatch
+        self.nthreads=nthreads
+        self.amp=numpy.zeros((nbatch,n,n),numpy.complex64)
+        self.phasor=numpy.zeros((n,n),numpy.complex64)
+        self.fftPlan=None
+        if hasattr(cmod.fft,"PlanMany"):
+            #Note, planning destroys the array.
+            cmod.fft.InitialiseThreading(nthreads)
+            self.fftPlan=cmod.fft.PlanMany(self.amp,self.amp,nthreads)
+        else:
+            print "WARNING atmos: cmod.fft.PlanMany not available (rebuild cmod) - using numpy.fft"
+        self.amp[:]=1
+
+    def __del__(self):
+        if getattr(self,"fftPlan",None) is not None:
+            cmod.fft.FreePlan(self.fftPlan)
+            self.fftPlan=None
+
+    def reset(self):
+        """Set all amplitudes to a unit plane wave"""
+        self.amp[:]=1
+
+    def addPhase(self,i,phs):
+        """Multiply the ith amplitude by exp(1j*phs)"""
+        numpy.cos(phs,self.phasor.real)
+        numpy.sin(phs,self.phasor.imag)
+        self.amp[i]*=self.phasor
+
+    def fft(self):
+        if self.fftPlan is not None:
+            cmod.fft.ExecutePlan(self.fftPlan)
+        else:
+            self.amp[:]=numpy.fft.fft2(self.amp)
+
+    def propagate(self,fac):
+        """Propagate all the amplitudes.
+        @param fac: The propagation factor, from getFresnelPropFactor
+        @type fac: Array
+        """
+        self.fft()
+        numpy.conjugate(self.amp,self.amp)
+        self.amp*=fac
+        self.fft()
+        numpy.conjugate(self.amp,self.amp)
+
+def groupPhysPropBatch(atmosList):
+    """Group atmos objects into batches that can be propagated together by
+    doPhysPropBatch, i.e. with the same wavelength and sortedLayerList.
+    Order is preserved, both of the groups and within them.
+    @param atmosList: The atmos objects
+    @type atmosList: List
+    @return: The groups
+    @rtype: List of lists
+    """
+    groups=[]
+    index={}
+    for atm in atmosList:
+        key=(atm.sourceLam,tuple(atm.sortedLayerList))
+        if key not in index:
+            index[key]=len(groups)
+            groups.append([])
+        groups[index[key]].append(atm)
+    return groups
+
+def doPhysPropBatch(atmosList,phaseScreens,interpPosColDict,interpPosRowDict,propagator):
+    """Fresnel propagate the phase screens down to the telescope pupil for
+    several atmos objects (directions) together, batching the FFTs.  These
+    must have the same wavelength and sortedLayerList.  Directions that
+    don't see a layer (i.e. a LGS below it) are unaffected by its
+    propagation, since they are still a plane wave.  The results are placed
+    in the phs and amp attributes of each atmos object.
+    @param atmosList: The atmos objects
+    @type atmosList: List
+    @param propagator: With nbatch==len(atmosList)
+    @type propagator: fresnelPropagator
+    """
+    propagator.reset()
+    atmos0=atmosList[0]
+    for key in atmos0.sortedLayerList[::-1]:#start at the top
+        used=0
+        for i in range(len(atmosList)):
+            atm=atmosList[i]
+            if len(atm.positionDict[key])>0:#this layer is used (ie below star height)
+                propagator.addPhase(i,atm.getLayerPhase(key,phaseScreens,interpPosColDict,interpPosRowDict))
+                used=1
+        if used:
+            fac=atmos0.getFresnelPropFactor(key)
+            if fac is not None:
+                propagator.propagate(fac)
+    for i in range(len(atmosList)):
+        #Now get the phase and amplitude.
+        atmosList[i].phs=numpy.angle(propagator.amp[i])
+        atmosList[i].amp=numpy.absolute(propagator.amp[i])
 
 
 
@@ -1219,12 +1357,7 @@ class iatmos:
                 #scale=posDict[9]#the scale (<1 for layerheight>0 if using lgs).
                 shift=interpPosRowDict[key]#layer should be interpolshifted by this amount.  Which corresponds to an x and y shift when rotated.
                 #Now, rotate the correct part of the phase screen into the outputData.   Add 90 because of the way the phase layers are defined (moving up).
-                if not self.interpStruct.has_key(key):
-                    #print "Initialising atmos interpolation"
-                    if self.ygradients==None:
-                        self.interpStruct[key]=cmod.iscrn.initialiseInterp(self.phaseScreens[key],None,-self.windDirection[key]+self.skyRotation,self.outputData,scale,self.pupil.fn,self.interpolationNthreads[0],self.interpolationNthreads[1],self.interpolationNthreads[2])#interpolationNthreads=0,1,1 by default.
-                    else:
-                        self.interpStruct[key]=cmod.iscrn.initialiseInterp(self.phaseScreens[key],self.ygradients[key],-self.windDirection[key]+self.skyRotation,self.outputData,scale,self.pupil.fn,self.interpolationNthreads[0],self.interpolationNthreads[1],self.interpolationNthreads[2])
+                self.initialiseInterp(key,scale)
                 #print "%s %g %g %gxxx"%(key,x,y,shift)
                 if control["fullPupil"]:#temporarily set pupil to 1
                     tmp=self.pupil.fn.copy()
@@ -1264,7 +1397,30 @@ class iatmos:
             self.outputData[:,]*=(500./self.sourceLam)
         #print "atmos time8 %g"%(time.time()-t1)
 
-                   
+    def initialiseInterp(self,key,scale):
+        """Create the interpolation structure for a layer, if not yet done."""
+        if not self.interpStruct.has_key(key):
+            #print "Initialising atmos interpolation"
+            if self.ygradients==None:
+                self.interpStruct[key]=cmod.iscrn.initialiseInterp(self.phaseScreens[key],None,-self.windDirection[key]+self.skyRotation,self.outputData,scale,self.pupil.fn,self.interpolationNthreads[0],self.interpolationNthreads[1],self.interpolationNthreads[2])#interpolationNthreads=0,1,1 by default.
+            else:
+                self.interpStruct[key]=cmod.iscrn.initialiseInterp(self.phaseScreens[key],self.ygradients[key],-self.windDirection[key]+self.skyRotation,self.outputData,scale,self.pupil.fn,self.interpolationNthreads[0],self.interpolationNthreads[1],self.interpolationNthreads[2])
+
+    def createPupilPhsMany(self,positionDictList,interpPosRowDict,insertPosDict,control,out,nthreads=1):
+        """As createPupilPhs, but for several lines of sight (e.g. the field
+        directions of wideField.py), with all the layers and directions
+        interpolated in one threaded call.  Layers seen at the same position
+        by all directions (e.g. the ground layer) are interpolated once.
+        Uplink tip/tilt is not computed.
+        @param positionDictList: The positionDict (from updatePositionDict) for each direction
+        @type positionDictList: List of Dict
+        @param out: The output, shape (ndir,npup,npup), float32
+        @type out: Array
+        @param nthreads: Number of threads (each computes whole directions)
+        @type nthreads: Int
+        """
+        createPupilPhsBatch([self]*len(positionDictList),positionDictList,interpPosRowDict,insertPosDict,control,out,nthreads)
+
 #    def createSingleLayerPhs(self,phaseScreens,ygradients,interpPosRowDict,insertPosDict,key,control):
     def createSingleLayerPhs(self,interpPosRowDict,insertPosDict,key,control):
         """Just do the interpolation for a single layer."""
@@ -1364,6 +1520,105 @@ class iatmos:
         #     return self.interpPhs*self.pupil.fn
 
 
+def createPupilPhsBatch(atmosList,positionDictList,interpPosRowDict,insertPosDict,control,out,nthreads=1):
+    """Compute the pupil phase for several lines of sight in one threaded
+    pass, each layer being read once for all directions.  The directions
+    can belong to different iatmos objects (e.g. the resource sharers of
+    the iatmos module), with different heights (cone effect), wavelengths,
+    layer lists and intrinsic phases.  Layers seen at the same position by
+    all directions (e.g. the ground layer, for NGS) are interpolated once.
+    Uplink tip/tilt is not computed.
+    @param atmosList: The iatmos object for each direction (may be repeated)
+    @type atmosList: List of iatmos
+    @param positionDictList: The positionDict for each direction
+    @type positionDictList: List of Dict
+    @param out: The output, shape (ndir,npup,npup), float32
+    @type out: Array
+    @param nthreads: Number of threads (each computes whole directions)
+    @type nthreads: Int
+    """
+    ndir=len(atmosList)
+    layerList=[]
+    for atm in atmosList:
+        for key in atm.sortedLayerList:
+            if key not in layerList:
+                layerList.append(key)
+    layerList.sort(key=lambda k:atmosList[0].layerAltitude[k])#stable, so each direction keeps its order.
+    for d in range(ndir):
+        if atmosList[d].intrinsicPhase is not None:
+            out[d]=atmosList[d].intrinsicPhase
+        else:
+            out[d]=0.
+    structList=[]
+    sx=[]
+    sy=[]
+    used=[]
+    wrappoint=[]
+    sharedList=[]
+    for key in layerList:#for each atmosphere layer... (increasing in height)
+        posList=[positionDictList[d].get(key,()) if key in atmosList[d].layerList else () for d in range(ndir)]
+        usedList=[len(pos)>0 for pos in posList]
+        if not any(usedList):
+            continue
+        shift=interpPosRowDict[key]
+        structs=[]
+        for d in range(ndir):
+            if usedList[d]:
+                atmosList[d].initialiseInterp(key,posList[d][2])
+                structs.append(atmosList[d].interpStruct[key])
+            else:
+                structs.append(None)
+        shareKey=[(posList[d],atmosList[d].skyRotation,id(atmosList[d].pupil)) for d in range(ndir)]
+        if all(usedList) and shareKey.count(shareKey[0])==ndir:
+            sharedList.append(key)
+        else:
+            structList+=structs
+            sx.append([pos[0] if len(pos)>0 else 0. for pos in posList])
+            sy.append([pos[1]-shift if len(pos)>0 else 0. for pos in posList])
+            used.append(usedList)
+            wrappoint.append(insertPosDict[key])
+    pupList=[]
+    for atm in atmosList:
+        if atm.pupil not in pupList:
+            pupList.append(atm.pupil)
+    if control["fullPupil"]:#temporarily set pupil to 1
+        tmpList=[]
+        for pup in pupList:
+            tmpList.append(pup.fn.copy())
+            pup.fn[:]=1
+    nout=0
+    atm=atmosList[0]
+    for key in sharedList:#interpolate once, into outputData of the first.
+        pos=positionDictList[0][key]
+        atm.outputData[:]=0
+        nout+=cmod.iscrn.rotShiftWrapSplineImageThreaded(atm.interpStruct[key],pos[0],pos[1]-interpPosRowDict[key],insertPosDict[key])
+        out+=atm.outputData
+    if len(used)>0:
+        nout+=cmod.iscrn.rotShiftWrapSplineImageMany(structList,numpy.array(sx,numpy.float32),numpy.array(sy,numpy.float32),numpy.array(wrappoint,numpy.int32),numpy.array(used,numpy.uint8),out,nthreads)
+    if control["fullPupil"]:#copy proper pupil back.
+        for pup,tmp in zip(pupList,tmpList):
+            pup.fn[:]=tmp
+    if nout!=0:
+        print "%d points out of range in interpolation"%nout
+    # Remove overall piston
+    if control["removePiston"]:
+        if control["fullPupil"]:
+            pfnArea=atm.npup*atm.npup
+        else:
+            pfnArea=numpy.array([a.pupil.area for a in atmosList],out.dtype)
+        pist=out.sum(2).sum(1)/pfnArea#already has the pupil function imposed
+        out-=pist[:,None,None]
+    # Multiply by pupil and scale to output wavelength
+    if not control["fullPupil"]:
+        if len(pupList)==1:
+            out*=atm.pupil.fn
+        else:
+            for d in range(ndir):
+                out[d]*=atmosList[d].pupil.fn
+    lamScale=numpy.array([500./a.sourceLam for a in atmosList],out.dtype)
+    if numpy.any(lamScale!=1):
+        out*=lamScale[:,None,None]
+
 def rotateShiftWrapSplineImage(img,dimg,deg,shiftx,shifty,wrappoint,out,r=1.):
     """Rotates an image by deg degrees, shifts centre by x,y and puts result into out, which can be different size from img.
     wrappoint is the point at which img is wrapped, being the oldest phase.
@@ -38,6 +38,7 @@ CALCOEFF=19
 USEBRIGHTEST=20
 INTEGSTEPS=21#should never be changed to something larger than the initial value.
 OUTPUTPHASEARR=22#just for testing
+CURINTEG=23#current integration step, used when restoring from a checkpoint.
 class centcmod:
   def __init__(self,nthreads,nsubx,ncen,fftsize,clipsize,nimg,phasesize,readnoise,readbg,
                addPoisson,noiseFloor,sig,skybrightness,calsource,pxlPower,nintegrations,nlatency,seed,
@@ -144,6 +145,21 @@ class centcmod:
     """
     cmod.cent.update(self.centstruct,what,val)
 
+def runBatch(centList,calsource,slope=0):
+  """Run several centcmod objects together, in a single threaded call.
+  Each has its own thread pool, and these all run concurrently, with the
+  GIL released.  Typically used for resource shared WFSs, with the
+  threads divided between them.
+  centList is a list of centcmod objects.
+  slope is 1 if the input is an image (runSlope) rather than phase.
+  Returns the time taken.
+  """
+  for c in centList:
+    if calsource!=c.calsource:
+      cmod.cent.update(c.centstruct,CALSOURCE,calsource)
+      c.calsource=calsource
+  return cmod.cent.runBatch(tuple([c.centstruct for c in centList]),slope)
+
 if __name__=="__main__":
 #  import Numeric
   import util.centcmod
@@ -559,18 +559,23 @@ class centroid:
                 self.outputData-=self.refCents
                 
     def runCalc(self,control={"cal_source":0}):
-        doref=1
         if self.phaseMultiplier!=1:
             self.phase*=self.phaseMultiplier
         if control.get("useCmod",1):
             self.runCmod(control["cal_source"])
-            # no calibration done, or done in c, so ref can be done by c:
-            if self.linearSteps is None or self.psf is not None or self.correlationCentroiding!=0 or self.calNCoeff!=0:
-                doref=0#ref subtraction is done in c code...
         else:
             # use software version
             # Create the images
             self.runPy(control["cal_source"])
+        self.finishCalc(control.get("useCmod",1))
+
+    def finishCalc(self,usedCmod):
+        """Apply calibration and reference subtraction, once the slopes have been computed"""
+        doref=1
+        if usedCmod:
+            # no calibration done, or done in c, so ref can be done by c:
+            if self.linearSteps is None or self.psf is not None or self.correlationCentroiding!=0 or self.calNCoeff!=0:
+                doref=0#ref subtraction is done in c code...
         if self.linearSteps is not None:
             self.applyCalibration()
         if doref:
@@ -603,6 +608,10 @@ class centroid:
             self.magicShackHartmann()
             return
         self.centcmod.run(calsource)
+        self.copyCmodImage()
+
+    def copyCmodImage(self):
+        """Copy the cmod image into outputData, if imageOnly is set"""
         if self.imageOnly==0:
             pass
         elif self.imageOnly==1:
@@ -1678,6 +1687,36 @@ class centroid:
                 self.centWeight=self.cmodbimg.copy()
                 self.centcmod.update(util.centcmod.CENTWEIGHT,self.centWeight)
 
+def runBatch(centList,control={"cal_source":0}):
+    """Compute slopes for several centroid objects in a single threaded call.
+    Typically used for a set of LGS WFSs with the same subaperture geometry
+    (resource shared in wfscent).  Each object keeps its own cmod workspace
+    (and random number streams), but they are all run concurrently, so the
+    threads given to initialiseCmod should be divided between them.  Objects
+    that can't use the c code (magic centroiding, or useCmod not set) are run
+    individually.
+    @param centList: The centroid objects, with phase already in place
+    @type centList: List
+    @param control: The control dictionary, as for runCalc
+    @type control: Dict
+    @return: The slopes (outputData) for each object
+    @rtype: List of arrays
+    """
+    batch=[]
+    for c in centList:
+        if c.centcmod is None or c.magicCentroiding or not control.get("useCmod",1):
+            c.runCalc(control)
+        else:
+            if c.phaseMultiplier!=1:
+                c.phase*=c.phaseMultiplier
+            batch.append(c)
+    if len(batch)>0:
+        util.centcmod.runBatch([c.centcmod for c in batch],control["cal_source"])
+        for c in batch:
+            c.copyCmodImage()
+            c.finishCalc(1)
+    return [c.outputData for c in centList]
+
 def computeOld(phase,nsubx):
     """Simple interface..."""
     c=centroid(nsubx,pup=util.tel.Pupil(phase.shape[0],phase.shape[0]/2,0))
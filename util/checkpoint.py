@@ -0,0 +1,376 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Checkpoint and restart of the simulation state.
+
+Each module returns its state from getState() (see base.aobase - by
+default the attributes listed in checkpointAttrs, and checkpointThisAttrs
+for each resource sharing object), and restores it with setState().
+
+Every checkpointInterval iterations, util.Ctrl writes the state of all
+modules on each rank to checkpointDir/iter%d/rank%d.dat (the arrays, as a
+flat memory mapped file) and rank%d.idx (a pickle of everything else).
+All ranks write in parallel, after which rank 0 marks the checkpoint as
+complete, and removes old ones.
+
+When restoring, arrays are copied into the existing arrays in place, so
+memory shared with cmod modules (e.g. iscrn screens) is updated.  A
+simulation can therefore also be forked from a converged closed loop
+state of a different simulation (with e.g. different gains), as long as
+the array shapes match - entries that don't match are skipped with a
+warning.
+
+Parameters (from the globals section of the param file):
+ - checkpointInterval - 0 (default) to disable, or number of iterations
+   between checkpoints.
+ - checkpointDir - directory for the checkpoints, default "checkpoint".
+ - checkpointKeep - number of checkpoints to keep, default 2.
+ - checkpointRestore - None (default), "latest", an iteration number, or
+   a checkpoint directory (iter%d) from which to restore at startup.  The
+   iteration count continues from the restored value.
+"""
+import os,time,types,cPickle,shutil
+import numpy
+
+class arrayRef:
+    """Placeholder for an array stored in the data file"""
+    def __init__(self,offset,dtype,shape):
+        self.offset=offset
+        self.dtype=dtype
+        self.shape=shape
+
+def getPath(obj,name,default=None):
+    """Get an attribute, with name possibly dotted, e.g. "wfscentObj.curInteg" """
+    for n in name.split("."):
+        if obj is None:
+            return default
+        obj=getattr(obj,n,None)
+    if obj is None:
+        return default
+    return obj
+
+def setPath(obj,name,val):
+    names=name.split(".")
+    for n in names[:-1]:
+        obj=getattr(obj,n)
+    setattr(obj,names[-1],val)
+
+def hasPath(obj,name):
+    for n in name.split("."):
+        if not hasattr(obj,n):
+            return 0
+        obj=getattr(obj,n)
+    return 1
+
+def getObjectState(obj,attrs):
+    """Return a dict of the attributes attrs of obj (those that exist)"""
+    state={}
+    for name in attrs:
+        if hasPath(obj,name):
+            state[name]=getPath(obj,name)
+    return state
+
+def copyValue(saved):
+    """Return saved, with any arrays (read only memory maps of the checkpoint
+    file) copied into writable arrays, including within lists, tuples and
+    dicts."""
+    if isinstance(saved,numpy.ndarray):
+        return numpy.array(saved)
+    if type(saved)==types.ListType:
+        return [copyValue(x) for x in saved]
+    if type(saved)==types.TupleType:
+        return tuple([copyValue(x) for x in saved])
+    if type(saved)==types.DictType:
+        d={}
+        for k,v in saved.items():
+            d[k]=copyValue(v)
+        return d
+    return saved
+
+def restoreValue(cur,saved,name=""):
+    """Restore a saved value, in place if possible.  Returns the value to be
+    set (which is cur if restored in place)."""
+    if isinstance(saved,numpy.ndarray):
+        if isinstance(cur,numpy.ndarray):
+            if cur.shape==saved.shape and cur.dtype==saved.dtype:
+                cur[...]=saved
+            else:
+                print "WARNING checkpoint: Not restoring %s - shape/type %s %s differs from saved %s %s"%(name,str(cur.shape),cur.dtype.char,str(saved.shape),saved.dtype.char)
+            return cur
+        return numpy.array(saved)
+    if type(saved)==types.DictType and type(cur)==types.DictType:
+        for k in saved.keys():
+            cur[k]=restoreValue(cur.get(k),saved[k],"%s[%s]"%(name,repr(k)))
+        return cur
+    if type(saved)==types.ListType and type(cur)==types.ListType and len(saved)==len(cur):
+        for i in range(len(saved)):
+            cur[i]=restoreValue(cur[i],saved[i],"%s[%d]"%(name,i))
+        return cur
+    return copyValue(saved)
+
+def setObjectState(obj,state,prefix=""):
+    for name in state.keys():
+        cur=getPath(obj,name)
+        try:
+            setPath(obj,name,restoreValue(cur,state[name],prefix+name))
+        except AttributeError:
+            print "WARNING checkpoint: Unable to restore %s%s"%(prefix,name)
+
+def getModuleState(module):
+    """Default state of an aobase module: attributes in checkpointAttrs, and
+    checkpointThisAttrs for each resource sharing object (thisObjList, or
+    thisObjDict)."""
+    state={"self":getObjectState(module,module.checkpointAttrs)}
+    thisAttrs=module.checkpointThisAttrs
+    if len(thisAttrs)>0:
+        if len(module.thisObjList)>0:
+            state["this"]=[getObjectState(this,thisAttrs) for this in module.thisObjList]
+        elif type(getattr(module,"thisObjDict",None))==types.DictType:
+            state["thisDict"]={}
+            for key,this in module.thisObjDict.items():
+                state["thisDict"][key]=getObjectState(this,thisAttrs)
+    return state
+
+def setModuleState(module,state):
+    setObjectState(module,state.get("self",{}),module.objID+".")
+    if state.has_key("this"):
+        if len(state["this"])!=len(module.thisObjList):
+            print "WARNING checkpoint: %s has %d resource sharing objects, but %d saved"%(module.objID,len(module.thisObjList),len(state["this"]))
+        for this,s in zip(module.thisObjList,state["this"]):
+            setObjectState(this,s,module.objID+".this.")
+    if state.has_key("thisDict"):
+        for key,s in state["thisDict"].items():
+            if module.thisObjDict.has_key(key):
+                setObjectState(module.thisObjDict[key],s,"%s.%s."%(module.objID,str(key)))
+            else:
+                print "WARNING checkpoint: %s has no %s"%(module.objID,str(key))
+
+def flatten(val,arrList,offset):
+    """Replace arrays (within dicts, lists and tuples) by arrayRef objects,
+    adding them to arrList.  Returns the new value and offset."""
+    if isinstance(val,numpy.ndarray) and val.dtype!=numpy.object:
+        ref=arrayRef(offset,val.dtype.str,val.shape)
+        arrList.append((offset,val))
+        offset+=(val.nbytes+63)//64*64#keep arrays aligned
+        return ref,offset
+    if type(val)==types.DictType:
+        d={}
+        for k,v in val.items():
+            d[k],offset=flatten(v,arrList,offset)
+        return d,offset
+    if type(val) in [types.ListType,types.TupleType]:
+        l=[]
+        for v in val:
+            v,offset=flatten(v,arrList,offset)
+            l.append(v)
+        if type(val)==types.TupleType:
+            l=tuple(l)
+        return l,offset
+    return val,offset
+
+def unflatten(val,data):
+    if isinstance(val,arrayRef):
+        dtype=numpy.dtype(val.dtype)
+        n=int(numpy.prod(val.shape))*dtype.itemsize
+        return data[val.offset:val.offset+n].view(dtype).reshape(val.shape)
+    if type(val)==types.DictType:
+        d={}
+        for k,v in val.items():
+            d[k]=unflatten(v,data)
+        return d
+    if type(val) in [types.ListType,types.TupleType]:
+        l=[unflatten(v,data) for v in val]
+        if type(val)==types.TupleType:
+            l=tuple(l)
+        return l
+    return val
+
+def writeState(fname,state):
+    """Write state to fname.dat (arrays, via a memory map) and fname.idx.
+    Written to temporary files then renamed."""
+    arrList=[]
+    index,size=flatten(state,arrList,0)
+    pid=os.getpid()
+    tmpname="%s.dat.%d.tmp"%(fname,pid)
+    if size>0:
+        mm=numpy.memmap(tmpname,dtype=numpy.uint8,mode="w+",shape=(size,))
+        for offset,arr in arrList:
+            mm[offset:offset+arr.nbytes]=numpy.ascontiguousarray(arr).view(numpy.uint8).ravel()
+        mm.flush()
+        del(mm)
+    else:
+        open(tmpname,"wb").close()
+    os.rename(tmpname,fname+".dat")
+    tmpname="%s.idx.%d.tmp"%(fname,pid)
+    f=open(tmpname,"wb")
+    try:
+        cPickle.dump(index,f,cPickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    os.rename(tmpname,fname+".idx")
+    return size
+
+def readState(fname):
+    """Read state written by writeState.  Arrays are read only memory maps."""
+    f=open(fname+".idx","rb")
+    try:
+        index=cPickle.load(f)
+    finally:
+        f.close()
+    if os.path.getsize(fname+".dat")>0:
+        data=numpy.memmap(fname+".dat",dtype=numpy.uint8,mode="r")
+    else:
+        data=numpy.zeros((0,),numpy.uint8)
+    return unflatten(index,data)
+
+class Checkpointer:
+    """Writes and restores checkpoints for util.Ctrl.
+    @cvar interval: Iterations between checkpoints (0 to disable)
+    @type interval: Int
+    @cvar dirname: The checkpoint directory
+    @type dirname: String
+    @cvar keep: Number of checkpoints to keep
+    @type keep: Int
+    @cvar restoreFrom: Checkpoint to restore from at startup, or None
+    @type restoreFrom: None, Int or String
+    """
+    def __init__(self,config,rank=0,mpiComm=None):
+        """
+        @param config: The config object (parameters are taken from globals)
+        @type config: AOXml instance
+        @param rank: MPI rank
+        @type rank: Int
+        @param mpiComm: The MPI communicator, used for barriers
+        @type mpiComm: mpiWrapper instance
+        """
+        self.interval=config.getVal("checkpointInterval",default=0,warn=0)
+        self.dirname=config.getVal("checkpointDir",default="checkpoint",warn=0)
+        self.keep=config.getVal("checkpointKeep",default=2,warn=0)
+        self.restoreFrom=config.getVal("checkpointRestore",default=None,warn=0)
+        self.noState={}#modules without getState, already reported.
+        self.rank=rank
+        self.mpiComm=mpiComm
+
+    def due(self,iteration):
+        return self.interval>0 and iteration>0 and iteration%self.interval==0
+
+    def iterDir(self,iteration):
+        return os.path.join(self.dirname,"iter%d"%iteration)
+
+    def listComplete(self):
+        """Return a sorted list of iterations with complete checkpoints"""
+        iters=[]
+        if os.path.isdir(self.dirname):
+            for d in os.listdir(self.dirname):
+                if d.startswith("iter") and os.path.exists(os.path.join(self.dirname,d,"complete")):
+                    try:
+                        iters.append(int(d[4:]))
+                    except ValueError:
+                        pass
+        iters.sort()
+        return iters
+
+    def getModuleKeys(self,compList):
+        """Return a list of (key,module) for the unique modules in compList (a
+        resource sharing module appears several times)."""
+        mods=[]
+        done={}
+        keys={}
+        for module in compList:
+            if done.has_key(id(module)):
+                continue
+            done[id(module)]=1
+            key=module.objID
+            if keys.has_key(key):
+                keys[key]+=1
+                key="%s#%d"%(key,keys[key])
+            else:
+                keys[key]=0
+            mods.append((key,module))
+        return mods
+
+    def write(self,iteration,compList):
+        """Write a checkpoint.  Must be called by all ranks at the same iteration.
+        @param iteration: The number of iterations completed
+        @type iteration: Int
+        @param compList: The simulation modules
+        @type compList: List
+        """
+        t0=time.time()
+        d=self.iterDir(iteration)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):#could have been created by another rank
+                    raise
+        state={"iteration":iteration,"numpyRandom":numpy.random.get_state(),"modules":{}}
+        for key,module in self.getModuleKeys(compList):
+            if hasattr(module,"getState"):
+                state["modules"][key]=module.getState()
+            elif not self.noState.has_key(key):#e.g. shmGet/shmSend, which are not aobase modules.
+                print "INFORMATION checkpoint: %s has no getState method - no state saved"%key
+                self.noState[key]=1
+        size=writeState(os.path.join(d,"rank%d"%self.rank),state)
+        if self.mpiComm is not None:
+            self.mpiComm.barrier()
+        if self.rank==0:
+            open(os.path.join(d,"complete"),"w").write("%d\n"%iteration)
+            iters=self.listComplete()
+            if self.keep>0:
+                for it in iters[:-self.keep]:
+                    shutil.rmtree(self.iterDir(it),ignore_errors=True)
+        print "INFORMATION Written checkpoint %s (%d bytes) in %gs"%(d,size,time.time()-t0)
+
+    def findCheckpoint(self,which=None):
+        """Return the checkpoint directory for which ("latest", an iteration or a directory)"""
+        if which is None:
+            which=self.restoreFrom
+        if which=="latest":
+            iters=self.listComplete()
+            if len(iters)==0:
+                return None
+            return self.iterDir(iters[-1])
+        if type(which) in [types.IntType,types.LongType]:
+            return self.iterDir(which)
+        return which
+
+    def restore(self,compList,which=None):
+        """Restore the state of all modules.
+        @param compList: The simulation modules
+        @type compList: List
+        @param which: "latest", an iteration number, or a checkpoint directory.  If None, uses restoreFrom.
+        @type which: None, Int or String
+        @return: The iteration number of the checkpoint, or None if there is no checkpoint
+        @rtype: Int
+        """
+        d=self.findCheckpoint(which)
+        if d is None:
+            print "WARNING No checkpoint found in %s - starting from the beginning"%self.dirname
+            return None
+        if not os.path.exists(os.path.join(d,"complete")):
+            raise Exception("ERROR checkpoint %s is not complete"%d)
+        state=readState(os.path.join(d,"rank%d"%self.rank))
+        numpy.random.set_state(state["numpyRandom"])
+        modules=state["modules"]
+        for key,module in self.getModuleKeys(compList):
+            if not hasattr(module,"setState"):
+                print "INFORMATION checkpoint: %s has no setState method - not restored"%key
+            elif modules.has_key(key):
+                module.setState(modules[key])
+            else:
+                print "WARNING checkpoint: No state saved for %s"%key
+        print "INFORMATION Restored checkpoint %s (iteration %d)"%(d,state["iteration"])
+        return state["iteration"]
@@ -0,0 +1,184 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compact storage formats for large (reconstructor) matrices, with a fused
+decompress and matrix-vector multiply (cmod.utils.compactMvm), so that the
+matrix is read from memory once per multiply, with no decompressed copy.
+
+Formats:
+ - compressed - truncated mantissa and compressed exponent floats, as
+   cmod.utils.compressFloatArrayAll (mbits bits of mantissa).
+ - float16 - IEEE half precision.
+ - bfloat16 - top 16 bits of float32 (rounded to nearest).
+ - int8, int16 - integers, with a float32 scale per row.
+
+Typical use::
+
+ rmx=util.compactMatrix.compactMatrix(rmx,"bfloat16",nthreads=8)
+ acts=rmx.dot(slopes)
+
+dot() multiplies by the matrix, or by its transpose (transpose=1, or
+deduced from the size of the vector if the matrix is not square).
+"""
+import os
+import numpy
+import cmod.utils
+
+formats={"compressed":0,"float16":1,"bfloat16":2,"int8":3,"int16":4}
+dtypes={"compressed":numpy.uint32,"float16":numpy.uint16,"bfloat16":numpy.uint16,"int8":numpy.int8,"int16":numpy.int16}
+
+class compactMatrix:
+    """A 2D matrix in a compact format.
+    @cvar fmt: The format
+    @type fmt: String
+    @cvar shape: Shape of the matrix
+    @type shape: Tuple
+    @cvar data: The packed matrix
+    @type data: Array
+    @cvar scale: Per row scale (int formats), or None
+    @type scale: Array
+    """
+    def __init__(self,mx=None,fmt="float16",nthreads=0,mbits=15,blockSize=1024):
+        """
+        @param mx: The matrix to pack (not altered), or None if setting data later (e.g. fromCompressed)
+        @type mx: 2D Array
+        @param fmt: The format, one of compressed, float16, bfloat16, int8, int16
+        @type fmt: String
+        @param nthreads: Number of threads to use for the multiply (0 for all CPUs)
+        @type nthreads: Int
+        @param mbits: Number of mantissa bits for the compressed format
+        @type mbits: Int
+        @param blockSize: Number of rows converted at a time (limits temporary memory)
+        @type blockSize: Int
+        """
+        if not formats.has_key(fmt):
+            raise Exception("compactMatrix: format %s not known - should be one of %s"%(fmt,str(formats.keys())))
+        self.fmt=fmt
+        if nthreads==0:
+            nthreads=os.sysconf("SC_NPROCESSORS_ONLN")
+        self.nthreads=nthreads
+        self.mbits=mbits
+        self.expMin=self.expMax=0
+        self.scale=None
+        self.data=None
+        self.shape=None
+        if mx is not None:
+            self.pack(mx,blockSize)
+
+    def pack(self,mx,blockSize=1024):
+        """Convert the float matrix mx into the compact format"""
+        if len(mx.shape)!=2:
+            raise Exception("compactMatrix: matrix must be 2D")
+        self.shape=mx.shape
+        nrows=mx.shape[0]
+        if self.fmt=="compressed":
+            r=numpy.array(mx,numpy.float32).ravel()
+            self.expMin,self.expMax=cmod.utils.compressFloatArrayAll(r,self.mbits)
+            self.data=r[:self.compressedWords()].view(numpy.uint32).copy()
+            return
+        self.data=numpy.empty(mx.shape,dtypes[self.fmt])
+        if self.fmt in ["int8","int16"]:
+            self.scale=numpy.zeros((nrows,),numpy.float32)
+            qmax=numpy.iinfo(dtypes[self.fmt]).max
+        for i in xrange(0,nrows,blockSize):
+            b=numpy.array(mx[i:i+blockSize],numpy.float32)
+            if self.fmt=="float16":
+                self.data[i:i+blockSize]=b.astype(numpy.float16).view(numpy.uint16)
+            elif self.fmt=="bfloat16":
+                u=b.view(numpy.uint32)
+                self.data[i:i+blockSize]=((u+0x7fff+((u>>16)&1))>>16).astype(numpy.uint16)
+            else:
+                s=numpy.abs(b).max(1)/qmax
+                self.scale[i:i+blockSize]=s
+                s[s==0]=1
+                self.data[i:i+blockSize]=numpy.round(b/s[:,None]).astype(dtypes[self.fmt])
+
+    def compressedWords(self):
+        ebits=1
+        while ((self.expMax-self.expMin+1)>>ebits)>0:
+            ebits+=1
+        bits=self.mbits+ebits+1
+        return (self.shape[0]*self.shape[1]*bits+31)/32
+
+    def toFloat(self,start=0,end=None):
+        """Decompress rows start to end, returning a float32 array"""
+        if end is None:
+            end=self.shape[0]
+        if self.fmt=="compressed":
+            out=numpy.empty((end-start,self.shape[1]),numpy.float32)
+            cmod.utils.uncompressFloatArrayAll(self.data,out.ravel(),self.mbits,self.expMin,self.expMax,start*self.shape[1])
+            return out
+        d=self.data[start:end]
+        if self.fmt=="float16":
+            return d.view(numpy.float16).astype(numpy.float32)
+        elif self.fmt=="bfloat16":
+            return (d.astype(numpy.uint32)<<16).view(numpy.float32)
+        return d.astype(numpy.float32)*self.scale[start:end,None]
+
+    def dot(self,vec,out=None,transpose=None):
+        """Multiply vec by the matrix (transpose=0, i.e. mx.vec) or by its
+        transpose (transpose=1, i.e. vec.mx).
+        @param vec: The vector
+        @type vec: 1D array
+        @param out: Output array (float32), or None
+        @type out: 1D array
+        @param transpose: Whether to multiply by the transpose, or None to deduce from the size of vec (not allowed for square matrices)
+        @type transpose: Int or None
+        @return: The result
+        @rtype: 1D float32 array
+        """
+        nrows,ncols=self.shape
+        if transpose is None:
+            if nrows==ncols:
+                raise Exception("compactMatrix: transpose must be specified for a square matrix")
+            transpose=int(vec.shape[0]==nrows)
+        if transpose:
+            trans=1
+            nout=ncols
+            nin=nrows
+        else:
+            trans=0
+            nout=nrows
+            nin=ncols
+        if vec.shape[0]!=nin:
+            raise Exception("compactMatrix: vector size %d does not match matrix shape %s (transpose=%d)"%(vec.shape[0],str(self.shape),trans))
+        if vec.dtype!=numpy.float32 or not vec.flags.c_contiguous:
+            vec=numpy.ascontiguousarray(vec,dtype=numpy.float32)
+        if out is None:
+            out=numpy.empty((nout,),numpy.float32)
+        if hasattr(cmod.utils,"compactMvm"):
+            cmod.utils.compactMvm(self.data,vec,out,formats[self.fmt],nrows,ncols,self.scale,self.mbits,self.expMin,self.expMax,trans,self.nthreads)
+        else:#older cmod - decompress a block at a time.
+            step=max(1,(1<<24)/ncols)
+            if trans:
+                out[:]=0
+            for i in xrange(0,nrows,step):
+                b=self.toFloat(i,min(i+step,nrows))
+                if trans:
+                    out+=numpy.dot(vec[i:i+step],b)
+                else:
+                    out[i:i+step]=numpy.dot(b,vec)
+        return out
+
+def fromCompressed(data,shape,mbits,expMin,expMax,nthreads=0):
+    """Create a compactMatrix from an existing compressed float matrix (as
+    created by util.computeRecon.compress, or loaded with a COMPBITS header).
+    """
+    m=compactMatrix(None,"compressed",nthreads,mbits)
+    m.data=data.view(numpy.uint32)
+    m.shape=tuple(shape)
+    m.expMin=expMin
+    m.expMax=expMax
+    return m
@@ -779,18 +779,23 @@ class makeRecon:
         """
         
 
-def getMem():
+def getMem(memtxt="MemTotal:"):
+    """Return the system memory (bytes) from /proc/meminfo, e.g. MemTotal: or MemAvailable:.
+    If memtxt isn't found (e.g. MemAvailable on older kernels), MemFree: is used."""
     lines=open("/proc/meminfo").readlines()
+    mem=None
     for line in lines:
-        if "MemTotal:" in line:
+        if memtxt in line:
             mem=int(line.split()[1])
             multiplier={"kB":1024,"b":1,"B":1,"mB":1024*1024,"MB":1024**2,"GB":1024**3,"gB":1024**3}
             if line.split()[2] in multiplier.keys():
                 mem*=multiplier[line.split()[2]]
             else:
                 print "WARNING - multiplier %s not known for memory"
-            print "Total system memory %d bytes"%mem
+            print "Total system memory (%s) %d bytes"%(memtxt[:-1],mem)
             break
+    if mem is None and memtxt!="MemFree:":
+        mem=getMem("MemFree:")
     return mem
 
 
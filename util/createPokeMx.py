@@ -98,6 +98,110 @@ def straightPokes(nact,vlist=[1.],pupfn=None,actmap=None,returnfull=0):
         pokemx=pokemxfull
     return pokemx
 
+def multiPokePatterns(nact,pokeType="hadamard",npatterns=None,seed=0,dtype=na.float32):
+    """Create a set of multi-actuator poke patterns, for which all actuators
+    are poked (+1 or -1) at once.  The poke matrix is then recovered from the
+    measured response to all patterns using decodeMultiPokes.
+    Each pattern takes one simulation iteration, so with npatterns>=nact,
+    calibration is no faster than poking actuators individually (hadamard
+    rounds up to the next power of 2) - the gain is signal to noise ratio,
+    since every measurement uses all the actuators.  To reduce the number of
+    iterations, use random patterns with npatterns<nact, and decode using
+    the support of the poke matrix (multiPokeSupport), i.e. which actuators
+    can affect each subaperture.  npatterns then needs to be a few times
+    the largest number of actuators affecting one subaperture, independent
+    of nact.
+    pokeType can be:
+     - "hadamard": Sylvester Hadamard patterns, npatterns is the next power of 2>=nact.
+     - "random": random sign patterns, npatterns defaults to nact.
+    Returns an array of shape (npatterns,nact).
+    """
+    if pokeType=="hadamard":
+        n=1
+        while n<nact:
+            n*=2
+        if npatterns!=None and npatterns!=n:
+            raise Exception("multiPokePatterns: hadamard requires %d patterns (use random for fewer)"%n)
+        h=na.ones((1,1),dtype)
+        while h.shape[0]<n:
+            h=na.concatenate([na.concatenate([h,h],axis=1),na.concatenate([h,-h],axis=1)])
+        return na.ascontiguousarray(h[:,:nact])
+    elif pokeType=="random":
+        if npatterns==None:
+            npatterns=nact
+        if npatterns<1:
+            raise Exception("multiPokePatterns: need at least 1 random pattern")
+        r=na.random.RandomState(seed)
+        return (r.randint(0,2,size=(npatterns,nact))*2-1).astype(dtype)
+    else:
+        raise Exception("multiPokePatterns: pokeType %s not known"%str(pokeType))
+
+def multiPokeSupport(actCoords,subapCoords,radius):
+    """Compute which actuators can affect which subapertures, for decoding
+    fewer multi-actuator poke patterns than actuators.
+    @param actCoords: Coordinates of the actuators (in the order used by the poke matrix), shape (nact,2)
+    @type actCoords: Array
+    @param subapCoords: Coordinates of the subaperture centres, projected to the DM height, shape (nsub,2)
+    @type subapCoords: Array
+    @param radius: Distance within which an actuator affects a subaperture (same units as the coordinates)
+    @type radius: Float
+    @return: The support, shape (nact,nsub)
+    @rtype: Array of bool
+    """
+    actCoords=na.asarray(actCoords,na.float64)
+    subapCoords=na.asarray(subapCoords,na.float64)
+    dx=actCoords[:,0,None]-subapCoords[None,:,0]
+    dy=actCoords[:,1,None]-subapCoords[None,:,1]
+    return dx*dx+dy*dy<=radius*radius
+
+def decodeMultiPokes(patterns,response,pokeType="hadamard",support=None,reg=0.,out=None):
+    """Recover the poke matrix from the response to multi-actuator poke patterns.
+    patterns is shape (npatterns,nact) as from multiPokePatterns, and response
+    is shape (npatterns,ncents), the slopes measured for each pattern, with
+    the x slopes of all subapertures first, then the y slopes.
+    Returns the poke matrix, shape (nact,ncents), i.e. the least squares solution
+    of patterns . pokemx = response.
+    If support (shape (nact,ncents/2), from multiPokeSupport) is given, the
+    poke matrix is assumed zero outside it, and each subaperture is solved
+    separately over its own actuators, so that npatterns can be less than
+    nact.  reg is then a Tikhonov regularisation (relative to npatterns), to
+    stabilise subapertures for which the patterns are poorly conditioned.
+    @param out: Optional output array, shape (nact,ncents)
+    @type out: Array
+    """
+    npatterns,nact=patterns.shape
+    if support is None:
+        if npatterns<nact:
+            raise Exception("decodeMultiPokes: %d patterns for %d actuators needs a support"%(npatterns,nact))
+        if pokeType=="hadamard":#columns are orthogonal, so inverse is the scaled transpose.
+            res=na.dot(patterns.T,response)/npatterns
+        else:
+            res=na.linalg.lstsq(patterns,response,rcond=-1)[0]
+        if out is None:
+            return res
+        out[:]=res
+        return out
+    nsub=response.shape[1]//2
+    if support.shape!=(nact,nsub):
+        raise Exception("decodeMultiPokes: support should be shape (%d,%d)"%(nact,nsub))
+    if out is None:
+        out=na.zeros((nact,nsub*2),response.dtype)
+    else:
+        out[:]=0
+    p=patterns.astype(na.float64)
+    for s in range(nsub):
+        acts=na.nonzero(support[:,s])[0]
+        if acts.size==0:
+            continue
+        a=p[:,acts]
+        r=na.array([response[:,s],response[:,s+nsub]],na.float64).T
+        if reg>0:
+            x=na.linalg.solve(na.dot(a.T,a)+reg*npatterns*na.identity(acts.size),na.dot(a.T,r))
+        else:
+            x=na.linalg.lstsq(a,r,rcond=-1)[0]
+        out[acts,s]=x[:,0]
+        out[acts,s+nsub]=x[:,1]
+    return out
 
 class sparsePMX:
     """A class to represent a poke matrix (fried geometry, zonal) with a
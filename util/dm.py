@@ -698,13 +698,14 @@ class dmInfo:
     def getMirrorScale(self):
         return self.mirrorScale
         
-    def computePhaseCovariance(self,atmosGeom,r2,r0=None,l0=None,lam=None,fitpup=1,nthreads=8,mirrorSurface=None,width=None,dovignetted=1,rescaleModes=0,rescalePhasecov=0):
+    def computePhaseCovariance(self,atmosGeom,r2,r0=None,l0=None,lam=None,fitpup=1,nthreads=8,mirrorSurface=None,width=None,dovignetted=1,rescaleModes=0,rescalePhasecov=0,phaseCovCache=None):
         """r2 is the diameter of central obscuration of ground dm.
         r0 is frieds paramter
         l0 is outerscale
         lam is wavelength.
         If width is specified, it defines the size of the mirror modes (width x width rather than dmpup x dmpup).  This is good for zonal DMs.  Set to -1 to have defined as 4* actuator spacing (this is probably quite a good value).
         rescalePhasecov should probably be 1...
+        phaseCovCache can be a util.phaseCovariance.covarianceCache (or a directory for one), in which case the covariance for r0=1 is stored for each L0 and rescaled for atmosGeom.r0, so that changing r0 doesn't require a recomputation.
         """
         if r0 is not None or l0 is not None:
             print "WARNING util.dm.computePhaseCovariance - r0 and l0 no longer used - taken from atmosGeom."
@@ -716,11 +717,18 @@ class dmInfo:
         typ="vk"
         if atmosGeom.l0<0:
             typ="kol"
+        if type(phaseCovCache)==type(""):
+            phaseCovCache=util.phaseCovariance.covarianceCache(phaseCovCache)
         if width is None:#do the full thing
             pupil=util.tel.Pupil(self.dmpup,self.dmpup/2.,self.computeEffectiveObscuration(atmosGeom.npup,atmosGeom.telDiam,r2))
             mirrorModes=self.makeMirrorModes(atmosGeom,r2,fitpup,mirrorSurface)#self.interpType,actCoupling,actFlattening)
             nmode=mirrorModes.shape[0]
-            phasecov=util.phaseCovariance.make(typ=typ,npup=self.dmpup,nmode=nmode,pupil=pupil,modes=mirrorModes,r0=atmosGeom.r0,telDiam=self.dmDiam,l0=atmosGeom.l0,nthreads=nthreads,lam=lam)[3]
+            if phaseCovCache is not None:
+                key=phaseCovCache.makeKey(typ,self.dmpup,self.dmDiam,pupil.fn,mirrorModes)
+                compute=lambda l0:util.phaseCovariance.make(typ=typ,npup=self.dmpup,nmode=nmode,pupil=pupil,modes=mirrorModes,r0=1.,telDiam=self.dmDiam,l0=l0,nthreads=nthreads)[3]
+                phasecov=phaseCovCache.get(key,atmosGeom.r0,atmosGeom.l0,lam,compute)
+            else:
+                phasecov=util.phaseCovariance.make(typ=typ,npup=self.dmpup,nmode=nmode,pupil=pupil,modes=mirrorModes,r0=atmosGeom.r0,telDiam=self.dmDiam,l0=atmosGeom.l0,nthreads=nthreads,lam=lam)[3]
 #         elif width=="test":
 #             mirrorModes=self.makeMirrorModes(atmosGeom,r2,fitpup,mirrorSurface)#self.interpType,actCoupling,actFlattening)
 #             phasecov=util.phaseCovariance.computeCov3(mirrorModes,self.nact,self.dmflag,atmosGeom.r0,atmosGeom.l0,atmosGeom.telDiam)
@@ -794,7 +802,13 @@ class dmInfo:
                 for i in range(mirrorModes.shape[0]):
                     mirrorModes[i]*=self.mirrorScale[i]
             print "Making phase covariance... (mode shape=%s)"%str(mirrorModes.shape)
-            phasecov=util.phaseCovariance.makeWithLocalModesFFTThreaded(self.dmpup,mirrorModes,mirrorModeCoords,
+            if phaseCovCache is not None:
+                key=phaseCovCache.makeKey(typ,self.dmpup,self.dmDiam,mirrorModes,mirrorModeCoords)
+                compute=lambda l0:util.phaseCovariance.makeWithLocalModesFFTThreaded(self.dmpup,mirrorModes,mirrorModeCoords,
+                       r0=1.,l0=l0,telDiam=self.dmDiam,typ=typ,nthreads=nthreads)
+                phasecov=phaseCovCache.get(key,atmosGeom.r0,atmosGeom.l0,lam,compute)
+            else:
+                phasecov=util.phaseCovariance.makeWithLocalModesFFTThreaded(self.dmpup,mirrorModes,mirrorModeCoords,
                        r0=atmosGeom.r0,l0=atmosGeom.l0,telDiam=self.dmDiam,typ=typ,nthreads=nthreads,lam=lam)
         if rescalePhasecov:
             for i in range(mirrorModes.shape[0]):
@@ -803,7 +817,7 @@ class dmInfo:
         return phasecov
 
     def getMirrorSurface(self,interpType=None,actCoupling=None,actFlattening=None,couplingcoeff=0.1,gaussianIndex=2.,
-                         gaussianOverlapAccuracy=1e-6,phsOut=None,infFunc=None, interpolationNthreads = 0):
+                         gaussianOverlapAccuracy=1e-6,phsOut=None,infFunc=None, interpolationNthreads = 0,precompute=0,operatorCacheDir=None):
         """Create a MirrorSurface object for this DM"""
         if interpType is None:
             interpType=self.interpType
@@ -816,7 +830,8 @@ class dmInfo:
         return MirrorSurface(typ=interpType,npup=self.dmpup,nact=self.nact,phsOut=phsOut,actoffset=self.actoffset,
                              actCoupling=actCoupling,actFlattening=actFlattening,couplingcoeff=couplingcoeff,
                              gaussianIndex=gaussianIndex,gaussianOverlapAccuracy=gaussianOverlapAccuracy,
-                             infFunc=infFunc, interpolationNthreads = interpolationNthreads,stuckActs=self.stuckActs)
+                             infFunc=infFunc, interpolationNthreads = interpolationNthreads,stuckActs=self.stuckActs,
+                             precompute=precompute,operatorCacheDir=operatorCacheDir)
 
 class dmOverview:
     """DM object to hold info about DMs etc.
@@ -1268,13 +1283,17 @@ class dmOverview:
 class MirrorSurface:
     """A class for interpolating actuators onto a mirror surface.
     """
-    def __init__(self,typ,npup,nact,phsOut=None,actoffset="fried",actCoupling=None,actFlattening=None,couplingcoeff=0.1,gaussianIndex=2.,gaussianOverlapAccuracy=1e-6,infFunc=None, interpolationNthreads=0,stuckActs=None):
+    def __init__(self,typ,npup,nact,phsOut=None,actoffset="fried",actCoupling=None,actFlattening=None,couplingcoeff=0.1,gaussianIndex=2.,gaussianOverlapAccuracy=1e-6,infFunc=None, interpolationNthreads=0,stuckActs=None,precompute=0,operatorCacheDir=None,operatorThreshold=1e-6):
         """typ can be spline, bicubic, gaussian, linear, influence,  pspline or hex.  Others can be added as necessary.
         actCoupling and actFlattening are used for bicubic only.
         actCoupling is also used for spline and pspline
         couplingcoeff, gaussianIndex and gaussianOverlapAccuracy are used for gaussian only.
         infFunc should be used if typ=="influence", and can be an array or a filename.  Shape should be (nact*nact,npup,npup)
         StuckActs can be None, or a single value (number of stuck acts), or a tuple of (number of stuck,clumpSize=0,maxRadius=None,minRadius=0,actPatternSeed=None,fraction high, high value,frac lo, low value,fraction coupled).
+        If precompute is set, the (linear) actuator to surface operator is computed on the first call to fit(), and then
+        used for subsequent fits - see makeOperator().  operatorCacheDir, if not None, is a directory in which the
+        operator is cached (keyed by geometry), and operatorThreshold is the fraction of the peak of each influence
+        function below which elements are ignored (when a sparse operator is used).
 
         """
         self.typ=typ
@@ -1301,6 +1320,10 @@ class MirrorSurface:
         self.gaussianIndex=gaussianIndex
         self.gaussianOverlapAccuracy=gaussianOverlapAccuracy
         self.interpolationNthreads = interpolationNthreads
+        self.precompute=precompute
+        self.operatorCacheDir=operatorCacheDir
+        self.operatorThreshold=operatorThreshold
+        self.operator=None#None, or "separable" or "sparse" once computed.
         if self.typ=="spline":
             pass
         elif self.typ=="bicubic":
@@ -1319,6 +1342,10 @@ class MirrorSurface:
     def fit(self,actmap,phsOut=None,coords=None):
         """coords here can be a tuple of (ymin,xmin,ymax,xmax) over which the data is fitted.
         """
+        if self.precompute and coords is None:
+            if self.operator is None:
+                self.makeOperator()
+            return self.fitOperator(actmap,phsOut)
         if self.stuckActsMask is not None:
             actmap=actmap*self.stuckActsMask+self.stuckActsValue
             for c in self.coupledActsList:
@@ -1363,6 +1390,262 @@ class MirrorSurface:
         else:
             print "WARNING: mirror surface unknown type - not fitting"
 
+    def fitRaw(self,actmap,phsOut):
+        """Interpolate actmap into phsOut, without stuck actuators or the
+        precomputed operator.  Used when probing the operator."""
+        stuck=self.stuckActsMask
+        precompute=self.precompute
+        save=self.phsOut
+        self.stuckActsMask=None
+        self.precompute=0
+        self.phsOut=phsOut#some of the interpolation functions only work when phsOut is None.
+        try:
+            self.fit(actmap)
+        finally:
+            self.stuckActsMask=stuck
+            self.precompute=precompute
+            self.phsOut=save
+        return phsOut
+
+    def makeStuckActMatrix(self):
+        """Returns a sparse matrix P and vector c such that the stuck and
+        coupled actuator handling of fit() is actmap=P.actmap+c.
+        """
+        import scipy.sparse
+        nact=self.nact
+        mask=self.stuckActsMask.ravel()
+        c=self.stuckActsValue.ravel().astype(numpy.float64)
+        rows=[]
+        for k in xrange(nact*nact):
+            if mask[k]!=0:
+                rows.append({k:float(mask[k])})
+            else:
+                rows.append({})
+        for y,x in self.coupledActsList:
+            nb=[]
+            if y>0:
+                nb.append((y-1)*nact+x)
+            if y<nact-1 and self.stuckActsMask[y+1,x]==1:
+                nb.append((y+1)*nact+x)
+            if x>0:
+                nb.append(y*nact+x-1)
+            if x<nact-1 and self.stuckActsMask[y,x+1]==1:
+                nb.append(y*nact+x+1)
+            k=y*nact+x
+            row={}
+            ck=0.
+            for j in nb:
+                if j==k:
+                    continue
+                for i,v in rows[j].items():
+                    row[i]=row.get(i,0.)+v/len(nb)
+                ck+=c[j]/len(nb)
+            rows[k]=row
+            c[k]=ck
+        indptr=[0]
+        indices=[]
+        data=[]
+        for row in rows:
+            keys=sorted(row.keys())
+            indices+=keys
+            data+=[row[i] for i in keys]
+            indptr.append(len(indices))
+        P=scipy.sparse.csr_matrix((numpy.array(data,numpy.float64),numpy.array(indices,numpy.int32),numpy.array(indptr,numpy.int32)),shape=(nact*nact,nact*nact))
+        return P,c
+
+    def probeSparse(self,func,nin,nout,threshold=0.):
+        """Compute the sparse matrix (nout,nin) of a linear function func(unit vector), by probing each input."""
+        import scipy.sparse
+        indptr=[0]
+        indices=[]
+        data=[]
+        for i in xrange(nin):
+            col=func(i)
+            if threshold>0:
+                nz=numpy.nonzero(numpy.abs(col)>threshold*numpy.abs(col).max())[0]
+            else:
+                nz=numpy.nonzero(col)[0]
+            indices.append(nz.astype(numpy.int32))
+            data.append(col[nz].astype(numpy.float32))
+            indptr.append(indptr[-1]+nz.shape[0])
+        m=scipy.sparse.csc_matrix((numpy.concatenate(data),numpy.concatenate(indices),numpy.array(indptr,numpy.int64)),shape=(nout,nin))
+        return m.tocsr()
+
+    def makeOperator(self):
+        """Compute the operator mapping actuators onto the mirror surface.
+        All the interpolation types are linear in the actuator values, so
+        surface = Post(Pre actmap) + surface0
+        where Pre (sparse, nact^2 x nact^2) includes the stuck/coupled
+        actuators (and actCoupling for the spline types), surface0 is the
+        surface due to stuck actuators, and Post is either separable
+        (Ly actmap Lx^T, for spline, pspline, linear and gaussian
+        interpolation, checked numerically), or a sparse CSR matrix
+        (npup^2 x nact^2) computed by poking each actuator in turn.
+        The Post operator is cached in operatorCacheDir if set.
+        """
+        import scipy.sparse,util.matrixCache
+        t1=time.time()
+        nact=self.nact
+        npup=self.npup
+        cache=None
+        if self.operatorCacheDir is not None:
+            cache=util.matrixCache.matrixCache(self.operatorCacheDir)
+            infFunc=None
+            if self.typ=="influence":#only used by influence interpolation.
+                if type(self.infFunc)==type(""):
+                    self.setupInfluence()
+                infFunc=numpy.asarray(self.infFunc)#all of it - a changed file of the same name, or any changed value, needs a new operator.
+            key=util.matrixCache.makeKey("mirrorSurface",self.typ,npup,nact,self.actoffset,self.actCoupling,self.actFlattening,
+                                         self.couplingcoeff,self.gaussianIndex,self.gaussianOverlapAccuracy,infFunc,self.operatorThreshold)
+        spline=self.typ in ["spline","pspline"]
+        #Pre operator.
+        pre=None
+        c=None
+        if self.stuckActsMask is not None:
+            pre,c=self.makeStuckActMatrix()
+        if spline and self.actCoupling:
+            def fudgeCol(i):
+                a=numpy.zeros((nact*nact,),numpy.float64)
+                a[i]=1
+                return self.fudge(a.reshape(nact,nact),self.actCoupling).ravel()
+            F=self.probeSparse(fudgeCol,nact*nact,nact*nact).astype(numpy.float64)
+            if pre is None:
+                pre=F
+            else:
+                pre=F.dot(pre).tocsr()
+                c=F.dot(c)
+        self.opPre=pre
+        #Post operator.
+        self.opLy=self.opLx=self.opMatrix=None
+        actCoupling=self.actCoupling
+        if spline:
+            self.actCoupling=None#the fudge is in pre.
+        try:
+            if cache is not None and cache.has(key+"Ly"):
+                self.opLy=cache.get(key+"Ly")
+                self.opLx=cache.get(key+"Lx")
+            elif cache is not None and cache.has(key+"data"):
+                self.opMatrix=scipy.sparse.csr_matrix((cache.get(key+"data"),cache.get(key+"indices"),cache.get(key+"indptr")),shape=(npup*npup,nact*nact))
+            else:
+                if self.typ in ["spline","pspline","linear","gaussian"]:
+                    self.opLy,self.opLx=self.probeSeparable()
+                    self.operator="separable"
+                    if not self.checkOperator():
+                        print "INFORMATION MirrorSurface: %s interpolation not separable - using sparse operator"%self.typ
+                        self.opLy=self.opLx=None
+                if self.opLy is None:
+                    if self.typ=="influence":
+                        m=numpy.asarray(self.infFunc).reshape(nact*nact,npup*npup)
+                        self.opMatrix=self.probeSparse(lambda i:m[i],nact*nact,npup*npup,self.operatorThreshold)
+                    else:
+                        tmp=numpy.zeros((npup,npup),numpy.float32)
+                        a=numpy.zeros((nact,nact),numpy.float32)
+                        def probe(i):
+                            a.ravel()[i]=1
+                            self.fitRaw(a,tmp)
+                            a.ravel()[i]=0
+                            return tmp.ravel()
+                        self.opMatrix=self.probeSparse(probe,nact*nact,npup*npup,self.operatorThreshold)
+                if cache is not None:
+                    if self.opLy is not None:
+                        cache.put(key+"Ly",self.opLy)
+                        cache.put(key+"Lx",self.opLx)
+                    else:
+                        cache.put(key+"data",self.opMatrix.data)
+                        cache.put(key+"indices",self.opMatrix.indices)
+                        cache.put(key+"indptr",self.opMatrix.indptr)
+        finally:
+            self.actCoupling=actCoupling
+        if self.opLy is not None:
+            self.operator="separable"
+        else:
+            self.operator="sparse"
+            nthreads=max(1,self.interpolationNthreads)
+            step=(npup*npup+nthreads-1)/nthreads
+            self.opBlocks=[(i,min(i+step,npup*npup),self.opMatrix[i:i+step]) for i in range(0,npup*npup,step)]
+        self.opSurface0=None
+        if c is not None:
+            self.opSurface0=numpy.zeros((npup,npup),numpy.float32)
+            self.applyPost(c,self.opSurface0)
+        print "INFORMATION MirrorSurface: Computed %s operator for %s interpolation in %gs"%(self.operator,self.typ,time.time()-t1)
+        if self.operator=="sparse":
+            print "INFORMATION MirrorSurface: Sparse operator has %d elements"%self.opMatrix.nnz
+
+    def probeSeparable(self):
+        """Compute Ly, Lx (npup,nact) assuming the interpolation is separable,
+        i.e. surface=Ly actmap Lx^T.
+        """
+        nact=self.nact
+        npup=self.npup
+        k=nact/2
+        a=numpy.zeros((nact,nact),numpy.float32)
+        tmp=numpy.zeros((npup,npup),numpy.float32)
+        a[k,k]=1
+        rkk=self.fitRaw(a,tmp).astype(numpy.float64)
+        py,px=numpy.unravel_index(numpy.argmax(numpy.abs(rkk)),rkk.shape)
+        s=numpy.sqrt(numpy.abs(rkk[py,px]))
+        lyk=s
+        lxk=rkk[py,px]/s
+        Ly=numpy.zeros((npup,nact),numpy.float32)
+        Lx=numpy.zeros((npup,nact),numpy.float32)
+        for i in range(nact):
+            a[:]=0
+            a[i,k]=1
+            Ly[:,i]=self.fitRaw(a,tmp)[:,px]/lxk
+            a[:]=0
+            a[k,i]=1
+            Lx[:,i]=self.fitRaw(a,tmp)[py,:]/lyk
+        return Ly,Lx
+
+    def checkOperator(self,tol=1e-4):
+        """Check that the precomputed operator agrees with the interpolation for a random actuator map"""
+        a=numpy.random.RandomState(0).normal(size=(self.nact,self.nact)).astype(numpy.float32)
+        ref=self.fitRaw(a,numpy.zeros((self.npup,self.npup),numpy.float32))
+        out=numpy.zeros((self.npup,self.npup),numpy.float32)
+        self.applyPost(a.ravel(),out)
+        err=numpy.abs(out-ref).max()
+        return err<=tol*max(numpy.abs(ref).max(),1e-30)
+
+    def applyPost(self,a,phsOut):
+        """Apply the post operator to actuator vector a, putting the result in phsOut"""
+        if self.opLy is not None:
+            a=a.reshape(self.nact,self.nact).astype(numpy.float32)
+            phsOut[:]=quick.dot(quick.dot(self.opLy,a),self.opLx.T)
+        else:
+            out=phsOut.ravel()
+            if len(self.opBlocks)==1:
+                out[:]=self.opMatrix.dot(a)
+            else:
+                def run(s,e,m):
+                    out[s:e]=m.dot(a)
+                tlist=[]
+                for s,e,m in self.opBlocks:
+                    t=threading.Thread(target=run,args=(s,e,m))
+                    t.start()
+                    tlist.append(t)
+                for t in tlist:
+                    t.join()
+        return phsOut
+
+    def fitOperator(self,actmap,phsOut=None):
+        """Compute the mirror surface using the precomputed operator"""
+        if phsOut is None:
+            phsOut=self.phsOut
+        a=actmap.ravel()
+        if self.opPre is not None:
+            a=self.opPre.dot(a)
+        if self.operator=="sparse":
+            a=a.astype(numpy.float32)
+        if not phsOut.flags.c_contiguous:
+            tmp=numpy.empty(phsOut.shape,numpy.float32)
+            self.applyPost(a,tmp)
+            phsOut[:]=tmp
+        else:
+            self.applyPost(a,phsOut)
+        if self.opSurface0 is not None:
+            phsOut+=self.opSurface0
+        return phsOut
+
     def makeStuckActPattern(self,stuckActs):
         """Makes a pattern for stuck actuators
         stuckActs is int, or tuple of (nstuck,clumpsize,maxRadius,minRadius,seed, fraction high, high value,frac low, low value, fraction coupled)
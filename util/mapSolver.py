@@ -0,0 +1,353 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""MAP (MMSE) reconstructor construction without dense covariance matrices.
+
+The MAP reconstructor is
+rmx=C_p A^T (A C_p A^T + C_n)^{-1}
+where A is the poke matrix (ncents,nmodes), C_p the phase covariance of
+the DM modes and C_n the noise covariance.  Forming C_p and inverting
+(A C_p A^T + C_n) requires O(nmodes^2) and O(ncents^2) memory, which
+is not possible for ELT scale systems.
+
+Here, A is held as a scipy.sparse matrix, C_p is block diagonal (one
+block per DM), with each block a Block Toeplitz Toeplitz Block (BTTB)
+matrix (as util.phaseCovariance.bttb) which is applied using FFTs of a
+circulant embedding, and C_n is diagonal.  The system
+(A C_p A^T + C_n) y = s is then solved using conjugate gradients, with
+a Jacobi preconditioner (the diagonal of A C_p A^T is computed exactly,
+a block of rows of A at a time).  Poke matrices of spline (or other
+extended) influence functions have no exact zeros, so elements smaller
+than a threshold fraction of the maximum are dropped to keep A sparse.
+
+The solver can then either be used on the fly (reconstruct()), or to
+build the control matrix a block of rows at a time
+(makeControlMatrix()), in which case peak memory is the control matrix
+itself, plus O(ncents x blockSize).
+"""
+import numpy
+import numpy.fft
+import scipy.sparse
+import util.phaseCovariance
+
+def covarianceKernel(nact,actSpacing,r0,l0):
+    """Phase covariance between two points separated by (i,j) actuator
+    spacings, for 0<=i,j<nact.  The same model as used by
+    util.phaseCovariance.bttb().
+    @param nact: Number of actuators across the DM
+    @type nact: Int
+    @param actSpacing: Actuator spacing (m)
+    @type actSpacing: Float
+    @param r0: Fried parameter (m, at 500nm)
+    @type r0: Float
+    @param l0: Outer scale (m)
+    @type l0: Float
+    @return: The covariance (radians^2 at 500nm)
+    @rtype: Array, shape (nact,nact)
+    """
+    sigma2=0.5*0.17253*(l0/r0)**(5./3)
+    k=numpy.zeros((nact,nact),numpy.float64)
+    for i in range(nact):
+        for j in range(i,nact):
+            sep=numpy.sqrt(i*i+j*j)*actSpacing
+            k[i,j]=k[j,i]=sigma2-util.phaseCovariance.vonKal(sep,l0,r0)/2
+    return k
+
+class bttbCovariance:
+    """The phase covariance between the actuators of a zonal DM, as a BTTB
+    matrix, optionally scaled by a per-actuator factor (for mirror modes
+    that are not point like), i.e. C=S K S where K is BTTB and S diagonal.
+    Only O(nact^2) memory is used.
+    @cvar nact: Number of actuators across the DM
+    @type nact: Int
+    @cvar indices: Indices (into the nact x nact grid) of the used actuators
+    @type indices: Array
+    @cvar n: Number of used actuators
+    @type n: Int
+    """
+    def __init__(self,nact,actSpacing,r0,l0,dmflag=None,modeScale=None,lam=500.):
+        """
+        @param nact: Number of actuators across the DM
+        @type nact: Int
+        @param actSpacing: Actuator spacing (m)
+        @type actSpacing: Float
+        @param r0: Fried parameter (m, at 500nm)
+        @type r0: Float
+        @param l0: Outer scale (m)
+        @type l0: Float
+        @param dmflag: The used actuators, or None for all
+        @type dmflag: Array, shape (nact,nact)
+        @param modeScale: Scale factor for each used actuator, or None
+        @type modeScale: Array or None
+        @param lam: Wavelength (nm) of the reconstruction
+        @type lam: Float
+        """
+        self.nact=nact
+        if dmflag is None:
+            self.indices=numpy.arange(nact*nact)
+        else:
+            self.indices=numpy.nonzero(numpy.array(dmflag).ravel())[0]
+        self.n=self.indices.shape[0]
+        self.kernel=covarianceKernel(nact,actSpacing,r0,l0)*(500./lam)**2
+        if modeScale is None:
+            self.scale=None
+        else:
+            self.scale=numpy.array(modeScale,numpy.float64).ravel()
+            if self.scale.shape[0]!=self.n:
+                raise Exception("util.mapSolver: modeScale has %d entries, expecting %d"%(self.scale.shape[0],self.n))
+        #circulant embedding of size 2*nact in each dimension.
+        N=self.N=2*nact
+        c=numpy.zeros((N,N),numpy.float64)
+        c[:nact,:nact]=self.kernel
+        c[N-nact+1:,:nact]=self.kernel[:0:-1]
+        c[:,N-nact+1:]=c[:,nact-1:0:-1]
+        self.eig=numpy.fft.rfft2(c).real
+        self.yind=self.indices/nact
+        self.xind=self.indices%nact
+
+    def matvec(self,x):
+        """Multiply by the covariance.
+        @param x: The vector(s) to multiply
+        @type x: Array, shape (n,) or (n,nvec)
+        @return: The product, same shape as x
+        @rtype: Array
+        """
+        vec=(x.ndim==1)
+        if vec:
+            x=x[:,None]
+        if self.scale is not None:
+            x=x*self.scale[:,None]
+        nvec=x.shape[1]
+        grid=numpy.zeros((nvec,self.N,self.N),numpy.float64)
+        grid[:,self.yind,self.xind]=x.T
+        grid=numpy.fft.irfft2(numpy.fft.rfft2(grid)*self.eig,s=(self.N,self.N))
+        y=grid[:,self.yind,self.xind].T
+        if self.scale is not None:
+            y*=self.scale[:,None]
+        if vec:
+            y=y[:,0]
+        return y
+
+    def entries(self,i,j):
+        """Return the covariance elements C[i,j], for arrays of indices i,j.
+        """
+        c=self.kernel[numpy.abs(self.yind[i]-self.yind[j]),numpy.abs(self.xind[i]-self.xind[j])]
+        if self.scale is not None:
+            c=c*self.scale[i]*self.scale[j]
+        return c
+
+class blockDiagonalCovariance:
+    """A block diagonal covariance (e.g. one block for each DM), each block
+    having matvec and entries methods, and an n attribute.
+    """
+    def __init__(self,blockList):
+        self.blockList=blockList
+        self.offsets=numpy.cumsum([0]+[b.n for b in blockList])
+        self.n=self.offsets[-1]
+
+    def matvec(self,x):
+        y=numpy.empty(x.shape,numpy.float64)
+        for i in range(len(self.blockList)):
+            s,e=self.offsets[i],self.offsets[i+1]
+            y[s:e]=self.blockList[i].matvec(x[s:e])
+        return y
+
+    def entries(self,i,j):
+        bi=numpy.searchsorted(self.offsets,i,side="right")-1
+        bj=numpy.searchsorted(self.offsets,j,side="right")-1
+        c=numpy.zeros(i.shape,numpy.float64)
+        for b in range(len(self.blockList)):
+            sel=numpy.nonzero((bi==b)&(bj==b))[0]
+            if sel.size>0:
+                off=self.offsets[b]
+                c[sel]=self.blockList[b].entries(i[sel]-off,j[sel]-off)
+        return c
+
+def sparsify(pmx,threshold=0.,blockSize=1024):
+    """Convert a poke matrix (nmodes,ncents) into a scipy.sparse csr matrix,
+    with elements less than threshold*max(abs(pmx)) set to zero.  Dense
+    matrices are converted a block of rows at a time, so no dense
+    temporary copies are made.
+    """
+    if scipy.sparse.issparse(pmx):
+        pmx=pmx.tocsr()
+        if threshold>0:
+            pmx.data[numpy.abs(pmx.data)<threshold*numpy.abs(pmx.data).max()]=0
+            pmx.eliminate_zeros()
+        return pmx
+    lim=0.
+    if threshold>0:
+        lim=threshold*numpy.abs(pmx).max()
+    blocks=[]
+    for i in xrange(0,pmx.shape[0],blockSize):
+        b=numpy.array(pmx[i:i+blockSize],numpy.float64)
+        b[numpy.abs(b)<=lim]=0
+        blocks.append(scipy.sparse.csr_matrix(b))
+    return scipy.sparse.vstack(blocks).tocsr()
+
+class mapSolver:
+    """Solves for MAP actuator commands using preconditioned conjugate
+    gradients, with the phase covariance kept in structured form.
+    @cvar A: The interaction matrix (ncents,nmodes)
+    @type A: scipy.sparse.csr_matrix
+    @cvar AT: Transpose of A
+    @type AT: scipy.sparse.csr_matrix
+    @cvar cov: The phase covariance operator
+    @type cov: bttbCovariance or blockDiagonalCovariance
+    @cvar noise: Diagonal of the noise covariance
+    @type noise: Array
+    @cvar precon: Inverse of the diagonal of (A C_p A^T + C_n)
+    @type precon: Array
+    """
+    def __init__(self,pmx,cov,noiseCov=None,tol=1e-6,maxiter=200,sparseThreshold=1e-3):
+        """
+        @param pmx: The poke matrix, shape (nmodes,ncents), dense or sparse
+        @type pmx: Array or scipy.sparse matrix
+        @param cov: The phase covariance operator, with n==nmodes
+        @type cov: bttbCovariance or blockDiagonalCovariance
+        @param noiseCov: Noise covariance: None, a scalar, the diagonal, or a matrix (from which the diagonal is used)
+        @type noiseCov: None, Float, Array or BlockMatrix
+        @param tol: Relative residual at which CG is converged
+        @type tol: Float
+        @param maxiter: Maximum number of CG iterations
+        @type maxiter: Int
+        @param sparseThreshold: Poke matrix elements smaller than this fraction of the maximum are ignored
+        @type sparseThreshold: Float
+        """
+        self.AT=sparsify(pmx,sparseThreshold)
+        self.A=self.AT.T.tocsr()
+        self.ncents,self.nmodes=self.A.shape
+        if cov.n!=self.nmodes:
+            raise Exception("util.mapSolver: phase covariance has %d modes, poke matrix %d"%(cov.n,self.nmodes))
+        self.cov=cov
+        self.tol=tol
+        self.maxiter=maxiter
+        self.y0=None
+        self.niters=0
+        print "INFORMATION:**mapSolver**:Poke matrix has %d non-zero elements (%g full)"%(self.A.nnz,self.A.nnz/float(self.ncents*self.nmodes))
+        d=self.computeDiagonal()
+        if noiseCov is None or (type(noiseCov) in [type(0),type(0.)] and noiseCov==0):
+            noise=numpy.zeros((self.ncents,),numpy.float64)
+        elif type(noiseCov) in [type(0),type(0.)]:
+            noise=numpy.ones((self.ncents,),numpy.float64)*noiseCov
+        elif hasattr(noiseCov,"blockList") or len(noiseCov.shape)==2:
+            print "INFORMATION:**mapSolver**:Using only the diagonal of the noise covariance"
+            noise=numpy.array(noiseCov.diagonal(),numpy.float64)
+        else:
+            noise=numpy.array(noiseCov,numpy.float64)
+        if numpy.all(noise==0):
+            print "WARNING:**mapSolver**:No noise covariance - regularising with 1e-6 of the mean diagonal"
+            noise[:]=1e-6*d.mean()
+        self.noise=noise
+        d=d+noise
+        d[d==0]=1.
+        self.precon=1./d
+
+    def computeDiagonal(self,blockSize=64):
+        """Compute the diagonal of A C_p A^T, a block of rows of A at a time.
+        Element i is a_i^T C_p a_i where a_i is row i of A, so for a block B
+        of rows, this is the row sum of B*(C_p B^T)^T.  Memory used is
+        O(nmodes x blockSize), whatever the sparsity of A.
+        @param blockSize: Number of rows of A used at once
+        @type blockSize: Int
+        @return: The diagonal
+        @rtype: Array, shape (ncents,)
+        """
+        d=numpy.zeros((self.ncents,),numpy.float64)
+        for r0 in xrange(0,self.ncents,blockSize):
+            r1=min(r0+blockSize,self.ncents)
+            B=self.A[r0:r1]
+            CBT=self.cov.matvec(B.T.toarray())
+            d[r0:r1]=numpy.asarray(B.multiply(CBT.T).sum(1)).ravel()
+        return d
+
+    def applySystem(self,y):
+        """Multiply by (A C_p A^T + C_n).  y has shape (ncents,nvec)"""
+        return self.A.dot(self.cov.matvec(self.AT.dot(y)))+self.noise[:,None]*y
+
+    def pcg(self,b,x0=None):
+        """Solve (A C_p A^T + C_n) x = b for several right hand sides at once,
+        using Jacobi preconditioned conjugate gradients.
+        @param b: The right hand sides
+        @type b: Array, shape (ncents,nvec)
+        @param x0: Initial guess, or None
+        @type x0: Array
+        @return: The solution, and the number of iterations
+        @rtype: Tuple of (Array, Int)
+        """
+        if x0 is None:
+            x=numpy.zeros(b.shape,numpy.float64)
+            r=b.astype(numpy.float64)
+        else:
+            x=x0.astype(numpy.float64)
+            r=b-self.applySystem(x)
+        bnorm=numpy.sqrt((b*b).sum(0))
+        bnorm[bnorm==0]=1.
+        z=self.precon[:,None]*r
+        p=z.copy()
+        rz=(r*z).sum(0)
+        it=0
+        for it in xrange(1,self.maxiter+1):
+            q=self.applySystem(p)
+            pq=(p*q).sum(0)
+            alpha=numpy.where(pq!=0,rz/numpy.where(pq!=0,pq,1.),0.)
+            x+=alpha*p
+            r-=alpha*q
+            if numpy.all(numpy.sqrt((r*r).sum(0))<=self.tol*bnorm):
+                break
+            z=self.precon[:,None]*r
+            rznew=(r*z).sum(0)
+            beta=numpy.where(rz!=0,rznew/numpy.where(rz!=0,rz,1.),0.)
+            p=z+beta*p
+            rz=rznew
+        else:
+            print "WARNING:**mapSolver**:CG did not converge in %d iterations"%self.maxiter
+        return x,it
+
+    def reconstruct(self,slopes):
+        """Compute the MAP actuator values for a slope vector, using the
+        previous solution as a starting point.
+        @param slopes: The slopes
+        @type slopes: Array, shape (ncents,)
+        @return: The actuator values (for orthonormal mirror modes)
+        @rtype: Array, shape (nmodes,)
+        """
+        y,self.niters=self.pcg(numpy.asarray(slopes,numpy.float64)[:,None],self.y0)
+        self.y0=y
+        return self.cov.matvec(self.AT.dot(y))[:,0]
+
+    def makeControlMatrix(self,out=None,dtype=numpy.float32,blockSize=64):
+        """Build the control matrix, blockSize rows at a time.  Row m of the
+        control matrix is the solution of (A C_p A^T + C_n) y = A C_p e_m.
+        @param out: Array to fill (e.g. a numpy.memmap), or None
+        @type out: Array, shape (nmodes,ncents)
+        @param dtype: Data type of the control matrix if out is None
+        @type dtype: numpy dtype
+        @param blockSize: Number of rows to solve for at once
+        @type blockSize: Int
+        @return: The control matrix
+        @rtype: Array, shape (nmodes,ncents)
+        """
+        if out is None:
+            out=numpy.empty((self.nmodes,self.ncents),dtype)
+        for m0 in xrange(0,self.nmodes,blockSize):
+            m1=min(m0+blockSize,self.nmodes)
+            e=numpy.zeros((self.nmodes,m1-m0),numpy.float64)
+            e[numpy.arange(m0,m1),numpy.arange(m1-m0)]=1
+            rhs=self.A.dot(self.cov.matvec(e))
+            y,it=self.pcg(rhs)
+            out[m0:m1]=y.T
+            print "INFORMATION:**mapSolver**:Control matrix rows %d-%d of %d done (%d CG iterations)"%(m0,m1,self.nmodes,it)
+        return out
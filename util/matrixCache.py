@@ -0,0 +1,275 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A persistent on-disk cache for large matrices (poke matrices, control
+matrices etc), keyed by a hash of the parameters that were used to create
+them.
+
+Matrices are stored as .npy files, and returned memory mapped (read only),
+so that only the pages used are read.  The cache has a maximum size, and
+least recently used entries are removed when this is exceeded.  Entries
+are written to a temporary file and then renamed, so that simultaneous
+simulations (e.g. different batch numbers) sharing a cache directory won't
+see partially written matrices.
+
+Processes that share a cache can use getOrLock instead of get, so that a
+matrix that is needed by several of them is only built once (e.g. when
+running a parameter sweep with util/sweep.py): the first process to miss
+takes a lock on the key, and the others wait until it has been put.
+
+Typical use::
+
+ cache=util.matrixCache.matrixCache("/tmp/daspcache",maxSize=10*1024**3)
+ key=util.matrixCache.makeKey("rmx",nact,actoffset,actCoupling,subflag,pupil.fn,rcond)
+ rmx=cache.get(key)
+ if rmx is None:
+     rmx=computeRmx()
+     cache.put(key,rmx)
+"""
+import os,time,hashlib,types,fcntl
+import numpy
+
+def hashObject(obj,h,depth=0):
+    """Update hash h with a representation of obj that does not depend
+    on memory addresses.  Numpy arrays, lists, tuples, dicts and
+    scipy.sparse matrices are recursed into.  Methods and functions are
+    ignored.  Other class instances raise an exception: their __dict__
+    can hold anything (other simulation objects, state that changes during
+    a simulation, etc), so callers should pass the parameters that
+    determine the matrix explicitly.
+    @param obj: The object to hash
+    @type obj: Anything
+    @param h: The hash object, from hashlib
+    @type h: Hash
+    """
+    if depth>20:
+        h.update("<depth>")
+        return
+    t=type(obj)
+    if isinstance(obj,numpy.ndarray):
+        h.update("A%s%s"%(str(obj.dtype),str(obj.shape)))
+        h.update(numpy.ascontiguousarray(obj).view(numpy.uint8).data)
+    elif t in [types.ListType,types.TupleType]:
+        h.update("L%d"%len(obj))
+        for o in obj:
+            hashObject(o,h,depth+1)
+    elif t==types.DictType:
+        keys=obj.keys()
+        keys.sort()
+        h.update("D%d"%len(keys))
+        for k in keys:
+            h.update(repr(k))
+            hashObject(obj[k],h,depth+1)
+    elif t in [types.FunctionType,types.MethodType,types.BuiltinFunctionType,types.ModuleType]:
+        pass
+    elif hasattr(obj,"tocsr") and hasattr(obj,"shape"):#scipy.sparse
+        m=obj.tocsr()
+        hashObject([m.shape,m.data,m.indices,m.indptr],h,depth+1)
+    elif hasattr(obj,"__dict__") and not isinstance(obj,type):
+        raise Exception("matrixCache: Cannot hash a %s instance - pass the parameters that determine the matrix instead"%obj.__class__.__name__)
+    else:
+        h.update(repr(obj))
+
+heldLocks={}#keys locked by this process, across all matrixCache instances.
+
+def makeKey(*args):
+    """Create a cache key (hex string) from the given objects.
+    @return: The key
+    @rtype: String
+    """
+    h=hashlib.sha1()
+    for a in args:
+        hashObject(a,h)
+    return h.hexdigest()
+
+class matrixCache:
+    """A least recently used, size limited, on-disk matrix cache.
+    @cvar cacheDir: The cache directory
+    @type cacheDir: String
+    @cvar maxSize: Maximum total size of the cache (bytes)
+    @type maxSize: Int
+    """
+    def __init__(self,cacheDir,maxSize=10*1024**3,debug=None):
+        """
+        @param cacheDir: Directory in which to store matrices (created if necessary)
+        @type cacheDir: String
+        @param maxSize: Maximum size (bytes) of the cache
+        @type maxSize: Int
+        """
+        self.cacheDir=cacheDir
+        self.maxSize=maxSize
+        self.debug=debug
+        if not os.path.exists(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                if not os.path.isdir(cacheDir):#could have been created by another process.
+                    raise
+
+    def filename(self,key):
+        return os.path.join(self.cacheDir,key+".npy")
+
+    def lockname(self,key):
+        return os.path.join(self.cacheDir,key+".lock")
+
+    def lock(self,key):
+        """Take an exclusive lock on key, shared between processes, waiting
+        until any other process holding it has released it.  Locks are
+        released automatically if the process holding them dies.
+        @param key: The key, from makeKey
+        @type key: String
+        @return: 1 if the lock was taken, 0 if already held by this process
+        @rtype: Int
+        """
+        if heldLocks.has_key(key):
+            return 0
+        fd=os.open(self.lockname(key),os.O_CREAT|os.O_RDWR,0666)
+        try:
+            fcntl.flock(fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except IOError:
+            print "INFORMATION matrixCache: Waiting for %s to be created by another process"%key
+            t1=time.time()
+            fcntl.flock(fd,fcntl.LOCK_EX)
+            print "INFORMATION matrixCache: Waited %gs for %s"%(time.time()-t1,key)
+        heldLocks[key]=fd
+        return 1
+
+    def unlock(self,key):
+        """Release a lock taken with lock (does nothing if not held)"""
+        fd=heldLocks.pop(key,None)
+        if fd is not None:
+            fcntl.flock(fd,fcntl.LOCK_UN)
+            os.close(fd)
+
+    def has(self,key):
+        return os.path.exists(self.filename(key))
+
+    def get(self,key,mmap=1):
+        """Return the matrix stored with key, or None if it doesn't exist.
+        @param key: The key, from makeKey
+        @type key: String
+        @param mmap: Whether to memory map the matrix (read only), or load it
+        @type mmap: Int
+        @return: The matrix or None
+        @rtype: Array
+        """
+        fname=self.filename(key)
+        if not os.path.exists(fname):
+            return None
+        try:
+            if mmap:#asarray so that type(arr)==numpy.ndarray (still memory mapped).
+                arr=numpy.asarray(numpy.load(fname,mmap_mode="r"))
+            else:
+                arr=numpy.load(fname)
+        except:
+            print "WARNING matrixCache: Unable to load %s - removing"%fname
+            self.remove(key)
+            return None
+        try:
+            os.utime(fname,None)#mark as recently used.
+        except OSError:
+            pass
+        if self.debug!=None:
+            print "matrixCache: got %s %s"%(key,str(arr.shape))
+        return arr
+
+    def getOrLock(self,key,mmap=1):
+        """As get, but if the matrix doesn't exist, return None holding the
+        lock on key.  Other processes calling getOrLock for this key then
+        wait until it has been put (or unlock called, or this process
+        ends), rather than computing it themselves.  Note, if the key is
+        already locked by this process, None is returned without waiting.
+        @param key: The key, from makeKey
+        @type key: String
+        @param mmap: Whether to memory map the matrix (read only), or load it
+        @type mmap: Int
+        @return: The matrix or None
+        @rtype: Array
+        """
+        arr=self.get(key,mmap)
+        if arr is None and self.lock(key):
+            arr=self.get(key,mmap)#may have been created while waiting.
+            if arr is not None:
+                self.unlock(key)
+        return arr
+
+    def put(self,key,arr):
+        """Store a matrix in the cache, then remove least recently used entries
+        if the cache is too large.  Matrices larger than maxSize are not stored.
+        @param key: The key, from makeKey
+        @type key: String
+        @param arr: The matrix
+        @type arr: Array
+        """
+        arr=numpy.asarray(arr)
+        if arr.nbytes>self.maxSize:
+            print "INFORMATION matrixCache: Not caching %s - larger than cache size"%key
+            self.unlock(key)
+            return
+        self.evict(self.maxSize-arr.nbytes)
+        fname=self.filename(key)
+        tmpname="%s.%d.tmp"%(fname,os.getpid())
+        f=open(tmpname,"wb")
+        try:
+            numpy.save(f,arr)
+        finally:
+            f.close()
+        os.rename(tmpname,fname)
+        self.unlock(key)
+        if self.debug!=None:
+            print "matrixCache: stored %s %s"%(key,str(arr.shape))
+
+    def remove(self,key):
+        try:
+            os.unlink(self.filename(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        """Return a list of (last used time, size, filename) for the cache entries, oldest first"""
+        ent=[]
+        for f in os.listdir(self.cacheDir):
+            if f.endswith(".npy"):
+                fname=os.path.join(self.cacheDir,f)
+                try:
+                    st=os.stat(fname)
+                except OSError:#removed by another process
+                    continue
+                ent.append((st.st_mtime,st.st_size,fname))
+        ent.sort()
+        return ent
+
+    def size(self):
+        """Total size of the cache in bytes"""
+        return sum([e[1] for e in self.entries()])
+
+    def evict(self,maxSize=None):
+        """Remove least recently used entries until the cache is no larger than maxSize.
+        @param maxSize: The size to reduce to, or None for self.maxSize
+        @type maxSize: Int
+        """
+        if maxSize==None:
+            maxSize=self.maxSize
+        ent=self.entries()
+        tot=sum([e[1] for e in ent])
+        for t,s,fname in ent:
+            if tot<=maxSize:
+                break
+            print "INFORMATION matrixCache: Removing %s from cache (%d bytes)"%(fname,s)
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+            tot-=s
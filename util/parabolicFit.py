@@ -115,6 +115,37 @@ def getMaxPosQuadInterp(data):
     x=(2*a3*a4-a2*a6)/(a6*a6-4*a3*a5)
     return x+1,y+1
     
+def quadInterpCoeffs(data,allPoints=0):
+    """Vectorised quadratic interpolation coefficients (as used by
+    getMaxPosQuadInterp) for arrays of 3x3 regions.
+    @param data: The regions, shape (...,3,3)
+    @type data: Array
+    @param allPoints: If set, the first and second derivatives are averaged over all 3 rows/columns rather than taken from the central one
+    @type allPoints: Int
+    @return: a2,a3,a4,a5,a6 (first and second derivatives in y, then x, then the cross term), each of shape data.shape[:-2]
+    @rtype: Tuple of Array
+    """
+    if data.shape[-2:]!=(3,3):
+        raise Exception("Should be (...,3,3), is %s"%str(data.shape))
+    if allPoints:
+        r0=data[...,0,:].sum(-1)
+        r1=data[...,1,:].sum(-1)
+        r2=data[...,2,:].sum(-1)
+        c0=data[...,:,0].sum(-1)
+        c1=data[...,:,1].sum(-1)
+        c2=data[...,:,2].sum(-1)
+        a2=(r2-r0)/6.
+        a3=(r2-2*r1+r0)/6.
+        a4=(c2-c0)/6.
+        a5=(c2-2*c1+c0)/6.
+    else:
+        a2=(data[...,2,1]-data[...,0,1])/2.
+        a3=(data[...,2,1]-2*data[...,1,1]+data[...,0,1])/2.
+        a4=(data[...,1,2]-data[...,1,0])/2.
+        a5=(data[...,1,2]-2*data[...,1,1]+data[...,1,0])/2.
+    a6=(data[...,2,2]-data[...,0,2]-data[...,2,0]+data[...,0,0])/4.
+    return a2,a3,a4,a5,a6
+
 def fitPeak(data,size=3,minimum=1,quadInterp=0):
     """Finds the parabola max/min for a region of size x size around the minimum or maximum of dat."""
     if minimum:
@@ -43,6 +43,8 @@ import util.zernikeMod
 import cmod.phaseCov#agbhome
 import types
 import sys
+import os
+import bisect
 #import FFT
 #use the make() method...
 def computeCov(modes,scale,r0,l0):
@@ -496,6 +498,147 @@ def makeWithLocalModesFFTThreaded(npup,modes,modeCoords,r0=0.12,l0=30.,telDiam=4
         p.join()
     out=numpy.array(output)*(500./lam)**2
     return out
+
+class covarianceCache:
+    """An on-disk cache of phase covariance matrices, for reconstructors that
+    need rebuilding as r0 (and L0) change, e.g. MAP reconstructors in r0
+    tracking studies.
+
+    von Karman (and Kolmogorov) covariance is proportional to r0**(-5/3),
+    and to (500/lam)**2, so only the kernel for r0=1, lam=500nm is stored,
+    once for each geometry (mirror modes etc) and L0, and then rescaled.
+    If interpolate is set, and the L0 requested lies between two L0 values
+    already stored for this geometry (no more than maxL0Ratio apart), the
+    kernel is linearly interpolated in log(L0) rather than being computed.
+
+    Typical use::
+
+     cache=util.phaseCovariance.covarianceCache("/tmp/phasecov")
+     key=cache.makeKey(modes,modeCoords,npup,telDiam,typ)
+     phasecov=cache.get(key,r0,l0,lam,lambda l0:makeWithLocalModesFFTThreaded(npup,modes,modeCoords,r0=1.,l0=l0,telDiam=telDiam))
+    @cvar cache: The matrix cache storing the kernels
+    @type cache: util.matrixCache.matrixCache
+    @cvar interpolate: Whether to interpolate between L0 values
+    @type interpolate: Int
+    @cvar maxL0Ratio: Max ratio of the L0 values used for interpolation
+    @type maxL0Ratio: Float
+    """
+    def __init__(self,cacheDir,maxSize=10*1024**3,interpolate=1,maxL0Ratio=1.5):
+        """
+        @param cacheDir: Directory in which to store the kernels
+        @type cacheDir: String
+        @param maxSize: Maximum size (bytes) of the cache
+        @type maxSize: Int
+        @param interpolate: Whether to interpolate between stored L0 values
+        @type interpolate: Int
+        @param maxL0Ratio: Max ratio of the bracketing L0 values for interpolation
+        @type maxL0Ratio: Float
+        """
+        import util.matrixCache
+        self.cache=util.matrixCache.matrixCache(cacheDir,maxSize)
+        self.interpolate=interpolate
+        self.maxL0Ratio=maxL0Ratio
+
+    def makeKey(self,*args):
+        """Create a key for the geometry (not including r0, L0 or wavelength).
+        @return: The key
+        @rtype: String
+        """
+        import util.matrixCache
+        return util.matrixCache.makeKey("phasecov",version(),*args)
+
+    def kernelKey(self,key,l0):
+        if l0<0:
+            return key+"_kol"
+        return key+"_l0_%.6g"%l0
+
+    def storedL0(self,key):
+        """Return a sorted list of the L0 values stored for the geometry key"""
+        prefix=key+"_l0_"
+        l0List=[]
+        for f in os.listdir(self.cache.cacheDir):
+            if f.startswith(prefix) and f.endswith(".npy"):
+                try:
+                    l0List.append(float(f[len(prefix):-4]))
+                except ValueError:
+                    pass
+        l0List.sort()
+        return l0List
+
+    def getKernel(self,key,l0,compute=None):
+        """Return the covariance for r0=1, lam=500nm.
+        @param key: The geometry key, from makeKey
+        @type key: String
+        @param l0: The outer scale, or <0 for Kolmogorov
+        @type l0: Float
+        @param compute: Function taking l0, returning the covariance for r0=1, lam=500nm, or None
+        @type compute: Function
+        @return: The kernel, or None if not stored and compute is None
+        @rtype: Array
+        """
+        kkey=self.kernelKey(key,l0)
+        kernel=self.cache.getOrLock(kkey)
+        if kernel is not None:
+            return kernel
+        if self.interpolate and l0>0:
+            l0List=self.storedL0(key)
+            i=bisect.bisect(l0List,l0)
+            if i>0 and i<len(l0List) and l0List[i]/l0List[i-1]<=self.maxL0Ratio:
+                lo=self.cache.get(self.kernelKey(key,l0List[i-1]))
+                hi=self.cache.get(self.kernelKey(key,l0List[i]))
+                if lo is not None and hi is not None:
+                    self.cache.unlock(kkey)
+                    w=numpy.log(l0/l0List[i-1])/numpy.log(l0List[i]/l0List[i-1])
+                    print "INFORMATION phaseCovariance: Interpolating covariance for L0=%g from L0=%g,%g"%(l0,l0List[i-1],l0List[i])
+                    return ((1-w)*lo+w*hi).astype(numpy.float32)
+        if compute is None:
+            self.cache.unlock(kkey)
+            return None
+        print "INFORMATION phaseCovariance: Computing covariance kernel for L0=%g"%l0
+        try:
+            kernel=numpy.array(compute(l0))
+        except:
+            self.cache.unlock(kkey)
+            raise
+        self.cache.put(kkey,kernel)
+        return kernel
+
+    def get(self,key,r0,l0,lam=500.,compute=None):
+        """Return the phase covariance for this geometry, r0, L0 and wavelength.
+        @param key: The geometry key, from makeKey
+        @type key: String
+        @param r0: Fried's parameter (m)
+        @type r0: Float
+        @param l0: The outer scale (m), or <0 for Kolmogorov
+        @type l0: Float
+        @param lam: Wavelength (nm)
+        @type lam: Float
+        @param compute: Function taking l0, returning the covariance for r0=1, lam=500nm, or None
+        @type compute: Function
+        @return: The covariance, or None if not available and compute is None
+        @rtype: Array
+        """
+        kernel=self.getKernel(key,l0,compute)
+        if kernel is None:
+            return None
+        return (kernel*(r0**(-5./3)*(500./lam)**2)).astype(numpy.float32)
+
+    def precompute(self,key,l0List,compute):
+        """Store kernels for a grid of L0 values, so that intermediate values can be interpolated.
+        @param key: The geometry key, from makeKey
+        @type key: String
+        @param l0List: The L0 values
+        @type l0List: List of Float
+        @param compute: Function taking l0, returning the covariance for r0=1, lam=500nm
+        @type compute: Function
+        """
+        interp=self.interpolate
+        self.interpolate=0
+        try:
+            for l0 in l0List:
+                self.getKernel(key,l0,compute)
+        finally:
+            self.interpolate=interp
         
 
 
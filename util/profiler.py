@@ -0,0 +1,221 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Per-module instrumentation of the simulation main loop.
+
+A Profiler is created by util.Ctrl when the "profile" parameter is set,
+and is attached to every module in the compList (module.profiler).  It
+then records:
+ - wall and cpu time per module per iteration (histogrammed, so memory
+   use is independent of the number of iterations),
+ - time spent in prepareNextIter, generateNext and endThisIter (from
+   aobase.doNextIter),
+ - time spent blocked waiting on communications (mpiSend, mpiGet, shmGet
+   etc),
+ - a timeline of events which can be written as a Chrome trace
+   (chrome://tracing or https://ui.perfetto.dev), one file per MPI rank.
+
+Parameters (from the globals section of the param file):
+ - profile - 0 (default) to disable, 1 to enable.
+ - profileTraceFile - filename for the timeline, default profile%d.json
+   where %d is replaced by the MPI rank.  None to not write a trace.
+ - profileMaxEvents - maximum number of timeline events to store, default
+   100000.  Statistics continue to be gathered after this.
+"""
+import time,json
+import numpy
+
+class Profiler:
+    """Collects timing statistics for simulation modules.
+    @cvar rank: MPI rank
+    @type rank: Int
+    @cvar bins: Histogram bin edges (seconds), logarithmically spaced
+    @type bins: Array
+    @cvar stats: Dict of (objID,category) to a timingStat instance
+    @type stats: Dict
+    @cvar events: The timeline events
+    @type events: List
+    @cvar maxEvents: Max number of timeline events to store
+    @type maxEvents: Int
+    """
+    def __init__(self,rank=0,traceFile=None,maxEvents=100000,nbins=120,tmin=1e-6,tmax=1e3):
+        """
+        @param rank: The MPI rank
+        @type rank: Int
+        @param traceFile: Filename to write timeline to, or None.  Any %d is replaced by rank.
+        @type traceFile: String or None
+        @param maxEvents: Max number of timeline events to store
+        @type maxEvents: Int
+        @param nbins: Number of histogram bins
+        @type nbins: Int
+        @param tmin: Lower histogram edge (s)
+        @type tmin: Float
+        @param tmax: Upper histogram edge (s)
+        @type tmax: Float
+        """
+        self.rank=rank
+        if traceFile!=None and "%d" in traceFile:
+            traceFile=traceFile%rank
+        self.traceFile=traceFile
+        self.maxEvents=maxEvents
+        self.bins=numpy.logspace(numpy.log10(tmin),numpy.log10(tmax),nbins+1)
+        self.stats={}
+        self.order=[]
+        self.events=[]
+        self.droppedEvents=0
+        self.t0=time.time()
+
+    def getStat(self,name,cat):
+        """Get (creating if necessary) the timingStat for name, category"""
+        key=(name,cat)
+        s=self.stats.get(key)
+        if s is None:
+            s=timingStat(self.bins)
+            self.stats[key]=s
+            self.order.append(key)
+        return s
+
+    def add(self,name,cat,tstart,wall,cpu=None,tid=0):
+        """Record a timing.
+        @param name: Module objID
+        @type name: String
+        @param cat: Category, e.g. "iter", "generateNext", "blocked"
+        @type cat: String
+        @param tstart: Start time, from time.time()
+        @type tstart: Float
+        @param wall: Wall clock duration (s)
+        @type wall: Float
+        @param cpu: CPU duration (s), or None
+        @type cpu: Float
+        @param tid: Thread ID for the timeline
+        @type tid: Int
+        """
+        self.getStat(name,cat).add(wall,cpu)
+        if self.traceFile!=None:
+            if len(self.events)<self.maxEvents:
+                self.events.append((name,cat,tstart,wall,tid))
+            else:
+                self.droppedEvents+=1
+
+    def addBlocked(self,name,tstart,wall):
+        """Record time spent blocked waiting for communications"""
+        self.add(name,"blocked",tstart,wall,tid=1)
+
+    def summary(self,percentiles=(50,90,99)):
+        """Return a text summary of the timings.
+        @param percentiles: The percentiles to report
+        @type percentiles: Tuple of Float
+        @return: The summary
+        @rtype: String
+        """
+        txt="%-30s %-13s %8s %10s %10s %10s"%("Module","Category","N","mean(s)","stdev(s)","cpu(s)")
+        for p in percentiles:
+            txt+=" %10s"%("p%g(s)"%p)
+        txt+="\n"
+        for key in self.order:
+            s=self.stats[key]
+            txt+="%-30s %-13s %8d %10.4g %10.4g %10.4g"%(key[0],key[1],s.n,s.mean(),s.stdev(),s.meanCpu())
+            for p in percentiles:
+                txt+=" %10.4g"%s.percentile(p)
+            txt+="\n"
+        return txt
+
+    def getStats(self,percentiles=(50,90,99)):
+        """Return the statistics as a dict, suitable for json.
+        """
+        d={}
+        for key in self.order:
+            s=self.stats[key]
+            entry={"n":s.n,"mean":s.mean(),"stdev":s.stdev(),"cpu":s.meanCpu(),"total":s.tot,"max":s.tmax,
+                   "hist":s.hist.tolist()}
+            for p in percentiles:
+                entry["p%g"%p]=s.percentile(p)
+            d.setdefault(key[0],{})[key[1]]=entry
+        return d
+
+    def writeTrace(self,fname=None):
+        """Write the timeline as a Chrome trace event json file.  Statistics
+        are stored in the "otherData" section.
+        @param fname: Filename, or None to use traceFile
+        @type fname: String
+        """
+        if fname==None:
+            fname=self.traceFile
+        if fname==None:
+            return
+        ev=[]
+        ev.append({"name":"process_name","ph":"M","pid":self.rank,"args":{"name":"rank %d"%self.rank}})
+        ev.append({"name":"thread_name","ph":"M","pid":self.rank,"tid":0,"args":{"name":"compute"}})
+        ev.append({"name":"thread_name","ph":"M","pid":self.rank,"tid":1,"args":{"name":"blocked"}})
+        for name,cat,tstart,wall,tid in self.events:
+            ev.append({"name":name,"cat":cat,"ph":"X","pid":self.rank,"tid":tid,
+                       "ts":(tstart-self.t0)*1e6,"dur":wall*1e6})
+        d={"traceEvents":ev,"displayTimeUnit":"ms",
+           "otherData":{"rank":self.rank,"t0":self.t0,"droppedEvents":self.droppedEvents,
+                        "histBins":self.bins.tolist(),"stats":self.getStats()}}
+        f=open(fname,"w")
+        json.dump(d,f)
+        f.close()
+        print "INFORMATION Written profile timeline to %s"%fname
+
+
+class timingStat:
+    """Running statistics and histogram of a timing.
+    @cvar n: Number of samples
+    @type n: Int
+    @cvar hist: Histogram of wall clock times
+    @type hist: Array
+    """
+    def __init__(self,bins):
+        self.bins=bins
+        self.hist=numpy.zeros((bins.shape[0]+1,),numpy.int64)#includes under/overflow
+        self.n=0
+        self.tot=0.
+        self.tot2=0.
+        self.totCpu=0.
+        self.tmax=0.
+    def add(self,wall,cpu=None):
+        self.n+=1
+        self.tot+=wall
+        self.tot2+=wall*wall
+        if cpu!=None:
+            self.totCpu+=cpu
+        if wall>self.tmax:
+            self.tmax=wall
+        self.hist[numpy.searchsorted(self.bins,wall)]+=1
+    def mean(self):
+        if self.n==0:
+            return 0.
+        return self.tot/self.n
+    def stdev(self):
+        if self.n==0:
+            return 0.
+        v=self.tot2/self.n-(self.tot/self.n)**2
+        return numpy.sqrt(max(v,0.))
+    def meanCpu(self):
+        if self.n==0:
+            return 0.
+        return self.totCpu/self.n
+    def percentile(self,p):
+        """Estimate the percentile from the histogram (geometric centre of the bin)"""
+        if self.n==0:
+            return 0.
+        c=numpy.cumsum(self.hist)
+        i=int(numpy.searchsorted(c,self.n*p/100.))
+        if i==0:
+            return self.bins[0]
+        if i>=self.bins.shape[0]:
+            return self.tmax
+        return numpy.sqrt(self.bins[i-1]*self.bins[i])
@@ -0,0 +1,229 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Dataflow scheduler, allowing independent modules in the compList to
+run concurrently within an iteration.
+
+Enabled by setting the schedulerThreads parameter (globals) to a value
+greater than 1 (or "all" to use ncpu).  Since most heavy computation is
+done within cmod functions which release the GIL, this allows e.g.
+several wfscent or science objects to run at the same time.
+
+Dependencies are taken from the aobase parent objects (and parentList
+and thisObjList for resource sharing modules).  For modules i and j, with
+i before j in the compList, j must wait for i if:
+ - i is a parent of j (data produced this iteration).
+ - j is a parent of i (i reads j's output from the previous iteration,
+   so j must not overwrite it until i has finished - e.g. the loop delay
+   between recon and dm).
+ - i and j are the same object (resource sharing).
+ - i and j are both communication objects (mpi/shm send/get), which are
+   always run in compList order, since MPI calls are not thread safe, and
+   message ordering must be consistent between ranks.
+ - either i or j has schedulerSerial set (a class or instance attribute),
+   for modules that are not thread safe.
+"""
+import threading,Queue,time,sys,resource
+
+commModules=["mpiSend","mpiGet","shmSend","shmGet","remoteMPISend","remoteMPIGet","remoteSHMSend","remoteSHMGet","fifo","splitOutput","joinOutputs"]
+
+def getParentObjects(module):
+    """Return a list of all the parent objects of a module.
+    @param module: The simulation object
+    @type module: aobase instance
+    @return: List of parent objects
+    @rtype: List
+    """
+    todo=[getattr(module,"parent",None),getattr(module,"parentList",None)]
+    for obj in getattr(module,"thisObjList",[]):
+        todo.append(getattr(obj,"parent",None))
+    plist=[]
+    while len(todo)>0:
+        p=todo.pop()
+        if p is None:
+            continue
+        if type(p)==type({}):
+            todo+=p.values()
+        elif type(p) in [type([]),type(())]:
+            todo+=list(p)
+        else:
+            plist.append(p)
+    return plist
+
+def threadClock():
+    """Return the CPU time used by the calling thread.  time.clock() gives
+    the CPU time of the whole process, which is not useful for modules
+    running concurrently, so on linux, getrusage(RUSAGE_THREAD) is used."""
+    if sys.platform.startswith("linux"):
+        r=resource.getrusage(getattr(resource,"RUSAGE_THREAD",1))
+        return r.ru_utime+r.ru_stime
+    return time.clock()
+
+def isCommModule(module):
+    return getattr(module,"moduleName",None) in commModules
+
+def computeDependencies(compList):
+    """Compute the dependencies between entries in the compList.
+    @param compList: The list of simulation objects
+    @type compList: List
+    @return: List (one entry for each compList entry) of the indices that must complete before it can start
+    @rtype: List of List of Int
+    """
+    n=len(compList)
+    parents=[]
+    for module in compList:
+        parents.append(map(id,getParentObjects(module)))
+    deps=[]
+    for j in range(n):
+        mj=compList[j]
+        d=[]
+        for i in range(j):
+            mi=compList[i]
+            if (id(mi) in parents[j] or id(mj) in parents[i] or mi is mj or
+                (isCommModule(mi) and isCommModule(mj)) or
+                getattr(mi,"schedulerSerial",0) or getattr(mj,"schedulerSerial",0)):
+                d.append(i)
+        deps.append(d)
+    return deps
+
+class dagScheduler:
+    """Runs the modules of a compList using a pool of threads, respecting
+    the dependencies between them.
+    @cvar compList: The simulation objects
+    @type compList: List
+    @cvar deps: Dependencies for each module
+    @type deps: List of List of Int
+    @cvar children: Modules that depend on each module
+    @type children: List of List of Int
+    @cvar nthreads: Number of threads
+    @type nthreads: Int
+    """
+    def __init__(self,compList,nthreads,debug=None,running=None):
+        """
+        @param compList: The simulation objects
+        @type compList: List
+        @param nthreads: Number of worker threads
+        @type nthreads: Int
+        @param running: Function called before starting each module - if it returns false, the rest of the iteration is skipped (e.g. Ctrl.running).
+        @type running: None or Function
+        """
+        self.compList=compList
+        self.nthreads=nthreads
+        self.debug=debug
+        self.running=running
+        self.deps=computeDependencies(compList)
+        self.children=[[] for m in compList]
+        for j in range(len(compList)):
+            for i in self.deps[j]:
+                self.children[i].append(j)
+        self.queue=Queue.Queue()
+        self.lock=threading.Lock()
+        self.doneCond=threading.Condition(self.lock)
+        self.threadList=[]
+        for i in range(nthreads):
+            t=threading.Thread(target=self.worker)
+            t.daemon=True
+            t.start()
+            self.threadList.append(t)
+
+    def describe(self):
+        """Return a description of the dependency graph"""
+        txt=""
+        for j in range(len(self.compList)):
+            txt+="%d %s <- %s\n"%(j,self.compList[j].objID,str(self.deps[j]))
+        return txt
+
+    def worker(self):
+        while 1:
+            i=self.queue.get()
+            if i is None:
+                break
+            module=self.compList[i]
+            skip=self.error!=None or (self.running is not None and not self.running())
+            err=None
+            if not skip:
+                t1=time.time()
+                c1=threadClock()
+                try:
+                    module.doNextIter()
+                except:
+                    err=sys.exc_info()
+                c2=threadClock()-c1
+                t2=time.time()-t1
+            self.lock.acquire()
+            try:
+                self.npending-=1
+                if not skip:
+                    self.times[i]=(t1,t2,c2)
+                if err!=None:
+                    if self.error==None:
+                        self.error=(i,err)
+                elif self.error==None:
+                    #if stopped, children are still released, so that they are skipped and the iteration completes.
+                    self.ndone+=1
+                    for j in self.children[i]:
+                        self.remaining[j]-=1
+                        if self.remaining[j]==0:
+                            self.npending+=1
+                            self.queue.put(j)
+                if self.ndone==self.nstarted or self.npending==0:
+                    self.doneCond.notify()
+            finally:
+                self.lock.release()
+
+    def runIter(self):
+        """Run one iteration of all modules.  Returns when all have completed.
+        If a module raises an exception, no further modules are started, and
+        the exception is re-raised once those already running have finished.
+        @return: List of (start time, wall time, cpu time) for each module, or None for modules skipped because running() became false
+        @rtype: List
+        """
+        n=len(self.compList)
+        self.lock.acquire()
+        try:
+            self.remaining=map(len,self.deps)
+            self.times=[None]*n
+            self.ndone=0
+            self.nstarted=n
+            self.npending=0
+            self.error=None
+            for i in range(n):
+                if self.remaining[i]==0:
+                    self.npending+=1
+                    self.queue.put(i)
+            while self.ndone<self.nstarted and self.error==None:
+                self.doneCond.wait(1.)
+            if self.error!=None:
+                #drain anything not yet started, and wait for modules still running.
+                while 1:
+                    try:
+                        self.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    self.npending-=1
+                while self.npending>0:
+                    self.doneCond.wait(1.)
+                i,err=self.error
+                print "ERROR in generate next for %dth module (%s)"%(i,self.compList[i].objID)
+                raise err[0],err[1],err[2]
+        finally:
+            self.lock.release()
+        return self.times
+
+    def stop(self):
+        """Stop the worker threads"""
+        for t in self.threadList:
+            self.queue.put(None)
+        self.threadList=[]
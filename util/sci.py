@@ -19,6 +19,7 @@ import numpy
 from util.flip import fliparray2
 from util.dist import dist
 import time
+import threading
 import util.FITS
 import os
 import tempfile
@@ -725,8 +726,9 @@ class science:
                 self.phs[0]*=self.phaseMultiplier
         
         
-    def doScienceCalc(self,inputData,control,curtime=0):
-        """compute the science calculation.  Here, inputData is the phase, control is a dictionary of control commands, such as useFPGA, calcRMSFile, zero_science and science_integrate."""
+    def doScienceCalc(self,inputData,control,curtime=0,batch=None):
+        """compute the science calculation.  Here, inputData is the phase, control is a dictionary of control commands, such as useFPGA, calcRMSFile, zero_science and science_integrate.
+        If batch (a scienceBatch instance) is given, the phase is passed to it, and the PSF is computed and integrated when batch.run() is called."""
         ##we compute the piston and remove it into the pupil
         # if self.atmosPhaseType=="phaseonly":
         #     if inputData.shape!=(self.npup,self.npup):#are we binning the phase before centroid calculation - might be needed for XAO systems if want to use the fpga (npup max is 1024 for the fpga).
@@ -784,71 +786,11 @@ class science:
                     if not control["calcRMS"]:
                         self.prepareInput(inputData)
                     self.psfSamp=0
-                    self.computeShortExposurePSF(self.phs)#calc short exposure PSF
-                    if self.nimgLongExp==self.nimg:
-                        self.longExpImg+=self.instImg# Integrate img
+                    if batch is not None:
+                        batch.add(self,control)
                     else:
-                        f=(self.nimg-self.nimgLongExp)//2
-                        t=f+self.nimgLongExp
-                        self.longExpImg+=self.instImg[f:t,f:t]
-                        self.clippedEnergy+=self.instImg[:f].sum()
-                        self.clippedEnergy+=self.instImg[t:].sum()
-                        self.clippedEnergy+=self.instImg[f:t,:f].sum()
-                        self.clippedEnergy+=self.instImg[f:t,t:].sum()
-                    #instantaneous strehl calc...
-                    self.dictScience['strehlInst']=numpy.max(self.instImg)/self.diffn_core_en
-                    self.n_integn+=1 ##We increment the number of integrations used to compute long exposure PSF
-                    self.isamp+=1##we increment the isamp counter
-                    if (self.isamp>=self.scinSamp): #compute scientific parameters
-                        self.isamp=0#we reset isamp to 0
-                        # We do the average of the PSF and normalise it to 1
-                        self.longExpPSF[:,]=self.longExpImg/(numpy.sum(self.longExpImg)+self.clippedEnergy)##We normalise the instantaneous PSF to 1
-
-                        self.computeScientificParameters()
-
-                        # we update the history lists
-                        if self.history is None:
-                            self.historyKeys=self.dictScience.keys()
-                            self.history=numpy.zeros((len(self.historyKeys),self.historyListsSize),numpy.float32)
-                            self.historyCnt=0
-                        for ik in range(len(self.historyKeys)):
-                            k=self.historyKeys[ik]
-                            self.history[ik,self.historyCnt]=self.dictScience[k]
-                        self.historyCnt=(self.historyCnt+1)%self.history.shape[1]
-                    if control["lucky_integrate"]:#doing lucky...
-                        if self.luckyCnt==0:
-                            if self.luckyImg is None:
-                                self.luckyImg=numpy.empty((self.nimg,self.nimg),self.fpDataType)
-                            self.luckyRms=self.phaseRMS
-                            self.luckyImg[:]=self.instImg
-                        else:
-                            self.luckyRms+=self.phaseRMS
-                            self.luckyImg+=self.instImg
-                        self.luckyCnt+=1
-                        if self.luckyCnt>=self.luckyNSampFrames:
-                            self.luckyCnt=0
-                            #Now do the lucky calculations.
-                            self.luckyImg/=self.luckyImg.sum()#normalise it
-                            self.computeScientificParameters(self.luckyImg,self.luckyDict)
-                            self.luckyDict["rms"]=self.luckyRms/self.luckyNSampFrames#the mean RMS phase that went into this image.
-                            if self.luckyHistory is None:
-                                self.luckyHistoryKeys=self.luckyDict.keys()
-                                self.luckyHistory=numpy.zeros((len(self.luckyHistoryKeys),self.luckyHistorySize),numpy.float32)
-                                self.luckyHistoryCnt=0
-                            for ik in range(len(self.luckyHistoryKeys)):
-                                k=self.luckyHistoryKeys[ik]
-                                self.luckyHistory[ik,self.luckyHistoryCnt%self.luckyHistory.shape[1]]=self.luckyDict[k]
-                            self.luckyHistoryCnt+=1
-                            if self.luckyImgFilename!=None and self.luckyImgSize>0:
-                                if self.luckyFile is None:
-                                    self.luckyFile=tempfile.TemporaryFile()
-                                    self.luckyLastImg=numpy.zeros((self.luckyImgSize,self.luckyImgSize),self.luckyImg.dtype)
-                                self.luckyLastImg[:]=self.luckyImg[self.nimg/2-self.luckyImgSize/2:self.nimg/2+self.luckyImgSize/2,self.nimg/2-self.luckyImgSize/2:self.nimg/2+self.luckyImgSize/2]
-                                if self.luckyByteswap:
-                                    self.luckyLastImg.byteswap(True)
-                                self.luckyFile.write(self.luckyLastImg.tostring())
-                                if self.luckyByteswap:
-                                    self.luckyLastImg.byteswap(True)
+                        self.computeShortExposurePSF(self.phs)#calc short exposure PSF
+                        self.integratePSF(control)
 
 
         if(self.timing):print "science",time.time()-t1
@@ -856,6 +798,225 @@ class science:
             print "science: generateNext done (debug=%s)"%str(self.debug)
         return None
 
+    def integratePSF(self,control):
+        """Add the short exposure PSF (self.instImg) to the long exposure
+        image, and compute the science parameters if it is time to do so.
+        """
+        if self.nimgLongExp==self.nimg:
+            self.longExpImg+=self.instImg# Integrate img
+        else:
+            f=(self.nimg-self.nimgLongExp)//2
+            t=f+self.nimgLongExp
+            self.longExpImg+=self.instImg[f:t,f:t]
+            self.clippedEnergy+=self.instImg[:f].sum()
+            self.clippedEnergy+=self.instImg[t:].sum()
+            self.clippedEnergy+=self.instImg[f:t,:f].sum()
+            self.clippedEnergy+=self.instImg[f:t,t:].sum()
+        #instantaneous strehl calc...
+        self.dictScience['strehlInst']=numpy.max(self.instImg)/self.diffn_core_en
+        self.n_integn+=1 ##We increment the number of integrations used to compute long exposure PSF
+        self.isamp+=1##we increment the isamp counter
+        if (self.isamp>=self.scinSamp): #compute scientific parameters
+            self.isamp=0#we reset isamp to 0
+            # We do the average of the PSF and normalise it to 1
+            self.longExpPSF[:,]=self.longExpImg/(numpy.sum(self.longExpImg)+self.clippedEnergy)##We normalise the instantaneous PSF to 1
+
+            self.computeScientificParameters()
+
+            # we update the history lists
+            if self.history is None:
+                self.historyKeys=self.dictScience.keys()
+                self.history=numpy.zeros((len(self.historyKeys),self.historyListsSize),numpy.float32)
+                self.historyCnt=0
+            for ik in range(len(self.historyKeys)):
+                k=self.historyKeys[ik]
+                self.history[ik,self.historyCnt]=self.dictScience[k]
+            self.historyCnt=(self.historyCnt+1)%self.history.shape[1]
+        if control["lucky_integrate"]:#doing lucky...
+            if self.luckyCnt==0:
+                if self.luckyImg is None:
+                    self.luckyImg=numpy.empty((self.nimg,self.nimg),self.fpDataType)
+                self.luckyRms=self.phaseRMS
+                self.luckyImg[:]=self.instImg
+            else:
+                self.luckyRms+=self.phaseRMS
+                self.luckyImg+=self.instImg
+            self.luckyCnt+=1
+            if self.luckyCnt>=self.luckyNSampFrames:
+                self.luckyCnt=0
+                #Now do the lucky calculations.
+                self.luckyImg/=self.luckyImg.sum()#normalise it
+                self.computeScientificParameters(self.luckyImg,self.luckyDict)
+                self.luckyDict["rms"]=self.luckyRms/self.luckyNSampFrames#the mean RMS phase that went into this image.
+                if self.luckyHistory is None:
+                    self.luckyHistoryKeys=self.luckyDict.keys()
+                    self.luckyHistory=numpy.zeros((len(self.luckyHistoryKeys),self.luckyHistorySize),numpy.float32)
+                    self.luckyHistoryCnt=0
+                for ik in range(len(self.luckyHistoryKeys)):
+                    k=self.luckyHistoryKeys[ik]
+                    self.luckyHistory[ik,self.luckyHistoryCnt%self.luckyHistory.shape[1]]=self.luckyDict[k]
+                self.luckyHistoryCnt+=1
+                if self.luckyImgFilename!=None and self.luckyImgSize>0:
+                    if self.luckyFile is None:
+                        self.luckyFile=tempfile.TemporaryFile()
+                        self.luckyLastImg=numpy.zeros((self.luckyImgSize,self.luckyImgSize),self.luckyImg.dtype)
+                    self.luckyLastImg[:]=self.luckyImg[self.nimg/2-self.luckyImgSize/2:self.nimg/2+self.luckyImgSize/2,self.nimg/2-self.luckyImgSize/2:self.nimg/2+self.luckyImgSize/2]
+                    if self.luckyByteswap:
+                        self.luckyLastImg.byteswap(True)
+                    self.luckyFile.write(self.luckyLastImg.tostring())
+                    if self.luckyByteswap:
+                        self.luckyLastImg.byteswap(True)
+
+
+
+class scienceBatch:
+    """Computes the short exposure PSFs for several science objects at once.
+    The science objects (science instances) must have the same npup, nfft,
+    nimg and atmosPhaseType (e.g. many evaluation directions at the same
+    wavelength).  Phases are stacked, and a single batched FFT is performed
+    (cmod.fft.PlanMany, multi-threaded by FFTW), with the pupil filling and
+    image formation done in nthreads threads.  Requires 2*n*nfft*nfft
+    complex64 of memory for n objects.
+
+    Use: for each object, call sciObj.doScienceCalc(...,batch=thisBatch),
+    which stores the phase, and once all have been added, call run(),
+    which computes the PSFs and integrates them.
+    @cvar sciObjList: The science objects
+    @type sciObjList: List
+    @cvar pending: The objects (index, control dict) added since the last run
+    @type pending: List
+    """
+    def __init__(self,sciObjList,nthreads=1):
+        """
+        @param sciObjList: List of science objects
+        @type sciObjList: List
+        @param nthreads: Number of threads to use
+        @type nthreads: Int
+        """
+        s0=sciObjList[0]
+        for s in sciObjList:
+            if (s.npup,s.nfft,s.nimg,s.atmosPhaseType)!=(s0.npup,s0.nfft,s0.nimg,s0.atmosPhaseType):
+                raise Exception("scienceBatch: science objects must have the same npup, nfft, nimg and atmosPhaseType")
+        self.sciObjList=sciObjList
+        self.nthreads=nthreads
+        self.n=n=len(sciObjList)
+        self.npup=npup=s0.npup
+        self.nfft=nfft=s0.nfft
+        self.nimg=nimg=s0.nimg
+        self.atmosPhaseType=s0.atmosPhaseType
+        self.index={}
+        for i in range(n):
+            self.index[id(sciObjList[i])]=i
+        self.pup=numpy.array([s.pup for s in sciObjList]).astype(numpy.float32)
+        self.phaseTilt=numpy.array([s.phaseTilt for s in sciObjList]).astype(numpy.float32)
+        if self.atmosPhaseType=="phaseamp":
+            self.phs=numpy.zeros((n,2,npup,npup),numpy.float32)
+        elif self.atmosPhaseType=="realimag":
+            self.phs=numpy.zeros((n,npup,npup),numpy.complex64)
+        else:
+            self.phs=numpy.zeros((n,npup,npup),numpy.float32)
+        self.pupilAmplitude=numpy.zeros((n,nfft,nfft),numpy.complex64)
+        self.focusAmplitude=numpy.zeros((n,nfft,nfft),numpy.complex64)
+        self.tempImg=numpy.zeros((n,nfft,nfft),numpy.float32)
+        if nimg==nfft:
+            self.binImg=self.tempImg
+        else:
+            self.binImg=numpy.zeros((n,nimg,nimg),numpy.float32)
+        self.fftPlan=None
+        if hasattr(cmod.fft,"PlanMany"):
+            cmod.fft.InitialiseThreading(nthreads)
+            self.fftPlan=cmod.fft.PlanMany(self.pupilAmplitude,self.focusAmplitude,nthreads)
+        else:
+            print "WARNING scienceBatch: cmod.fft.PlanMany not available (rebuild cmod) - using numpy.fft"
+        self.pending=[]
+        self.PSFTime=0.
+
+    def __del__(self):
+        if self.fftPlan!=None:
+            cmod.fft.FreePlan(self.fftPlan)
+            self.fftPlan=None
+
+    def add(self,sciObj,control):
+        """Store the phase (already prepared, in sciObj.phs) for sciObj.
+        @param sciObj: The science object
+        @type sciObj: science instance
+        @param control: The control dictionary (copied, since integration happens later)
+        @type control: Dict
+        """
+        i=self.index[id(sciObj)]
+        self.phs[i]=sciObj.phs
+        self.pending.append((i,control.copy()))
+
+    def parallel(self,fn,indxList):
+        """Call fn(i) for each i in indxList, using nthreads threads.  Numpy
+        releases the GIL for the large array operations used here."""
+        nthr=min(self.nthreads,len(indxList))
+        if nthr<=1:
+            for i in indxList:
+                fn(i)
+            return
+        thrList=[]
+        for t in range(nthr):
+            thr=threading.Thread(target=map,args=(fn,indxList[t::nthr]))
+            thr.start()
+            thrList.append(thr)
+        for thr in thrList:
+            thr.join()
+
+    def fillPupil(self,i):
+        npup=self.npup
+        amp=self.pupilAmplitude[i]
+        amp[npup:]=0.#fft may destroy the input
+        amp[:npup,npup:]=0.
+        if self.atmosPhaseType=="phaseonly":
+            phs=self.phs[i]+self.phaseTilt[i]
+            amp.real[:npup,:npup]=self.pup[i]*numpy.cos(phs)
+            amp.imag[:npup,:npup]=self.pup[i]*numpy.sin(phs)
+        elif self.atmosPhaseType=="phaseamp":
+            phs=self.phs[i,0]+self.phaseTilt[i]
+            amp.real[:npup,:npup]=self.pup[i]*numpy.cos(phs)*self.phs[i,1]
+            amp.imag[:npup,:npup]=self.pup[i]*numpy.sin(phs)*self.phs[i,1]
+        else:
+            amp[:npup,:npup]=self.pup[i]*self.phs[i]
+
+    def formImage(self,i):
+        if self.fftPlan is None:
+            self.focusAmplitude[i]=numpy.fft.fft2(self.pupilAmplitude[i])
+        img=self.tempImg[i]
+        numpy.absolute(self.focusAmplitude[i],img)
+        img*=img
+        if self.nimg!=self.nfft:#as computeShortExposurePSF, so that the PSFs are identical.
+            cmod.binimg.binimg(img,self.binImg[i])
+        img=self.binImg[i]
+        s=self.sciObjList[i]
+        if self.atmosPhaseType=="phaseonly":
+            tot=img.sum()
+            if tot!=0:
+                img/=tot
+            else:
+                print "No signal in sci.py scienceBatch (object %d)"%i
+        elif self.atmosPhaseType=="phaseamp":
+            img/=s.pupsum*self.nfft*self.nfft
+
+    def run(self):
+        """Compute the PSFs for the objects added since the last call, and
+        integrate them into the long exposure images.
+        """
+        if len(self.pending)==0:
+            return
+        t1=time.time()
+        indxList=[i for i,c in self.pending]
+        self.parallel(self.fillPupil,indxList)
+        if self.fftPlan is not None:
+            cmod.fft.ExecutePlan(self.fftPlan)
+        self.parallel(self.formImage,indxList)
+        self.PSFTime=time.time()-t1
+        for i,control in self.pending:
+            s=self.sciObjList[i]
+            s.instImg[:]=self.binImg[i]
+            s.integratePSF(control)
+        self.pending=[]
+
         
 def difYorick (x, i = 0) :
 
@@ -0,0 +1,132 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""An archive of the phase screen rows generated by iscrn, so that the
+same turbulence can be replayed in later simulations without running the
+generator (see the screenArchive parameter of science.iscrn).
+
+There is one file per layer.  This contains:
+ - The magic string DASPSCRN and the length of the header (8 bytes each).
+ - A json header, giving the layer parameters and seeds used to create the
+   screen, padded to a multiple of 8 bytes.
+ - The initial screen, float64, shape (scrnYPxls,scrnXPxls).
+ - One record per iteration, float64, containing the insert position after
+   the iteration, followed by the last maxRowAdd rows added to the screen
+   (in the order they appear in the screen).
+
+When reading, the file is memory mapped, so replay runs at page cache
+speed, and the data are exactly those produced by the generator.
+"""
+import os,json
+import numpy
+
+magic="DASPSCRN"
+
+class screenArchive:
+    """Read or write a phase screen archive for one layer.
+    @cvar header: The header (layer parameters)
+    @type header: Dict
+    @cvar screen: The initial screen (read only, if reading)
+    @type screen: Array
+    @cvar recSize: Number of elements in each iteration record
+    @type recSize: Int
+    """
+    def __init__(self,filename,mode="r",header=None,screen=None,maxRowAdd=None):
+        """
+        @param filename: The archive file
+        @type filename: String
+        @param mode: "r" to read, "w" to create
+        @type mode: String
+        @param header: If creating, the layer parameters (must be json serialisable)
+        @type header: Dict
+        @param screen: If creating, the initial screen
+        @type screen: Array
+        @param maxRowAdd: If creating, the number of rows stored each iteration
+        @type maxRowAdd: Int
+        """
+        self.filename=filename
+        self.mode=mode
+        self.file=None
+        if mode=="w":
+            screen=numpy.ascontiguousarray(screen,dtype=numpy.float64)
+            self.header=header.copy()
+            self.header["scrnShape"]=list(screen.shape)
+            self.header["maxRowAdd"]=maxRowAdd
+            txt=json.dumps(self.header)
+            txt+=" "*((8-len(txt)%8)%8)
+            d=os.path.dirname(filename)
+            if len(d)>0 and not os.path.exists(d):
+                os.makedirs(d)
+            self.file=open(filename,"wb")
+            self.file.write(magic+"%08d"%len(txt)+txt)
+            self.file.write(screen.tostring())
+            self.dataStart=16+len(txt)+screen.nbytes
+            self.screen=screen
+        elif mode=="r":
+            f=open(filename,"rb")
+            hdr=f.read(16)
+            if hdr[:8]!=magic:
+                f.close()
+                raise Exception("%s is not a phase screen archive"%filename)
+            n=int(hdr[8:])
+            self.header=json.loads(f.read(n))
+            f.close()
+            ny,nx=self.header["scrnShape"]
+            self.dataStart=16+n+ny*nx*8
+            self.mmap=numpy.memmap(filename,dtype=numpy.float64,mode="r",offset=16+n)
+            self.screen=self.mmap[:ny*nx].reshape(ny,nx)
+        else:
+            raise Exception("screenArchive mode must be r or w")
+        self.scrnXPxls=self.header["scrnShape"][1]
+        self.maxRowAdd=self.header["maxRowAdd"]
+        self.recSize=1+self.maxRowAdd*self.scrnXPxls
+        if mode=="r":
+            nrec=(self.mmap.shape[0]-self.screen.size)//self.recSize#ignores a partially written record.
+            self.records=self.mmap[self.screen.size:self.screen.size+nrec*self.recSize].reshape(nrec,self.recSize)
+
+    def nIters(self):
+        """Number of iterations stored (if reading)"""
+        return self.records.shape[0]
+
+    def write(self,iteration,insertPos,rows):
+        """Store the rows for an iteration.  Iterations are normally written
+        in order, but can be rewritten (e.g. after restoring a checkpoint).
+        @param iteration: The iteration number (from 0)
+        @type iteration: Int
+        @param insertPos: The screen insert position after this iteration
+        @type insertPos: Int
+        @param rows: The last maxRowAdd rows added, shape (maxRowAdd,scrnXPxls)
+        @type rows: Array
+        """
+        self.file.seek(self.dataStart+iteration*self.recSize*8)
+        self.file.write(numpy.array([insertPos],numpy.float64).tostring())
+        self.file.write(numpy.ascontiguousarray(rows,dtype=numpy.float64).tostring())
+
+    def read(self,iteration):
+        """Return the insert position and rows (read only) for an iteration"""
+        if iteration>=self.records.shape[0]:
+            raise Exception("Phase screen archive %s only has %d iterations (iteration %d requested)"%(self.filename,self.records.shape[0],iteration))
+        rec=self.records[iteration]
+        return int(rec[0]),rec[1:].reshape(self.maxRowAdd,self.scrnXPxls)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file=None
+        self.mmap=None
@@ -0,0 +1,336 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Run a parameter sweep (a set of batch numbers) of a simulation, on a
+local pool of processes, sharing the precomputed artefacts that are common
+between the sweep points.
+
+Usage::
+
+ python util/sweep.py sim.py params.py --batchno=0-9,12 --nproc=4 [--results=sweep.csv] [--shmdir=/dev/shm/daspsweep] [--logdir=sweeplogs] [--param="this.globals.xxx=..."] [--keep] [-- extra simulation args]
+
+The parameter file for each batch number is read, and the initial phase
+screens it requires are identified (science.iscrn.initialScreenParams).
+Each distinct screen is then generated once (in parallel), and stored in a
+matrixCache in shmdir (by default in /dev/shm, i.e. shared memory).  The
+simulations are then run, at most nproc at a time, with screenCacheDir
+pointing at this cache, so that the screens are read from there.
+
+Poke and control matrices (tomoRecon reconCacheDir) can only be identified
+by the simulations themselves, so these are shared by giving all of them
+the same reconCacheDir (unless set in the parameter file), with
+reconCacheLock set.  The first simulation that needs a given matrix then
+computes it, and the others wait for it to appear, and memory map it (read
+only), rather than computing it themselves.  Note, this means that a
+simulation may sit idle in the pool while waiting.
+
+Once all have finished, the science results (written to the scicsvFilename
+or sciOverview summaryFilename files) for each batch number are collected
+into a single csv table, along with the exit status and run time of each
+simulation, and the simulation output is in logdir.
+
+Simulations using MPI (more than one process each) are not supported.
+"""
+import sys,os,getopt,time,subprocess,multiprocessing,shutil,re,ast,csv
+import base.readConfig
+import science.iscrn
+import util.matrixCache
+
+def parseBatchList(txt):
+    """Convert e.g. "0-3,7,10-12" to [0,1,2,3,7,10,11,12]"""
+    blist=[]
+    for part in txt.split(","):
+        part=part.strip()
+        if len(part)==0:
+            continue
+        if "-" in part[1:]:
+            i=part.index("-",1)
+            blist+=range(int(part[:i]),int(part[i+1:])+1)
+        else:
+            blist.append(int(part))
+    return blist
+
+def getSummaryFiles(config):
+    """Return a list of the files that science results will be appended to"""
+    flist=[]
+    so=config.searchOrder
+    config.setSearchOrder(["science","globals"])
+    fname=config.getVal("scicsvFilename",default=None,raiseerror=0)
+    if fname!=None:
+        flist.append(fname)
+    sciOverview=config.getVal("sciOverview",default=None,raiseerror=0)
+    config.setSearchOrder(so)
+    if sciOverview!=None:
+        for sci in sciOverview.values():
+            if sci.summaryFilename!=None and sci.summaryFilename not in flist:
+                flist.append(sci.summaryFilename)
+    return flist
+
+def buildScreen(args):
+    """Generate an initial phase screen and put it in the cache (run in the pool)"""
+    cacheDir,key,params=args
+    cache=util.matrixCache.matrixCache(cacheDir)
+    if not cache.has(key):
+        params=params.copy()
+        params["scrnDir"]=None#don't also save it as fits.
+        cache.put(key,science.iscrn.makeInitialScreen(**params))
+    return key
+
+resultRE=re.compile(r"^(?P<name>.*?) \((?P<niter>\d+)x(?P<psfsamp>\d+) iters, batchno (?P<batchno>-?\d+) .*?\): (?P<dict>\{.*\})(?P<rms>.*)$")
+
+def parseResults(fname,offset,batchList):
+    """Read science results appended to fname after offset.
+    @return: List of (batchno,name,dict of results)
+    @rtype: List
+    """
+    res=[]
+    if not os.path.exists(fname):
+        return res
+    f=open(fname)
+    f.seek(offset)
+    lines=f.readlines()
+    f.close()
+    for line in lines:
+        m=resultRE.match(line.strip())
+        if m==None:
+            continue
+        b=int(m.group("batchno"))
+        if b not in batchList:
+            continue
+        try:
+            d=ast.literal_eval(m.group("dict"))
+        except:
+            d={"result":m.group("dict")}
+        d["niter"]=int(m.group("niter"))
+        if len(m.group("rms").strip())>0:
+            d["rms"]=m.group("rms").strip()
+        res.append((b,m.group("name"),d))
+    return res
+
+class Sweep:
+    """A parameter sweep over batch numbers.
+    @cvar batchList: The batch numbers
+    @type batchList: List of Int
+    @cvar nproc: Max number of simulations to run at once
+    @type nproc: Int
+    @cvar screens: Dict of screen cache key to (makeInitialScreen arguments, list of batch numbers using it)
+    @type screens: Dict
+    """
+    def __init__(self,simfile,paramfile,batchList,nproc=None,shmdir=None,logdir="sweeplogs",paramString=None,simArgs=[],results="sweep.csv"):
+        """
+        @param simfile: The simulation python script
+        @type simfile: String
+        @param paramfile: The parameter files
+        @type paramfile: List of String
+        @param batchList: The batch numbers to run
+        @type batchList: List of Int
+        @param nproc: Max number of simulations to run at once (default ncpu)
+        @type nproc: Int
+        @param shmdir: Directory for shared artefacts
+        @type shmdir: String
+        @param logdir: Directory for simulation output
+        @type logdir: String
+        @param paramString: Passed to each simulation with --param
+        @type paramString: String
+        @param simArgs: Extra arguments for each simulation
+        @type simArgs: List of String
+        @param results: The csv file for consolidated results
+        @type results: String
+        """
+        self.simfile=simfile
+        self.paramfile=paramfile
+        self.batchList=batchList
+        if nproc==None:
+            nproc=multiprocessing.cpu_count()
+        self.nproc=nproc
+        if shmdir==None:
+            if os.path.isdir("/dev/shm"):
+                shmdir="/dev/shm/daspsweep%d"%os.getpid()
+            else:
+                shmdir="daspsweep%d"%os.getpid()
+        self.shmdir=shmdir
+        self.screenDir=os.path.join(shmdir,"screens")
+        self.reconDir=os.path.join(shmdir,"recon")
+        self.logdir=logdir
+        self.paramString=paramString
+        self.simArgs=simArgs
+        self.results=results
+        self.screens={}
+        self.summaryFiles=[]
+        self.hasReconCacheDir={}
+
+    def readConfig(self,batchno):
+        config=base.readConfig.AOXml(self.paramfile,batchno=batchno)
+        if self.paramString!=None:
+            exec self.paramString in {"this":config.this}
+        return config
+
+    def analyse(self):
+        """Read the parameters for each batch number, and find the distinct
+        initial screens that are required."""
+        for b in self.batchList:
+            config=self.readConfig(b)
+            config.setSearchOrder(["globals"])
+            atmosGeom=config.getVal("atmosGeom",default=None,raiseerror=0)
+            if atmosGeom!=None:
+                for lay in atmosGeom.layerDict.keys():
+                    params=science.iscrn.initialScreenParams(config,str(lay))
+                    key=science.iscrn.initialScreenKey(params)
+                    if key!=None:
+                        self.screens.setdefault(key,(params,[]))[1].append(b)
+            for fname in getSummaryFiles(config):
+                if fname not in self.summaryFiles:
+                    self.summaryFiles.append(fname)
+            config.setSearchOrder(["tomoRecon","globals"])
+            self.hasReconCacheDir[b]=config.getVal("reconCacheDir",default=None,raiseerror=0)!=None
+        nuse=sum([len(x[1]) for x in self.screens.values()])
+        print "INFORMATION sweep: %d batch numbers use %d distinct initial screens (%d in total)"%(len(self.batchList),len(self.screens),nuse)
+
+    def buildScreens(self):
+        """Generate the distinct initial screens in a process pool"""
+        todo=[(self.screenDir,key,params) for key,(params,blist) in self.screens.items()]
+        if len(todo)==0:
+            return
+        util.matrixCache.matrixCache(self.screenDir)#create the directory
+        t1=time.time()
+        pool=multiprocessing.Pool(min(self.nproc,len(todo)))
+        try:
+            pool.map(buildScreen,todo)
+        finally:
+            pool.close()
+            pool.join()
+        print "INFORMATION sweep: Generated %d screens in %gs"%(len(todo),time.time()-t1)
+
+    def simCommand(self,batchno):
+        p="this.globals.screenCacheDir=%r\nthis.globals.reconCacheLock=1\n"%self.screenDir
+        if not self.hasReconCacheDir.get(batchno,0):
+            p+="this.globals.reconCacheDir=%r\n"%self.reconDir
+        if self.paramString!=None:
+            p+=self.paramString
+        return [sys.executable,self.simfile]+self.paramfile+["--batchno=%d"%batchno,"--param=%s"%p,"--nostdin"]+self.simArgs
+
+    def run(self):
+        """Run the simulations, nproc at a time.
+        @return: Dict of batchno to (exit status, run time)
+        @rtype: Dict
+        """
+        if not os.path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+        todo=list(self.batchList)
+        running={}
+        status={}
+        while len(todo)>0 or len(running)>0:
+            while len(todo)>0 and len(running)<self.nproc:
+                b=todo.pop(0)
+                log=open(os.path.join(self.logdir,"batch%d.log"%b),"w")
+                print "INFORMATION sweep: Starting batch %d"%b
+                p=subprocess.Popen(self.simCommand(b),stdout=log,stderr=subprocess.STDOUT)
+                log.close()
+                running[b]=(p,time.time())
+            time.sleep(0.1)
+            for b,(p,t1) in running.items():
+                rt=p.poll()
+                if rt is not None:
+                    status[b]=(rt,time.time()-t1)
+                    del(running[b])
+                    if rt==0:
+                        print "INFORMATION sweep: Batch %d finished in %gs"%(b,status[b][1])
+                    else:
+                        print "WARNING sweep: Batch %d failed (status %d) - see %s"%(b,rt,os.path.join(self.logdir,"batch%d.log"%b))
+        return status
+
+    def writeResults(self,status,offsets):
+        """Collect the science results into a single csv file"""
+        rows=[]
+        for fname in self.summaryFiles:
+            rows+=parseResults(fname,offsets.get(fname,0),self.batchList)
+        keys=[]
+        for b,name,d in rows:
+            for k in sorted(d.keys()):
+                if k not in keys:
+                    keys.append(k)
+        f=open(self.results,"wb")
+        w=csv.writer(f)
+        w.writerow(["batchno","status","time","name"]+keys)
+        found={}
+        for b,name,d in rows:
+            found[b]=1
+            rt,t=status.get(b,(None,0.))
+            w.writerow([b,rt,"%.1f"%t,name]+[d.get(k,"") for k in keys])
+        for b in self.batchList:#those with no results (e.g. failed).
+            if not found.has_key(b):
+                rt,t=status.get(b,(None,0.))
+                w.writerow([b,rt,"%.1f"%t,""]+[""]*len(keys))
+        f.close()
+        print "INFORMATION sweep: Written %d results to %s"%(len(rows),self.results)
+
+    def go(self,keep=0):
+        """Analyse, build shared artefacts, run and collect the results"""
+        self.analyse()
+        offsets={}
+        for fname in self.summaryFiles:
+            if os.path.exists(fname):
+                offsets[fname]=os.path.getsize(fname)
+        try:
+            self.buildScreens()
+            status=self.run()
+        finally:
+            if not keep:
+                shutil.rmtree(self.shmdir,ignore_errors=1)
+        self.writeResults(status,offsets)
+        return status
+
+def main(argv):
+    simArgs=[]
+    if "--" in argv:
+        simArgs=argv[argv.index("--")+1:]
+        argv=argv[:argv.index("--")]
+    optlist,arglist=getopt.gnu_getopt(argv,"h",["batchno=","nproc=","results=","shmdir=","logdir=","param=","keep","help"])
+    batchList=None
+    nproc=None
+    results="sweep.csv"
+    shmdir=None
+    logdir="sweeplogs"
+    paramString=None
+    keep=0
+    for o,a in optlist:
+        if o=="--batchno":
+            batchList=parseBatchList(a)
+        elif o=="--nproc":
+            nproc=int(a)
+        elif o=="--results":
+            results=a
+        elif o=="--shmdir":
+            shmdir=a
+            keep=1
+        elif o=="--logdir":
+            logdir=a
+        elif o=="--param":
+            paramString=a
+        elif o=="--keep":
+            keep=1
+        elif o in ["-h","--help"]:
+            print __doc__
+            sys.exit(0)
+    if len(arglist)<2 or batchList==None:
+        print "Usage: python util/sweep.py sim.py params.py --batchno=0-9,12 [--nproc=N --results=sweep.csv --shmdir=dir --logdir=dir --param=xxx --keep] [-- simulation args]"
+        sys.exit(1)
+    s=Sweep(arglist[0],arglist[1:],batchList,nproc=nproc,shmdir=shmdir,logdir=logdir,paramString=paramString,simArgs=simArgs,results=results)
+    status=s.go(keep)
+    if len([x for x in status.values() if x[0]!=0])>0:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main(sys.argv[1:])
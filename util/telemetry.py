@@ -0,0 +1,259 @@
+#dasp, the Durham Adaptive optics Simulation Platform.
+#Copyright (C) 2004-2016 Alastair Basden and Durham University.
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as
+#published by the Free Software Foundation, either version 3 of the
+#License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Publish/subscribe telemetry of module outputs, for GUIs and other
+clients watching a running simulation.
+
+Polling with rpt commands (util.SockConn) executes python and serialises
+whole arrays within the main loop, for every client, every time.  Instead,
+a client can subscribe (a ConnMsg with action "sub", or
+ConnObj.subscribe) to a named output, giving:
+ - name - the module objID, optionally followed by a (dotted) attribute,
+   e.g. "wfscent_1" (its outputData) or "science_1.sciObj.instStrehl".
+ - decimate - a snapshot is taken every decimate iterations.
+ - roi - region of interest, a list of (start,stop[,step]) (or None) for
+   each dimension, so that only part of a large array is copied and sent.
+ - maxRate - maximum number of messages per second sent to the client.
+ - mode - "latest" to send only the most recent snapshot (default), or
+   "all" to send all snapshots since the last message (up to nslots), so
+   that data are not lost when rate limited.
+ - nslots - size of the ring buffer (default 4).
+
+The main loop (Ctrl.mainloop) then only copies the region of interest into
+a ring buffer every decimate iterations.  A separate thread serialises and
+sends to clients, at most maxRate times per second, so slow clients don't
+slow the simulation.  Messages are ["data",tag,{"name":name,"iter":iters,
+"data":data}] where iters is the iteration number (or list of, if mode is
+"all", in which case data has an extra leading dimension).
+
+Unsubscribe with action "unsub" (all subscriptions of the connection with
+the given tag, or all if tag is None), or by closing the connection.
+"""
+import threading,time,traceback
+import numpy
+import util.checkpoint
+
+class Subscription:
+    """A subscription of a client to a module output.
+    @cvar ring: The snapshots
+    @type ring: Array
+    @cvar iters: The iteration of each ring entry
+    @type iters: List
+    @cvar writeCnt: Total number of snapshots taken
+    @type writeCnt: Int
+    @cvar sentCnt: writeCnt at the last message sent
+    @type sentCnt: Int
+    """
+    def __init__(self,sock,tag,spec,defaultMaxRate):
+        """
+        @param sock: The client socket
+        @type sock: socket.socket instance
+        @param tag: The tag for returned data
+        @type tag: String
+        @param spec: The subscription, a dict (see module doc), or a name
+        @type spec: Dict or String
+        @param defaultMaxRate: The max rate to use if not specified
+        @type defaultMaxRate: Float
+        """
+        if type(spec)==type(""):
+            spec={"name":spec}
+        self.sock=sock
+        self.tag=tag
+        self.name=spec["name"]
+        self.decimate=max(1,int(spec.get("decimate",1)))
+        self.maxRate=spec.get("maxRate",defaultMaxRate)
+        if self.maxRate is None or self.maxRate<=0 or self.maxRate>defaultMaxRate:
+            self.maxRate=defaultMaxRate
+        self.mode=spec.get("mode","latest")
+        if self.mode not in ["latest","all"]:
+            raise Exception("telemetry mode should be latest or all")
+        self.nslots=max(1,int(spec.get("nslots",4)))
+        roi=spec.get("roi",None)
+        if roi is None:
+            self.roi=None
+        else:
+            self.roi=tuple([slice(None) if r is None else slice(*r) for r in roi])
+        self.lock=threading.Lock()
+        self.ring=None
+        self.iters=[None]*self.nslots
+        self.writeCnt=0
+        self.sentCnt=0
+        self.lastSent=0.
+        self.obj=None
+        self.attr=None
+
+    def resolve(self,compList):
+        """Find the module and attribute that name refers to"""
+        for module in compList:
+            objID=getattr(module,"objID",None)
+            if objID==self.name:
+                self.obj,self.attr=module,"outputData"
+            elif objID is not None and self.name.startswith(objID+"."):
+                self.obj,self.attr=module,self.name[len(objID)+1:]
+            else:
+                continue
+            return
+        raise Exception("telemetry: no module %s"%self.name)
+
+    def snapshot(self,thisiter):
+        """Copy the region of interest into the ring buffer (main loop)"""
+        data=util.checkpoint.getPath(self.obj,self.attr)
+        if data is None:
+            return
+        data=numpy.asarray(data)
+        if self.roi is not None:
+            data=data[self.roi]
+        self.lock.acquire()
+        try:
+            if self.ring is None or self.ring.shape[1:]!=data.shape or self.ring.dtype!=data.dtype:
+                self.ring=numpy.zeros((self.nslots,)+data.shape,data.dtype)
+            slot=self.writeCnt%self.nslots
+            self.ring[slot]=data
+            self.iters[slot]=thisiter
+            self.writeCnt+=1
+        finally:
+            self.lock.release()
+
+    def getMessage(self):
+        """Return the data to send (copied from the ring), or None if nothing new (sender thread)"""
+        self.lock.acquire()
+        try:
+            if self.writeCnt==self.sentCnt:
+                return None
+            if self.mode=="latest":
+                slot=(self.writeCnt-1)%self.nslots
+                rt={"name":self.name,"iter":self.iters[slot],"data":self.ring[slot].copy()}
+            else:
+                n=min(self.writeCnt-self.sentCnt,self.nslots)
+                slots=[(self.writeCnt-n+i)%self.nslots for i in range(n)]
+                rt={"name":self.name,"iter":[self.iters[s] for s in slots],"data":self.ring[slots]}
+            self.sentCnt=self.writeCnt
+            return rt
+        finally:
+            self.lock.release()
+
+class Telemetry:
+    """The telemetry service.  Subscriptions are added by util.SockConn,
+    snapshots taken by util.Ctrl.mainloop, and data sent by a separate
+    thread.
+    @cvar subs: The current subscriptions
+    @type subs: List of Subscription
+    @cvar maxRate: Max message rate per subscription (Hz)
+    @type maxRate: Float
+    """
+    def __init__(self,sockConn,maxRate=10.):
+        """
+        @param sockConn: The SockConn object, used to send data
+        @type sockConn: util.SockConn.SockConn instance
+        @param maxRate: Max message rate per subscription (Hz)
+        @type maxRate: Float
+        """
+        self.sockConn=sockConn
+        self.maxRate=maxRate
+        self.subs=[]
+        self.compList=None
+        self.lock=threading.Lock()
+        self.cond=threading.Condition(self.lock)
+        self.thread=None
+        self.go=1
+
+    def subscribe(self,sock,tag,spec):
+        """Add a subscription (called by SockConn when a sub message arrives)"""
+        sub=Subscription(sock,tag,spec,self.maxRate)
+        self.lock.acquire()
+        try:
+            self.subs.append(sub)
+            if self.thread is None:
+                self.thread=threading.Thread(target=self.sendLoop)
+                self.thread.daemon=True
+                self.thread.start()
+        finally:
+            self.lock.release()
+        print "INFORMATION telemetry: subscribed to %s (decimate %d, max rate %g Hz)"%(sub.name,sub.decimate,sub.maxRate)
+        return sub
+
+    def unsubscribe(self,sock,tag=None):
+        """Remove the subscriptions of a client with tag, or all if tag is None"""
+        self.lock.acquire()
+        try:
+            self.subs=[s for s in self.subs if not (s.sock is sock and (tag is None or s.tag==tag))]
+        finally:
+            self.lock.release()
+
+    def snapshot(self,thisiter,compList=None):
+        """Take snapshots for subscriptions that are due.  Called from the
+        main loop at the end of each iteration.  This doesn't block waiting
+        for clients.
+        @param thisiter: The iteration number
+        @type thisiter: Int
+        @param compList: The simulation modules
+        @type compList: List
+        """
+        if len(self.subs)==0:
+            return
+        if compList is not None:
+            self.compList=compList
+        taken=0
+        for sub in self.subs[:]:
+            if thisiter%sub.decimate!=0:
+                continue
+            try:
+                if sub.obj is None:
+                    sub.resolve(self.compList)
+                sub.snapshot(thisiter)
+                taken=1
+            except:
+                print "ERROR telemetry: unable to snapshot %s - unsubscribing"%sub.name
+                traceback.print_exc()
+                self.sockConn.sendMessage(["error",sub.tag,"telemetry: unable to get %s"%sub.name],sub.sock)
+                self.unsubscribe(sub.sock,sub.tag)
+        if taken:
+            self.cond.acquire()
+            self.cond.notify()
+            self.cond.release()
+
+    def sendLoop(self):
+        """Send data to subscribers, rate limited (runs in its own thread)"""
+        while self.go:
+            self.cond.acquire()
+            try:
+                timeout=1.
+                now=time.time()
+                todo=[]
+                for sub in self.subs:
+                    if sub.writeCnt!=sub.sentCnt:
+                        wait=sub.lastSent+1./sub.maxRate-now
+                        if wait<=0:
+                            todo.append(sub)
+                        else:
+                            timeout=min(timeout,wait)
+                if len(todo)==0:
+                    self.cond.wait(timeout)
+            finally:
+                self.cond.release()
+            for sub in todo:
+                msg=sub.getMessage()
+                if msg is None:
+                    continue
+                sub.lastSent=time.time()
+                if self.sockConn.sendMessage(["data",sub.tag,msg],sub.sock)!=0:
+                    print "INFORMATION telemetry: unable to send %s - unsubscribing"%sub.name
+                    self.unsubscribe(sub.sock,sub.tag)
+
+    def stop(self):
+        self.go=0
+        self.cond.acquire()
+        self.cond.notify()
+        self.cond.release()